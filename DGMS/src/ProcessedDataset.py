@@ -7,9 +7,11 @@
 # @Lab      : nesa.zju.edu.cn
 # ************************************
 import json
+import numpy as np
 import os
 import pickle
 import random
+import shutil
 import torch
 from datetime import datetime
 from torch_geometric.data import Batch
@@ -18,15 +20,139 @@ from tqdm import tqdm
 from utils import write_log_file
 
 
+class PackedGraphStore(object):
+    """
+    All graphs of a dataset packed into a few memory-mapped arrays, so that a mini-batch is sliced out of
+    them instead of being torch.load-ed graph by graph:
+        meta.json               number of graphs/nodes/edges, dtypes and widths of the arrays below, and the total size and
+                                latest mtime of the .pt files they were packed from (to notice a stale pack)
+        graph_ids.npy           (G,) graph id of every graph
+        node_offsets.npy        (G + 1,) the nodes of graph g are [node_offsets[g], node_offsets[g + 1])
+        edge_offsets.npy        (G + 1,) likewise for the edges
+        x.bin                   (total nodes, node feature size) node features
+        edge_index.bin          (total edges, 2) int32 (source, target), relative to the graph
+        edge_attr.bin           (total edges, edge feature size) edge features
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.graph_ids = np.load(os.path.join(path, 'graph_ids.npy'))
+        self.row_of_graph = {gid: row for row, gid in enumerate(self.graph_ids.tolist())}
+        self.node_offsets = np.load(os.path.join(path, 'node_offsets.npy'))
+        self.edge_offsets = np.load(os.path.join(path, 'edge_offsets.npy'))
+        self.x = self._memmap('x', self.meta['num_nodes'], self.meta['x_dim'])
+        self.edge_index = self._memmap('edge_index', self.meta['num_edges'], 2)
+        self.edge_attr = self._memmap('edge_attr', self.meta['num_edges'], self.meta['edge_attr_dim'])
+    
+    def _memmap(self, name, rows, cols):
+        dtype = self.meta['{}_dtype'.format(name)]
+        if rows == 0:
+            return np.zeros((0, cols), dtype=dtype)
+        return np.memmap(os.path.join(self.path, '{}.bin'.format(name)), dtype=dtype, mode='r', shape=(rows, cols))
+    
+    @staticmethod
+    def exists(path):
+        return os.path.isfile(os.path.join(path, 'meta.json'))
+    
+    @staticmethod
+    def source_signature(source_files):
+        stats = [os.stat(file) for file in source_files]
+        return {'source_bytes': int(sum(s.st_size for s in stats)), 'source_mtime_ns': int(max([s.st_mtime_ns for s in stats], default=0))}
+    
+    def is_stale(self, graph_id_list, source_files):
+        """
+        Whether the pack no longer matches the dataset: other graph ids, or .pt files rewritten since it was built.
+        If the .pt files have been removed after packing, only the graph ids can be checked.
+        """
+        if self.graph_ids.tolist() != list(graph_id_list):
+            return True
+        if not all(os.path.isfile(file) for file in source_files):
+            return False
+        signature = self.source_signature(source_files)
+        return any(self.meta.get(key) != value for key, value in signature.items())
+    
+    @staticmethod
+    def build(path, graph_id_list, load_graph, source_files):
+        """
+        Pack the graphs of graph_id_list, streaming them to disk one by one.
+        :param load_graph: function from a graph id to its torch_geometric Data (with x, edge_index and edge_attr)
+        :param source_files: the .pt files of graph_id_list, recorded in meta.json to detect a stale pack later
+        """
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        meta = {'num_graphs': len(graph_id_list)}
+        meta.update(PackedGraphStore.source_signature(source_files))
+        node_counts, edge_counts = [], []
+        files = {name: open(os.path.join(tmp_path, '{}.bin'.format(name)), 'wb') for name in ['x', 'edge_index', 'edge_attr']}
+        for gid in tqdm(graph_id_list):
+            data = load_graph(gid)
+            arrays = {'x': data.x.numpy(), 'edge_index': data.edge_index.t().numpy().astype(np.int32), 'edge_attr': data.edge_attr.numpy()}
+            for name, array in arrays.items():
+                meta.setdefault('{}_dtype'.format(name), array.dtype.str)
+                meta.setdefault('{}_dim'.format(name), array.shape[1])
+                files[name].write(np.ascontiguousarray(array, dtype=meta['{}_dtype'.format(name)]).tobytes())
+            node_counts.append(arrays['x'].shape[0])
+            edge_counts.append(arrays['edge_index'].shape[0])
+        for f in files.values():
+            f.close()
+        meta['num_nodes'] = int(np.sum(node_counts))
+        meta['num_edges'] = int(np.sum(edge_counts))
+        np.save(os.path.join(tmp_path, 'graph_ids.npy'), np.asarray(graph_id_list))
+        np.save(os.path.join(tmp_path, 'node_offsets.npy'), np.cumsum([0] + node_counts).astype(np.int64))
+        np.save(os.path.join(tmp_path, 'edge_offsets.npy'), np.cumsum([0] + edge_counts).astype(np.int64))
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(tmp_path, path)
+    
+    def get_batch(self, gid_list):
+        """
+        Slice the graphs of gid_list out of the packed arrays into one PyG mini-batch.
+        """
+        rows = [self.row_of_graph[gid] for gid in gid_list]
+        node_counts = self.node_offsets[1:][rows] - self.node_offsets[:-1][rows]
+        node_bases = np.cumsum(node_counts) - node_counts
+        x, edge_index, edge_attr = [], [], []
+        for row, node_base in zip(rows, node_bases):
+            x.append(self.x[self.node_offsets[row]:self.node_offsets[row + 1]])
+            edge_index.append(self.edge_index[self.edge_offsets[row]:self.edge_offsets[row + 1]].astype(np.int64) + node_base)
+            edge_attr.append(self.edge_attr[self.edge_offsets[row]:self.edge_offsets[row + 1]])
+        return Batch(x=torch.from_numpy(np.concatenate(x)),
+                     edge_index=torch.from_numpy(np.concatenate(edge_index)).t().contiguous(),
+                     edge_attr=torch.from_numpy(np.concatenate(edge_attr)),
+                     batch=torch.from_numpy(np.repeat(np.arange(len(rows)), node_counts)))
+
+
 class ProcessedDataset(object):
-    def __init__(self, name, root, log_path):
+    def __init__(self, name, root, log_path, pack_graphs=False):
         self.name = name
         self.data_processed_path = os.path.join(root, '{}_processed'.format(self.name))
+        self.data_packed_path = os.path.join(root, '{}_packed'.format(self.name))
         self.graph_id_file = os.path.join(root, '{}_graph_ids.pt'.format(self.name))
         self.graph_id_list = torch.load(self.graph_id_file)
         self.log_path = log_path
         
-        self._check_whether_all_graph_ids_files_exist()
+        # without --pack_graphs the per-graph files are always read, even if a pack exists
+        self.packed_graphs = None
+        if pack_graphs:
+            if PackedGraphStore.exists(self.data_packed_path):
+                self.packed_graphs = PackedGraphStore(self.data_packed_path)
+                if self.packed_graphs.is_stale(self.graph_id_list, self.processed_file_names()):
+                    write_log_file(self.log_path, "{} is stale, re-packing it".format(self.data_packed_path))
+                    self.packed_graphs = None
+            if self.packed_graphs is None:
+                self._check_whether_all_graph_ids_files_exist()
+                time_1 = datetime.now()
+                PackedGraphStore.build(self.data_packed_path, self.graph_id_list, self.get_one_graph, self.processed_file_names())
+                write_log_file(self.log_path, "pack {} graphs into {}, time = {}".format(len(self.graph_id_list), self.data_packed_path, datetime.now() - time_1))
+                self.packed_graphs = PackedGraphStore(self.data_packed_path)
+        else:
+            self._check_whether_all_graph_ids_files_exist()
         self.total_graph = {}
         # self.get_total_graphs()
         
@@ -64,6 +190,8 @@ class ProcessedDataset(object):
         :param gid_list: list of graph ids
         :return: PyG Batch consisting of corresponding graphs
         """
+        if self.packed_graphs is not None:
+            return self.packed_graphs.get_batch(gid_list)
         batch = []
         for gid in gid_list:
             batch.append(self.get_one_graph(idx=gid))
@@ -31,11 +31,15 @@ parser.add_argument("--dropout", type=float, default=0.1, help="Dropout probabil
 # testing
 parser.add_argument('--only_test', type=lambda x: (str(x).lower() == 'true'), default='false')
 parser.add_argument('--model_path', type=str, default='.')
+parser.add_argument('--test_mode', type=str, default='cached',
+                    help="(cached/pairwise) cached: encode every test graph once and only run the matching layer per pair; pairwise: run the whole model on every pair.")
 
 # others
 parser.add_argument('--print_interval', type=int, default=2000)
 parser.add_argument('--valid_interval', type=int, default=10000)
 parser.add_argument('--gpu_index', type=str, default='3', help="gpu index to use")
+parser.add_argument('--pack_graphs', type=lambda x: (str(x).lower() == 'true'), default='false',
+                    help="pack the per-graph .pt files into memory-mapped arrays ({code,text}_packed) on first use, and read batches from them.")
 
 args = parser.parse_args()
 
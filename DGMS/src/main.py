@@ -13,6 +13,7 @@ from datetime import datetime
 
 import numpy as np
 import torch
+from torch.nn.utils.rnn import pad_sequence
 
 from ProcessedDataset import ProcessedDataset
 from config import args as arguments
@@ -59,9 +60,9 @@ class Trainer(object):
         self.optimizer = torch.optim.Adam(self.model.parameters(), lr=args.lr)
         
         write_log_file(self.log_path, "Init Reading Code Graphs ... ")
-        self.code_data = ProcessedDataset(name='code', root=self.dataset_dir, log_path=self.log_path)
+        self.code_data = ProcessedDataset(name='code', root=self.dataset_dir, log_path=self.log_path, pack_graphs=args.pack_graphs)
         write_log_file(self.log_path, "Init Reading Text Graphs ... ")
-        self.text_data = ProcessedDataset(name='text', root=self.dataset_dir, log_path=self.log_path)
+        self.text_data = ProcessedDataset(name='text', root=self.dataset_dir, log_path=self.log_path, pack_graphs=args.pack_graphs)
         
         # for plotting and record (init empty list)
         self.train_iter, self.train_smooth_loss, self.valid_iter, self.valid_loss, self.test_iter, self.test_mrr, self.test_s1, self.test_s5, self.test_s10 = ([] for _ in range(9))
@@ -155,8 +156,8 @@ class Trainer(object):
             self.model.eval()
             with torch.no_grad():
                 score = self.model(code_batch, text_batch)
-            for candidate_id in text_graph_list:
-                rank[candidate_id] = score[text_graph_list.index(candidate_id)]
+            for candidate_id, candidate_score in zip(text_graph_list, score.tolist()):
+                rank[candidate_id] = candidate_score
             one_query_scores.extend(score.tolist())
             st = ed
         
@@ -164,6 +165,41 @@ class Trainer(object):
         assert len(one_query_scores) == len(candidate_id_list), "must be equal, ERROR"
         return rank, np.array(one_query_scores)
     
+    def encode_graphs(self, gid_list, data):
+        """
+        Encode every graph of gid_list once, valid_batch_size graphs at a time.
+        :return: dict from graph id to its (number of nodes, dim) node embeddings
+        """
+        self.model.eval()
+        embeddings = {}
+        with torch.no_grad():
+            for gid_chunk in chunk(gid_list, self.valid_batch_size):
+                embeddings.update(zip(gid_chunk, self.model.encode_graphs(data.get_batch_graph(gid_chunk))))
+        return embeddings
+    
+    def pad_candidates(self, candidate_id_list, candidate_embeddings):
+        """
+        Group the candidates into batches of valid_batch_size, zero-padded together like to_dense_batch does in
+        retrieve_rank, so that the padding (and thus the max/avg aggregation) is the same as when running the whole model.
+        :return: list of (candidate ids, (batch, max number of nodes, dim) node embeddings)
+        """
+        return [(candidates, pad_sequence([candidate_embeddings[candidate_id] for candidate_id in candidates], batch_first=True))
+                for candidates in chunk(candidate_id_list, self.valid_batch_size)]
+    
+    def retrieve_rank_cached(self, query_embedding, candidate_id_list, padded_candidates):
+        """
+        Same as retrieve_rank, from embeddings computed by encode_graphs and pad_candidates.
+        """
+        one_query_scores = []
+        with torch.no_grad():
+            for candidates, feature_h in padded_candidates:
+                feature_p = query_embedding.unsqueeze(0).expand(len(candidates), -1, -1)
+                one_query_scores.extend(self.model.match(feature_p, feature_h).tolist())
+        rank = dict(zip(candidate_id_list, one_query_scores))
+        rank = [a[0] for a in sorted(list(rank.items()), key=lambda x: x[1], reverse=True)]
+        assert len(one_query_scores) == len(candidate_id_list), "must be equal, ERROR"
+        return rank, np.array(one_query_scores)
+    
     @staticmethod
     def calculate_square_mrr(similarity):
         assert similarity.shape[0] == similarity.shape[1]
@@ -178,10 +214,21 @@ class Trainer(object):
         success = {1: 0, 5: 0, 10: 0}
         total_test_scores = []
         test_start = datetime.now()
+        if self.args.test_mode == 'cached':
+            text_embeddings = self.encode_graphs(test_query_ids, self.text_data)
+            code_embeddings = self.encode_graphs(test_query_ids, self.code_data)
+            write_log_file(self.log_path, "encode {} test text and code graphs, time elapsed = {}.".format(len(test_query_ids), datetime.now() - test_start))
+        elif self.args.test_mode != 'pairwise':
+            raise NotImplementedError
         for test_chunk in chunk(test_query_ids, 100):
             one_chunk_scores = []
+            if self.args.test_mode == 'cached':
+                padded_candidates = self.pad_candidates(test_chunk, code_embeddings)
             for i, query_id in enumerate(test_chunk):
-                rank_ids, one_row_scores = self.retrieve_rank(query_id, test_chunk, self.text_data, self.code_data)
+                if self.args.test_mode == 'cached':
+                    rank_ids, one_row_scores = self.retrieve_rank_cached(text_embeddings[query_id], test_chunk, padded_candidates)
+                else:
+                    rank_ids, one_row_scores = self.retrieve_rank(query_id, test_chunk, self.text_data, self.code_data)
                 one_chunk_scores.append(one_row_scores)
                 for k in success.keys():
                     if query_id in rank_ids[:k]:
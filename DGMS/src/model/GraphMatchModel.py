@@ -91,23 +91,46 @@ class GraphMatchNetwork(torch.nn.Module):
             x_in = x_out
         return x_out
     
+    def encode_nodes(self, batch):
+        """
+        :param batch: PyG mini-batch
+        :return: (total number of nodes, dim) node embeddings
+        """
+        batch = batch.to(self.device)
+        if self.args.conv == 'rgcn':
+            edge_type = torch.argmax(batch.edge_attr, dim=1)
+            return self.forward_message_passing_layers(x=batch.x, edge_index=batch.edge_index, edge_attr=edge_type)
+        return self.forward_message_passing_layers(x=batch.x, edge_index=batch.edge_index, edge_attr=batch.edge_attr)
+    
+    def encode(self, batch):
+        """
+        :param batch: PyG mini-batch
+        :return: (batch, max number of nodes, dim) node embeddings, zero-padded
+        """
+        return to_dense_batch(x=self.encode_nodes(batch), batch=batch.batch.to(self.device))[0]
+    
+    def encode_graphs(self, batch):
+        """
+        :param batch: PyG mini-batch
+        :return: list of the (number of nodes, dim) node embeddings of every graph of the batch
+        """
+        node_counts = torch.bincount(batch.batch, minlength=batch.num_graphs).tolist()
+        return list(torch.split(self.encode_nodes(batch), node_counts))
+    
     def forward(self, batch_1, batch_2):
         
         # ---------- Node Embedding Layer ----------
-        batch_1 = batch_1.to(self.device)
-        batch_2 = batch_2.to(self.device)
-        
-        if self.args.conv == 'rgcn':
-            b1_edge_type = torch.argmax(batch_1.edge_attr, dim=1)
-            b2_edge_type = torch.argmax(batch_2.edge_attr, dim=1)
-            feature_p = self.forward_message_passing_layers(x=batch_1.x, edge_index=batch_1.edge_index, edge_attr=b1_edge_type)
-            feature_h = self.forward_message_passing_layers(x=batch_2.x, edge_index=batch_2.edge_index, edge_attr=b2_edge_type)
-        else:
-            feature_p = self.forward_message_passing_layers(x=batch_1.x, edge_index=batch_1.edge_index, edge_attr=batch_1.edge_attr)
-            feature_h = self.forward_message_passing_layers(x=batch_2.x, edge_index=batch_2.edge_index, edge_attr=batch_2.edge_attr)
-        
-        feature_p = to_dense_batch(x=feature_p, batch=batch_1.batch)[0]
-        feature_h = to_dense_batch(x=feature_h, batch=batch_2.batch)[0]
+        feature_p = self.encode(batch_1)
+        feature_h = self.encode(batch_2)
+        return self.match(feature_p, feature_h)
+    
+    def match(self, feature_p, feature_h):
+        """
+        Cross-graph matching of two batches of encoded graphs.
+        :param feature_p: (batch, len1, dim) zero-padded node embeddings, see encode
+        :param feature_h: (batch, len2, dim)
+        :return: (batch,) similarities
+        """
         
         # ---------- Semantic Matching Layer ----------
         
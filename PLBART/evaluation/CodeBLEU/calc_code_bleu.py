@@ -6,8 +6,7 @@ import argparse
 import bleu
 import json
 import weighted_ngram_match
-import syntax_match
-import dataflow_match
+import code_match
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--refs', type=str, nargs='+', required=True,
@@ -19,6 +18,8 @@ parser.add_argument('--lang', type=str, required=True,
                     help='programming language')
 parser.add_argument('--params', type=str, default='0.25,0.25,0.25,0.25',
                     help='alpha, beta and gamma')
+parser.add_argument('--workers', type=int, default=None,
+                    help='processes for syntax/dataflow matching (default: all cpus, at most 8)')
 
 args = parser.parse_args()
 
@@ -55,7 +56,7 @@ tokenized_refs = [[x.split() for x in reference] for reference in references]
 ngram_match_score = bleu.corpus_bleu(tokenized_refs, tokenized_hyps)
 
 # calculate weighted ngram match
-keywords = [x.strip() for x in open('keywords/' + args.lang + '.txt', 'r', encoding='utf-8').readlines()]
+keywords = {x.strip() for x in open('keywords/' + args.lang + '.txt', 'r', encoding='utf-8').readlines()}
 
 
 def make_weights(reference_tokens, key_word_list):
@@ -68,11 +69,9 @@ tokenized_refs_with_weights = [[[reference_tokens, make_weights(reference_tokens
 
 weighted_ngram_match_score = weighted_ngram_match.corpus_bleu(tokenized_refs_with_weights, tokenized_hyps)
 
-# calculate syntax match
-syntax_match_score = syntax_match.corpus_syntax_match(references, hypothesis, args.lang)
-
-# calculate dataflow match
-dataflow_match_score = dataflow_match.corpus_dataflow_match(references, hypothesis, args.lang)
+# calculate syntax match and dataflow match, parsing every snippet once
+syntax_match_score, dataflow_match_score = code_match.corpus_syntax_dataflow_match(references, hypothesis, args.lang,
+                                                                                   args.workers)
 
 print('ngram match: {0}, weighted ngram match: {1}, syntax_match: {2}, dataflow_match: {3}'. \
       format(ngram_match_score, weighted_ngram_match_score, syntax_match_score, dataflow_match_score))
@@ -0,0 +1,195 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+"""
+Single-parse syntax and dataflow matching for CodeBLEU.
+
+`corpus_syntax_match` and `corpus_dataflow_match` used to parse every snippet
+separately, rebuild the tree-sitter parser on each call and match with list
+membership / list.remove. Here each snippet is cleaned and parsed once, the same
+tree gives both its sub-trees and its dataflow, matching is done with Counters,
+and shards of the corpus are scored in a process pool. The scores are the same
+as the old loops:
+    - a reference sub-tree matches if the candidate has that sub-tree at all
+    - a reference dataflow matches one not yet matched candidate dataflow
+"""
+
+from collections import Counter
+from multiprocessing import Pool
+import os
+
+from parser import DFG_python, DFG_java, DFG_ruby, DFG_go, DFG_php, DFG_javascript, DFG_csharp
+from parser import (remove_comments_and_docstrings,
+                    tree_to_token_index,
+                    index_to_code_token)
+from tree_sitter import Language, Parser
+
+dfg_function = {
+    'python': DFG_python,
+    'java': DFG_java,
+    'ruby': DFG_ruby,
+    'go': DFG_go,
+    'php': DFG_php,
+    'javascript': DFG_javascript,
+    'c_sharp': DFG_csharp,
+}
+
+# tree-sitter parsers of this process, one per language
+_parsers = {}
+
+# default number of scoring processes, and the pool reused by every corpus_match_counts call
+MAX_WORKERS = 8
+_pool = None
+_pool_workers = 0
+
+
+def get_parser(lang):
+    if lang not in _parsers:
+        parser = Parser()
+        parser.set_language(Language('parser/my-languages.so', lang))
+        _parsers[lang] = parser
+    return _parsers[lang]
+
+
+def get_all_sub_trees(root_node):
+    """s-expressions of the root and of every non-leaf node below it."""
+    node_stack = [root_node]
+    sub_tree_sexp_list = []
+    while len(node_stack) != 0:
+        cur_node = node_stack.pop()
+        sub_tree_sexp_list.append(cur_node.sexp())
+        for child_node in cur_node.children:
+            if len(child_node.children) != 0:
+                node_stack.append(child_node)
+    return sub_tree_sexp_list
+
+
+def tree_data_flow(code, root_node, dfg_fn):
+    """Merged DFG of `code`, whose tree-sitter tree is `root_node`."""
+    try:
+        tokens_index = tree_to_token_index(root_node)
+        code = code.split('\n')
+        code_tokens = [index_to_code_token(x, code) for x in tokens_index]
+        index_to_code = {}
+        for idx, (index, code) in enumerate(zip(tokens_index, code_tokens)):
+            index_to_code[index] = (idx, code)
+        try:
+            DFG, _ = dfg_fn(root_node, index_to_code, {})
+        except:
+            DFG = []
+        DFG = sorted(DFG, key=lambda x: x[1])
+        indexs = set()
+        for d in DFG:
+            if len(d[-1]) != 0:
+                indexs.add(d[1])
+            for x in d[-1]:
+                indexs.add(x)
+        new_DFG = []
+        for d in DFG:
+            if d[1] in indexs:
+                new_DFG.append(d)
+        dfg = new_DFG
+    except:
+        dfg = []
+    # merge nodes
+    dic = {}
+    for d in dfg:
+        if d[1] not in dic:
+            dic[d[1]] = d
+        else:
+            dic[d[1]] = (d[0], d[1], d[2], list(set(dic[d[1]][3] + d[3])), list(set(dic[d[1]][4] + d[4])))
+    DFG = []
+    for d in dic:
+        DFG.append(dic[d])
+    return DFG
+
+
+def normalize_dataflow(dataflow):
+    var_dict = {}
+    i = 0
+    normalized_dataflow = []
+    for item in dataflow:
+        var_name = item[0]
+        relationship = item[2]
+        par_vars_name_list = item[3]
+        for name in par_vars_name_list:
+            if name not in var_dict:
+                var_dict[name] = 'var_' + str(i)
+                i += 1
+        if var_name not in var_dict:
+            var_dict[var_name] = 'var_' + str(i)
+            i += 1
+        normalized_dataflow.append((var_dict[var_name], relationship, [var_dict[x] for x in par_vars_name_list]))
+    return normalized_dataflow
+
+
+def code_features(code, lang, syntax=True, dataflow=True):
+    """(sub-tree Counter, normalized dataflow Counter) of one snippet, from a single parse."""
+    try:
+        code = remove_comments_and_docstrings(code, 'java')
+    except:
+        pass
+    root_node = get_parser(lang).parse(bytes(code, 'utf8')).root_node
+    sub_trees = Counter(get_all_sub_trees(root_node)) if syntax else Counter()
+    dfg = Counter()
+    if dataflow:
+        dfg = Counter((var, rel, tuple(par_vars)) for var, rel, par_vars in
+                      normalize_dataflow(tree_data_flow(code, root_node, dfg_function[lang])))
+    return sub_trees, dfg
+
+
+def sample_match_counts(references, candidate, lang, syntax=True, dataflow=True):
+    """[syntax matches, syntax total, dataflow matches, dataflow total] of one candidate."""
+    cand_sub_trees, cand_dfg = code_features(candidate, lang, syntax, dataflow)
+    counts = [0, 0, 0, 0]
+    for reference in references:
+        ref_sub_trees, ref_dfg = code_features(reference, lang, syntax, dataflow)
+        counts[0] += sum(n for sub_tree, n in ref_sub_trees.items() if sub_tree in cand_sub_trees)
+        counts[1] += sum(ref_sub_trees.values())
+        counts[2] += sum((ref_dfg & cand_dfg).values())
+        counts[3] += sum(ref_dfg.values())
+    return counts
+
+
+def _shard_match_counts(item):
+    references, candidates, lang, syntax, dataflow = item
+    counts = [0, 0, 0, 0]
+    for references_sample, candidate in zip(references, candidates):
+        for i, n in enumerate(sample_match_counts(references_sample, candidate, lang, syntax, dataflow)):
+            counts[i] += n
+    return counts
+
+
+def _get_pool(workers):
+    """Process pool of `workers` processes, created once and kept for the later calls."""
+    global _pool, _pool_workers
+    if _pool is None or _pool_workers != workers:
+        if _pool is not None:
+            _pool.close()
+        _pool = Pool(workers)
+        _pool_workers = workers
+    return _pool
+
+
+def corpus_match_counts(references, candidates, lang, syntax=True, dataflow=True, workers=None, shard_size=64):
+    """Summed `sample_match_counts` of a corpus, scoring shards in `workers` processes
+    (default: all cpus, at most MAX_WORKERS)."""
+    shards = [(references[i:i + shard_size], candidates[i:i + shard_size], lang, syntax, dataflow)
+              for i in range(0, len(candidates), shard_size)]
+    workers = workers or min(os.cpu_count() or 1, MAX_WORKERS)
+    if workers > 1 and len(shards) > 1:
+        results = _get_pool(workers).map(_shard_match_counts, shards, chunksize=1)
+    else:
+        results = [_shard_match_counts(shard) for shard in shards]
+    return [sum(x) for x in zip(*results)] if results else [0, 0, 0, 0]
+
+
+def dataflow_score(match_count, total_count):
+    return match_count / total_count if total_count > 0 else 0
+
+
+def corpus_syntax_dataflow_match(references, candidates, lang, workers=None):
+    """(syntax match, dataflow match) scores of a corpus, parsing every snippet once."""
+    syntax_match_count, syntax_total, dataflow_match_count, dataflow_total = \
+        corpus_match_counts(references, candidates, lang, workers=workers)
+    return syntax_match_count / syntax_total, dataflow_score(dataflow_match_count, dataflow_total)
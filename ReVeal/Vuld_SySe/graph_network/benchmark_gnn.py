@@ -0,0 +1,86 @@
+"""Benchmark of the per-edge-type and the fused message passing of GatedGraphNeuralNetwork.
+
+Both modes share the same weights. For every graph size, the script reports the forward time
+(and forward + backward time) per batch in eval mode, where dropout is disabled and the outputs
+of the two modes must match up to floating point error.
+
+    cd ReVeal && python -m Vuld_SySe.graph_network.benchmark_gnn --devices cpu cuda
+"""
+import argparse
+import time
+
+import torch
+
+from Vuld_SySe.graph_network.ggnn_dataset import AdjacencyList
+from Vuld_SySe.graph_network.gnn import GatedGraphNeuralNetwork
+
+
+def random_adjacency_lists(node_num, edge_num, num_edge_types, device):
+    edge_types = torch.randint(num_edge_types, (edge_num,))
+    edges = torch.randint(node_num, (edge_num, 2))
+    return [AdjacencyList(node_num=node_num, adj_list=edges[edge_types == edge_type].tolist(), device=device)
+            for edge_type in range(num_edge_types)]
+
+
+def time_step(gnn, node_states, adjacency_lists, backward, repeats, device):
+    def step():
+        output = gnn(node_states, adjacency_lists)
+        if backward:
+            output.sum().backward()
+
+    for _ in range(3):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return 1000 * (time.perf_counter() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--devices', nargs='+', default=['cpu', 'cuda'])
+    parser.add_argument('--node_nums', nargs='+', type=int, default=[50, 200, 1000, 5000, 20000])
+    parser.add_argument('--edges_per_node', type=float, default=4)
+    parser.add_argument('--hidden_size', type=int, default=200)
+    parser.add_argument('--num_edge_types', type=int, default=12)
+    parser.add_argument('--num_steps', type=int, default=8)
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=1000)
+    args = parser.parse_args()
+
+    for device_name in args.devices:
+        if device_name == 'cuda' and not torch.cuda.is_available():
+            print('CUDA is not available, skipping')
+            continue
+        device = torch.device(device_name)
+        torch.manual_seed(args.seed)
+        gnn = GatedGraphNeuralNetwork(hidden_size=args.hidden_size, num_edge_types=args.num_edge_types,
+                                      layer_timesteps=[args.num_steps], residual_connections={}).to(device)
+        gnn.eval()
+        for node_num in args.node_nums:
+            adjacency_lists = random_adjacency_lists(
+                node_num, int(node_num * args.edges_per_node), args.num_edge_types, device)
+            node_states = torch.randn(node_num, args.hidden_size, device=device)
+            results = {}
+            outputs = {}
+            for mode, fused in [('loop', False), ('fused', True)]:
+                gnn.fused_message_passing = fused
+                with torch.no_grad():
+                    outputs[mode] = gnn(node_states, adjacency_lists)
+                    forward_ms = time_step(gnn, node_states, adjacency_lists, False, args.repeats, device)
+                backward_ms = time_step(gnn, node_states, adjacency_lists, True, args.repeats, device)
+                results[mode] = (forward_ms, backward_ms)
+            max_diff = (outputs['loop'] - outputs['fused']).abs().max().item()
+            print('%-4s V=%-6d E=%-7d loop %8.2f / %8.2f ms  fused %8.2f / %8.2f ms  speedup %5.2fx / %5.2fx  '
+                  'max |diff| %.2e' % (
+                      device_name, node_num, sum(a.edge_num for a in adjacency_lists),
+                      results['loop'][0], results['loop'][1], results['fused'][0], results['fused'][1],
+                      results['loop'][0] / results['fused'][0], results['loop'][1] / results['fused'][1], max_diff))
+
+
+if __name__ == '__main__':
+    main()
@@ -13,7 +13,8 @@ class GatedGraphNeuralNetwork(nn.Module):
                  residual_connections,
                  state_to_message_dropout=0.3,
                  rnn_dropout=0.3,
-                 use_bias_for_message_linear=True):
+                 use_bias_for_message_linear=True,
+                 fused_message_passing=False):
 
         super(GatedGraphNeuralNetwork, self).__init__()
 
@@ -24,6 +25,9 @@ class GatedGraphNeuralNetwork(nn.Module):
         self.state_to_message_dropout = state_to_message_dropout
         self.rnn_dropout = rnn_dropout
         self.use_bias_for_message_linear = use_bias_for_message_linear
+        # compute the messages of all edge types with one gather, one bmm and one index_add_ per timestep
+        # instead of one linear layer per edge type, see compute_fused_messages
+        self.fused_message_passing = fused_message_passing
 
         # Prepare linear transformations from node states to messages, for each layer and each edge type
         # Prepare rnn cells for each layer
@@ -84,6 +88,21 @@ class GatedGraphNeuralNetwork(nn.Module):
                 message_targets.append(edge_targets)
         message_targets = torch.cat(message_targets, dim=0)  # Shape [M]
 
+        if self.fused_message_passing:
+            # edges bucketed by type into a [T, E_max] grid, T ~ number of edge types that have edges;
+            # padding slots read node 0 and send their message to the extra row V, which is dropped
+            present_edge_types = [edge_type_idx for edge_type_idx, adjacency_list_for_edge_type in enumerate(adjacency_lists)
+                                  if adjacency_list_for_edge_type.edge_num > 0]
+            max_edge_num = max(adjacency_lists[edge_type_idx].edge_num for edge_type_idx in present_edge_types)
+            bucket_sources = torch.zeros(len(present_edge_types), max_edge_num, dtype=torch.long, device=device)
+            bucket_targets = torch.full((len(present_edge_types), max_edge_num), node_num, dtype=torch.long, device=device)
+            for slot, edge_type_idx in enumerate(present_edge_types):
+                adjacency_list_for_edge_type = adjacency_lists[edge_type_idx]
+                bucket_sources[slot, :adjacency_list_for_edge_type.edge_num] = adjacency_list_for_edge_type[:, 0]
+                bucket_targets[slot, :adjacency_list_for_edge_type.edge_num] = adjacency_list_for_edge_type[:, 1]
+            bucket_sources = bucket_sources.view(-1)  # Shape [T * E_max]
+            bucket_targets = bucket_targets.view(-1)  # Shape [T * E_max]
+
         # sparse matrix of shape [V, M]
         # incoming_msg_sparse_matrix = self.get_incoming_message_sparse_matrix(adjacency_lists).to(device)
         for layer_idx, num_timesteps in enumerate(self.layer_timesteps):
@@ -99,37 +118,47 @@ class GatedGraphNeuralNetwork(nn.Module):
             layer_residual_states: List[torch.FloatTensor] = [node_states_per_layer[residual_layer_idx]
                                                               for residual_layer_idx in layer_residual_connections]
 
+            if self.fused_message_passing:
+                # Shape [T, D, D], [T, 1, D]
+                linears = [self.state_to_message_linears[layer_idx][edge_type_idx] for edge_type_idx in present_edge_types]
+                fused_weight = torch.stack([linear.weight.t() for linear in linears], dim=0)
+                fused_bias = torch.stack([linear.bias for linear in linears], dim=0).unsqueeze(1) if self.use_bias_for_message_linear else None
+
             # Record new states for this layer. Initialised to last state, but will be updated below:
             node_states_for_this_layer = node_states_per_layer[-1]
             # For each message propagation step
             for t in range(num_timesteps):
-                messages: List[torch.FloatTensor] = []  # list of tensors of messages of shape [E, D]
-                message_source_states: List[torch.FloatTensor] = []  # list of tensors of edge source states of shape [E, D]
-
-                # Collect incoming messages per edge type
-                for edge_type_idx, adjacency_list_for_edge_type in enumerate(adjacency_lists):
-                    if adjacency_list_for_edge_type.edge_num > 0:
-                        # shape [E]
-                        edge_sources = adjacency_list_for_edge_type[:, 0]
-                        # shape [E, D]
-                        edge_source_states = node_states_for_this_layer[edge_sources]
-
-                        f_state_to_message = self.state_to_message_linears[layer_idx][edge_type_idx]
-                        # Shape [E, D]
-                        all_messages_for_edge_type = self.state_to_message_dropout_layer(f_state_to_message(edge_source_states))
-
-                        messages.append(all_messages_for_edge_type)
-                        message_source_states.append(edge_source_states)
-
-                # shape [M, D]
-                messages: torch.FloatTensor = torch.cat(messages, dim=0)
-
-                # Sum up messages that go to the same target node
-                # shape [V, D]
-                incoming_messages = torch.zeros(node_num, messages.size(1), device=device)
-                incoming_messages = incoming_messages.scatter_add_(0,
-                                                                   message_targets.unsqueeze(-1).expand_as(messages),
-                                                                   messages)
+                if self.fused_message_passing:
+                    incoming_messages = self.compute_fused_messages(
+                        node_states_for_this_layer, fused_weight, fused_bias, bucket_sources, bucket_targets)
+                else:
+                    messages: List[torch.FloatTensor] = []  # list of tensors of messages of shape [E, D]
+                    message_source_states: List[torch.FloatTensor] = []  # list of tensors of edge source states of shape [E, D]
+
+                    # Collect incoming messages per edge type
+                    for edge_type_idx, adjacency_list_for_edge_type in enumerate(adjacency_lists):
+                        if adjacency_list_for_edge_type.edge_num > 0:
+                            # shape [E]
+                            edge_sources = adjacency_list_for_edge_type[:, 0]
+                            # shape [E, D]
+                            edge_source_states = node_states_for_this_layer[edge_sources]
+
+                            f_state_to_message = self.state_to_message_linears[layer_idx][edge_type_idx]
+                            # Shape [E, D]
+                            all_messages_for_edge_type = self.state_to_message_dropout_layer(f_state_to_message(edge_source_states))
+
+                            messages.append(all_messages_for_edge_type)
+                            message_source_states.append(edge_source_states)
+
+                    # shape [M, D]
+                    messages: torch.FloatTensor = torch.cat(messages, dim=0)
+
+                    # Sum up messages that go to the same target node
+                    # shape [V, D]
+                    incoming_messages = torch.zeros(node_num, messages.size(1), device=device)
+                    incoming_messages = incoming_messages.scatter_add_(0,
+                                                                       message_targets.unsqueeze(-1).expand_as(messages),
+                                                                       messages)
 
                 # shape [V, D * (1 + num of residual connections)]
                 incoming_information = torch.cat(layer_residual_states + [incoming_messages], dim=-1)
@@ -148,6 +177,28 @@ class GatedGraphNeuralNetwork(nn.Module):
             node_states_for_last_layer = node_states_per_layer[-1]
             return node_states_for_last_layer
 
+    def compute_fused_messages(self, node_states, fused_weight, fused_bias, bucket_sources, bucket_targets):
+        """Sum of the incoming messages of every node, for all edge types at once.
+
+        The source states of the edges, bucketed by type into a padded [T, E_max] grid, are gathered
+        with one index_select, each bucket is multiplied by the weight of its edge type with one bmm,
+        and the messages are summed per target node with one index_add_. Only the edge sources are
+        transformed, T * E_max rows instead of M in the per-type loop.
+        """
+        node_num, hidden_size = node_states.size()
+        bucket_num = fused_weight.size(0)
+        # Shape [T, E_max, D]
+        source_states = node_states.index_select(0, bucket_sources).view(bucket_num, -1, hidden_size)
+        if fused_bias is None:
+            messages = torch.bmm(source_states, fused_weight)
+        else:
+            messages = torch.baddbmm(fused_bias, source_states, fused_weight)
+        # Shape [T * E_max, D]
+        messages = self.state_to_message_dropout_layer(messages.view(-1, hidden_size))
+        # Shape [V + 1, D], the last row collects the padding messages
+        incoming_messages = torch.zeros(node_num + 1, hidden_size, dtype=messages.dtype, device=messages.device)
+        return incoming_messages.index_add_(0, bucket_targets, messages)[:node_num]
+
 
 def main():
     gnn = GatedGraphNeuralNetwork(hidden_size=256, num_edge_types=4,
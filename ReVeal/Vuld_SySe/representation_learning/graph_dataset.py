@@ -37,24 +37,24 @@ class DataSet:
         self.test_batch_indices = []
         self.batch_size = batch_size
         self.hdim = hdim
-        self.positive_indices_in_train = []
-        self.negative_indices_in_train = []
+        self.positive_indices_in_train = np.zeros(0, dtype=np.int64)
+        self.negative_indices_in_train = np.zeros(0, dtype=np.int64)
+        # contiguous (N, hdim) float32 features and (N,) targets of every part,
+        # rebuilt from the entries whenever a part has changed
+        self.features = {}
+        self.targets = {}
 
     def initialize_dataset(self, balance=True, output_buffer=sys.stderr):
         if isinstance(balance, bool) and balance:
             entries = []
-            train_features = []
-            train_targets = []
-            for entry in self.train_entries:
-                train_features.append(entry.features)
-                train_targets.append(entry.label)
-            train_features = np.array(train_features)
-            train_targets = np.array(train_targets)
+            train_features, train_targets = self.get_part_data('train')
             smote = SMOTE(random_state=1000)
             features, targets = smote.fit_resample(train_features, train_targets)
             for feature, target in zip(features, targets):
                 entries.append(DataEntry(self, feature.tolist(), target.item()))
             self.train_entries = entries
+            self.features['train'] = np.ascontiguousarray(features, dtype=np.float32)
+            self.targets['train'] = np.asarray(targets, dtype=np.int64)
         elif isinstance(balance, list) and len(balance) == 2:
             entries = []
             for entry in self.train_entries:
@@ -69,12 +69,11 @@ class DataSet:
                             DataEntry(self, entry.features, entry.label, entry.meta_data)
                         )
             self.train_entries = entries
-            pass
-        for tidx, entry in enumerate(self.train_entries):
-            if entry.label == 1:
-                self.positive_indices_in_train.append(tidx)
-            else:
-                self.negative_indices_in_train.append(tidx)
+            self.features.pop('train', None)
+            self.targets.pop('train', None)
+        _, train_targets = self.get_part_data('train')
+        self.positive_indices_in_train = np.flatnonzero(train_targets == 1)
+        self.negative_indices_in_train = np.flatnonzero(train_targets != 1)
         self.initialize_train_batches()
         if output_buffer is not None:
             print('Number of Train Entries %d #Batches %d' % \
@@ -91,12 +90,23 @@ class DataSet:
     def add_data_entry(self, feature, label, part='train'):
         assert part in ['train', 'valid', 'test']
         entry = DataEntry(self, feature, label)
-        if part == 'train':
-            self.train_entries.append(entry)
-        elif part == 'valid':
-            self.valid_entries.append(entry)
-        else:
-            self.test_entries.append(entry)
+        self.get_entries(part).append(entry)
+        self.features.pop(part, None)
+        self.targets.pop(part, None)
+
+    def get_entries(self, part):
+        return {'train': self.train_entries, 'valid': self.valid_entries, 'test': self.test_entries}[part]
+
+    def get_part_data(self, part):
+        """(features, targets) arrays of all the entries of `part`."""
+        entries = self.get_entries(part)
+        if part not in self.features or len(self.features[part]) != len(entries):
+            features = np.zeros(shape=(len(entries), self.hdim), dtype=np.float32)
+            if entries:
+                features[:] = [entry.features for entry in entries]
+            self.features[part] = features
+            self.targets[part] = np.asarray([entry.label for entry in entries], dtype=np.int64)
+        return self.features[part], self.targets[part]
 
     def initialize_train_batches(self):
         self.train_batch_indices = self.create_batches(self.batch_size, self.train_entries)
@@ -105,6 +115,8 @@ class DataSet:
 
     def clear_test_set(self):
         self.test_entries = []
+        self.features.pop('test', None)
+        self.targets.pop('test', None)
 
     def initialize_valid_batches(self, batch_size=-1):
         if batch_size == -1:
@@ -123,7 +135,7 @@ class DataSet:
     def get_next_train_batch(self):
         if len(self.train_batch_indices) > 0:
             indices = self.train_batch_indices.pop()
-            features, targets = self.prepare_data(self.train_entries, indices)
+            features, targets = self.prepare_part_data('train', indices)
             same_class_features = self.find_same_class_data(ignore_indices=indices)
             different_class_features = self.find_different_class_data(ignore_indices=indices)
             return features, targets, same_class_features, different_class_features
@@ -133,14 +145,14 @@ class DataSet:
     def get_next_valid_batch(self):
         if len(self.valid_batch_indices) > 0:
             indices = self.valid_batch_indices.pop()
-            return self.prepare_data(self.valid_entries, indices)
+            return self.prepare_part_data('valid', indices)
         raise ValueError('Initialize Valid Batch First by calling dataset.initialize_valid_batches()')
         pass
 
     def get_next_test_batch(self):
         if len(self.test_batch_indices) > 0:
             indices = self.test_batch_indices.pop()
-            return self.prepare_data(self.test_entries, indices)
+            return self.prepare_part_data('test', indices)
         raise ValueError('Initialize Test Batch First by calling dataset.initialize_test_batches()')
         pass
 
@@ -163,41 +175,63 @@ class DataSet:
         return _batches
 
     def prepare_data(self, _entries, indices):
-        batch_size = len(indices)
-        features = np.zeros(shape=(batch_size, self.hdim))
-        targets = np.zeros(shape=(batch_size))
-        for tidx, idx in enumerate(indices):
-            entry = _entries[idx]
-            assert isinstance(entry, DataEntry)
-            targets[tidx] = entry.label
-            for feature_idx in range(self.hdim):
-                features[tidx, feature_idx] = entry.features[feature_idx]
-        return torch.FloatTensor(features), torch.LongTensor(targets)
-        pass
+        for part in ['train', 'valid', 'test']:
+            if _entries is self.get_entries(part):
+                return self.prepare_part_data(part, indices)
+        features = np.zeros(shape=(len(indices), self.hdim), dtype=np.float32)
+        if len(indices) > 0:
+            features[:] = [_entries[idx].features for idx in indices]
+        targets = np.asarray([_entries[idx].label for idx in indices], dtype=np.int64)
+        return torch.from_numpy(features), torch.from_numpy(targets)
+
+    def prepare_part_data(self, part, indices):
+        features, targets = self.get_part_data(part)
+        indices = np.asarray(indices, dtype=np.int64)
+        return torch.from_numpy(features[indices]), torch.from_numpy(targets[indices])
 
     def find_same_class_data(self, ignore_indices):
-        positive_indices_pool = set(self.positive_indices_in_train).difference(ignore_indices)
-        negative_indices_pool = set(self.negative_indices_in_train).difference(ignore_indices)
         return self.find_triplet_loss_data(
-            ignore_indices, negative_indices_pool, positive_indices_pool)
+            ignore_indices, self.negative_indices_in_train, self.positive_indices_in_train)
 
     def find_different_class_data(self, ignore_indices):
-        positive_indices_pool = set(self.negative_indices_in_train).difference(ignore_indices)
-        negative_indices_pool = set(self.positive_indices_in_train).difference(ignore_indices)
         return self.find_triplet_loss_data(
-            ignore_indices, negative_indices_pool, positive_indices_pool)
+            ignore_indices, self.positive_indices_in_train, self.negative_indices_in_train)
 
     def find_triplet_loss_data(self, ignore_indices, negative_indices_pool, positive_indices_pool):
-        indices = []
-        for eidx in ignore_indices:
-            if self.train_entries[eidx].is_positive():
-                indices_pool = positive_indices_pool
-            else:
-                indices_pool = negative_indices_pool
-            indices_pool = list(indices_pool)
-            indices.append(np.random.choice(indices_pool))
-        features, _ = self.prepare_data(self.train_entries, indices)
-        return features
+        """For every entry of the batch `ignore_indices`, features of a random train entry outside of
+        the batch, drawn from `positive_indices_pool` for positive entries and from `negative_indices_pool`
+        for the others."""
+        train_features, train_targets = self.get_part_data('train')
+        ignore_indices = np.asarray(ignore_indices, dtype=np.int64)
+        in_batch = np.zeros(len(train_features), dtype=bool)
+        in_batch[ignore_indices] = True
+        is_positive = train_targets[ignore_indices] == 1
+        indices = np.empty(len(ignore_indices), dtype=np.int64)
+        for mask, pool in [(is_positive, positive_indices_pool), (~is_positive, negative_indices_pool)]:
+            indices[mask] = self.sample_outside(pool, in_batch, int(mask.sum()))
+        return torch.from_numpy(train_features[indices])
+
+    @staticmethod
+    def sample_outside(pool, excluded, size, max_tries=4):
+        """`size` indices drawn uniformly with replacement from `pool` minus the `excluded` mask."""
+        if size == 0:
+            return np.zeros(0, dtype=np.int64)
+        if len(pool) == 0:
+            raise ValueError('No train entry of the required class to sample a triplet from')
+        samples = pool[np.random.randint(len(pool), size=size)]
+        # the batch is small compared to the pool, so a few redraws are usually enough
+        for _ in range(max_tries):
+            redraw = np.flatnonzero(excluded[samples])
+            if len(redraw) == 0:
+                return samples
+            samples[redraw] = pool[np.random.randint(len(pool), size=len(redraw))]
+        redraw = np.flatnonzero(excluded[samples])
+        if len(redraw) > 0:
+            allowed = pool[~excluded[pool]]
+            if len(allowed) == 0:
+                raise ValueError('No train entry outside of the batch to sample a triplet from')
+            samples[redraw] = allowed[np.random.randint(len(allowed), size=len(redraw))]
+        return samples
 
 
 def create_dataset(train_file, valid_file=None, test_file=None, batch_size=32, output_buffer=sys.stderr):
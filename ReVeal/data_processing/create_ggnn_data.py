@@ -3,6 +3,8 @@ import csv
 import json
 import numpy as np
 import os
+import shutil
+from multiprocessing import Pool
 from gensim.models import Word2Vec
 from tqdm import tqdm
 
@@ -161,6 +163,10 @@ import warnings
 
 warnings.filterwarnings('ignore')
 
+keyword_set = frozenset(keywords)
+punc_set = frozenset(puncs)
+l_func_set = frozenset(l_funcs)
+
 
 def symbolic_tokenize(code):
     tokens = nltk.word_tokenize(code)
@@ -174,14 +180,14 @@ def symbolic_tokenize(code):
     final_tokens = []
     for idx in range(len(c_tokens)):
         t = c_tokens[idx]
-        if t in keywords:
+        if t in keyword_set:
             final_tokens.append(t)
-        elif t in puncs:
+        elif t in punc_set:
             final_tokens.append(t)
-        elif t in l_funcs:
+        elif t in l_func_set:
             final_tokens.append(t)
         elif (idx+1) < len(c_tokens) and c_tokens[idx + 1] == '(':
-            if t in keywords:
+            if t in keyword_set:
                 final_tokens.append(t)
             else:
                 if t not in symbol_table.keys():
@@ -192,7 +198,7 @@ def symbolic_tokenize(code):
 
         elif t.endswith('('):
             t = t[:-1]
-            if t in keywords:
+            if t in keyword_set:
                 final_tokens.append(t + '(')
             else:
                 if t not in symbol_table.keys():
@@ -201,7 +207,7 @@ def symbolic_tokenize(code):
                 final_tokens.append(symbol_table[t] + '(')
         elif t.endswith('()'):
             t = t[:-2]
-            if t in keywords:
+            if t in keyword_set:
                 final_tokens.append(t + '( )')
             else:
                 if t not in symbol_table.keys():
@@ -286,71 +292,156 @@ def checkVul(cFile):
         return (1 if "BUFWRITE_COND_UNSAFE" in fileString or "BUFWRITE_TAUT_UNSAFE" in fileString else 0)
 
 
-def inputGeneration(nodeCSV, edgeCSV, target, wv, edge_type_map, cfg_only=False):
-    gInput = dict()
-    gInput["targets"] = list()
-    gInput["graph"] = list()
-    gInput["node_features"] = list()
-    gInput["targets"].append([target])
+def word2vec_vocabulary(wv):
+    """token -> row of wv.wv.vectors, for gensim 3 and 4."""
+    if hasattr(wv.wv, 'key_to_index'):
+        return wv.wv.key_to_index
+    return {token: vocab.index for token, vocab in wv.wv.vocab.items()}
+
+
+def embed_nodes(codes, wv, vocabulary):
+    """Mean Word2Vec vector of the nltk tokens of every node; unknown tokens count as zero vectors."""
+    token_ids, owners = [], []
+    for nidx, code in enumerate(codes):
+        for token in nltk.word_tokenize(code):
+            token_ids.append(vocabulary.get(token, -1))
+            owners.append(nidx)
+    token_ids = np.asarray(token_ids, dtype=np.int64)
+    owners = np.asarray(owners, dtype=np.int64)
+    vectors = wv.wv.vectors
+    embeddings = np.zeros((len(codes), vectors.shape[1]))
+    known = token_ids >= 0
+    np.add.at(embeddings, owners[known], vectors[token_ids[known]])
+    embeddings /= np.maximum(np.bincount(owners, minlength=len(codes)), 1)[:, None]
+    return embeddings.astype(np.float32)
+
+
+class FunctionGraph:
+    """All the nodes and edges of one function, read once from its Joern CSVs."""
+
+    def __init__(self, node_types, is_cfg_node, embeddings, edges):
+        self.node_types = node_types  # (N,) type_map ids
+        self.is_cfg_node = is_cfg_node  # (N,) bool
+        self.embeddings = embeddings  # (N, wv size) float32
+        self.edges = edges  # (E, 3) int64 [start, edgeType_full id, end]
+
+    def view(self, edge_type_map, cfg_only=False):
+        """Subgraph with the edges of `edge_type_map` and the nodes they connect, as
+        (node_features, edges) with edges as (E, 3) int32 [start, type, end] node indices,
+        or None if it is empty or too large. Like inputGeneration, the nodes are restricted
+        to the CFG nodes unless cfg_only is set."""
+        keep = np.ones(len(self.node_types), dtype=bool) if cfg_only else self.is_cfg_node
+        if not 0 < keep.sum() < 500:
+            return None
+        type_lookup = np.zeros(max(edgeType_full.values()) + 1, dtype=np.int64)
+        for name, etype in edge_type_map.items():
+            if name in edgeType_full:
+                type_lookup[edgeType_full[name]] = etype
+        start, etype, end = self.edges.T
+        edges = self.edges[keep[start] & keep[end] & (type_lookup[etype] > 0)]
+        if len(edges) == 0:
+            return None
+        nodes, local = np.unique(edges[:, [0, 2]], return_inverse=True)
+        local = local.reshape(-1, 2)
+        node_features = np.concatenate(
+            [type_one_hot[self.node_types[nodes] - 1], self.embeddings[nodes]], axis=1).astype(np.float32)
+        edges = np.stack([local[:, 0], type_lookup[edges[:, 1]], local[:, 1]], axis=1).astype(np.int32)
+        return node_features, edges
+
+
+def parse_function(nodeCSV, edgeCSV, wv, vocabulary=None):
+    if vocabulary is None:
+        vocabulary = word2vec_vocabulary(wv)
+    node_index = {}
+    node_types, is_cfg_node, codes = [], [], []
     with open(nodeCSV, 'r') as nc:
-        nodes = csv.DictReader(nc, delimiter='\t')
-        nodeMap = dict()
-        allNodes = {}
-        node_idx = 0
-        for idx, node in enumerate(nodes):
-            cfgNode = node['isCFGNode'].strip()
-            if not cfg_only and (cfgNode == '' or cfgNode == 'False'):
+        for node in csv.DictReader(nc, delimiter='\t'):
+            if node['type'] == 'File':
                 continue
-            nodeKey = node['key']
-            node_type = node['type']
-            if node_type == 'File':
+            cfgNode = node['isCFGNode'].strip()
+            node_index[node['key']] = len(node_types)
+            node_types.append(type_map[node['type']])
+            is_cfg_node.append(cfgNode != '' and cfgNode != 'False')
+            codes.append(node['code'].strip())
+    edges = []
+    with open(edgeCSV, 'r') as ec:
+        for e in csv.DictReader(ec, delimiter='\t'):
+            start, end, eType = node_index.get(e['start']), node_index.get(e['end']), edgeType_full.get(e['type'])
+            if start is None or end is None or eType is None:
                 continue
-            node_content = node['code'].strip()
-            node_split = nltk.word_tokenize(node_content)
-            nrp = np.zeros(100)
-            for token in node_split:
-                try:
-                    embedding = wv.wv[token]
-                except:
-                    embedding = np.zeros(100)
-                nrp = np.add(nrp, embedding)
-            if len(node_split) > 0:
-                fNrp = np.divide(nrp, len(node_split))
-            else:
-                fNrp = nrp
-            node_feature = type_one_hot[type_map[node_type] - 1].tolist()
-            node_feature.extend(fNrp.tolist())
-            allNodes[nodeKey] = node_feature
-            nodeMap[nodeKey] = node_idx
-            node_idx += 1
-        if node_idx == 0 or node_idx >= 500:
-            return None
-        all_nodes_with_edges = set()
-        trueNodeMap = {}
-        all_edges = []
-        with open(edgeCSV, 'r') as ec:
-            reader = csv.DictReader(ec, delimiter='\t')
-            for e in reader:
-                start, end, eType = e["start"], e["end"], e["type"]
-                if eType != "IS_FILE_OF":
-                    if not start in nodeMap or not end in nodeMap or not eType in edge_type_map:
-                        continue
-                    all_nodes_with_edges.add(start)
-                    all_nodes_with_edges.add(end)
-                    edge = [start, edge_type_map[eType], end]
-                    all_edges.append(edge)
-        if len(all_edges) == 0:
-            return None
-        for i, node in enumerate(all_nodes_with_edges):
-            trueNodeMap[node] = i
-            gInput["node_features"].append(allNodes[node])
-        for edge in all_edges:
-            start, t, end = edge
-            start = trueNodeMap[start]
-            end = trueNodeMap[end]
-            e = [start, t, end]
-            gInput["graph"].append(e)
-    return gInput
+            edges.append((start, eType, end))
+    return FunctionGraph(
+        np.asarray(node_types, dtype=np.int64), np.asarray(is_cfg_node, dtype=bool),
+        embed_nodes(codes, wv, vocabulary), np.asarray(edges, dtype=np.int64).reshape(-1, 3))
+
+
+def graph_to_json(graph, target):
+    if graph is None:
+        return None
+    node_features, edges = graph
+    return {'targets': [[target]], 'graph': edges.tolist(), 'node_features': node_features.tolist()}
+
+
+def inputGeneration(nodeCSV, edgeCSV, target, wv, edge_type_map, cfg_only=False):
+    return graph_to_json(parse_function(nodeCSV, edgeCSV, wv).view(edge_type_map, cfg_only), target)
+
+
+graph_views = [
+    ('full_graph', edgeType_full, False),
+    ('cgraph', edgeType_control, True),
+    ('dgraph', edgeType_data, True),
+    ('cdgraph', edgeType_control_data, True),
+]
+
+
+def write_graph_shard(data_points, output_dir):
+    """Write data points whose graphs are (node_features, edges) pairs to a directory:
+
+        entries.json                    the data points without their graphs
+        {view}.node_offsets.npy         (G + 1,) int64, the nodes of data point g are [offsets[g], offsets[g + 1])
+        {view}.edge_offsets.npy         (G + 1,) int64, likewise for the edges
+        {view}.node_features.npy        (total nodes, 69 + wv size) float32
+        {view}.edges.npy                (total edges, 3) int32 [start, edge type, end], relative to the graph
+
+    A missing view has no nodes and no edges.
+    """
+    tmp_dir = '%s.%d.tmp' % (output_dir, os.getpid())
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    for view, _, _ in graph_views:
+        graphs = [data_point[view] for data_point in data_points]
+        node_counts = [0 if graph is None else len(graph[0]) for graph in graphs]
+        edge_counts = [0 if graph is None else len(graph[1]) for graph in graphs]
+        graphs = [graph for graph in graphs if graph is not None]
+        np.save(os.path.join(tmp_dir, view + '.node_offsets.npy'), np.cumsum([0] + node_counts).astype(np.int64))
+        np.save(os.path.join(tmp_dir, view + '.edge_offsets.npy'), np.cumsum([0] + edge_counts).astype(np.int64))
+        np.save(os.path.join(tmp_dir, view + '.node_features.npy'),
+                np.concatenate([graph[0] for graph in graphs]) if graphs else np.zeros((0, 0), dtype=np.float32))
+        np.save(os.path.join(tmp_dir, view + '.edges.npy'),
+                np.concatenate([graph[1] for graph in graphs]) if graphs else np.zeros((0, 3), dtype=np.int32))
+    with open(os.path.join(tmp_dir, 'entries.json'), 'w') as fp:
+        view_names = set(view for view, _, _ in graph_views)
+        json.dump([{k: v for k, v in data_point.items() if k not in view_names} for data_point in data_points], fp)
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    os.replace(tmp_dir, output_dir)
+
+
+def read_graph_shard(shard_dir, view='full_graph'):
+    """Yield (entry, node_features, edges) for every data point of a shard written by write_graph_shard,
+    with node_features and edges None where the view is missing."""
+    with open(os.path.join(shard_dir, 'entries.json')) as fp:
+        entries = json.load(fp)
+    arrays = {name: np.load(os.path.join(shard_dir, '%s.%s.npy' % (view, name)), mmap_mode='r')
+              for name in ['node_offsets', 'edge_offsets', 'node_features', 'edges']}
+    node_offsets, edge_offsets = arrays['node_offsets'], arrays['edge_offsets']
+    for g, entry in enumerate(entries):
+        if node_offsets[g] == node_offsets[g + 1]:
+            yield entry, None, None
+        else:
+            yield entry, np.asarray(arrays['node_features'][node_offsets[g]:node_offsets[g + 1]]), \
+                np.asarray(arrays['edges'][edge_offsets[g]:edge_offsets[g + 1]])
 
 
 def extract_slices(linized_code, list_of_slices):
@@ -378,6 +469,66 @@ def unify_slices(list_of_list_of_slices):
     pass
 
 
+_worker_args = None
+_worker_model = None
+_worker_vocabulary = None
+
+
+def _init_worker(args):
+    global _worker_args, _worker_model, _worker_vocabulary
+    _worker_args = args
+    _worker_model = Word2Vec.load(args.wv)
+    _worker_vocabulary = word2vec_vocabulary(_worker_model)
+
+
+def process_entry(job):
+    didx, entry = job
+    args = _worker_args
+    file_name = entry['file_path'].split('/')[-1]
+    nodes_path = os.path.join(args.csv, file_name, 'nodes.csv')
+    edges_path = os.path.join(args.csv, file_name, 'edges.csv')
+    label = int(entry['label'])
+    if not os.path.exists(nodes_path) or not os.path.exists(edges_path):
+        return None
+    function_graph = parse_function(nodes_path, edges_path, _worker_model, _worker_vocabulary)
+    graphs = {view: function_graph.view(edge_type_map, cfg_only) for view, edge_type_map, cfg_only in graph_views}
+    if graphs['full_graph'] is None:
+        return None
+    if args.format == 'json':
+        graphs = {view: graph_to_json(graph, label) for view, graph in graphs.items()}
+    linized_code = {}
+    for ln, code in enumerate(entry['code'].split('\n')):
+        linized_code[ln + 1] = code
+    vuld_slices = extract_slices(linized_code, entry['call_slices_vd'])
+    syse_slices = extract_slices(
+        linized_code, unify_slices(
+            [entry['call_slices_sy'], entry['array_slices_sy'], entry['arith_slices_sy'], entry['ptr_slices_sy']]
+        )
+    )
+    data_point = {
+        'id': didx,
+        'file_name': file_name, 'file_path': os.path.abspath(entry['file_path']),
+        'code': entry['code'],
+        'vuld': vuld_slices, 'vd_present': 1 if len(vuld_slices) > 0 else 0,
+        'syse': syse_slices, 'syse_present': 1 if len(syse_slices) > 0 else 0,
+        'draper': entry['tokenized'],
+        'label': label
+    }
+    data_point.update(graphs)
+    return data_point
+
+
+def save_shard(final_data, data_shard, args):
+    if args.format == 'json':
+        output_path = args.output + '.shard' + str(data_shard)
+        with open(output_path, 'w') as fp:
+            json.dump(final_data, fp)
+    else:
+        output_path = os.path.splitext(args.output)[0] + '.shard' + str(data_shard)
+        write_graph_shard(final_data, output_path)
+    print('Saved Shard %d to %s' % (data_shard, output_path), '=' * 100, 'Done', sep='\n')
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--project', default='chrome_debian')
@@ -385,81 +536,41 @@ def main():
     parser.add_argument('--src', help='source c files to process', default='../data/chrome_debian/raw_code/')
     parser.add_argument('--wv', default='../data/chrome_debian/raw_code_deb_chro.100')
     parser.add_argument('--output', default='../data/full_experiment_real_data/chrome_debian/chrome_debian.json')
+    parser.add_argument('--format', choices=['json', 'npy'], default='json',
+                        help='json: the graphs as lists, read by full_data_prep_script.ipynb; '
+                             'npy: a directory of arrays per shard, read back with read_graph_shard')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
     args = parser.parse_args()
     json_file_path = '../data/' + args.project + '_full_data_with_slices.json'
     data = json.load(open(json_file_path))
-    model = Word2Vec.load(args.wv)
     final_data = []
     v, nv, vd_present, syse_present, cg_present, dg_present, cdg_present = 0, 0, 0, 0, 0, 0, 0
     data_shard = 1
-    for didx, entry in enumerate(tqdm(data)):
-        file_name = entry['file_path'].split('/')[-1]
-        nodes_path = os.path.join(args.csv, file_name, 'nodes.csv')
-        edges_path = os.path.join(args.csv, file_name, 'edges.csv')
-        label = int(entry['label'])
-        if not os.path.exists(nodes_path) or not os.path.exists(edges_path):
-            continue
-        linized_code = {}
-        for ln, code in enumerate(entry['code'].split('\n')):
-            linized_code[ln + 1] = code
-        vuld_slices = extract_slices(linized_code, entry['call_slices_vd'])
-        syse_slices = extract_slices(
-            linized_code, unify_slices(
-                [entry['call_slices_sy'], entry['array_slices_sy'], entry['arith_slices_sy'], entry['ptr_slices_sy']]
-            )
-        )
-        graph_input_full = inputGeneration(
-            nodes_path, edges_path, label, model, edgeType_full, False)
-        graph_input_control = inputGeneration(
-            nodes_path, edges_path, label, model, edgeType_control, True)
-        graph_input_data = inputGeneration(nodes_path, edges_path, label, model, edgeType_data, True)
-        graph_input_cd = inputGeneration(
-            nodes_path, edges_path, label, model, edgeType_control_data, True)
-        draper_code = entry['tokenized']
-        if graph_input_full is None:
-            continue
-        if label == 1:
-            v += 1
-        else:
-            nv += 1
-        if len(vuld_slices) > 0: vd_present += 1
-        if len(syse_slices) > 0: syse_present += 1
-        if graph_input_control is not None: cg_present += 1
-        if graph_input_data is not None: dg_present += 1
-        if graph_input_cd is not None: cdg_present += 1
-        data_point = {
-            'id': didx,
-            'file_name': file_name, 'file_path': os.path.abspath(entry['file_path']),
-            'code': entry['code'],
-            'vuld': vuld_slices, 'vd_present': 1 if len(vuld_slices) > 0 else 0,
-            'syse': syse_slices, 'syse_present': 1 if len(syse_slices) > 0 else 0,
-            'draper': draper_code,
-            'full_graph': graph_input_full,
-            'cgraph': graph_input_control,
-            'dgraph': graph_input_data,
-            'cdgraph': graph_input_cd,
-            'label': int(entry['label'])
-        }
-        final_data.append(data_point)
-        if len(final_data) == 5000:
-            output_path = args.output + '.shard' + str(data_shard)
-            with open(output_path, 'w') as fp:
-                json.dump(final_data, fp)
-                fp.close()
-            print('Saved Shard %d to %s' % (data_shard, output_path), '=' * 100, 'Done', sep='\n')
-            final_data = []
-            data_shard += 1
+    with Pool(args.workers, initializer=_init_worker, initargs=(args,)) as pool:
+        for data_point in tqdm(pool.imap(process_entry, enumerate(data), chunksize=16), total=len(data)):
+            if data_point is None:
+                continue
+            if data_point['label'] == 1:
+                v += 1
+            else:
+                nv += 1
+            vd_present += data_point['vd_present']
+            syse_present += data_point['syse_present']
+            if data_point['cgraph'] is not None: cg_present += 1
+            if data_point['dgraph'] is not None: dg_present += 1
+            if data_point['cdgraph'] is not None: cdg_present += 1
+            final_data.append(data_point)
+            if len(final_data) == 5000:
+                save_shard(final_data, data_shard, args)
+                final_data = []
+                data_shard += 1
     print("Vulnerable:\t%d\n"
           "Non-Vul:\t%d\n"
           "VulDeePecker:\t%d\n"
           "SySeVr:\t%d\n"
           "Control: %d\tData: %d\tBoth: %d" % \
           (v, nv, vd_present, syse_present, cg_present, dg_present, cdg_present))
-    output_path = args.output + '.shard' + str(data_shard)
-    with open(output_path, 'w') as fp:
-        json.dump(final_data, fp)
-        fp.close()
-    print('Saved Shard %d to %s' % (data_shard, output_path), '=' * 100, 'Done', sep='\n')
+    save_shard(final_data, data_shard, args)
 
 
 if __name__ == '__main__':
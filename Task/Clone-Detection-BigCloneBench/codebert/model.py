@@ -38,7 +38,7 @@ class Model(nn.Module):
     
         
     def forward(self, input_ids=None,labels=None): 
-        input_ids=input_ids.view(-1,self.args.block_size)
+        input_ids=input_ids.view(-1,input_ids.size(-1))
         outputs = self.encoder(input_ids= input_ids,attention_mask=input_ids.ne(1))[0]
         logits=self.classifier(outputs)
         prob=F.softmax(logits)
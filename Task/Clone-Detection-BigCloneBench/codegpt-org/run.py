@@ -43,6 +43,7 @@ except:
 from tqdm import tqdm, trange
 import multiprocessing
 from model import Model
+from threshold_sweep import GRID_THRESHOLDS, best_f1_threshold
 
 cpu_cont = 16
 from transformers import (WEIGHTS_NAME, AdamW, get_linear_schedule_with_warmup,
@@ -355,28 +356,11 @@ def evaluate(args, model, tokenizer, prefix="",pool=None,eval_when_training=Fals
         nb_eval_steps += 1
     logits=np.concatenate(logits,0)
     y_trues=np.concatenate(y_trues,0)
-    best_threshold=0
-    best_f1=0
-    for i in range(1,100):
-        threshold=i/100
-        y_preds=logits[:,1]>threshold
-        from sklearn.metrics import recall_score
-        recall=recall_score(y_trues, y_preds, average='macro')
-        from sklearn.metrics import precision_score
-        precision=precision_score(y_trues, y_preds, average='macro')   
-        from sklearn.metrics import f1_score
-        f1=f1_score(y_trues, y_preds, average='macro') 
-        if f1>best_f1:
-            best_f1=f1
-            best_threshold=threshold
-
-    y_preds=logits[:,1]>best_threshold
-    from sklearn.metrics import recall_score
-    recall=recall_score(y_trues, y_preds, average='macro')
-    from sklearn.metrics import precision_score
-    precision=precision_score(y_trues, y_preds, average='macro')   
-    from sklearn.metrics import f1_score
-    f1=f1_score(y_trues, y_preds, average='macro')             
+    #macro precision/recall/F1 at every threshold from one sort of the scores
+    thresholds=GRID_THRESHOLDS if args.threshold_search=='grid' else None
+    best,_=best_f1_threshold(logits[:,1],y_trues,thresholds)
+    best_threshold=best['threshold']
+    recall,precision,f1=best['recall'],best['precision'],best['f1']
     result = {
         "eval_recall": float(recall),
         "eval_precision": float(precision),
@@ -534,6 +518,8 @@ def main():
                         help="Overwrite the content of the output directory")
     parser.add_argument('--overwrite_cache', action='store_true',
                         help="Overwrite the cached training and evaluation sets")
+    parser.add_argument('--threshold_search', default='grid', choices=['grid', 'exact'],
+                        help="Pick the evaluation threshold on the 0.01..0.99 grid, or exactly over every distinct score.")
     parser.add_argument('--seed', type=int, default=42,
                         help="random seed for initialization")
     parser.add_argument('--epoch', type=int, default=42,
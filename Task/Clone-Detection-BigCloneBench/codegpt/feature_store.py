@@ -0,0 +1,79 @@
+"""
+Per-function feature store for pairwise clone detection.
+
+A BigCloneBench pair file references the same few thousand functions (the `idx`
+field of data.jsonl) hundreds of thousands of times. Instead of featurizing both
+sides of every pair, each unique function is featurized once, in parallel, and the
+result is pickled next to data.jsonl. Datasets then build pairs as lookups into
+the store, and every later run (train/valid/test) reuses the same file.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import pickle
+
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+
+def read_functions(data_file):
+    """Return {idx: func} for every line of a data.jsonl file."""
+    url_to_code={}
+    with open(data_file) as f:
+        for line in f:
+            line=line.strip()
+            js=json.loads(line)
+            url_to_code[js['idx']]=js['func']
+    return url_to_code
+
+
+def feature_store_path(data_file, signature):
+    """Location of the store for `data_file` featurized under `signature`.
+
+    The signature must name everything the features depend on (model family,
+    tokenizer, length limits); the data file's size and mtime are added so that an
+    edited data.jsonl never reuses stale features.
+    """
+    stat=os.stat(data_file)
+    key='{}|{}|{}'.format(stat.st_size,int(stat.st_mtime),signature)
+    digest=hashlib.md5(key.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(os.path.dirname(data_file),'cached_features_{}.pkl'.format(digest))
+
+
+def _featurize_chunk(item):
+    featurize,chunk,tokenizer,args=item
+    return [(idx,featurize(code,tokenizer,args)) for idx,code in chunk]
+
+
+def load_or_build_feature_store(data_file, featurize, tokenizer, args, signature, pool=None, chunk_size=256):
+    """Return {idx: featurize(code, tokenizer, args)} for every function in `data_file`.
+
+    `featurize` must be a module-level function so it can be sent to `pool`
+    workers. Functions are shipped in chunks so the tokenizer is pickled once per
+    chunk rather than once per function.
+    """
+    store_path=feature_store_path(data_file,signature)
+    if os.path.exists(store_path) and not getattr(args,'overwrite_cache',False):
+        logger.info("Loading function features from cached file %s", store_path)
+        with open(store_path,'rb') as f:
+            return pickle.load(f)
+
+    url_to_code=read_functions(data_file)
+    items=[(idx,' '.join(code.split())) for idx,code in url_to_code.items()]
+    chunks=[(featurize,items[i:i+chunk_size],tokenizer,args) for i in range(0,len(items),chunk_size)]
+    logger.info("Featurizing %d unique functions from %s", len(items), data_file)
+    mapper=pool.imap if pool is not None else map
+    store={}
+    for results in tqdm(mapper(_featurize_chunk,chunks),total=len(chunks)):
+        store.update(results)
+
+    #write to a temporary file first so concurrent readers never see a partial store
+    tmp_path='{}.{}.tmp'.format(store_path,os.getpid())
+    with open(tmp_path,'wb') as f:
+        pickle.dump(store,f,protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path,store_path)
+    logger.info("Saving function features into cached file %s", store_path)
+    return store
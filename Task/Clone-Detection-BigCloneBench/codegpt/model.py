@@ -37,7 +37,7 @@ class Model(nn.Module):
     
         
     def forward(self, input_ids=None,labels=None): 
-        input_ids=input_ids.view(-1,self.args.block_size)
+        input_ids=input_ids.view(-1,input_ids.size(-1))
         outputs = self.encoder(input_ids= input_ids,attention_mask=input_ids.ne(self.tokenizer.pad_token_id))[0] # 2B * L * D
         sequence_lengths = torch.ne(input_ids, self.tokenizer.pad_token_id).sum(-1) - 1
         outputs=outputs[range(input_ids.size(0)),sequence_lengths,:] # 2B * D
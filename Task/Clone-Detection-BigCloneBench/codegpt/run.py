@@ -29,10 +29,9 @@ import pickle
 import random
 import re
 import shutil
-import json
 import numpy as np
 import torch
-from torch.utils.data import DataLoader, Dataset, SequentialSampler, RandomSampler,TensorDataset
+from torch.utils.data import DataLoader, Dataset,TensorDataset
 from torch.utils.data.distributed import DistributedSampler
 
 try:
@@ -43,6 +42,9 @@ except:
 from tqdm import tqdm, trange
 import multiprocessing
 from model import Model
+from threshold_sweep import GRID_THRESHOLDS, best_f1_threshold
+from feature_store import load_or_build_feature_store
+from dynamic_padding import PadCollate, bucketed_dataloader, restore_order
 
 cpu_cont = 16
 from transformers import (WEIGHTS_NAME, AdamW, get_linear_schedule_with_warmup,
@@ -62,26 +64,25 @@ MODEL_CLASSES = {
     'distilbert': (DistilBertConfig, DistilBertForMaskedLM, DistilBertTokenizer)
 }
 
-def get_example(item):
-    url1,url2,label,tokenizer,args,cache,url_to_code=item
-    if url1 in cache:
-        code1=cache[url1].copy()
-    else:
-        try:
-            code=' '.join(url_to_code[url1].split())
-        except:
-            code=""
-        code1=tokenizer.tokenize(code)
-    if url2 in cache:
-        code2=cache[url2].copy()
-    else:
-        try:
-            code=' '.join(url_to_code[url2].split())
-        except:
-            code=""
-        code2=tokenizer.tokenize(code)
-        
-    return convert_examples_to_features(code1,code2,label,url1,url2,tokenizer,args,cache)
+def featurize_function(code,tokenizer,args):
+    """Tokenize one function into its unpadded half of a pair (at most `block_size` ids)."""
+    code_tokens=tokenizer.tokenize(code)[:args.block_size-2]
+    code_tokens =[tokenizer.bos_token]+code_tokens+[tokenizer.eos_token]
+    code_ids=tokenizer.convert_tokens_to_ids(code_tokens)
+    # padded per batch by PadCollate
+    return {'input_tokens':code_tokens,'input_ids':code_ids}
+
+
+class InputExample(object):
+    """A single (url1, url2) pair, resolved against the feature store on access."""
+    def __init__(self,
+                 url1,
+                 url2,
+                 label
+    ):
+        self.url1=url1
+        self.url2=url2
+        self.label=label
 
 
 class InputFeatures(object):
@@ -100,25 +101,9 @@ class InputFeatures(object):
         self.url1=url1
         self.url2=url2
         
-def convert_examples_to_features(code1_tokens,code2_tokens,label,url1,url2,tokenizer,args,cache):
-    #source
-    code1_tokens=code1_tokens[:args.block_size-2]
-    code1_tokens =[tokenizer.bos_token]+code1_tokens+[tokenizer.eos_token]
-    code2_tokens=code2_tokens[:args.block_size-2]
-    code2_tokens =[tokenizer.bos_token]+code2_tokens+[tokenizer.eos_token]  
-    
-    code1_ids=tokenizer.convert_tokens_to_ids(code1_tokens)
-    padding_length = args.block_size - len(code1_ids)
-    code1_ids+=[tokenizer.pad_token_id]*padding_length
-    
-    code2_ids=tokenizer.convert_tokens_to_ids(code2_tokens)
-    code2_length=len(code2_ids)
-    padding_length = args.block_size - code2_length
-    code2_ids+=[tokenizer.pad_token_id]*padding_length
-    
-    source_tokens=code1_tokens+code2_tokens
-    source_ids=code1_ids+code2_ids
-    length=len(code1_ids)+code2_length
+def convert_examples_to_features(feature1,feature2,label,url1,url2):
+    source_tokens=feature1['input_tokens']+feature2['input_tokens']
+    source_ids=feature1['input_ids']+feature2['input_ids']
     return InputFeatures(source_tokens,source_ids,label,url1,url2)
 
 class TextDataset(Dataset):
@@ -127,47 +112,51 @@ class TextDataset(Dataset):
         self.examples = []
         index_filename=file_path
         logger.info("Creating features from index file at %s ", index_filename)
-        url_to_code={}
-        with open('/'.join(index_filename.split('/')[:-1])+'/{}/data.jsonl'.format(args.test_type)) as f:
-            for line in f:
-                line=line.strip()
-                js=json.loads(line)
-                url_to_code[js['idx']]=js['func']
+        data_file='/'.join(index_filename.split('/')[:-1])+'/{}/data.jsonl'.format(args.test_type)
+        signature='codegpt|unpadded|{}|{}|{}'.format(type(tokenizer).__name__,args.tokenizer_name,args.block_size)
+        self.features=load_or_build_feature_store(data_file,featurize_function,tokenizer,args,signature,pool=pool)
 
         data=[]
-        cache={}
-        f=open(index_filename)
         with open(index_filename) as f:
             for line in f:
                 line=line.strip()
                 url1,url2,label=line.split('\t')
-                if url1 not in url_to_code or url2 not in url_to_code:
+                if url1 not in self.features or url2 not in self.features:
                     continue
                 if label=='0':
                     label=0
                 else:
                     label=1
-                data.append((url1,url2,label,tokenizer, args,cache,url_to_code))
+                data.append(InputExample(url1,url2,label))
         if 'test' not in postfix:
             data=random.sample(data,int(len(data)*0.1))
 
-        self.examples=pool.map(get_example,tqdm(data,total=len(data)))
+        self.examples=data
+        #a pair is as long as its longest side, both sides are padded to the batch width
+        self.lengths=[max(len(self.features[e.url1]['input_ids']),len(self.features[e.url2]['input_ids']))
+                      for e in self.examples]
+        self.collate_fn=PadCollate([tokenizer.pad_token_id,tokenizer.pad_token_id,None])
         if 'train' in postfix:
-            for idx, example in enumerate(self.examples[:3]):
+            for idx in range(min(3,len(self.examples))):
+                    example=self.get_pair(idx)
                     logger.info("*** Example ***")
                     logger.info("idx: {}".format(idx))
                     logger.info("label: {}".format(example.label))
                     logger.info("input_tokens: {}".format([x.replace('\u0120','_') for x in example.input_tokens]))
                     logger.info("input_ids: {}".format(' '.join(map(str, example.input_ids))))
 
-
+    def get_pair(self, item):
+        example=self.examples[item]
+        return convert_examples_to_features(self.features[example.url1],self.features[example.url2],
+                                            example.label,example.url1,example.url2)
 
     def __len__(self):
         return len(self.examples)
 
     def __getitem__(self, item):
-        
-        return torch.tensor(self.examples[item].input_ids),torch.tensor(self.examples[item].label)
+        example=self.examples[item]
+        return torch.tensor(self.features[example.url1]['input_ids']),\
+               torch.tensor(self.features[example.url2]['input_ids']),torch.tensor(example.label)
 
 
 def load_and_cache_examples(args, tokenizer, evaluate=False,test=False,pool=None):
@@ -186,9 +175,12 @@ def train(args, train_dataset, model, tokenizer,pool):
     """ Train the model """
 
     args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
-    train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
-    
-    train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.train_batch_size)
+    if args.local_rank == -1:
+        train_dataloader = bucketed_dataloader(train_dataset, train_dataset.lengths, args.train_batch_size, shuffle=True,
+                                               bucketing=not args.no_length_bucketing, collate_fn=train_dataset.collate_fn)
+    else:
+        train_dataloader = DataLoader(train_dataset, sampler=DistributedSampler(train_dataset),
+                                      collate_fn=train_dataset.collate_fn, batch_size=args.train_batch_size)
     args.max_steps=args.epoch*len( train_dataloader)
     # # # # args.save_steps=len( train_dataloader)
     args.warmup_steps=len( train_dataloader)
@@ -253,8 +245,9 @@ def train(args, train_dataset, model, tokenizer,pool):
         tr_num=0
         train_loss=0
         for step, batch in enumerate(bar):
-            inputs = batch[0].to(args.device)        
-            labels=batch[1].to(args.device) 
+            #both sides of every pair, B * 2 * L
+            inputs = torch.stack((batch[0],batch[1]),1).to(args.device)        
+            labels=batch[2].to(args.device) 
             model.train()
             loss,logits = model(inputs,labels)
 
@@ -343,8 +336,13 @@ def evaluate(args, model, tokenizer, prefix="",pool=None,eval_when_training=Fals
 
     args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
     # Note that DistributedSampler samples randomly
-    eval_sampler = SequentialSampler(eval_dataset) if args.local_rank == -1 else DistributedSampler(eval_dataset)
-    eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size,num_workers=4,pin_memory=True)
+    if args.local_rank == -1:
+        eval_dataloader = bucketed_dataloader(eval_dataset, eval_dataset.lengths, args.eval_batch_size, shuffle=False,
+                                              bucketing=not args.no_length_bucketing, collate_fn=eval_dataset.collate_fn,
+                                              num_workers=4,pin_memory=True)
+    else:
+        eval_dataloader = DataLoader(eval_dataset, sampler=DistributedSampler(eval_dataset), collate_fn=eval_dataset.collate_fn,
+                                     batch_size=args.eval_batch_size,num_workers=4,pin_memory=True)
 
     # multi-gpu evaluate
     if args.n_gpu > 1 and eval_when_training is False:
@@ -360,38 +358,22 @@ def evaluate(args, model, tokenizer, prefix="",pool=None,eval_when_training=Fals
     logits=[]  
     y_trues=[]
     for batch in eval_dataloader:
-        inputs = batch[0].to(args.device)        
-        labels=batch[1].to(args.device) 
+        inputs = torch.stack((batch[0],batch[1]),1).to(args.device)        
+        labels=batch[2].to(args.device) 
         with torch.no_grad():
             lm_loss,logit = model(inputs,labels)
             eval_loss += lm_loss.mean().item()
             logits.append(logit.cpu().numpy())
             y_trues.append(labels.cpu().numpy())
         nb_eval_steps += 1
-    logits=np.concatenate(logits,0)
-    y_trues=np.concatenate(y_trues,0)
-    best_threshold=0
-    best_f1=-1
-    for i in range(1,100):
-        threshold=i/100
-        y_preds=logits[:,1]>threshold
-        from sklearn.metrics import recall_score
-        recall=recall_score(y_trues, y_preds, average='macro')
-        from sklearn.metrics import precision_score
-        precision=precision_score(y_trues, y_preds, average='macro')   
-        from sklearn.metrics import f1_score
-        f1=f1_score(y_trues, y_preds, average='macro') 
-        if f1>best_f1:
-            best_f1=f1
-            best_threshold=threshold
-
-    y_preds=logits[:,1]>best_threshold
-    from sklearn.metrics import recall_score
-    recall=recall_score(y_trues, y_preds, average='macro')
-    from sklearn.metrics import precision_score
-    precision=precision_score(y_trues, y_preds, average='macro')   
-    from sklearn.metrics import f1_score
-    f1=f1_score(y_trues, y_preds, average='macro')             
+    #batches come sorted by length, back to the order of the examples
+    logits=restore_order(eval_dataloader,np.concatenate(logits,0))
+    y_trues=restore_order(eval_dataloader,np.concatenate(y_trues,0))
+    #macro precision/recall/F1 at every threshold from one sort of the scores
+    thresholds=GRID_THRESHOLDS if args.threshold_search=='grid' else None
+    best,_=best_f1_threshold(logits[:,1],y_trues,thresholds)
+    best_threshold=best['threshold']
+    recall,precision,f1=best['recall'],best['precision'],best['f1']
     result = {
         "eval_recall": float(recall),
         "eval_precision": float(precision),
@@ -413,8 +395,13 @@ def test(args, model, tokenizer, prefix="",pool=None,best_threshold=0):
 
     args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
     # Note that DistributedSampler samples randomly
-    eval_sampler = SequentialSampler(eval_dataset) if args.local_rank == -1 else DistributedSampler(eval_dataset)
-    eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size,num_workers=4,pin_memory=True)
+    if args.local_rank == -1:
+        eval_dataloader = bucketed_dataloader(eval_dataset, eval_dataset.lengths, args.eval_batch_size, shuffle=False,
+                                              bucketing=not args.no_length_bucketing, collate_fn=eval_dataset.collate_fn,
+                                              num_workers=4,pin_memory=True)
+    else:
+        eval_dataloader = DataLoader(eval_dataset, sampler=DistributedSampler(eval_dataset), collate_fn=eval_dataset.collate_fn,
+                                     batch_size=args.eval_batch_size,num_workers=4,pin_memory=True)
 
     # multi-gpu evaluate
     if args.n_gpu > 1:
@@ -430,16 +417,17 @@ def test(args, model, tokenizer, prefix="",pool=None,best_threshold=0):
     logits=[]  
     y_trues=[]
     for batch in tqdm(eval_dataloader, total=len(eval_dataloader)):
-        inputs = batch[0].to(args.device)        
-        labels=batch[1].to(args.device) 
+        inputs = torch.stack((batch[0],batch[1]),1).to(args.device)        
+        labels=batch[2].to(args.device) 
         with torch.no_grad():
             lm_loss,logit = model(inputs,labels)
             eval_loss += lm_loss.mean().item()
             logits.append(logit.cpu().numpy())
             y_trues.append(labels.cpu().numpy())
         nb_eval_steps += 1
-    logits=np.concatenate(logits,0)
-    y_trues=np.concatenate(y_trues,0)
+    #batches come sorted by length, back to the order of the examples
+    logits=restore_order(eval_dataloader,np.concatenate(logits,0))
+    y_trues=restore_order(eval_dataloader,np.concatenate(y_trues,0))
     y_preds=logits[:,1]>best_threshold
     with open(os.path.join(args.output_dir,"predictions.txt"),'w') as f:
         for example,pred in zip(eval_dataset.examples,y_preds):
@@ -549,6 +537,8 @@ def main():
                         help="Overwrite the content of the output directory")
     parser.add_argument('--overwrite_cache', action='store_true',
                         help="Overwrite the cached training and evaluation sets")
+    parser.add_argument('--threshold_search', default='grid', choices=['grid', 'exact'],
+                        help="Pick the evaluation threshold on the 0.01..0.99 grid, or exactly over every distinct score.")
     parser.add_argument('--seed', type=int, default=42,
                         help="random seed for initialization")
     parser.add_argument('--epoch', type=int, default=42,
@@ -558,6 +548,8 @@ def main():
     parser.add_argument('--fp16_opt_level', type=str, default='O1',
                         help="For fp16: Apex AMP optimization level selected in ['O0', 'O1', 'O2', and 'O3']."
                              "See details at https://nvidia.github.io/apex/amp.html")
+    parser.add_argument("--no_length_bucketing", action='store_true',
+                        help="Batch pairs in random/sequential order instead of by length (still padded per batch).")
     parser.add_argument("--local_rank", type=int, default=-1,
                         help="For distributed training: local_rank")
     parser.add_argument('--server_ip', type=str, default='', help="For distant debugging.")
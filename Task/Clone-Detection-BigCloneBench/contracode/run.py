@@ -29,7 +29,6 @@ import pickle
 import random
 import re
 import shutil
-import json
 import numpy as np
 import torch
 from torch.utils.data import DataLoader, Dataset, SequentialSampler, RandomSampler,TensorDataset
@@ -43,6 +42,7 @@ except:
 from tqdm import tqdm, trange
 import multiprocessing
 from model import Model
+from threshold_sweep import GRID_THRESHOLDS, best_f1_threshold
 
 cpu_cont = 16
 from transformers import (WEIGHTS_NAME, AdamW, get_linear_schedule_with_warmup,
@@ -55,6 +55,7 @@ import sentencepiece as spm
 
 from representjs.data.util import Timer, normalize_program, EncodeAsIds
 from model import CloneDetectionEncoder
+from feature_store import load_or_build_feature_store
 
 logger = logging.getLogger(__name__)
 
@@ -66,20 +67,27 @@ MODEL_CLASSES = {
     'distilbert': (DistilBertConfig, DistilBertForMaskedLM, DistilBertTokenizer)
 }
 
-def get_example(item):
-    url1,url2,label,tokenizer,args,cache,url_to_code=item
-    try:
-        code1=' '.join(url_to_code[url1].split())
-    except:
-        code1=""
-    # code1=tokenizer.tokenize(code)
-    try:
-        code2=' '.join(url_to_code[url2].split())
-    except:
-        code2=""
-    # code2=tokenizer.tokenize(code)
-        
-    return convert_examples_to_features(code1,code2,label,url1,url2,tokenizer,args,cache)
+def featurize_function(code,tokenizer,args):
+    """Encode one function into its padded `block_size` half of a pair."""
+    code = normalize_program(code)
+    code_tokens = tokenizer.EncodeAsPieces(code)
+    code_ids =  EncodeAsIds(tokenizer, 0, code)
+    code_ids = [tokenizer.PieceToId("<s>")] + code_ids[: (args.block_size - 2)] + [tokenizer.PieceToId("</s>")]
+    padding_length = args.block_size - len(code_ids)
+    code_ids+=[tokenizer.PieceToId("<pad>")]*padding_length
+    return {'input_tokens':code_tokens,'input_ids':code_ids}
+
+
+class InputExample(object):
+    """A single (url1, url2) pair, resolved against the feature store on access."""
+    def __init__(self,
+                 url1,
+                 url2,
+                 label
+    ):
+        self.url1=url1
+        self.url2=url2
+        self.label=label
 
 
 class InputFeatures(object):
@@ -98,26 +106,9 @@ class InputFeatures(object):
         self.url1=url1
         self.url2=url2
         
-def convert_examples_to_features(code1,code2,label,url1,url2,tokenizer,args,cache):
-    #source
-    code1 = normalize_program(code1)
-    code1_tokens = tokenizer.EncodeAsPieces(code1)
-    code1_ids =  EncodeAsIds(tokenizer, 0, code1)
-    code1_ids = [tokenizer.PieceToId("<s>")] + code1_ids[: (args.block_size - 2)] + [tokenizer.PieceToId("</s>")]
-
-    code2 = normalize_program(code2)
-    code2_tokens = tokenizer.EncodeAsPieces(code2)
-    code2_ids =  EncodeAsIds(tokenizer, 0, code2)
-    code2_ids = [tokenizer.PieceToId("<s>")] + code2_ids[: (args.block_size - 2)] + [tokenizer.PieceToId("</s>")]
-
-    padding_length = args.block_size - len(code1_ids)
-    code1_ids+=[tokenizer.PieceToId("<pad>")]*padding_length
-    
-    padding_length = args.block_size - len(code2_ids)
-    code2_ids+=[tokenizer.PieceToId("<pad>")]*padding_length
-    
-    source_tokens=code1_tokens+code2_tokens
-    source_ids=code1_ids+code2_ids
+def convert_examples_to_features(feature1,feature2,label,url1,url2):
+    source_tokens=feature1['input_tokens']+feature2['input_tokens']
+    source_ids=feature1['input_ids']+feature2['input_ids']
     return InputFeatures(source_tokens,source_ids,label,url1,url2)
 
 class TextDataset(Dataset):
@@ -126,47 +117,46 @@ class TextDataset(Dataset):
         self.examples = []
         index_filename=file_path
         logger.info("Creating features from index file at %s ", index_filename)
-        url_to_code={}
-        with open('/'.join(index_filename.split('/')[:-1])+'/{}/data.jsonl'.format(args.test_type)) as f:
-            for line in f:
-                line=line.strip()
-                js=json.loads(line)
-                url_to_code[js['idx']]=js['func']
+        data_file='/'.join(index_filename.split('/')[:-1])+'/{}/data.jsonl'.format(args.test_type)
+        signature='contracode|{}|{}'.format(args.tokenizer_name,args.block_size)
+        self.features=load_or_build_feature_store(data_file,featurize_function,tokenizer,args,signature,pool=pool)
 
         data=[]
-        cache={}
-        f=open(index_filename)
         with open(index_filename) as f:
             for line in f:
                 line=line.strip()
                 url1,url2,label=line.split('\t')
-                if url1 not in url_to_code or url2 not in url_to_code:
+                if url1 not in self.features or url2 not in self.features:
                     continue
                 if label=='0':
                     label=0
                 else:
                     label=1
-                data.append((url1,url2,label,tokenizer, args,cache,url_to_code))
+                data.append(InputExample(url1,url2,label))
         if 'test' not in postfix:
             data=random.sample(data,int(len(data)*0.1))
 
-        self.examples=pool.map(get_example,tqdm(data,total=len(data)))
+        self.examples=data
         if 'train' in postfix:
-            for idx, example in enumerate(self.examples[:3]):
+            for idx in range(min(3,len(self.examples))):
+                    example=self.get_pair(idx)
                     logger.info("*** Example ***")
                     logger.info("idx: {}".format(idx))
                     logger.info("label: {}".format(example.label))
                     logger.info("input_tokens: {}".format([x.replace('\u0120','_') for x in example.input_tokens]))
                     logger.info("input_ids: {}".format(' '.join(map(str, example.input_ids))))
 
-
+    def get_pair(self, item):
+        example=self.examples[item]
+        return convert_examples_to_features(self.features[example.url1],self.features[example.url2],
+                                            example.label,example.url1,example.url2)
 
     def __len__(self):
         return len(self.examples)
 
     def __getitem__(self, item):
-        
-        return torch.tensor(self.examples[item].input_ids),torch.tensor(self.examples[item].label)
+        example=self.get_pair(item)
+        return torch.tensor(example.input_ids),torch.tensor(example.label)
 
 
 def load_and_cache_examples(args, tokenizer, evaluate=False,test=False,pool=None):
@@ -353,28 +343,11 @@ def evaluate(args, model, tokenizer, prefix="",pool=None,eval_when_training=Fals
         nb_eval_steps += 1
     logits=np.concatenate(logits,0)
     y_trues=np.concatenate(y_trues,0)
-    best_threshold=0
-    best_f1=0
-    for i in range(1,100):
-        threshold=i/100
-        y_preds=logits[:,1]>threshold
-        from sklearn.metrics import recall_score
-        recall=recall_score(y_trues, y_preds, average='macro')
-        from sklearn.metrics import precision_score
-        precision=precision_score(y_trues, y_preds, average='macro')   
-        from sklearn.metrics import f1_score
-        f1=f1_score(y_trues, y_preds, average='macro') 
-        if f1>best_f1:
-            best_f1=f1
-            best_threshold=threshold
-
-    y_preds=logits[:,1]>best_threshold
-    from sklearn.metrics import recall_score
-    recall=recall_score(y_trues, y_preds, average='macro')
-    from sklearn.metrics import precision_score
-    precision=precision_score(y_trues, y_preds, average='macro')   
-    from sklearn.metrics import f1_score
-    f1=f1_score(y_trues, y_preds, average='macro')             
+    #macro precision/recall/F1 at every threshold from one sort of the scores
+    thresholds=GRID_THRESHOLDS if args.threshold_search=='grid' else None
+    best,_=best_f1_threshold(logits[:,1],y_trues,thresholds)
+    best_threshold=best['threshold']
+    recall,precision,f1=best['recall'],best['precision'],best['f1']
     result = {
         "eval_recall": float(recall),
         "eval_precision": float(precision),
@@ -533,6 +506,8 @@ def main():
                         help="Overwrite the content of the output directory")
     parser.add_argument('--overwrite_cache', action='store_true',
                         help="Overwrite the cached training and evaluation sets")
+    parser.add_argument('--threshold_search', default='grid', choices=['grid', 'exact'],
+                        help="Pick the evaluation threshold on the 0.01..0.99 grid, or exactly over every distinct score.")
     parser.add_argument('--seed', type=int, default=42,
                         help="random seed for initialization")
     parser.add_argument('--epoch', type=int, default=42,
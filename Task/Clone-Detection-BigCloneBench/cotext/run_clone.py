@@ -30,7 +30,7 @@ from io import open
 from tqdm import tqdm
 import torch
 from torch.utils.tensorboard import SummaryWriter
-from torch.utils.data import DataLoader, SequentialSampler, RandomSampler
+from torch.utils.data import DataLoader, Dataset
 from torch.utils.data.distributed import DistributedSampler
 from transformers import (AdamW, get_linear_schedule_with_warmup,
                           RobertaConfig, RobertaModel, RobertaTokenizer,
@@ -45,6 +45,7 @@ import sentencepiece as spm
 from configs import add_args, set_seed
 from utils import get_filenames, get_elapse_time, load_and_cache_clone_data
 from models import get_model_size
+from dynamic_padding import PadCollate, bucketed_dataloader, restore_order, sequence_lengths
 
 MODEL_CLASSES = {'roberta': (RobertaConfig, RobertaModel, RobertaTokenizer),
                  't5': (T5Config, T5ForConditionalGeneration, T5Tokenizer),
@@ -59,9 +60,39 @@ logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message
 logger = logging.getLogger(__name__)
 
 
-def evaluate(args, model, eval_examples, eval_data, write_to_pred=False):
-    eval_sampler = SequentialSampler(eval_data)
-    eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.eval_batch_size)
+class PairHalves(Dataset):
+    """Cached clone pairs (two max_source_length halves side by side), as (ids1, ids2, label) items."""
+
+    def __init__(self, data, half_length):
+        self.data = data
+        self.half_length = half_length
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        source_ids, label = self.data[index]
+        return source_ids[:self.half_length], source_ids[self.half_length:], label
+
+
+def pair_dataloader(args, data, pad_id, batch_size, shuffle):
+    """DataLoader over the halves of the cached pairs, by length unless --no_length_bucketing.
+
+    The cache keeps its fixed-width padded columns; every batch is cut to its longest half.
+    """
+    dataset = PairHalves(data, args.max_source_length)
+    collate_fn = PadCollate([pad_id, pad_id, None])
+    if args.local_rank != -1 and shuffle:
+        return DataLoader(dataset, sampler=DistributedSampler(dataset), batch_size=batch_size, collate_fn=collate_fn)
+    ids = data.columns[0]
+    lengths = np.maximum(sequence_lengths(ids[:, :args.max_source_length], pad_id),
+                         sequence_lengths(ids[:, args.max_source_length:], pad_id))
+    return bucketed_dataloader(dataset, lengths, batch_size, shuffle=shuffle,
+                               bucketing=not args.no_length_bucketing, collate_fn=collate_fn)
+
+
+def evaluate(args, model, eval_examples, eval_data, pad_id, write_to_pred=False):
+    eval_dataloader = pair_dataloader(args, eval_data, pad_id, args.eval_batch_size, shuffle=False)
 
     # Eval!
     logger.info("***** Running evaluation  *****")
@@ -74,15 +105,17 @@ def evaluate(args, model, eval_examples, eval_data, write_to_pred=False):
     y_trues = []
     for batch in tqdm(eval_dataloader, total=len(eval_dataloader), desc="Evaluating"):
         batch = tuple(t.to(args.device) for t in batch)
-        inputs, labels = batch
+        # both sides of every pair, B * 2 * L
+        inputs, labels = torch.stack(batch[:2], 1), batch[2]
         with torch.no_grad():
             lm_loss, logit = model(inputs, labels)
             eval_loss += lm_loss.mean().item()
             logits.append(logit.cpu().numpy())
             y_trues.append(labels.cpu().numpy())
         nb_eval_steps += 1
-    logits = np.concatenate(logits, 0)
-    y_trues = np.concatenate(y_trues, 0)
+    # batches come sorted by length, back to the order of the examples
+    logits = restore_order(eval_dataloader, np.concatenate(logits, 0))
+    y_trues = restore_order(eval_dataloader, np.concatenate(y_trues, 0))
     best_threshold = 0.5
 
     y_preds = logits[:, 1] > best_threshold
@@ -140,6 +173,7 @@ def main():
     tokenizer = spm.SentencePieceProcessor(model_file=args.tokenizer_path)
 
     model = CloneModel(model, config, tokenizer, args)
+    pad_id = tokenizer.piece_to_id("<pad>")
     logger.info("Finish loading model [%s] from %s", get_model_size(model), args.model_name_or_path)
 
     if args.load_model_path is not None:
@@ -163,11 +197,7 @@ def main():
         # Prepare training data loader
         train_examples, train_data = load_and_cache_clone_data(args, args.train_filename, pool, tokenizer, 'train',
                                                                is_sample=True)
-        if args.local_rank == -1:
-            train_sampler = RandomSampler(train_data)
-        else:
-            train_sampler = DistributedSampler(train_data)
-        train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=args.train_batch_size)
+        train_dataloader = pair_dataloader(args, train_data, pad_id, args.train_batch_size, shuffle=True)
 
         num_train_optimization_steps = args.num_train_epochs * len(train_dataloader)
         save_steps = max(len(train_dataloader) // 5, 1)
@@ -205,7 +235,7 @@ def main():
             model.train()
             for step, batch in enumerate(bar):
                 batch = tuple(t.to(device) for t in batch)
-                source_ids, labels = batch
+                source_ids, labels = torch.stack(batch[:2], 1), batch[2]
                 # pdb.set_trace()
 
                 loss, logits = model(source_ids, labels)
@@ -237,7 +267,7 @@ def main():
                     eval_examples, eval_data = load_and_cache_clone_data(args, args.dev_filename, pool, tokenizer,
                                                                          'valid', is_sample=True)
 
-                    result = evaluate(args, model, eval_examples, eval_data)
+                    result = evaluate(args, model, eval_examples, eval_data, pad_id)
                     eval_f1 = result['eval_f1']
 
                     if args.data_num == -1:
@@ -307,7 +337,7 @@ def main():
             eval_examples, eval_data = load_and_cache_clone_data(args, args.test_filename, pool, tokenizer, 'test',
                                                                  False)
 
-            result = evaluate(args, model, eval_examples, eval_data, write_to_pred=True)
+            result = evaluate(args, model, eval_examples, eval_data, pad_id, write_to_pred=True)
             logger.info("  test_f1=%.4f", result['eval_f1'])
             logger.info("  test_prec=%.4f", result['eval_precision'])
             logger.info("  test_rec=%.4f", result['eval_recall'])
@@ -0,0 +1,180 @@
+"""
+Compact graph-guided attention masks for GraphCodeBERT.
+
+Every example used to carry a dense (code_length+data_flow_length)^2 boolean mask
+filled with Python loops. Instead, each example keeps a `DFGGraph` (a few int32
+arrays describing its data flow) and the collate function expands a whole batch
+into one boolean tensor with vectorized indexing.
+
+With `packed=True` the collate function returns a `GraphAttnMask` instead of the
+dense tensor. It moves to the device like a tensor and the model expands it there,
+so the host never materializes B x L x L masks.
+
+With `trim=True` the batch is cut to its longest non-padding sequence, so the
+encoder never attends over columns that are padding in every example.
+
+The pattern is the one from the GraphCodeBERT paper:
+    - code tokens attend to code tokens
+    - special tokens (<s>, </s>) attend to every non-padding position
+    - a DFG node and the code tokens it was identified from attend to each other
+    - a DFG node attends to the nodes its value comes from
+"""
+
+import numpy as np
+import torch
+from torch.utils.data.dataloader import default_collate
+
+
+class DFGGraph(object):
+    """Graph-guided attention pattern of one sequence, stored as int32 arrays."""
+    __slots__ = ('length', 'node_index', 'max_length', 'special', 'code_spans', 'node_edges')
+
+    def __init__(self, length, node_index, max_length, special, code_spans, node_edges):
+        self.length = length
+        self.node_index = node_index
+        self.max_length = max_length
+        #positions of <s>/</s> tokens, shape (S,)
+        self.special = special
+        #(node row, first code token, end code token), shape (M, 3)
+        self.code_spans = code_spans
+        #(node row, source node column), shape (E, 2)
+        self.node_edges = node_edges
+
+    @classmethod
+    def from_features(cls, input_ids, position_idx, dfg_to_code, dfg_to_dfg):
+        input_ids = np.asarray(input_ids)
+        position_idx = np.asarray(position_idx)
+        length = len(position_idx)
+        #begin index of nodes and max length of input
+        node_index = int(np.count_nonzero(position_idx > 1))
+        max_length = int(np.count_nonzero(position_idx != 1))
+        special = np.flatnonzero((input_ids == 0) | (input_ids == 2)).astype(np.int32)
+
+        spans = np.asarray(dfg_to_code, dtype=np.int32).reshape(-1, 2)
+        rows = np.arange(len(spans), dtype=np.int32) + node_index
+        keep = (spans[:, 0] < node_index) & (spans[:, 1] < node_index)
+        code_spans = np.column_stack([rows[keep], spans[keep]]).astype(np.int32)
+
+        degrees = [len(nodes) for nodes in dfg_to_dfg]
+        src = np.repeat(np.arange(len(dfg_to_dfg), dtype=np.int32), degrees) + node_index
+        dst = np.fromiter((a for nodes in dfg_to_dfg for a in nodes), dtype=np.int32,
+                          count=sum(degrees)) + node_index
+        keep = dst < length
+        node_edges = np.column_stack([src[keep], dst[keep]]).astype(np.int32)
+        return cls(length, node_index, max_length, special, code_spans, node_edges)
+
+
+def _batch_column(arrays, width):
+    """Concatenate per-graph index arrays, prefixing each row with its graph number."""
+    sizes = [len(x) for x in arrays]
+    if sum(sizes) == 0:
+        return torch.zeros((0, width + 1), dtype=torch.long)
+    graph = np.repeat(np.arange(len(arrays)), sizes)
+    rows = np.concatenate([x.reshape(-1, width) for x in arrays])
+    return torch.from_numpy(np.column_stack([graph, rows]).astype(np.int64))
+
+
+class GraphAttnMask(object):
+    """Packed graph-guided attention masks of N sequences of length L.
+
+    Behaves like a tensor for `.to()`/`.pin_memory()`; `dense()` expands it into
+    the (N, L, L) boolean mask on whatever device it lives on.
+    """
+
+    def __init__(self, length, node_index, max_length, special, code_spans, node_edges):
+        self.length = length
+        self.node_index = node_index
+        self.max_length = max_length
+        self.special = special
+        self.code_spans = code_spans
+        self.node_edges = node_edges
+
+    @classmethod
+    def from_graphs(cls, graphs, length=None):
+        """Masks of `graphs`, cut to the first `length` positions if given (at least every max_length)."""
+        assert all(g.length == graphs[0].length for g in graphs)
+        if length is None:
+            length = graphs[0].length
+        assert all(g.max_length <= length for g in graphs)
+        return cls(length,
+                   torch.tensor([g.node_index for g in graphs]),
+                   torch.tensor([g.max_length for g in graphs]),
+                   _batch_column([g.special for g in graphs], 1),
+                   _batch_column([g.code_spans for g in graphs], 3),
+                   _batch_column([g.node_edges for g in graphs], 2))
+
+    def _apply(self, fn):
+        return GraphAttnMask(self.length, fn(self.node_index), fn(self.max_length),
+                             fn(self.special), fn(self.code_spans), fn(self.node_edges))
+
+    def to(self, *args, **kwargs):
+        return self._apply(lambda x: x.to(*args, **kwargs))
+
+    def pin_memory(self):
+        return self._apply(lambda x: x.pin_memory())
+
+    def __len__(self):
+        return len(self.node_index)
+
+    def dense(self):
+        n, length = len(self), self.length
+        device = self.node_index.device
+        seq = torch.arange(length, device=device)
+        #sequence can attend to sequence
+        in_code = seq[None, :] < self.node_index[:, None]
+        attn_mask = in_code[:, :, None] & in_code[:, None, :]
+        #special tokens attend to all tokens
+        special_rows = torch.zeros((n, length), dtype=torch.bool, device=device)
+        special_rows[self.special[:, 0], self.special[:, 1]] = True
+        attn_mask |= special_rows[:, :, None] & (seq[None, :] < self.max_length[:, None])[:, None, :]
+        #nodes attend to code tokens that are identified from, and vice versa
+        start = torch.zeros((n, length), dtype=torch.long, device=device)
+        end = torch.zeros((n, length), dtype=torch.long, device=device)
+        graph, row = self.code_spans[:, 0], self.code_spans[:, 1]
+        start[graph, row] = self.code_spans[:, 2]
+        end[graph, row] = self.code_spans[:, 3]
+        spans = (seq[None, None, :] >= start[:, :, None]) & (seq[None, None, :] < end[:, :, None])
+        attn_mask |= spans | spans.transpose(1, 2)
+        #nodes attend to adjacent nodes
+        attn_mask[self.node_edges[:, 0], self.node_edges[:, 1], self.node_edges[:, 2]] = True
+        return attn_mask
+
+
+def collate_graph_batch(batch, packed=False, trim=False):
+    """`default_collate` that turns DFGGraph fields into batched attention masks.
+
+    A field holding one DFGGraph per example becomes a (B, L, L) mask; a field
+    holding a tuple of k graphs per example (e.g. both sides of a clone pair)
+    becomes (B, k, L, L). With `packed=True` a flat GraphAttnMask over the B*k
+    sequences is returned instead.
+
+    With `trim=True`, L is cut to the largest max_length of the batch, and so is the
+    last dimension of every other (B, ..., L) field (input ids, position ids).
+    """
+    graph_fields = {}
+    for i, field in enumerate(zip(*batch)):
+        if isinstance(field[0], DFGGraph):
+            graph_fields[i] = list(field), (len(field),)
+        elif isinstance(field[0], (tuple, list)) and isinstance(field[0][0], DFGGraph):
+            graph_fields[i] = [g for x in field for g in x], (len(field), len(field[0]))
+    full_length = length = None
+    if trim and graph_fields:
+        all_graphs = [g for graphs, _ in graph_fields.values() for g in graphs]
+        full_length = all_graphs[0].length
+        length = max(1, max(g.max_length for g in all_graphs))
+
+    fields = []
+    for i, field in enumerate(zip(*batch)):
+        if i not in graph_fields:
+            field = default_collate(field)
+            if length is not None and isinstance(field, torch.Tensor) and field.dim() >= 2 \
+                    and field.size(-1) == full_length:
+                field = field[..., :length].contiguous()
+            fields.append(field)
+            continue
+        graphs, shape = graph_fields[i]
+        attn_mask = GraphAttnMask.from_graphs(graphs, length)
+        if not packed:
+            attn_mask = attn_mask.dense().view(*shape, attn_mask.length, attn_mask.length)
+        fields.append(attn_mask)
+    return fields
@@ -7,6 +7,7 @@ from torch.autograd import Variable
 import copy
 import torch.nn.functional as F
 from torch.nn import CrossEntropyLoss, MSELoss
+from graph_mask import GraphAttnMask
 
 class RobertaClassificationHead(nn.Module):
     """Head for sentence-level classification tasks."""
@@ -38,14 +39,12 @@ class Model(nn.Module):
     
         
     def forward(self, input_ids=None,position_idx=None,attn_mask=None,labels=None): 
-        assert input_ids.size(-1) % 2 == 0
-        assert position_idx.size(-1) % 2 == 0
-        assert attn_mask.size(-1) % 2 == 0
-
-        input_ids=input_ids.view(-1,input_ids.size(-1)//2) # 2B * L
-        position_idx=position_idx.view(-1,position_idx.size(-1)//2) # 2B * L
-        attn_mask=attn_mask.view(-1,attn_mask.size(1)//2,attn_mask.size(2),attn_mask.size(3))
-        attn_mask = attn_mask.squeeze(1) # 2B * L * L
+        input_ids=input_ids.view(-1,input_ids.size(-1)) # 2B * L
+        position_idx=position_idx.view(-1,position_idx.size(-1)) # 2B * L
+        if isinstance(attn_mask,GraphAttnMask):
+            attn_mask=attn_mask.dense() # 2B * L * L
+        else:
+            attn_mask=attn_mask.view(-1,attn_mask.size(-2),attn_mask.size(-1)) # 2B * L * L
 
         nodes_mask=position_idx.eq(0)
         token_mask=position_idx.ge(2)        
@@ -29,10 +29,9 @@ import pickle
 import random
 import re
 import shutil
-import json
 import numpy as np
 import torch
-from torch.utils.data import DataLoader, Dataset, SequentialSampler, RandomSampler,TensorDataset
+from torch.utils.data import DataLoader, Dataset,TensorDataset
 from torch.utils.data.distributed import DistributedSampler
 
 try:
@@ -43,6 +42,11 @@ except:
 from tqdm import tqdm, trange
 import multiprocessing
 from model import Model
+from threshold_sweep import GRID_THRESHOLDS, best_f1_threshold
+from feature_store import load_or_build_feature_store
+from graph_mask import DFGGraph, collate_graph_batch
+from dynamic_padding import bucketed_dataloader, restore_order
+from functools import partial
 
 cpu_cont = 16
 from transformers import (WEIGHTS_NAME, AdamW, get_linear_schedule_with_warmup,
@@ -124,18 +128,54 @@ def extract_dataflow(code, parser,lang):
         dfg=[]
     return code_tokens,dfg
 
-def get_example(item):
-    url1,url2,label,tokenizer,args,cache,url_to_code=item
-    try:
-        code1=' '.join(url_to_code[url1].split())
-    except:
-        code1=""
-    try:
-        code2=' '.join(url_to_code[url2].split())
-    except:
-        code2=""
-        
-    return convert_examples_to_features(code1,code2,label,url1,url2,tokenizer,args,cache)
+def featurize_function(code,tokenizer,args):
+    """Parse, tokenize and extract the data flow of one function."""
+    #extract data flow
+    code_tokens,dfg=extract_dataflow(code,parsers['java'],'java')
+    code_tokens=[tokenizer.tokenize('@ '+x)[1:] if idx!=0 else tokenizer.tokenize(x) for idx,x in enumerate(code_tokens)]
+    ori2cur_pos={}
+    ori2cur_pos[-1]=(0,0)
+    for i in range(len(code_tokens)):
+        ori2cur_pos[i]=(ori2cur_pos[i-1][1],ori2cur_pos[i-1][1]+len(code_tokens[i]))    
+    code_tokens=[y for x in code_tokens for y in x]  
+    
+    #truncating
+    code_tokens=code_tokens[:args.code_length+args.data_flow_length-3-min(len(dfg),args.data_flow_length)][:512-3]
+    source_tokens =[tokenizer.cls_token]+code_tokens+[tokenizer.sep_token]
+    source_ids =  tokenizer.convert_tokens_to_ids(source_tokens)
+    position_idx = [i+tokenizer.pad_token_id + 1 for i in range(len(source_tokens))]
+    dfg=dfg[:args.code_length+args.data_flow_length-len(source_tokens)]
+    source_tokens+=[x[0] for x in dfg]
+    position_idx+=[0 for x in dfg]
+    source_ids+=[tokenizer.unk_token_id for x in dfg]
+    padding_length=args.code_length+args.data_flow_length-len(source_ids)
+    position_idx+=[tokenizer.pad_token_id]*padding_length
+    source_ids+=[tokenizer.pad_token_id]*padding_length      
+    
+    #reindex
+    reverse_index={}
+    for idx,x in enumerate(dfg):
+        reverse_index[x[1]]=idx
+    for idx,x in enumerate(dfg):
+        dfg[idx]=x[:-1]+([reverse_index[i] for i in x[-1] if i in reverse_index],)    
+    dfg_to_dfg=[x[-1] for x in dfg]
+    dfg_to_code=[ori2cur_pos[x[1]] for x in dfg]
+    length=len([tokenizer.cls_token])
+    dfg_to_code=[(x[0]+length,x[1]+length) for x in dfg_to_code]        
+    return {'input_tokens':source_tokens,'input_ids':source_ids,'position_idx':position_idx,
+            'dfg_to_code':dfg_to_code,'dfg_to_dfg':dfg_to_dfg}
+
+
+class InputExample(object):
+    """A single (url1, url2) pair, resolved against the feature store on access."""
+    def __init__(self,
+                 url1,
+                 url2,
+                 label
+    ):
+        self.url1=url1
+        self.url2=url2
+        self.label=label
 
 
 class InputFeatures(object):
@@ -171,75 +211,11 @@ class InputFeatures(object):
         self.dfg_to_code2=dfg_to_code2
         self.dfg_to_dfg2=dfg_to_dfg2
         
-def convert_examples_to_features(code1,code2,label,url1,url2,tokenizer,args,cache):
-    #extract data flow
-    code_tokens,dfg=extract_dataflow(code1,parsers['java'],'java')
-    code_tokens=[tokenizer.tokenize('@ '+x)[1:] if idx!=0 else tokenizer.tokenize(x) for idx,x in enumerate(code_tokens)]
-    ori2cur_pos={}
-    ori2cur_pos[-1]=(0,0)
-    for i in range(len(code_tokens)):
-        ori2cur_pos[i]=(ori2cur_pos[i-1][1],ori2cur_pos[i-1][1]+len(code_tokens[i]))    
-    code_tokens=[y for x in code_tokens for y in x]  
-    
-    #truncating
-    code_tokens=code_tokens[:args.code_length+args.data_flow_length-3-min(len(dfg),args.data_flow_length)][:512-3]
-    code1_tokens =[tokenizer.cls_token]+code_tokens+[tokenizer.sep_token]
-    code1_ids =  tokenizer.convert_tokens_to_ids(code1_tokens)
-    position1_idx = [i+tokenizer.pad_token_id + 1 for i in range(len(code1_tokens))]
-    dfg=dfg[:args.code_length+args.data_flow_length-len(code1_tokens)]
-    code1_tokens+=[x[0] for x in dfg]
-    position1_idx+=[0 for x in dfg]
-    code1_ids+=[tokenizer.unk_token_id for x in dfg]
-    padding_length=args.code_length+args.data_flow_length-len(code1_ids)
-    position1_idx+=[tokenizer.pad_token_id]*padding_length
-    code1_ids+=[tokenizer.pad_token_id]*padding_length      
-    
-    #reindex
-    reverse_index={}
-    for idx,x in enumerate(dfg):
-        reverse_index[x[1]]=idx
-    for idx,x in enumerate(dfg):
-        dfg[idx]=x[:-1]+([reverse_index[i] for i in x[-1] if i in reverse_index],)    
-    dfg_to_dfg1=[x[-1] for x in dfg]
-    dfg_to_code1=[ori2cur_pos[x[1]] for x in dfg]
-    length=len([tokenizer.cls_token])
-    dfg_to_code1=[(x[0]+length,x[1]+length) for x in dfg_to_code1]        
-
-    #extract data flow
-    code_tokens,dfg=extract_dataflow(code2,parser,'java')
-    code_tokens=[tokenizer.tokenize('@ '+x)[1:] if idx!=0 else tokenizer.tokenize(x) for idx,x in enumerate(code_tokens)]
-    ori2cur_pos={}
-    ori2cur_pos[-1]=(0,0)
-    for i in range(len(code_tokens)):
-        ori2cur_pos[i]=(ori2cur_pos[i-1][1],ori2cur_pos[i-1][1]+len(code_tokens[i]))    
-    code_tokens=[y for x in code_tokens for y in x]  
-    
-    #truncating
-    code_tokens=code_tokens[:args.code_length+args.data_flow_length-3-min(len(dfg),args.data_flow_length)][:512-3]
-    code2_tokens =[tokenizer.cls_token]+code_tokens+[tokenizer.sep_token]
-    code2_ids =  tokenizer.convert_tokens_to_ids(code2_tokens)
-    position2_idx = [i+tokenizer.pad_token_id + 1 for i in range(len(code2_tokens))]
-    dfg=dfg[:args.code_length+args.data_flow_length-len(code2_tokens)]
-    code2_tokens+=[x[0] for x in dfg]
-    position2_idx+=[0 for x in dfg]
-    code2_ids+=[tokenizer.unk_token_id for x in dfg]
-    padding_length=args.code_length+args.data_flow_length-len(code2_ids)
-    position2_idx+=[tokenizer.pad_token_id]*padding_length
-    code2_ids+=[tokenizer.pad_token_id]*padding_length      
-    
-    #reindex
-    reverse_index={}
-    for idx,x in enumerate(dfg):
-        reverse_index[x[1]]=idx
-    for idx,x in enumerate(dfg):
-        dfg[idx]=x[:-1]+([reverse_index[i] for i in x[-1] if i in reverse_index],)    
-    dfg_to_dfg2=[x[-1] for x in dfg]
-    dfg_to_code2=[ori2cur_pos[x[1]] for x in dfg]
-    length=len([tokenizer.cls_token])
-    dfg_to_code2=[(x[0]+length,x[1]+length) for x in dfg_to_code2]        
-
-    return InputFeatures(code1_tokens,code1_ids,position1_idx,dfg_to_code1,dfg_to_dfg1,
-                         code2_tokens,code2_ids,position2_idx,dfg_to_code2,dfg_to_dfg2,
+def convert_examples_to_features(feature1,feature2,label,url1,url2):
+    return InputFeatures(feature1['input_tokens'],feature1['input_ids'],feature1['position_idx'],
+                         feature1['dfg_to_code'],feature1['dfg_to_dfg'],
+                         feature2['input_tokens'],feature2['input_ids'],feature2['position_idx'],
+                         feature2['dfg_to_code'],feature2['dfg_to_dfg'],
                          label,url1,url2)
 
 class TextDataset(Dataset):
@@ -249,97 +225,57 @@ class TextDataset(Dataset):
         self.examples = []
         index_filename=file_path
         logger.info("Creating features from index file at %s ", index_filename)
-        url_to_code={}
-        with open('/'.join(index_filename.split('/')[:-1])+'/{}/data.jsonl'.format(args.test_type)) as f:
-            for line in f:
-                line=line.strip()
-                js=json.loads(line)
-                url_to_code[js['idx']]=js['func']
+        data_file='/'.join(index_filename.split('/')[:-1])+'/{}/data.jsonl'.format(args.test_type)
+        signature='graphcodebert|{}|{}|{}|{}'.format(type(tokenizer).__name__,args.tokenizer_name,
+                                                      args.code_length,args.data_flow_length)
+        self.features=load_or_build_feature_store(data_file,featurize_function,tokenizer,args,signature,pool=pool)
+        #compact graph-guided attention masks, expanded per batch by collate_graph_batch
+        self.graphs={}
+        for url,feature in self.features.items():
+            self.graphs[url]=DFGGraph.from_features(feature['input_ids'],feature['position_idx'],
+                                                    feature['dfg_to_code'],feature['dfg_to_dfg'])
 
         data=[]
-        cache={}
-        f=open(index_filename)
         with open(index_filename) as f:
             for line in f:
                 line=line.strip()
                 url1,url2,label=line.split('\t')
-                if url1 not in url_to_code or url2 not in url_to_code:
+                if url1 not in self.features or url2 not in self.features:
                     continue
                 if label=='0':
                     label=0
                 else:
                     label=1
-                data.append((url1,url2,label,tokenizer, args,cache,url_to_code))
+                data.append(InputExample(url1,url2,label))
         if 'test' not in postfix:
             data=random.sample(data,int(len(data)*0.1))
 
-        self.examples=pool.map(get_example,tqdm(data,total=len(data)))
+        self.examples=data
+        #a pair is as long as its longest side, batches are trimmed to it by collate_graph_batch
+        self.lengths=[max(self.graphs[e.url1].max_length,self.graphs[e.url2].max_length) for e in self.examples]
         if 'train' in postfix:
-            for idx, example in enumerate(self.examples[:3]):
+            for idx in range(min(3,len(self.examples))):
+                    example=self.get_pair(idx)
                     logger.info("*** Example ***")
                     logger.info("idx: {}".format(idx))
                     logger.info("label: {}".format(example.label))
                     logger.info("input_tokens: {}".format([x.replace('\u0120','_') for x in example.input_tokens1]))
                     logger.info("input_ids: {}".format(' '.join(map(str, example.input_ids1))))
 
-    def get_feature(self, example):
-        #calculate graph-guided masked function
-        attn_mask1= np.zeros((self.args.code_length+self.args.data_flow_length,
-                        self.args.code_length+self.args.data_flow_length),dtype=bool)
-        #calculate begin index of node and max length of input
-        node_index=sum([i>1 for i in example.position_idx1])
-        max_length=sum([i!=1 for i in example.position_idx1])
-        #sequence can attend to sequence
-        attn_mask1[:node_index,:node_index]=True
-        #special tokens attend to all tokens
-        for idx,i in enumerate(example.input_ids1):
-            if i in [0,2]:
-                attn_mask1[idx,:max_length]=True
-        #nodes attend to code tokens that are identified from
-        for idx,(a,b) in enumerate(example.dfg_to_code1):
-            if a<node_index and b<node_index:
-                attn_mask1[idx+node_index,a:b]=True
-                attn_mask1[a:b,idx+node_index]=True
-        #nodes attend to adjacent nodes 
-        for idx,nodes in enumerate(example.dfg_to_dfg1):
-            for a in nodes:
-                if a+node_index<len(example.position_idx1):
-                    attn_mask1[idx+node_index,a+node_index]=True  
-                    
-        #calculate graph-guided masked function
-        attn_mask2= np.zeros((self.args.code_length+self.args.data_flow_length,
-                        self.args.code_length+self.args.data_flow_length),dtype=bool)
-        #calculate begin index of node and max length of input
-        node_index=sum([i>1 for i in example.position_idx2])
-        max_length=sum([i!=1 for i in example.position_idx2])
-        #sequence can attend to sequence
-        attn_mask2[:node_index,:node_index]=True
-        #special tokens attend to all tokens
-        for idx,i in enumerate(example.input_ids2):
-            if i in [0,2]:
-                attn_mask2[idx,:max_length]=True
-        #nodes attend to code tokens that are identified from
-        for idx,(a,b) in enumerate(example.dfg_to_code2):
-            if a<node_index and b<node_index:
-                attn_mask2[idx+node_index,a:b]=True
-                attn_mask2[a:b,idx+node_index]=True
-        #nodes attend to adjacent nodes 
-        for idx,nodes in enumerate(example.dfg_to_dfg2):
-            for a in nodes:
-                if a+node_index<len(example.position_idx2):
-                    attn_mask2[idx+node_index,a+node_index]=True  
-
-        return torch.tensor(example.input_ids1+example.input_ids2),\
-               torch.tensor(example.position_idx1+example.position_idx2),\
-               torch.tensor([attn_mask1.tolist(), attn_mask2.tolist()]),\
-               torch.tensor(example.label)
+    def get_pair(self, item):
+        example=self.examples[item]
+        return convert_examples_to_features(self.features[example.url1],self.features[example.url2],
+                                            example.label,example.url1,example.url2)
 
     def __len__(self):
         return len(self.examples)
 
     def __getitem__(self, item):
-        
-        return self.get_feature(self.examples[item])
+        example=self.get_pair(item)
+        return torch.tensor([example.input_ids1,example.input_ids2]),\
+               torch.tensor([example.position_idx1,example.position_idx2]),\
+               (self.graphs[example.url1],self.graphs[example.url2]),\
+               torch.tensor(example.label)
 
 
 def load_and_cache_examples(args, tokenizer, evaluate=False,test=False,pool=None):
@@ -358,9 +294,13 @@ def train(args, train_dataset, model, tokenizer,pool):
     """ Train the model """
 
     args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
-    train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
-    
-    train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.train_batch_size)
+    collate_fn=partial(collate_graph_batch,packed=args.packed_graph_mask,trim=True)
+    if args.local_rank == -1:
+        train_dataloader = bucketed_dataloader(train_dataset, train_dataset.lengths, args.train_batch_size, shuffle=True,
+                                               bucketing=not args.no_length_bucketing, collate_fn=collate_fn)
+    else:
+        train_dataloader = DataLoader(train_dataset, sampler=DistributedSampler(train_dataset), batch_size=args.train_batch_size,
+                                      collate_fn=collate_fn)
     args.max_steps=args.epoch*len( train_dataloader)
     args.save_steps=len( train_dataloader)
     args.warmup_steps=len( train_dataloader)
@@ -501,8 +441,14 @@ def evaluate(args, model, tokenizer, prefix="",pool=None,eval_when_training=Fals
 
     args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
     # Note that DistributedSampler samples randomly
-    eval_sampler = SequentialSampler(eval_dataset) if args.local_rank == -1 else DistributedSampler(eval_dataset)
-    eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size,num_workers=4,pin_memory=True)
+    collate_fn=partial(collate_graph_batch,packed=args.packed_graph_mask,trim=True)
+    if args.local_rank == -1:
+        eval_dataloader = bucketed_dataloader(eval_dataset, eval_dataset.lengths, args.eval_batch_size, shuffle=False,
+                                              bucketing=not args.no_length_bucketing, collate_fn=collate_fn,
+                                              num_workers=4,pin_memory=True)
+    else:
+        eval_dataloader = DataLoader(eval_dataset, sampler=DistributedSampler(eval_dataset), batch_size=args.eval_batch_size,
+                                     num_workers=4,pin_memory=True,collate_fn=collate_fn)
 
     # multi-gpu evaluate
     if args.n_gpu > 1 and eval_when_training is False:
@@ -528,30 +474,14 @@ def evaluate(args, model, tokenizer, prefix="",pool=None,eval_when_training=Fals
             logits.append(logit.cpu().numpy())
             y_trues.append(labels.cpu().numpy())
         nb_eval_steps += 1
-    logits=np.concatenate(logits,0)
-    y_trues=np.concatenate(y_trues,0)
-    best_threshold=0
-    best_f1=0
-    for i in range(1,100):
-        threshold=i/100
-        y_preds=logits[:,1]>threshold
-        from sklearn.metrics import recall_score
-        recall=recall_score(y_trues, y_preds, average='macro')
-        from sklearn.metrics import precision_score
-        precision=precision_score(y_trues, y_preds, average='macro')   
-        from sklearn.metrics import f1_score
-        f1=f1_score(y_trues, y_preds, average='macro') 
-        if f1>best_f1:
-            best_f1=f1
-            best_threshold=threshold
-
-    y_preds=logits[:,1]>best_threshold
-    from sklearn.metrics import recall_score
-    recall=recall_score(y_trues, y_preds, average='macro')
-    from sklearn.metrics import precision_score
-    precision=precision_score(y_trues, y_preds, average='macro')   
-    from sklearn.metrics import f1_score
-    f1=f1_score(y_trues, y_preds, average='macro')             
+    #batches come sorted by length, back to the order of the examples
+    logits=restore_order(eval_dataloader,np.concatenate(logits,0))
+    y_trues=restore_order(eval_dataloader,np.concatenate(y_trues,0))
+    #macro precision/recall/F1 at every threshold from one sort of the scores
+    thresholds=GRID_THRESHOLDS if args.threshold_search=='grid' else None
+    best,_=best_f1_threshold(logits[:,1],y_trues,thresholds)
+    best_threshold=best['threshold']
+    recall,precision,f1=best['recall'],best['precision'],best['f1']
     result = {
         "eval_recall": float(recall),
         "eval_precision": float(precision),
@@ -573,8 +503,13 @@ def test(args, model, tokenizer, prefix="",pool=None,best_threshold=0):
 
     args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
     # Note that DistributedSampler samples randomly
-    eval_sampler = SequentialSampler(eval_dataset) if args.local_rank == -1 else DistributedSampler(eval_dataset)
-    eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size,num_workers=1)
+    collate_fn=partial(collate_graph_batch,packed=args.packed_graph_mask,trim=True)
+    if args.local_rank == -1:
+        eval_dataloader = bucketed_dataloader(eval_dataset, eval_dataset.lengths, args.eval_batch_size, shuffle=False,
+                                              bucketing=not args.no_length_bucketing, collate_fn=collate_fn, num_workers=1)
+    else:
+        eval_dataloader = DataLoader(eval_dataset, sampler=DistributedSampler(eval_dataset), batch_size=args.eval_batch_size,
+                                     num_workers=1,collate_fn=collate_fn)
 
     # multi-gpu evaluate
     if args.n_gpu > 1:
@@ -600,8 +535,9 @@ def test(args, model, tokenizer, prefix="",pool=None,best_threshold=0):
             logits.append(logit.cpu().numpy())
             y_trues.append(labels.cpu().numpy())
         nb_eval_steps += 1
-    logits=np.concatenate(logits,0)
-    y_trues=np.concatenate(y_trues,0)
+    #batches come sorted by length, back to the order of the examples
+    logits=restore_order(eval_dataloader,np.concatenate(logits,0))
+    y_trues=restore_order(eval_dataloader,np.concatenate(y_trues,0))
     y_preds=logits[:,1]>best_threshold
     with open(os.path.join(args.output_dir,"predictions.txt"),'w') as f:
         for example,pred in zip(eval_dataset.examples,y_preds):
@@ -711,6 +647,8 @@ def main():
                         help="Overwrite the content of the output directory")
     parser.add_argument('--overwrite_cache', action='store_true',
                         help="Overwrite the cached training and evaluation sets")
+    parser.add_argument('--threshold_search', default='grid', choices=['grid', 'exact'],
+                        help="Pick the evaluation threshold on the 0.01..0.99 grid, or exactly over every distinct score.")
     parser.add_argument('--seed', type=int, default=42,
                         help="random seed for initialization")
     parser.add_argument('--epoch', type=int, default=42,
@@ -724,6 +662,10 @@ def main():
                         help="For distributed training: local_rank")
     parser.add_argument('--server_ip', type=str, default='', help="For distant debugging.")
     parser.add_argument('--server_port', type=str, default='', help="For distant debugging.")
+    parser.add_argument('--packed_graph_mask', action='store_true',
+                        help="Send packed DFG graphs to the model and expand the graph-guided attention mask on device.")
+    parser.add_argument('--no_length_bucketing', action='store_true',
+                        help="Batch pairs in random/sequential order instead of by length (still trimmed per batch).")
     parser.add_argument("--test_type", default="", type=str,)
 
     
@@ -750,6 +692,9 @@ def main():
         torch.distributed.init_process_group(backend='nccl')
         args.n_gpu = 1
     args.device = device
+    if args.packed_graph_mask and args.n_gpu > 1 and args.local_rank == -1:
+        # DataParallel cannot scatter a packed mask across replicas
+        args.packed_graph_mask = False
     args.per_gpu_train_batch_size=args.train_batch_size//args.n_gpu
     args.per_gpu_eval_batch_size=args.eval_batch_size//args.n_gpu
     # Setup logging
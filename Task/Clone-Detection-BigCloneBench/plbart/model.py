@@ -38,8 +38,8 @@ class Model(nn.Module):
         
     def forward(self, input_ids=None,prev_tokens_ids=None,lengths=None,labels=None): 
         assert lengths.size(-1) % 2 == 0
-        input_ids=input_ids.view(-1,self.args.block_size)
-        prev_tokens_ids=prev_tokens_ids.view(-1,self.args.block_size)
+        input_ids=input_ids.view(-1,input_ids.size(-1))
+        prev_tokens_ids=prev_tokens_ids.view(-1,prev_tokens_ids.size(-1))
         lengths=lengths.view(-1,lengths.size(-1)//2)-1
         lengths=lengths.squeeze(-1)
 
@@ -0,0 +1,79 @@
+"""
+Precision/recall/F1 of a score threshold, swept over all thresholds at once.
+
+Picking the decision threshold used to loop over the 0.01..0.99 grid and call
+sklearn's recall_score, precision_score and f1_score at every point, i.e. about
+300 passes over the evaluation pairs. `f1_sweep` sorts the scores once; the
+confusion counts of `scores > t` at every threshold t then come from one
+searchsorted into cumulative label counts.
+
+With `thresholds=None` every distinct score is a candidate, so the optimum is
+exact over the observed scores. As on the grid, every candidate is finite: the
+lowest one is the lowest score, not -inf. `GRID_THRESHOLDS` gives the previous
+grid and selects the same threshold as the loop did.
+"""
+
+import numpy as np
+
+GRID_THRESHOLDS = np.arange(1, 100) / 100
+
+
+def _divide(a, b):
+    """a / b, 0 where b is 0 (sklearn's zero_division default, without the warning)."""
+    return np.divide(a, b, out=np.zeros(len(a), dtype=np.float64), where=b > 0)
+
+
+def f1_sweep(scores, labels, thresholds=None, average='macro'):
+    """Precision, recall and F1 of the predictions `scores > t` for every threshold t.
+
+    `average` is 'macro' (mean over the classes present in the labels or the
+    predictions, as in sklearn's average='macro') or 'binary' (positive class only).
+    Returns a dict of arrays aligned with the sorted thresholds: the PR curve.
+    """
+    scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+    labels = np.asarray(labels).reshape(-1).astype(bool)
+    order = np.argsort(scores, kind='stable')
+    sorted_scores = scores[order]
+    #positives among the i lowest scores
+    positives_below = np.concatenate([[0], np.cumsum(labels[order], dtype=np.int64)])
+    if thresholds is None:
+        #every distinct score, the lowest one (not -inf) being the lowest threshold
+        distinct = np.concatenate([sorted_scores[1:] != sorted_scores[:-1], [True]]) if len(scores) else []
+        thresholds = sorted_scores[distinct] if len(scores) else np.zeros(1)
+    thresholds = np.sort(np.asarray(thresholds, dtype=np.float64))
+
+    n, n_pos = len(scores), int(positives_below[-1])
+    #number of scores <= t, the others are predicted positive
+    below = np.searchsorted(sorted_scores, thresholds, side='right')
+    tp = n_pos - positives_below[below]
+    fp = (n - below) - tp
+    fn = n_pos - tp
+    tn = (n - n_pos) - fp
+
+    precision, recall, f1 = _divide(tp, tp + fp), _divide(tp, tp + fn), _divide(2 * tp, 2 * tp + fp + fn)
+    if average == 'macro':
+        #a class absent from both the labels and the predictions scores 0 and is not counted
+        num_classes = np.maximum((tp + fn + fp > 0).astype(np.int64) + (tn + fn + fp > 0), 1)
+        precision = (precision + _divide(tn, tn + fn)) / num_classes
+        recall = (recall + _divide(tn, tn + fp)) / num_classes
+        f1 = (f1 + _divide(2 * tn, 2 * tn + fn + fp)) / num_classes
+    elif average != 'binary':
+        raise ValueError("average must be 'macro' or 'binary', got {}".format(average))
+    return {'thresholds': thresholds, 'precision': precision, 'recall': recall, 'f1': f1}
+
+
+def best_f1_threshold(scores, labels, thresholds=None, average='macro'):
+    """(best, curve): the threshold with the highest F1 and its precision/recall/F1, and the full `f1_sweep`.
+
+    Ties go to the lowest threshold, like the strict `f1 > best_f1` of the grid loop.
+    If no threshold has a positive F1, the loop kept its initial threshold 0, and so
+    does this.
+    """
+    curve = f1_sweep(scores, labels, thresholds, average)
+    i = int(np.argmax(curve['f1']))
+    if curve['f1'][i] > 0:
+        best = {key: float(values[i]) for key, values in curve.items()}
+    else:
+        best = {key: float(values[0]) for key, values in f1_sweep(scores, labels, [0.0], average).items()}
+    best['threshold'] = best.pop('thresholds')
+    return best, curve
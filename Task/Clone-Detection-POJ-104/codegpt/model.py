@@ -7,6 +7,7 @@ from torch.autograd import Variable
 import copy
 import torch.nn.functional as F
 from torch.nn import CrossEntropyLoss, MSELoss
+from pk_batches import in_batch_contrastive_loss
 
 # Copied from transformers.models.bert.modeling_bert.BertPooler
 class Pooler(nn.Module):
@@ -34,12 +35,16 @@ class Model(nn.Module):
         
     def forward(self, input_ids=None,p_input_ids=None,n_input_ids=None,labels=None): 
         bs,_=input_ids.size()
-        input_ids=torch.cat((input_ids,p_input_ids,n_input_ids),0)
+        if p_input_ids is not None:
+            input_ids=torch.cat((input_ids,p_input_ids,n_input_ids),0)
         
         outputs=self.encoder(input_ids,attention_mask=input_ids.ne(self.config.pad_token_id))[0] # 3B * L * D
         sequence_lengths = torch.ne(input_ids, self.config.pad_token_id).sum(-1) - 1
-        outputs=outputs[range(3*bs),sequence_lengths,:] # 3B * D
+        outputs=outputs[range(len(input_ids)),sequence_lengths,:] # 3B * D
         outputs=self.pooler(outputs) # 3B * D
+        if p_input_ids is None:
+            #P x K batch: every other program of the batch is a positive or a negative
+            return in_batch_contrastive_loss(outputs,labels),outputs
         outputs=outputs.split(bs,0)
         
         prob_1=(outputs[0]*outputs[1]).sum(-1)
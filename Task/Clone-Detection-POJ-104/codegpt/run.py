@@ -43,6 +43,8 @@ except:
 from tqdm import tqdm, trange
 import multiprocessing
 from model import Model
+from pk_batches import PKBatchSampler
+from retrieval_metrics import map_at_r, write_predictions
 cpu_cont = multiprocessing.cpu_count()
 from transformers import (WEIGHTS_NAME, AdamW, get_linear_schedule_with_warmup,
                           BertConfig, BertForMaskedLM, BertTokenizer,
@@ -110,11 +112,15 @@ class TextDataset(Dataset):
             if e.label not in self.label_examples:
                 self.label_examples[e.label]=[]
             self.label_examples[e.label].append(e)
+        #False for P x K batches, which take their positives and negatives from the batch
+        self.with_pairs=True
         
     def __len__(self):
         return len(self.examples)
 
     def __getitem__(self, i):   
+        if not self.with_pairs:
+            return torch.tensor(self.examples[i].input_ids),torch.tensor(self.examples[i].label)
         label=self.examples[i].label
         index=self.examples[i].index
         labels=list(self.label_examples)
@@ -143,10 +149,22 @@ def train(args, train_dataset, model, tokenizer):
     """ Train the model """
     
     args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
-    train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
-    
-    train_dataloader = DataLoader(train_dataset, sampler=train_sampler, 
-                                  batch_size=args.train_batch_size,num_workers=4,pin_memory=True)
+    if args.pk_batches:
+        #P problems x K solutions per batch, every program is encoded once
+        if args.local_rank != -1:
+            raise ValueError("--pk_batches does not support distributed training")
+        #DataParallel splits the batch into contiguous per-GPU chunks, each replica needs its own negatives
+        if args.per_gpu_train_batch_size//args.pk_per_problem<2:
+            raise ValueError("--pk_batches needs at least 2 problems per GPU for in-batch negatives, "
+                             "got per_gpu_train_batch_size {} with pk_per_problem {}".format(args.per_gpu_train_batch_size,args.pk_per_problem))
+        train_dataset.with_pairs=False
+        train_sampler = PKBatchSampler([e.label for e in train_dataset.examples],
+                                       args.train_batch_size//args.pk_per_problem, args.pk_per_problem)
+        train_dataloader = DataLoader(train_dataset, batch_sampler=train_sampler,num_workers=4,pin_memory=True)
+    else:
+        train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
+        train_dataloader = DataLoader(train_dataset, sampler=train_sampler, 
+                                      batch_size=args.train_batch_size,num_workers=4,pin_memory=True)
     args.max_steps=args.epoch*len( train_dataloader)
     args.save_steps=len( train_dataloader)
     args.warmup_steps=len( train_dataloader)
@@ -220,9 +238,10 @@ def train(args, train_dataset, model, tokenizer):
         train_loss=0
         for step, batch in enumerate(bar):
             inputs = batch[0].to(args.device)    
-            p_inputs = batch[1].to(args.device)
-            n_inputs = batch[2].to(args.device)
-            labels = batch[3].to(args.device)
+            #P x K batches carry no sampled positive and negative
+            p_inputs = batch[1].to(args.device) if len(batch)==4 else None
+            n_inputs = batch[2].to(args.device) if len(batch)==4 else None
+            labels = batch[-1].to(args.device)
             model.train()
             loss,vec = model(inputs,p_inputs,n_inputs,labels)
 
@@ -332,28 +351,12 @@ def evaluate(args, model, tokenizer,eval_when_training=False, eval_data_file="")
     eval_loss = eval_loss / nb_eval_steps
     perplexity = torch.tensor(eval_loss)
 
-    scores=np.matmul(vecs,vecs.T)
-    dic={}
-    for i in range(scores.shape[0]):
-        scores[i,i]=-1000000
-        if int(labels[i]) not in dic:
-            dic[int(labels[i])]=-1
-        dic[int(labels[i])]+=1
-    sort_ids=np.argsort(scores, axis=-1, kind='quicksort', order=None)[:,::-1]
-    MAP=[]
-    for i in range(scores.shape[0]):
-        cont=0
-        label=int(labels[i])
-        Avep = []
-        for j in range(dic[label]):
-            index=sort_ids[i,j]
-            if int(labels[index])==label:
-                Avep.append((len(Avep)+1)/(j+1))
-        MAP.append(sum(Avep)/dic[label])
+    #MAP@R in query blocks, without the N x N score matrix
+    MAP=map_at_r(vecs,labels)
           
     result = {
         "eval_loss": float(perplexity),
-        "eval_map":float(np.mean(MAP))
+        "eval_map":MAP
     }
 
 
@@ -397,21 +400,9 @@ def test(args, model, tokenizer, epoch="best", model_ready=False):
     eval_loss = eval_loss / nb_eval_steps
     perplexity = torch.tensor(eval_loss)
 
-    scores=np.matmul(vecs,vecs.T)
-    for i in range(scores.shape[0]):
-        scores[i,i]=-1000000
-    sort_ids=np.argsort(scores, axis=-1, kind='quicksort', order=None)[:,::-1]
-    indexs=[]
-    for example in eval_dataset.examples:
-        indexs.append(example.index)
-    with open(os.path.join(args.output_dir,"predictions_epoch_{}.jsonl".format(epoch)),'w') as f:
-        for index,sort_id in zip(indexs,sort_ids):
-            js={}
-            js['index']=index
-            js['answers']=[]
-            for idx in sort_id[:499]:
-                js['answers'].append(indexs[int(idx)])
-            f.write(json.dumps(js)+'\n')
+    #top 499 of every program, streamed to the file query block by query block
+    indexs=[example.index for example in eval_dataset.examples]
+    write_predictions(vecs,os.path.join(args.output_dir,"predictions_epoch_{}.jsonl".format(epoch)),indexs)
 
                         
                         
@@ -496,6 +487,10 @@ def main():
                         help="Overwrite the content of the output directory")
     parser.add_argument('--overwrite_cache', action='store_true',
                         help="Overwrite the cached training and evaluation sets")
+    parser.add_argument('--pk_batches', action='store_true',
+                        help="Train on batches of P problems x K solutions, every other program of the batch being a positive or a negative, instead of sampled triplets.")
+    parser.add_argument('--pk_per_problem', type=int, default=4,
+                        help="K, the number of solutions per problem of a P x K batch (P = train batch size // K).")
     parser.add_argument('--seed', type=int, default=42,
                         help="random seed for initialization")
     parser.add_argument('--epoch', type=int, default=42,
@@ -5,6 +5,7 @@ from transformers import (RobertaConfig, RobertaModel, RobertaTokenizer,
                           BartConfig, BartForConditionalGeneration, BartTokenizer,
                           T5Config, T5ForConditionalGeneration, T5Tokenizer)
 import logging
+from pk_batches import in_batch_contrastive_loss
 
 logger = logging.getLogger(__name__)
 
@@ -163,7 +164,8 @@ class POJModel(nn.Module):
 
     def forward(self, input_ids=None,p_input_ids=None,n_input_ids=None,labels=None): 
         bs,_=input_ids.size()
-        input_ids=torch.cat((input_ids,p_input_ids,n_input_ids),0)
+        if p_input_ids is not None:
+            input_ids=torch.cat((input_ids,p_input_ids,n_input_ids),0)
         
         if self.args.model_type == 'codet5':
             outputs = self.get_t5_vec(input_ids)
@@ -172,6 +174,9 @@ class POJModel(nn.Module):
         elif self.args.model_type == 'roberta':
             outputs = self.get_roberta_vec(input_ids)
 
+        if p_input_ids is None:
+            #P x K batch: every other program of the batch is a positive or a negative
+            return in_batch_contrastive_loss(outputs,labels),outputs
         outputs=outputs.split(bs,0) # B * D , B * D , B * D 
         
         prob_1=(outputs[0]*outputs[1]).sum(-1) # B
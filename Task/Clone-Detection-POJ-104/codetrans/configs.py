@@ -94,6 +94,11 @@ def add_args(parser):
                         help="")
     parser.add_argument("--warmup_steps", default=100, type=int,
                         help="Linear warmup over warmup_steps.")
+    parser.add_argument("--pk_batches", action='store_true',
+                        help="Train on batches of P problems x K solutions, every other program of the batch "
+                             "being a positive or a negative, instead of sampled triplets.")
+    parser.add_argument("--pk_per_problem", type=int, default=4,
+                        help="K, the number of solutions per problem of a P x K batch (P = train batch size // K).")
     parser.add_argument("--local_rank", type=int, default=-1,
                         help="For distributed training: local_rank")
     parser.add_argument('--seed', type=int, default=1234,
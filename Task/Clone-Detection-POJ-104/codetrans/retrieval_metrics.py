@@ -0,0 +1,83 @@
+"""
+MAP@R of code embeddings retrieved against each other, in query blocks.
+
+evaluate/test used to build the full N x N score matrix, argsort every row and walk
+the top R of each row in Python. Here a block of queries is scored against the
+corpus chunk by chunk, only the running top K of every query is kept (argpartition),
+and average precision comes from vectorized label comparisons. Peak memory is
+O(query_block * (corpus_block + K)) whatever the number of programs, and the
+predictions are written as jsonl while the blocks are done.
+"""
+
+import json
+
+import numpy as np
+
+
+def iter_top_k(vecs, k, query_block=1024, corpus_block=65536):
+    """Yield (queries, ids): the k best matches by dot product of every query of a block, best first.
+
+    Every vector is a query and the query itself is never among its matches.
+    """
+    vecs = np.ascontiguousarray(vecs, dtype=np.float32)
+    k = min(k, len(vecs) - 1)
+    for query_start in range(0, len(vecs), query_block):
+        queries = np.arange(query_start, min(query_start + query_block, len(vecs)))
+        best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+        best_ids = np.zeros((len(queries), 0), dtype=np.int64)
+        for start in range(0, len(vecs), corpus_block):
+            scores = vecs[queries] @ vecs[start:start + corpus_block].T
+            own = np.flatnonzero((queries >= start) & (queries < start + scores.shape[1]))
+            scores[own, queries[own] - start] = -np.inf
+            ids = np.broadcast_to(np.arange(start, start + scores.shape[1]), scores.shape)
+            scores = np.concatenate([best_scores, scores], 1)
+            ids = np.concatenate([best_ids, ids], 1)
+            if scores.shape[1] > k:
+                keep = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                scores = np.take_along_axis(scores, keep, 1)
+                ids = np.take_along_axis(ids, keep, 1)
+            best_scores, best_ids = scores, ids
+        order = np.argsort(-best_scores, axis=1, kind='stable')
+        yield queries, np.take_along_axis(best_ids, order, 1)
+
+
+def _write_answers(f, queries, ids, indexes):
+    for query, answers in zip(queries, ids):
+        f.write(json.dumps({'index': indexes[query], 'answers': [indexes[a] for a in answers]}) + '\n')
+
+
+def map_at_r(vecs, labels, predictions_file=None, indexes=None, top_k=499, query_block=1024, corpus_block=65536):
+    """Mean over the queries of the average precision of their top R matches.
+
+    R is the number of other programs with the query's label. With `predictions_file`,
+    the `indexes` of the top `top_k` matches of every query are written there as
+    {"index", "answers"} jsonl lines, in query order.
+    """
+    labels = np.asarray(labels).reshape(-1)
+    _, inverse, counts = np.unique(labels, return_inverse=True, return_counts=True)
+    relevant = counts[inverse] - 1
+    k = int(relevant.max()) if len(labels) else 0
+    if predictions_file is not None:
+        k = max(k, top_k)
+    ap = np.zeros(len(labels))
+    f = open(predictions_file, 'w') if predictions_file is not None else None
+    try:
+        for queries, ids in iter_top_k(vecs, k, query_block, corpus_block):
+            r = relevant[queries]
+            ranks = np.arange(1, ids.shape[1] + 1)
+            hits = (labels[ids] == labels[queries, None]) & (ranks <= r[:, None])
+            precision = np.cumsum(hits, 1) / ranks
+            ap[queries] = np.divide((precision * hits).sum(1), r, out=np.zeros(len(r)), where=r > 0)
+            if f is not None:
+                _write_answers(f, queries, ids[:, :top_k], indexes)
+    finally:
+        if f is not None:
+            f.close()
+    return float(ap.mean())
+
+
+def write_predictions(vecs, predictions_file, indexes, top_k=499, query_block=1024, corpus_block=65536):
+    """Write the `indexes` of the top `top_k` matches of every query, as `map_at_r` does."""
+    with open(predictions_file, 'w') as f:
+        for queries, ids in iter_top_k(vecs, top_k, query_block, corpus_block):
+            _write_answers(f, queries, ids, indexes)
@@ -22,6 +22,8 @@ using a masked language modeling (MLM) loss.
 from __future__ import absolute_import
 import os
 from models import POJModel
+from retrieval_metrics import map_at_r
+from pk_batches import PKBatchSampler
 import logging
 import argparse
 import math
@@ -85,28 +87,12 @@ def evaluate(args, model, eval_data, device, write_to_pred=False):
     eval_loss = eval_loss / nb_eval_steps
     perplexity = torch.tensor(eval_loss)
 
-    scores=np.matmul(vecs,vecs.T)
-    dic={}
-    for i in range(scores.shape[0]):
-        scores[i,i]=-1000000
-        if int(labels[i]) not in dic:
-            dic[int(labels[i])]=-1
-        dic[int(labels[i])]+=1
-    sort_ids=np.argsort(scores, axis=-1, kind='quicksort', order=None)[:,::-1]
-    MAP=[]
-    for i in range(scores.shape[0]):
-        cont=0
-        label=int(labels[i])
-        Avep = []
-        for j in range(dic[label]):
-            index=sort_ids[i,j]
-            if int(labels[index])==label:
-                Avep.append((len(Avep)+1)/(j+1))
-        MAP.append(sum(Avep)/dic[label])
+    #MAP@R in query blocks, without the N x N score matrix
+    MAP=map_at_r(vecs,labels)
           
     result = {
         "eval_loss": float(perplexity),
-        "eval_map":float(np.mean(MAP))
+        "eval_map":MAP
     }
 
     return result
@@ -156,11 +142,15 @@ class TextDataset(Dataset):
             if e.label not in self.label_examples:
                 self.label_examples[e.label]=[]
             self.label_examples[e.label].append(e)
+        # False for P x K batches, which take their positives and negatives from the batch
+        self.with_pairs = True
         
     def __len__(self):
         return len(self.examples)
 
     def __getitem__(self, i):   
+        if not self.with_pairs:
+            return torch.tensor(self.examples[i].input_ids), torch.tensor(self.examples[i].label)
         label=self.examples[i].label
         index=self.examples[i].index
         labels=list(self.label_examples)
@@ -226,11 +216,26 @@ def main():
 
         # Prepare training data loader
         train_data = TextDataset(tokenizer, args, file_path=args.train_filename)
-        if args.local_rank == -1:
-            train_sampler = RandomSampler(train_data)
+        if args.pk_batches:
+            # P problems x K solutions per batch, every program is encoded once
+            if args.local_rank != -1:
+                raise ValueError("--pk_batches does not support distributed training")
+            # DataParallel splits the batch into contiguous per-GPU chunks, each replica needs its own negatives
+            per_gpu_train_batch_size = args.train_batch_size // max(1, args.n_gpu)
+            if per_gpu_train_batch_size // args.pk_per_problem < 2:
+                raise ValueError("--pk_batches needs at least 2 problems per GPU for in-batch negatives, "
+                                 "got {} examples per GPU (train_batch_size {} on {} GPUs) with pk_per_problem {}".format(
+                                     per_gpu_train_batch_size, args.train_batch_size, args.n_gpu, args.pk_per_problem))
+            train_data.with_pairs = False
+            train_sampler = PKBatchSampler([e.label for e in train_data.examples],
+                                           args.train_batch_size // args.pk_per_problem, args.pk_per_problem)
+            train_dataloader = DataLoader(train_data, batch_sampler=train_sampler)
         else:
-            train_sampler = DistributedSampler(train_data)
-        train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=args.train_batch_size)
+            if args.local_rank == -1:
+                train_sampler = RandomSampler(train_data)
+            else:
+                train_sampler = DistributedSampler(train_data)
+            train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=args.train_batch_size)
 
         num_train_optimization_steps = args.num_train_epochs * len(train_dataloader)
         save_steps = max(len(train_dataloader) // 5, 1)
@@ -268,7 +273,11 @@ def main():
             model.train()
             for step, batch in enumerate(bar):
                 batch = tuple(t.to(device) for t in batch)
-                inputs, p_inputs, n_inputs, labels = batch
+                if len(batch) == 4:
+                    inputs, p_inputs, n_inputs, labels = batch
+                else:
+                    # P x K batches carry no sampled positive and negative
+                    (inputs, labels), p_inputs, n_inputs = batch, None, None
                 # pdb.set_trace()
 
                 loss, vec = model(inputs,p_inputs,n_inputs,labels)
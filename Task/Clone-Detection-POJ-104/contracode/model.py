@@ -8,6 +8,7 @@ import copy
 import torch.nn.functional as F
 from torch.nn import CrossEntropyLoss, MSELoss
 from representjs.models.encoder import CodeEncoder
+from pk_batches import in_batch_contrastive_loss
 
 class Pooler(nn.Module):
     def __init__(self, hidden_size):
@@ -74,9 +75,13 @@ class Model(nn.Module):
         
     def forward(self, input_ids=None,p_input_ids=None,n_input_ids=None,labels=None): 
         bs,_=input_ids.size()
-        input_ids=torch.cat((input_ids,p_input_ids,n_input_ids),0)
+        if p_input_ids is not None:
+            input_ids=torch.cat((input_ids,p_input_ids,n_input_ids),0)
         
         outputs=self.encoder(input_ids)[1] # 3B * D
+        if p_input_ids is None:
+            #P x K batch: every other program of the batch is a positive or a negative
+            return in_batch_contrastive_loss(outputs,labels),outputs
         outputs=outputs.split(bs,0) # B * D , B * D , B * D 
         
         prob_1=(outputs[0]*outputs[1]).sum(-1) # B
@@ -0,0 +1,66 @@
+"""
+P x K batches with in-batch positives and negatives for POJ-104 training.
+
+The triplet mode samples one positive and one negative program per anchor and
+encodes all three, so every anchor sees a single sampled pair for three encoder
+passes. `PKBatchSampler` instead draws P problems and K solutions of each, and
+`in_batch_contrastive_loss` uses every other program of the batch as a positive
+(same problem) or a negative: each program is encoded once per batch and each
+anchor gets K-1 positives and (P-1)*K negatives.
+"""
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+class PKBatchSampler(Sampler):
+    """Batch sampler yielding `num_labels` labels x `num_per_label` examples of each.
+
+    Labels are drawn uniformly without replacement within a batch. The examples of
+    every label are visited in a shuffled order, reshuffled once used up, so one
+    epoch of len(labels) // (P * K) batches sees about every example once. Labels
+    with a single example cannot form positives and are never drawn.
+    """
+
+    def __init__(self, labels, num_labels, num_per_label, num_batches=None):
+        labels = np.asarray(labels)
+        groups = [np.flatnonzero(labels == label) for label in np.unique(labels)]
+        self.groups = [group for group in groups if len(group) >= 2]
+        if len(self.groups) < num_labels:
+            raise ValueError("{} labels per batch, but only {} labels have two examples or more".format(
+                num_labels, len(self.groups)))
+        self.num_labels = num_labels
+        self.num_per_label = num_per_label
+        self.num_batches = num_batches or max(1, len(labels) // (num_labels * num_per_label))
+
+    def __iter__(self):
+        queues = [np.random.permutation(group) for group in self.groups]
+        cursors = [0] * len(self.groups)
+        for _ in range(self.num_batches):
+            batch = []
+            for g in np.random.choice(len(self.groups), self.num_labels, replace=False):
+                k = min(self.num_per_label, len(self.groups[g]))
+                if cursors[g] + k > len(queues[g]):
+                    queues[g], cursors[g] = np.random.permutation(self.groups[g]), 0
+                batch.extend(queues[g][cursors[g]:cursors[g] + k].tolist())
+                cursors[g] += k
+            yield batch
+
+    def __len__(self):
+        return self.num_batches
+
+
+def in_batch_contrastive_loss(vecs, labels):
+    """Multi-positive InfoNCE over the dot products of a batch of program vectors.
+
+    For every anchor, the softmax runs over all the other programs of the batch and
+    the loss is the mean negative log-probability of the ones with the same label.
+    """
+    scores = torch.mm(vecs, vecs.t())  # B * B
+    own = torch.eye(len(labels), dtype=torch.bool, device=vecs.device)
+    log_prob = torch.log_softmax(scores.masked_fill(own, float('-inf')), -1)
+    positives = (labels[:, None] == labels[None, :]) & ~own
+    num_positives = positives.sum(-1)
+    loss = -torch.where(positives, log_prob, torch.zeros_like(log_prob)).sum(-1) / num_positives.clamp(min=1)
+    return loss[num_positives > 0].mean()
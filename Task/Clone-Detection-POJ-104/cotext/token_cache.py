@@ -0,0 +1,100 @@
+"""
+Content-addressed cache of tokenized datasets.
+
+Cache files used to be named after the split and `data_num` only, so changing
+the tokenizer, a length limit or the task silently reused stale tensors, and
+every cache was a whole TensorDataset pickle read into RAM with `torch.load`.
+
+Here a cache is a directory named after a hash of the data file contents, the
+tokenizer and every argument the features depend on. Each column is stored as a
+flat int32 .npy file that is memory-mapped when loaded, and the dataset
+statistics are stored next to it so a cache hit does not re-tokenize the split
+just to log them.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+# arguments read by read_examples / convert_*_examples_to_features
+CACHE_ARGS = ('task', 'sub_task', 'model_type', 'max_source_length', 'max_target_length',
+              'add_task_prefix', 'add_lang_ids', 'data_num', 'test_type')
+
+
+def file_digest(filename):
+    """md5 of the contents of `filename` (or of every file of a comma-separated list)."""
+    md5 = hashlib.md5()
+    for fn in filename.split(','):
+        with open(fn, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                md5.update(chunk)
+    return md5.hexdigest()
+
+
+def tokenizer_digest(tokenizer):
+    """md5 identifying the vocabulary and rules of a sentencepiece, tokenizers or transformers tokenizer."""
+    if hasattr(tokenizer, 'serialized_model_proto'):
+        blob = tokenizer.serialized_model_proto()
+    elif hasattr(tokenizer, 'to_str'):
+        blob = tokenizer.to_str().encode('utf-8')
+    else:
+        blob = '{}|{}|{}'.format(type(tokenizer).__name__, sorted(tokenizer.get_vocab().items()),
+                                 sorted(tokenizer.special_tokens_map.items())).encode('utf-8')
+    return hashlib.md5(blob).hexdigest()
+
+
+def token_cache_path(args, filename, tokenizer, name):
+    key = [name, file_digest(filename), tokenizer_digest(tokenizer)]
+    key += ['{}={}'.format(arg, getattr(args, arg, None)) for arg in CACHE_ARGS]
+    digest = hashlib.md5('|'.join(key).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(args.cache_path, '{}_{}'.format(name, digest))
+
+
+class TokenDataset(Dataset):
+    """Drop-in for TensorDataset over int32 columns; items are int64 tensors."""
+
+    def __init__(self, *columns):
+        assert all(len(c) == len(columns[0]) for c in columns)
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns[0])
+
+    def __getitem__(self, index):
+        return tuple(torch.from_numpy(np.array(c[index], dtype=np.int64)) for c in self.columns)
+
+
+def load_token_cache(path):
+    """(TokenDataset, stats) stored under `path`, or None if there is no cache yet."""
+    meta_fn = os.path.join(path, 'meta.json')
+    if not os.path.exists(meta_fn):
+        return None
+    with open(meta_fn) as f:
+        meta = json.load(f)
+    columns = [np.load(os.path.join(path, '{}.npy'.format(i)), mmap_mode='r') for i in range(meta['columns'])]
+    return TokenDataset(*columns), meta['stats']
+
+
+def build_token_dataset(path, columns, stats=None, save=True):
+    """Turn lists of ids/labels into a TokenDataset, caching it under `path` if `save`."""
+    columns = [np.asarray(c, dtype=np.int32) for c in columns]
+    if not save:
+        return TokenDataset(*columns)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    for i, column in enumerate(columns):
+        np.save(os.path.join(tmp_path, '{}.npy'.format(i)), column)
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump({'columns': len(columns), 'stats': stats}, f)
+    # swap the whole directory in so readers never see a partial cache
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+    return load_token_cache(path)[0]
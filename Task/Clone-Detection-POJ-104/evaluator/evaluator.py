@@ -15,36 +15,36 @@ def read_answers(filename):
     return answers
 
 def read_predictions(filename):
-    predictions={}
+    """Yield (index, answers) of every line of the predictions file, without keeping them all."""
     with open(filename) as f:
         for line in f:
             line=line.strip()
             js=json.loads(line)
-            predictions[js['index']]=js['answers']
-    return predictions
+            yield js['index'],js['answers']
+
+def average_precision(answer,prediction):
+    """Average precision of the ranked `prediction` against the set `answer`."""
+    hits=np.fromiter((p in answer for p in prediction),dtype=bool,count=len(prediction))
+    precision=np.cumsum(hits)/np.arange(1,len(prediction)+1)
+    return precision[hits].sum()/len(answer)
 
 def calculate_scores(answers,predictions):
-    scores=[]
-    for key in answers:
-        if key not in predictions:
-            logging.error("Missing prediction for index {}.".format(key))
-            sys.exit()
-            
-        if len(answers[key])!=len(predictions[key]):
+    scores={}
+    for key,prediction in predictions:
+        if key not in answers:
+            continue
+        if len(answers[key])!=len(prediction):
             logging.error("Mismatch the number of answers for index {}.".format(key))
             sys.exit()
-                
-        answer = set(answers[key])   
+        scores[key]=average_precision(set(answers[key]),prediction)
 
-        Avep = []
-        for k, p in enumerate(predictions[key]):
-            if p in answer:
-                Avep.append((len(Avep)+1)/(k+1))
-
-        scores.append(sum(Avep)/len(answer))
+    for key in answers:
+        if key not in scores:
+            logging.error("Missing prediction for index {}.".format(key))
+            sys.exit()
 
     result={}
-    result['MAP@R']= round(np.mean(scores),4)
+    result['MAP@R']= round(np.mean(list(scores.values())),4)
     return result
 
 def main():
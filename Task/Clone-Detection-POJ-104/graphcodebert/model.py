@@ -7,6 +7,7 @@ from torch.autograd import Variable
 import copy
 import torch.nn.functional as F
 from torch.nn import CrossEntropyLoss, MSELoss
+from pk_batches import in_batch_contrastive_loss
 
 
     
@@ -25,9 +26,10 @@ class Model(nn.Module):
                 labels=None): 
 
         bs,_=input_ids.size()
-        input_ids=torch.cat((input_ids,p_input_ids,n_input_ids),0)
-        position_idx=torch.cat((position_idx,p_position_idx,n_position_idx),0)
-        attn_mask=torch.cat((attn_mask,p_attn_mask,n_attn_mask),0)
+        if p_input_ids is not None:
+            input_ids=torch.cat((input_ids,p_input_ids,n_input_ids),0)
+            position_idx=torch.cat((position_idx,p_position_idx,n_position_idx),0)
+            attn_mask=torch.cat((attn_mask,p_attn_mask,n_attn_mask),0)
         
         nodes_mask=position_idx.eq(0)
         token_mask=position_idx.ge(2)        
@@ -41,6 +43,9 @@ class Model(nn.Module):
         # attn_mask: 96 * 640 * 640 
         # position_idx: 96 * 640
         outputs=self.encoder(inputs_embeds=inputs_embeddings,attention_mask=attn_mask,position_ids=position_idx)[1] # 3B * D
+        if p_input_ids is None:
+            #P x K batch: every other program of the batch is a positive or a negative
+            return in_batch_contrastive_loss(outputs,labels),outputs
         outputs=outputs.split(bs,0) # B * D , B * D , B * D 
         
         prob_1=(outputs[0]*outputs[1]).sum(-1) # B
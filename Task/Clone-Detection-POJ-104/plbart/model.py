@@ -7,6 +7,7 @@ from torch.autograd import Variable
 import copy
 import torch.nn.functional as F
 from torch.nn import CrossEntropyLoss, MSELoss
+from pk_batches import in_batch_contrastive_loss
 
 class Pooler(nn.Module):
     def __init__(self, hidden_size):
@@ -36,13 +37,18 @@ class Model(nn.Module):
                       n_input_ids=None,n_prev_tokens_ids=None,n_lengths=None,
                       labels=None): 
         bs,_=input_ids.size()
-        input_ids=torch.cat((input_ids,p_input_ids,n_input_ids),0)
-        prev_tokens_ids=torch.cat((prev_tokens_ids,p_prev_tokens_ids,n_prev_tokens_ids),0)
-        lengths=torch.cat((lengths,p_lengths,n_lengths),0)-1
+        if p_input_ids is not None:
+            input_ids=torch.cat((input_ids,p_input_ids,n_input_ids),0)
+            prev_tokens_ids=torch.cat((prev_tokens_ids,p_prev_tokens_ids,n_prev_tokens_ids),0)
+            lengths=torch.cat((lengths,p_lengths,n_lengths),0)
+        lengths=lengths-1
         
         outputs=self.encoder(src_tokens=input_ids,src_lengths=lengths,prev_output_tokens=prev_tokens_ids,features_only=True)[0] # L * 3B * D
-        outputs=outputs[range(3*bs),lengths,:] # 3B * D
+        outputs=outputs[range(len(input_ids)),lengths,:] # 3B * D
         outputs=self.pooler(outputs) # 3B * D
+        if p_input_ids is None:
+            #P x K batch: every other program of the batch is a positive or a negative
+            return in_batch_contrastive_loss(outputs,labels),outputs
         outputs=outputs.split(bs,0) # B * D , B * D , B * D 
         
         prob_1=(outputs[0]*outputs[1]).sum(-1) # B
@@ -50,37 +50,64 @@ class Seq2Seq(nn.Module):
             outputs = loss,loss*ids.sum(),ids.sum()
             return outputs
         else:
-            outputs = self.decoder(input_ids=inputs)
-            outputs = outputs[1]
-            p = []       
-            zero = torch.cuda.LongTensor(1).fill_(0)
-            for i in range(inputs.shape[0]):
-                past_hidden = [(x[0][i:i+1].expand(self.beam_size, -1, -1, -1),
-                                x[1][i:i+1].expand(self.beam_size, -1, -1, -1))
-                                 for x in outputs]
-                # context_mask=source_mask[i:i+1,:].expand(beam_size,-1)
-                beam = Beam(self.beam_size, self.sos_id, self.eos_id)
-                input_ids = None
-                for _ in range(self.max_length): 
-                    if beam.done():
-                        break
-                    input_ids = beam.getCurrentState()    
-                    # context_mask=torch.cat((context_mask,input_ids*0+1),-1)
-                    # mask=context_mask.unsqueeze(0).unsqueeze(-2).unsqueeze(-2).expand(self.config.n_layer, -1, -1, -1, -1)
-                    transformer_outputs = self.decoder(input_ids, past_key_values=past_hidden)
-                    out = self.m(transformer_outputs[0][:, -1, :]).data
-                    # out = self.lsm(self.lm_head(transformer_outputs[0][:,-1,:])).data
-                    beam.advance(out)
-                    past_hidden = [(x[0].data.index_select(0, beam.getCurrentOrigin()),
-                                    x[1].data.index_select(0, beam.getCurrentOrigin())) 
-                                    for x in transformer_outputs[1]]
-                hyp = beam.getHyp(beam.getFinal())
-                pred  =beam.buildTargetTokens(hyp)[:self.beam_size]
-
-                pred = [torch.cat([x.view(-1) for x in p]+[zero]*(self.max_length-len(p))).view(1,-1) for p in pred]
-                p.append(torch.cat(pred, 0).unsqueeze(0))
-            p = torch.cat(p, 0)
-            return p   
+            return self.beam_search(inputs, attn_mask)
+
+    def beam_search(self, inputs, attn_mask):
+        """
+            Beam search for a batch of left-padded prompts, all ending on the last column.
+
+            Every example keeps its own `Beam`, the beams of all the unfinished examples are
+            decoded together (B * beam rows) from the prompts' cached keys and values, and an
+            example leaves the batch as soon as its beam is done. Position ids count the real
+            tokens only, so the top-1 output is the one of decoding the example alone.
+        """
+        bs = inputs.size(0)
+        attn_mask = attn_mask.long()
+        position_ids = (attn_mask.cumsum(-1) - 1).clamp(min=0)
+        outputs = self.decoder(input_ids=inputs, attention_mask=attn_mask, position_ids=position_ids)
+        # beam_size rows per example
+        rows = torch.arange(bs, device=inputs.device).repeat_interleave(self.beam_size)
+        past_hidden = [(x[0].index_select(0, rows), x[1].index_select(0, rows)) for x in outputs[1]]
+        attn_mask = attn_mask.index_select(0, rows)
+        positions = position_ids[:, -1:].index_select(0, rows) + 1 # B*beam * 1
+        beams = [Beam(self.beam_size, self.sos_id, self.eos_id) for _ in range(bs)]
+        active = list(range(bs))
+        for _ in range(self.max_length):
+            keep = [j for j, i in enumerate(active) if not beams[i].done()]
+            if not keep:
+                break
+            if len(keep) < len(active):
+                # drop the rows of the examples whose beam is done
+                rows = (torch.tensor(keep, device=inputs.device).unsqueeze(1) * self.beam_size
+                        + torch.arange(self.beam_size, device=inputs.device)).view(-1)
+                past_hidden = [(x[0].index_select(0, rows), x[1].index_select(0, rows)) for x in past_hidden]
+                attn_mask = attn_mask.index_select(0, rows)
+                positions = positions.index_select(0, rows)
+                active = [active[j] for j in keep]
+            input_ids = torch.cat([beams[i].getCurrentState() for i in active], 0)
+            attn_mask = torch.cat((attn_mask, attn_mask.new_ones(attn_mask.size(0), 1)), -1)
+            transformer_outputs = self.decoder(input_ids, past_key_values=past_hidden,
+                                               attention_mask=attn_mask, position_ids=positions)
+            out = self.m(transformer_outputs[0][:, -1, :]).data.view(len(active), self.beam_size, -1)
+            origins = []
+            for j, i in enumerate(active):
+                beams[i].advance(out[j])
+                origins.append(beams[i].getCurrentOrigin() + j * self.beam_size)
+            # the rows of an example share its mask and positions, only the caches follow the beams
+            origins = torch.cat(origins)
+            past_hidden = [(x[0].data.index_select(0, origins), x[1].data.index_select(0, origins))
+                           for x in transformer_outputs[1]]
+            positions = positions + 1
+
+        p = []
+        zero = torch.cuda.LongTensor(1).fill_(0)
+        for beam in beams:
+            hyp = beam.getHyp(beam.getFinal())
+            pred = beam.buildTargetTokens(hyp)[:self.beam_size]
+            pred = [torch.cat([x.view(-1) for x in p]+[zero]*(self.max_length-len(p))).view(1,-1) for p in pred]
+            p.append(torch.cat(pred, 0).unsqueeze(0))
+        p = torch.cat(p, 0)
+        return p
         
 
 class Beam(object):
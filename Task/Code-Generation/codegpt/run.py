@@ -32,6 +32,7 @@ import argparse
 import numpy as np
 from io import open
 from itertools import cycle
+from functools import partial
 import torch.nn as nn
 from model import Seq2Seq
 from tqdm import tqdm, trange
@@ -156,6 +157,14 @@ class TextDataset(Dataset):
                torch.tensor(self.examples[item].attn_mask, dtype=torch.uint8), \
                torch.tensor(self.examples[item].loss_mask, dtype=torch.uint8)
 
+def left_pad_collate(batch, pad_id):
+    """Collate test-stage examples of different lengths, left-padded so that every prompt ends on the last column."""
+    width = max(len(item[0]) for item in batch)
+    fields = []
+    for values, pad in zip(zip(*batch), [pad_id, 0, 0, 0]):
+        fields.append(torch.stack([torch.cat((v.new_full((width - len(v),), pad), v)) for v in values]))
+    return fields
+
 def set_seed(seed=42):
     random.seed(seed)
     os.environ['PYHTONHASHSEED'] = str(seed)
@@ -176,7 +185,8 @@ def eval_bleu(args, dev_dataset, model, device, tokenizer):
         dev_dataset['dev_bleu']=eval_examples,eval_data
 
     eval_sampler = SequentialSampler(eval_data)
-    eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=1)
+    eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.pred_batch_size,
+                                 collate_fn=partial(left_pad_collate, pad_id=tokenizer.pad_token_id))
 
     model.eval() 
     p=[]
@@ -219,7 +229,8 @@ def test(args, model, tokenizer, device, epoch=0):
 
     # Calculate bleu
     eval_sampler = SequentialSampler(eval_data)
-    eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=1)
+    eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.pred_batch_size,
+                                 collate_fn=partial(left_pad_collate, pad_id=tokenizer.pad_token_id))
 
     model.eval() 
     p=[]
@@ -313,6 +324,8 @@ def main():
                         help="The initial learning rate for Adam.")
     parser.add_argument("--beam_size", default=10, type=int,
                         help="beam size for beam search")    
+    parser.add_argument("--pred_batch_size", default=8, type=int,
+                        help="Number of examples decoded together by the beam search.")
     parser.add_argument("--weight_decay", default=0.0, type=float,
                         help="Weight deay if we apply some.")
     parser.add_argument("--adam_epsilon", default=1e-8, type=float,
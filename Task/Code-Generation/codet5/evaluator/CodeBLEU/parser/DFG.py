@@ -8,54 +8,78 @@ from .utils import (remove_comments_and_docstrings,
                    tree_to_variable_index)
 
 
+def run_dfg(dfg_function,root_node,index_to_code,states):
+    # Walk the tree with an explicit stack of DFG_* generators instead of recursion.
+    # A generator yields (child,states) to visit a child and is sent back the child's
+    # states; every frame appends its edges to the one shared DFG list, which is
+    # sorted by token position once at the end (the sort is stable, so this is the
+    # order the old per-frame sorts produced).
+    DFG=[]
+    stack=[dfg_function(root_node,index_to_code,states.copy(),DFG)]
+    child_states=None
+    while stack:
+        try:
+            node,node_states=stack[-1].send(child_states)
+        except StopIteration as e:
+            stack.pop()
+            child_states=e.value
+            continue
+        stack.append(dfg_function(node,index_to_code,node_states,DFG))
+        child_states=None
+    return sorted(DFG,key=lambda x:x[1]),child_states
+
+
 def DFG_python(root_node,index_to_code,states):
+    return run_dfg(_DFG_python,root_node,index_to_code,states)
+
+
+def _DFG_python(root_node,index_to_code,states,DFG):
     assignment=['assignment','augmented_assignment','for_in_clause']
     if_statement=['if_statement']
     for_statement=['for_statement']
     while_statement=['while_statement']
-    do_first_statement=['for_in_clause'] 
+    do_first_statement=['for_in_clause']
     def_statement=['default_parameter']
-    states=states.copy() 
-    if (len(root_node.children)==0 or root_node.type in ['string_literal','string','character_literal']) and root_node.type!='comment':        
+    if (len(root_node.children)==0 or root_node.type in ['string_literal','string','character_literal']) and root_node.type!='comment':
         idx,code=index_to_code[(root_node.start_point,root_node.end_point)]
         if root_node.type==code:
-            return [],states
+            return states
         elif code in states:
-            return [(code,idx,'comesFrom',[code],states[code].copy())],states
+            DFG.append((code,idx,'comesFrom',[code],states[code].copy()))
+            return states
         else:
             if root_node.type=='identifier':
                 states[code]=[idx]
-            return [(code,idx,'comesFrom',[],[])],states
+            DFG.append((code,idx,'comesFrom',[],[]))
+            return states
     elif root_node.type in def_statement:
         name=root_node.child_by_field_name('name')
         value=root_node.child_by_field_name('value')
-        DFG=[]
         if value is None:
             indexs=tree_to_variable_index(name,index_to_code)
             for index in indexs:
                 idx,code=index_to_code[index]
                 DFG.append((code,idx,'comesFrom',[],[]))
                 states[code]=[idx]
-            return sorted(DFG,key=lambda x:x[1]),states
+            return states
         else:
             name_indexs=tree_to_variable_index(name,index_to_code)
             value_indexs=tree_to_variable_index(value,index_to_code)
-            temp,states=DFG_python(value,index_to_code,states)
-            DFG+=temp            
+            states=yield value,states
             for index1 in name_indexs:
                 idx1,code1=index_to_code[index1]
                 for index2 in value_indexs:
                     idx2,code2=index_to_code[index2]
                     DFG.append((code1,idx1,'comesFrom',[code2],[idx2]))
-                states[code1]=[idx1]   
-            return sorted(DFG,key=lambda x:x[1]),states        
+                states[code1]=[idx1]
+            return states
     elif root_node.type in assignment:
         if root_node.type=='for_in_clause':
             right_nodes=[root_node.children[-1]]
             left_nodes=[root_node.child_by_field_name('left')]
         else:
             if root_node.child_by_field_name('right') is None:
-                return [],states
+                return states
             left_nodes=[x for x in root_node.child_by_field_name('left').children if x.type!=',']
             right_nodes=[x for x in root_node.child_by_field_name('right').children if x.type!=',']
             if len(right_nodes)!=len(left_nodes):
@@ -65,11 +89,9 @@ def DFG_python(root_node,index_to_code,states):
                 left_nodes=[root_node.child_by_field_name('left')]
             if len(right_nodes)==0:
                 right_nodes=[root_node.child_by_field_name('right')]
-        DFG=[]
         for node in right_nodes:
-            temp,states=DFG_python(node,index_to_code,states)
-            DFG+=temp
-            
+            states=yield node,states
+
         for left_node,right_node in zip(left_nodes,right_nodes):
             left_tokens_index=tree_to_variable_index(left_node,index_to_code)
             right_tokens_index=tree_to_variable_index(right_node,index_to_code)
@@ -79,10 +101,9 @@ def DFG_python(root_node,index_to_code,states):
                 temp.append((code1,idx1,'computedFrom',[index_to_code[x][1] for x in right_tokens_index],
                              [index_to_code[x][0] for x in right_tokens_index]))
                 states[code1]=[idx1]
-            DFG+=temp        
-        return sorted(DFG,key=lambda x:x[1]),states
+            DFG+=temp
+        return states
     elif root_node.type in if_statement:
-        DFG=[]
         current_states=states.copy()
         others_states=[]
         tag=False
@@ -92,11 +113,9 @@ def DFG_python(root_node,index_to_code,states):
             if 'else' in child.type:
                 tag=True
             if child.type not in ['elif_clause','else_clause']:
-                temp,current_states=DFG_python(child,index_to_code,current_states)
-                DFG+=temp
+                current_states=yield child,current_states
             else:
-                temp,new_states=DFG_python(child,index_to_code,states)
-                DFG+=temp
+                new_states=yield child,states.copy()
                 others_states.append(new_states)
         others_states.append(current_states)
         if tag is False:
@@ -110,9 +129,9 @@ def DFG_python(root_node,index_to_code,states):
                     new_states[key]+=dic[key]
         for key in new_states:
             new_states[key]=sorted(list(set(new_states[key])))
-        return sorted(DFG,key=lambda x:x[1]),new_states
+        return new_states
     elif root_node.type in for_statement:
-        DFG=[]
+        start=len(DFG)
         for i in range(2):
             right_nodes=[x for x in root_node.child_by_field_name('right').children if x.type!=',']
             left_nodes=[x for x in root_node.child_by_field_name('left').children if x.type!=',']
@@ -124,8 +143,7 @@ def DFG_python(root_node,index_to_code,states):
             if len(right_nodes)==0:
                 right_nodes=[root_node.child_by_field_name('right')]
             for node in right_nodes:
-                temp,states=DFG_python(node,index_to_code,states)
-                DFG+=temp
+                states=yield node,states
             for left_node,right_node in zip(left_nodes,right_nodes):
                 left_tokens_index=tree_to_variable_index(left_node,index_to_code)
                 right_tokens_index=tree_to_variable_index(right_node,index_to_code)
@@ -135,49 +153,48 @@ def DFG_python(root_node,index_to_code,states):
                     temp.append((code1,idx1,'computedFrom',[index_to_code[x][1] for x in right_tokens_index],
                                  [index_to_code[x][0] for x in right_tokens_index]))
                     states[code1]=[idx1]
-                DFG+=temp   
+                DFG+=temp
             if  root_node.children[-1].type=="block":
-                temp,states=DFG_python(root_node.children[-1],index_to_code,states)
-                DFG+=temp 
+                states=yield root_node.children[-1],states
         dic={}
-        for x in DFG:
+        for x in DFG[start:]:
             if (x[0],x[1],x[2]) not in dic:
                 dic[(x[0],x[1],x[2])]=[x[3],x[4]]
             else:
                 dic[(x[0],x[1],x[2])][0]=list(set(dic[(x[0],x[1],x[2])][0]+x[3]))
                 dic[(x[0],x[1],x[2])][1]=sorted(list(set(dic[(x[0],x[1],x[2])][1]+x[4])))
-        DFG=[(x[0],x[1],x[2],y[0],y[1]) for x,y in sorted(dic.items(),key=lambda t:t[0][1])]
-        return sorted(DFG,key=lambda x:x[1]),states
-    elif root_node.type in while_statement:  
-        DFG=[]
+        DFG[start:]=[(x[0],x[1],x[2],y[0],y[1]) for x,y in sorted(dic.items(),key=lambda t:t[0][1])]
+        return states
+    elif root_node.type in while_statement:
+        start=len(DFG)
         for i in range(2):
             for child in root_node.children:
-                temp,states=DFG_python(child,index_to_code,states)
-                DFG+=temp    
+                states=yield child,states
         dic={}
-        for x in DFG:
+        for x in DFG[start:]:
             if (x[0],x[1],x[2]) not in dic:
                 dic[(x[0],x[1],x[2])]=[x[3],x[4]]
             else:
                 dic[(x[0],x[1],x[2])][0]=list(set(dic[(x[0],x[1],x[2])][0]+x[3]))
                 dic[(x[0],x[1],x[2])][1]=sorted(list(set(dic[(x[0],x[1],x[2])][1]+x[4])))
-        DFG=[(x[0],x[1],x[2],y[0],y[1]) for x,y in sorted(dic.items(),key=lambda t:t[0][1])]
-        return sorted(DFG,key=lambda x:x[1]),states        
+        DFG[start:]=[(x[0],x[1],x[2],y[0],y[1]) for x,y in sorted(dic.items(),key=lambda t:t[0][1])]
+        return states
     else:
-        DFG=[]
         for child in root_node.children:
             if child.type in do_first_statement:
-                temp,states=DFG_python(child,index_to_code,states)
-                DFG+=temp
+                states=yield child,states
         for child in root_node.children:
             if child.type not in do_first_statement:
-                temp,states=DFG_python(child,index_to_code,states)
-                DFG+=temp
-        
-        return sorted(DFG,key=lambda x:x[1]),states
-        
+                states=yield child,states
+
+        return states
+
 
 def DFG_java(root_node,index_to_code,states):
+    return run_dfg(_DFG_java,root_node,index_to_code,states)
+
+
+def _DFG_java(root_node,index_to_code,states,DFG):
     assignment=['assignment_expression']
     def_statement=['variable_declarator']
     increment_statement=['update_expression']
@@ -185,58 +202,54 @@ def DFG_java(root_node,index_to_code,states):
     for_statement=['for_statement']
     enhanced_for_statement=['enhanced_for_statement']
     while_statement=['while_statement']
-    do_first_statement=[]    
-    states=states.copy()
+    do_first_statement=[]
     if (len(root_node.children)==0 or root_node.type in ['string_literal','string','character_literal']) and root_node.type!='comment':
         idx,code=index_to_code[(root_node.start_point,root_node.end_point)]
         if root_node.type==code:
-            return [],states
+            return states
         elif code in states:
-            return [(code,idx,'comesFrom',[code],states[code].copy())],states
+            DFG.append((code,idx,'comesFrom',[code],states[code].copy()))
+            return states
         else:
             if root_node.type=='identifier':
                 states[code]=[idx]
-            return [(code,idx,'comesFrom',[],[])],states
+            DFG.append((code,idx,'comesFrom',[],[]))
+            return states
     elif root_node.type in def_statement:
         name=root_node.child_by_field_name('name')
         value=root_node.child_by_field_name('value')
-        DFG=[]
         if value is None:
             indexs=tree_to_variable_index(name,index_to_code)
             for index in indexs:
                 idx,code=index_to_code[index]
                 DFG.append((code,idx,'comesFrom',[],[]))
                 states[code]=[idx]
-            return sorted(DFG,key=lambda x:x[1]),states
+            return states
         else:
             name_indexs=tree_to_variable_index(name,index_to_code)
             value_indexs=tree_to_variable_index(value,index_to_code)
-            temp,states=DFG_java(value,index_to_code,states)
-            DFG+=temp            
+            states=yield value,states
             for index1 in name_indexs:
                 idx1,code1=index_to_code[index1]
                 for index2 in value_indexs:
                     idx2,code2=index_to_code[index2]
                     DFG.append((code1,idx1,'comesFrom',[code2],[idx2]))
-                states[code1]=[idx1]   
-            return sorted(DFG,key=lambda x:x[1]),states
+                states[code1]=[idx1]
+            return states
     elif root_node.type in assignment:
         left_nodes=root_node.child_by_field_name('left')
         right_nodes=root_node.child_by_field_name('right')
-        DFG=[]
-        temp,states=DFG_java(right_nodes,index_to_code,states)
-        DFG+=temp            
+        states=yield right_nodes,states
         name_indexs=tree_to_variable_index(left_nodes,index_to_code)
-        value_indexs=tree_to_variable_index(right_nodes,index_to_code)        
+        value_indexs=tree_to_variable_index(right_nodes,index_to_code)
         for index1 in name_indexs:
             idx1,code1=index_to_code[index1]
             for index2 in value_indexs:
                 idx2,code2=index_to_code[index2]
                 DFG.append((code1,idx1,'computedFrom',[code2],[idx2]))
-            states[code1]=[idx1]   
-        return sorted(DFG,key=lambda x:x[1]),states
+            states[code1]=[idx1]
+        return states
     elif root_node.type in increment_statement:
-        DFG=[]
         indexs=tree_to_variable_index(root_node,index_to_code)
         for index1 in indexs:
             idx1,code1=index_to_code[index1]
@@ -244,9 +257,8 @@ def DFG_java(root_node,index_to_code,states):
                 idx2,code2=index_to_code[index2]
                 DFG.append((code1,idx1,'computedFrom',[code2],[idx2]))
             states[code1]=[idx1]
-        return sorted(DFG,key=lambda x:x[1]),states   
+        return states
     elif root_node.type in if_statement:
-        DFG=[]
         current_states=states.copy()
         others_states=[]
         flag=False
@@ -257,12 +269,10 @@ def DFG_java(root_node,index_to_code,states):
             if 'else' in child.type:
                 tag=True
             if child.type not in if_statement and flag is False:
-                temp,current_states=DFG_java(child,index_to_code,current_states)
-                DFG+=temp
+                current_states=yield child,current_states
             else:
                 flag=True
-                temp,new_states=DFG_java(child,index_to_code,states)
-                DFG+=temp
+                new_states=yield child,states.copy()
                 others_states.append(new_states)
         others_states.append(current_states)
         if tag is False:
@@ -276,84 +286,81 @@ def DFG_java(root_node,index_to_code,states):
                     new_states[key]+=dic[key]
         for key in new_states:
             new_states[key]=sorted(list(set(new_states[key])))
-        return sorted(DFG,key=lambda x:x[1]),new_states
+        return new_states
     elif root_node.type in for_statement:
-        DFG=[]
+        start=len(DFG)
         for child in root_node.children:
-            temp,states=DFG_java(child,index_to_code,states)
-            DFG+=temp
+            states=yield child,states
         flag=False
         for child in root_node.children:
             if flag:
-                temp,states=DFG_java(child,index_to_code,states)
-                DFG+=temp                
+                states=yield child,states
             elif child.type=="local_variable_declaration":
                 flag=True
         dic={}
-        for x in DFG:
+        for x in DFG[start:]:
             if (x[0],x[1],x[2]) not in dic:
                 dic[(x[0],x[1],x[2])]=[x[3],x[4]]
             else:
                 dic[(x[0],x[1],x[2])][0]=list(set(dic[(x[0],x[1],x[2])][0]+x[3]))
                 dic[(x[0],x[1],x[2])][1]=sorted(list(set(dic[(x[0],x[1],x[2])][1]+x[4])))
-        DFG=[(x[0],x[1],x[2],y[0],y[1]) for x,y in sorted(dic.items(),key=lambda t:t[0][1])]
-        return sorted(DFG,key=lambda x:x[1]),states
+        DFG[start:]=[(x[0],x[1],x[2],y[0],y[1]) for x,y in sorted(dic.items(),key=lambda t:t[0][1])]
+        return states
     elif root_node.type in enhanced_for_statement:
         name=root_node.child_by_field_name('name')
         value=root_node.child_by_field_name('value')
         body=root_node.child_by_field_name('body')
-        DFG=[]
+        start=len(DFG)
         for i in range(2):
-            temp,states=DFG_java(value,index_to_code,states)
-            DFG+=temp       
+            states=yield value,states
             name_indexs=tree_to_variable_index(name,index_to_code)
-            value_indexs=tree_to_variable_index(value,index_to_code)        
+            value_indexs=tree_to_variable_index(value,index_to_code)
             for index1 in name_indexs:
                 idx1,code1=index_to_code[index1]
                 for index2 in value_indexs:
                     idx2,code2=index_to_code[index2]
                     DFG.append((code1,idx1,'computedFrom',[code2],[idx2]))
-                states[code1]=[idx1]   
-            temp,states=DFG_java(body,index_to_code,states)
-            DFG+=temp                       
+                states[code1]=[idx1]
+            states=yield body,states
         dic={}
-        for x in DFG:
+        for x in DFG[start:]:
             if (x[0],x[1],x[2]) not in dic:
                 dic[(x[0],x[1],x[2])]=[x[3],x[4]]
             else:
                 dic[(x[0],x[1],x[2])][0]=list(set(dic[(x[0],x[1],x[2])][0]+x[3]))
                 dic[(x[0],x[1],x[2])][1]=sorted(list(set(dic[(x[0],x[1],x[2])][1]+x[4])))
-        DFG=[(x[0],x[1],x[2],y[0],y[1]) for x,y in sorted(dic.items(),key=lambda t:t[0][1])]
-        return sorted(DFG,key=lambda x:x[1]),states
-    elif root_node.type in while_statement:  
-        DFG=[]
+        DFG[start:]=[(x[0],x[1],x[2],y[0],y[1]) for x,y in sorted(dic.items(),key=lambda t:t[0][1])]
+        return states
+    elif root_node.type in while_statement:
+        start=len(DFG)
         for i in range(2):
             for child in root_node.children:
-                temp,states=DFG_java(child,index_to_code,states)
-                DFG+=temp    
+                states=yield child,states
         dic={}
-        for x in DFG:
+        for x in DFG[start:]:
             if (x[0],x[1],x[2]) not in dic:
                 dic[(x[0],x[1],x[2])]=[x[3],x[4]]
             else:
                 dic[(x[0],x[1],x[2])][0]=list(set(dic[(x[0],x[1],x[2])][0]+x[3]))
                 dic[(x[0],x[1],x[2])][1]=sorted(list(set(dic[(x[0],x[1],x[2])][1]+x[4])))
-        DFG=[(x[0],x[1],x[2],y[0],y[1]) for x,y in sorted(dic.items(),key=lambda t:t[0][1])]
-        return sorted(DFG,key=lambda x:x[1]),states        
+        DFG[start:]=[(x[0],x[1],x[2],y[0],y[1]) for x,y in sorted(dic.items(),key=lambda t:t[0][1])]
+        return states
     else:
-        DFG=[]
         for child in root_node.children:
             if child.type in do_first_statement:
-                temp,states=DFG_java(child,index_to_code,states)
-                DFG+=temp
+                states=yield child,states
         for child in root_node.children:
             if child.type not in do_first_statement:
-                temp,states=DFG_java(child,index_to_code,states)
-                DFG+=temp
-        
-        return sorted(DFG,key=lambda x:x[1]),states
+                states=yield child,states
+
+        return states
+
 
 def DFG_csharp(root_node,index_to_code,states):
+    return run_dfg(_DFG_csharp,root_node,index_to_code,states)
+
+
+def _DFG_csharp(root_node,index_to_code,states,DFG):
     assignment=['assignment_expression']
     def_statement=['variable_declarator']
     increment_statement=['postfix_unary_expression']
@@ -361,18 +368,19 @@ def DFG_csharp(root_node,index_to_code,states):
     for_statement=['for_statement']
     enhanced_for_statement=['for_each_statement']
     while_statement=['while_statement']
-    do_first_statement=[]    
-    states=states.copy()
+    do_first_statement=[]
     if (len(root_node.children)==0 or root_node.type in ['string_literal','string','character_literal']) and root_node.type!='comment':
         idx,code=index_to_code[(root_node.start_point,root_node.end_point)]
         if root_node.type==code:
-            return [],states
+            return states
         elif code in states:
-            return [(code,idx,'comesFrom',[code],states[code].copy())],states
+            DFG.append((code,idx,'comesFrom',[code],states[code].copy()))
+            return states
         else:
             if root_node.type=='identifier':
                 states[code]=[idx]
-            return [(code,idx,'comesFrom',[],[])],states
+            DFG.append((code,idx,'comesFrom',[],[]))
+            return states
     elif root_node.type in def_statement:
         if len(root_node.children)==2:
             name=root_node.children[0]
@@ -380,43 +388,38 @@ def DFG_csharp(root_node,index_to_code,states):
         else:
             name=root_node.children[0]
             value=None
-        DFG=[]
         if value is None:
             indexs=tree_to_variable_index(name,index_to_code)
             for index in indexs:
                 idx,code=index_to_code[index]
                 DFG.append((code,idx,'comesFrom',[],[]))
                 states[code]=[idx]
-            return sorted(DFG,key=lambda x:x[1]),states
+            return states
         else:
             name_indexs=tree_to_variable_index(name,index_to_code)
             value_indexs=tree_to_variable_index(value,index_to_code)
-            temp,states=DFG_csharp(value,index_to_code,states)
-            DFG+=temp            
+            states=yield value,states
             for index1 in name_indexs:
                 idx1,code1=index_to_code[index1]
                 for index2 in value_indexs:
                     idx2,code2=index_to_code[index2]
                     DFG.append((code1,idx1,'comesFrom',[code2],[idx2]))
-                states[code1]=[idx1]   
-            return sorted(DFG,key=lambda x:x[1]),states
+                states[code1]=[idx1]
+            return states
     elif root_node.type in assignment:
         left_nodes=root_node.child_by_field_name('left')
         right_nodes=root_node.child_by_field_name('right')
-        DFG=[]
-        temp,states=DFG_csharp(right_nodes,index_to_code,states)
-        DFG+=temp            
+        states=yield right_nodes,states
         name_indexs=tree_to_variable_index(left_nodes,index_to_code)
-        value_indexs=tree_to_variable_index(right_nodes,index_to_code)        
+        value_indexs=tree_to_variable_index(right_nodes,index_to_code)
         for index1 in name_indexs:
             idx1,code1=index_to_code[index1]
             for index2 in value_indexs:
                 idx2,code2=index_to_code[index2]
                 DFG.append((code1,idx1,'computedFrom',[code2],[idx2]))
-            states[code1]=[idx1]   
-        return sorted(DFG,key=lambda x:x[1]),states
+            states[code1]=[idx1]
+        return states
     elif root_node.type in increment_statement:
-        DFG=[]
         indexs=tree_to_variable_index(root_node,index_to_code)
         for index1 in indexs:
             idx1,code1=index_to_code[index1]
@@ -424,9 +427,8 @@ def DFG_csharp(root_node,index_to_code,states):
                 idx2,code2=index_to_code[index2]
                 DFG.append((code1,idx1,'computedFrom',[code2],[idx2]))
             states[code1]=[idx1]
-        return sorted(DFG,key=lambda x:x[1]),states   
+        return states
     elif root_node.type in if_statement:
-        DFG=[]
         current_states=states.copy()
         others_states=[]
         flag=False
@@ -437,12 +439,10 @@ def DFG_csharp(root_node,index_to_code,states):
             if 'else' in child.type:
                 tag=True
             if child.type not in if_statement and flag is False:
-                temp,current_states=DFG_csharp(child,index_to_code,current_states)
-                DFG+=temp
+                current_states=yield child,current_states
             else:
                 flag=True
-                temp,new_states=DFG_csharp(child,index_to_code,states)
-                DFG+=temp
+                new_states=yield child,states.copy()
                 others_states.append(new_states)
         others_states.append(current_states)
         if tag is False:
@@ -456,127 +456,121 @@ def DFG_csharp(root_node,index_to_code,states):
                     new_states[key]+=dic[key]
         for key in new_states:
             new_states[key]=sorted(list(set(new_states[key])))
-        return sorted(DFG,key=lambda x:x[1]),new_states
+        return new_states
     elif root_node.type in for_statement:
-        DFG=[]
+        start=len(DFG)
         for child in root_node.children:
-            temp,states=DFG_csharp(child,index_to_code,states)
-            DFG+=temp
+            states=yield child,states
         flag=False
         for child in root_node.children:
             if flag:
-                temp,states=DFG_csharp(child,index_to_code,states)
-                DFG+=temp                
+                states=yield child,states
             elif child.type=="local_variable_declaration":
                 flag=True
         dic={}
-        for x in DFG:
+        for x in DFG[start:]:
             if (x[0],x[1],x[2]) not in dic:
                 dic[(x[0],x[1],x[2])]=[x[3],x[4]]
             else:
                 dic[(x[0],x[1],x[2])][0]=list(set(dic[(x[0],x[1],x[2])][0]+x[3]))
                 dic[(x[0],x[1],x[2])][1]=sorted(list(set(dic[(x[0],x[1],x[2])][1]+x[4])))
-        DFG=[(x[0],x[1],x[2],y[0],y[1]) for x,y in sorted(dic.items(),key=lambda t:t[0][1])]
-        return sorted(DFG,key=lambda x:x[1]),states
+        DFG[start:]=[(x[0],x[1],x[2],y[0],y[1]) for x,y in sorted(dic.items(),key=lambda t:t[0][1])]
+        return states
     elif root_node.type in enhanced_for_statement:
         name=root_node.child_by_field_name('left')
         value=root_node.child_by_field_name('right')
         body=root_node.child_by_field_name('body')
-        DFG=[]
+        start=len(DFG)
         for i in range(2):
-            temp,states=DFG_csharp(value,index_to_code,states)
-            DFG+=temp       
+            states=yield value,states
             name_indexs=tree_to_variable_index(name,index_to_code)
-            value_indexs=tree_to_variable_index(value,index_to_code)        
+            value_indexs=tree_to_variable_index(value,index_to_code)
             for index1 in name_indexs:
                 idx1,code1=index_to_code[index1]
                 for index2 in value_indexs:
                     idx2,code2=index_to_code[index2]
                     DFG.append((code1,idx1,'computedFrom',[code2],[idx2]))
-                states[code1]=[idx1]   
-            temp,states=DFG_csharp(body,index_to_code,states)
-            DFG+=temp                       
+                states[code1]=[idx1]
+            states=yield body,states
         dic={}
-        for x in DFG:
+        for x in DFG[start:]:
             if (x[0],x[1],x[2]) not in dic:
                 dic[(x[0],x[1],x[2])]=[x[3],x[4]]
             else:
                 dic[(x[0],x[1],x[2])][0]=list(set(dic[(x[0],x[1],x[2])][0]+x[3]))
                 dic[(x[0],x[1],x[2])][1]=sorted(list(set(dic[(x[0],x[1],x[2])][1]+x[4])))
-        DFG=[(x[0],x[1],x[2],y[0],y[1]) for x,y in sorted(dic.items(),key=lambda t:t[0][1])]
-        return sorted(DFG,key=lambda x:x[1]),states
-    elif root_node.type in while_statement:  
-        DFG=[]
+        DFG[start:]=[(x[0],x[1],x[2],y[0],y[1]) for x,y in sorted(dic.items(),key=lambda t:t[0][1])]
+        return states
+    elif root_node.type in while_statement:
+        start=len(DFG)
         for i in range(2):
             for child in root_node.children:
-                temp,states=DFG_csharp(child,index_to_code,states)
-                DFG+=temp    
+                states=yield child,states
         dic={}
-        for x in DFG:
+        for x in DFG[start:]:
             if (x[0],x[1],x[2]) not in dic:
                 dic[(x[0],x[1],x[2])]=[x[3],x[4]]
             else:
                 dic[(x[0],x[1],x[2])][0]=list(set(dic[(x[0],x[1],x[2])][0]+x[3]))
                 dic[(x[0],x[1],x[2])][1]=sorted(list(set(dic[(x[0],x[1],x[2])][1]+x[4])))
-        DFG=[(x[0],x[1],x[2],y[0],y[1]) for x,y in sorted(dic.items(),key=lambda t:t[0][1])]
-        return sorted(DFG,key=lambda x:x[1]),states        
+        DFG[start:]=[(x[0],x[1],x[2],y[0],y[1]) for x,y in sorted(dic.items(),key=lambda t:t[0][1])]
+        return states
     else:
-        DFG=[]
         for child in root_node.children:
             if child.type in do_first_statement:
-                temp,states=DFG_csharp(child,index_to_code,states)
-                DFG+=temp
+                states=yield child,states
         for child in root_node.children:
             if child.type not in do_first_statement:
-                temp,states=DFG_csharp(child,index_to_code,states)
-                DFG+=temp
-        
-        return sorted(DFG,key=lambda x:x[1]),states
+                states=yield child,states
+
+        return states
 
 
-    
-    
 def DFG_ruby(root_node,index_to_code,states):
+    return run_dfg(_DFG_ruby,root_node,index_to_code,states)
+
+
+def _DFG_ruby(root_node,index_to_code,states,DFG):
     assignment=['assignment','operator_assignment']
     if_statement=['if','elsif','else','unless','when']
     for_statement=['for']
     while_statement=['while_modifier','until']
-    do_first_statement=[] 
+    do_first_statement=[]
     def_statement=['keyword_parameter']
     if (len(root_node.children)==0 or root_node.type in ['string_literal','string','character_literal']) and root_node.type!='comment':
         states=states.copy()
         idx,code=index_to_code[(root_node.start_point,root_node.end_point)]
         if root_node.type==code:
-            return [],states
+            return states
         elif code in states:
-            return [(code,idx,'comesFrom',[code],states[code].copy())],states
+            DFG.append((code,idx,'comesFrom',[code],states[code].copy()))
+            return states
         else:
             if root_node.type=='identifier':
                 states[code]=[idx]
-            return [(code,idx,'comesFrom',[],[])],states
+            DFG.append((code,idx,'comesFrom',[],[]))
+            return states
     elif root_node.type in def_statement:
         name=root_node.child_by_field_name('name')
         value=root_node.child_by_field_name('value')
-        DFG=[]
         if value is None:
             indexs=tree_to_variable_index(name,index_to_code)
             for index in indexs:
                 idx,code=index_to_code[index]
                 DFG.append((code,idx,'comesFrom',[],[]))
                 states[code]=[idx]
-            return sorted(DFG,key=lambda x:x[1]),states
+            return states
         else:
             name_indexs=tree_to_variable_index(name,index_to_code)
             value_indexs=tree_to_variable_index(value,index_to_code)
-            temp,states=DFG_ruby(value,index_to_code,states)
-            DFG+=temp            
+            states=yield value,states
             for index1 in name_indexs:
                 idx1,code1=index_to_code[index1]
                 for index2 in value_indexs:
                     idx2,code2=index_to_code[index2]
                     DFG.append((code1,idx1,'comesFrom',[code2],[idx2]))
-                states[code1]=[idx1]   
-            return sorted(DFG,key=lambda x:x[1]),states        
+                states[code1]=[idx1]
+            return states
     elif root_node.type in assignment:
         left_nodes=[x for x in root_node.child_by_field_name('left').children if x.type!=',']
         right_nodes=[x for x in root_node.child_by_field_name('right').children if x.type!=',']
@@ -591,11 +585,9 @@ def DFG_ruby(root_node,index_to_code,states):
             left_nodes=[root_node.children[0]]
             right_nodes=[root_node.children[-1]]
 
-        DFG=[]
         for node in right_nodes:
-            temp,states=DFG_ruby(node,index_to_code,states)
-            DFG+=temp
-            
+            states=yield node,states
+
         for left_node,right_node in zip(left_nodes,right_nodes):
             left_tokens_index=tree_to_variable_index(left_node,index_to_code)
             right_tokens_index=tree_to_variable_index(right_node,index_to_code)
@@ -605,10 +597,9 @@ def DFG_ruby(root_node,index_to_code,states):
                 temp.append((code1,idx1,'computedFrom',[index_to_code[x][1] for x in right_tokens_index],
                              [index_to_code[x][0] for x in right_tokens_index]))
                 states[code1]=[idx1]
-            DFG+=temp        
-        return sorted(DFG,key=lambda x:x[1]),states
+            DFG+=temp
+        return states
     elif root_node.type in if_statement:
-        DFG=[]
         current_states=states.copy()
         others_states=[]
         tag=False
@@ -618,11 +609,9 @@ def DFG_ruby(root_node,index_to_code,states):
             if 'else' in child.type:
                 tag=True
             if child.type not in if_statement:
-                temp,current_states=DFG_ruby(child,index_to_code,current_states)
-                DFG+=temp
+                current_states=yield child,current_states
             else:
-                temp,new_states=DFG_ruby(child,index_to_code,states)
-                DFG+=temp
+                new_states=yield child,states.copy()
                 others_states.append(new_states)
         others_states.append(current_states)
         if tag is False:
@@ -636,16 +625,15 @@ def DFG_ruby(root_node,index_to_code,states):
                     new_states[key]+=dic[key]
         for key in new_states:
             new_states[key]=sorted(list(set(new_states[key])))
-        return sorted(DFG,key=lambda x:x[1]),new_states
+        return new_states
     elif root_node.type in for_statement:
-        DFG=[]
+        start=len(DFG)
         for i in range(2):
             left_nodes=[root_node.child_by_field_name('pattern')]
             right_nodes=[root_node.child_by_field_name('value')]
             assert len(right_nodes)==len(left_nodes)
             for node in right_nodes:
-                temp,states=DFG_ruby(node,index_to_code,states)
-                DFG+=temp
+                states=yield node,states
             for left_node,right_node in zip(left_nodes,right_nodes):
                 left_tokens_index=tree_to_variable_index(left_node,index_to_code)
                 right_tokens_index=tree_to_variable_index(right_node,index_to_code)
@@ -655,47 +643,47 @@ def DFG_ruby(root_node,index_to_code,states):
                     temp.append((code1,idx1,'computedFrom',[index_to_code[x][1] for x in right_tokens_index],
                                  [index_to_code[x][0] for x in right_tokens_index]))
                     states[code1]=[idx1]
-                DFG+=temp 
-            temp,states=DFG_ruby(root_node.child_by_field_name('body'),index_to_code,states)
-            DFG+=temp 
+                DFG+=temp
+            states=yield root_node.child_by_field_name('body'),states
         dic={}
-        for x in DFG:
+        for x in DFG[start:]:
             if (x[0],x[1],x[2]) not in dic:
                 dic[(x[0],x[1],x[2])]=[x[3],x[4]]
             else:
                 dic[(x[0],x[1],x[2])][0]=list(set(dic[(x[0],x[1],x[2])][0]+x[3]))
                 dic[(x[0],x[1],x[2])][1]=sorted(list(set(dic[(x[0],x[1],x[2])][1]+x[4])))
-        DFG=[(x[0],x[1],x[2],y[0],y[1]) for x,y in sorted(dic.items(),key=lambda t:t[0][1])]
-        return sorted(DFG,key=lambda x:x[1]),states
-    elif root_node.type in while_statement:  
-        DFG=[]
+        DFG[start:]=[(x[0],x[1],x[2],y[0],y[1]) for x,y in sorted(dic.items(),key=lambda t:t[0][1])]
+        return states
+    elif root_node.type in while_statement:
+        start=len(DFG)
         for i in range(2):
             for child in root_node.children:
-                temp,states=DFG_ruby(child,index_to_code,states)
-                DFG+=temp    
+                states=yield child,states
         dic={}
-        for x in DFG:
+        for x in DFG[start:]:
             if (x[0],x[1],x[2]) not in dic:
                 dic[(x[0],x[1],x[2])]=[x[3],x[4]]
             else:
                 dic[(x[0],x[1],x[2])][0]=list(set(dic[(x[0],x[1],x[2])][0]+x[3]))
                 dic[(x[0],x[1],x[2])][1]=sorted(list(set(dic[(x[0],x[1],x[2])][1]+x[4])))
-        DFG=[(x[0],x[1],x[2],y[0],y[1]) for x,y in sorted(dic.items(),key=lambda t:t[0][1])]
-        return sorted(DFG,key=lambda x:x[1]),states        
+        DFG[start:]=[(x[0],x[1],x[2],y[0],y[1]) for x,y in sorted(dic.items(),key=lambda t:t[0][1])]
+        return states
     else:
-        DFG=[]
         for child in root_node.children:
             if child.type in do_first_statement:
-                temp,states=DFG_ruby(child,index_to_code,states)
-                DFG+=temp
+                states=yield child,states
         for child in root_node.children:
             if child.type not in do_first_statement:
-                temp,states=DFG_ruby(child,index_to_code,states)
-                DFG+=temp
-        
-        return sorted(DFG,key=lambda x:x[1]),states
+                states=yield child,states
+
+        return states
+
 
 def DFG_go(root_node,index_to_code,states):
+    return run_dfg(_DFG_go,root_node,index_to_code,states)
+
+
+def _DFG_go(root_node,index_to_code,states,DFG):
     assignment=['assignment_statement',]
     def_statement=['var_spec']
     increment_statement=['inc_statement']
@@ -703,58 +691,54 @@ def DFG_go(root_node,index_to_code,states):
     for_statement=['for_statement']
     enhanced_for_statement=[]
     while_statement=[]
-    do_first_statement=[]    
-    states=states.copy()
+    do_first_statement=[]
     if (len(root_node.children)==0 or root_node.type in ['string_literal','string','character_literal']) and root_node.type!='comment':
         idx,code=index_to_code[(root_node.start_point,root_node.end_point)]
         if root_node.type==code:
-            return [],states
+            return states
         elif code in states:
-            return [(code,idx,'comesFrom',[code],states[code].copy())],states
+            DFG.append((code,idx,'comesFrom',[code],states[code].copy()))
+            return states
         else:
             if root_node.type=='identifier':
                 states[code]=[idx]
-            return [(code,idx,'comesFrom',[],[])],states
+            DFG.append((code,idx,'comesFrom',[],[]))
+            return states
     elif root_node.type in def_statement:
         name=root_node.child_by_field_name('name')
         value=root_node.child_by_field_name('value')
-        DFG=[]
         if value is None:
             indexs=tree_to_variable_index(name,index_to_code)
             for index in indexs:
                 idx,code=index_to_code[index]
                 DFG.append((code,idx,'comesFrom',[],[]))
                 states[code]=[idx]
-            return sorted(DFG,key=lambda x:x[1]),states
+            return states
         else:
             name_indexs=tree_to_variable_index(name,index_to_code)
             value_indexs=tree_to_variable_index(value,index_to_code)
-            temp,states=DFG_go(value,index_to_code,states)
-            DFG+=temp            
+            states=yield value,states
             for index1 in name_indexs:
                 idx1,code1=index_to_code[index1]
                 for index2 in value_indexs:
                     idx2,code2=index_to_code[index2]
                     DFG.append((code1,idx1,'comesFrom',[code2],[idx2]))
-                states[code1]=[idx1]   
-            return sorted(DFG,key=lambda x:x[1]),states
+                states[code1]=[idx1]
+            return states
     elif root_node.type in assignment:
         left_nodes=root_node.child_by_field_name('left')
         right_nodes=root_node.child_by_field_name('right')
-        DFG=[]
-        temp,states=DFG_go(right_nodes,index_to_code,states)
-        DFG+=temp            
+        states=yield right_nodes,states
         name_indexs=tree_to_variable_index(left_nodes,index_to_code)
-        value_indexs=tree_to_variable_index(right_nodes,index_to_code)        
+        value_indexs=tree_to_variable_index(right_nodes,index_to_code)
         for index1 in name_indexs:
             idx1,code1=index_to_code[index1]
             for index2 in value_indexs:
                 idx2,code2=index_to_code[index2]
                 DFG.append((code1,idx1,'computedFrom',[code2],[idx2]))
-            states[code1]=[idx1]   
-        return sorted(DFG,key=lambda x:x[1]),states
+            states[code1]=[idx1]
+        return states
     elif root_node.type in increment_statement:
-        DFG=[]
         indexs=tree_to_variable_index(root_node,index_to_code)
         for index1 in indexs:
             idx1,code1=index_to_code[index1]
@@ -762,9 +746,8 @@ def DFG_go(root_node,index_to_code,states):
                 idx2,code2=index_to_code[index2]
                 DFG.append((code1,idx1,'computedFrom',[code2],[idx2]))
             states[code1]=[idx1]
-        return sorted(DFG,key=lambda x:x[1]),states   
+        return states
     elif root_node.type in if_statement:
-        DFG=[]
         current_states=states.copy()
         others_states=[]
         flag=False
@@ -775,12 +758,10 @@ def DFG_go(root_node,index_to_code,states):
             if 'else' in child.type:
                 tag=True
             if child.type not in if_statement and flag is False:
-                temp,current_states=DFG_go(child,index_to_code,current_states)
-                DFG+=temp
+                current_states=yield child,current_states
             else:
                 flag=True
-                temp,new_states=DFG_go(child,index_to_code,states)
-                DFG+=temp
+                new_states=yield child,states.copy()
                 others_states.append(new_states)
         others_states.append(current_states)
         if tag is False:
@@ -799,48 +780,44 @@ def DFG_go(root_node,index_to_code,states):
                 new_states[key]+=states[key]
         for key in new_states:
             new_states[key]=sorted(list(set(new_states[key])))
-        return sorted(DFG,key=lambda x:x[1]),new_states
+        return new_states
     elif root_node.type in for_statement:
-        DFG=[]
+        start=len(DFG)
         for child in root_node.children:
-            temp,states=DFG_go(child,index_to_code,states)
-            DFG+=temp
+            states=yield child,states
         flag=False
         for child in root_node.children:
             if flag:
-                temp,states=DFG_go(child,index_to_code,states)
-                DFG+=temp                
+                states=yield child,states
             elif child.type=="for_clause":
                 if child.child_by_field_name('update') is not None:
-                    temp,states=DFG_go(child.child_by_field_name('update'),index_to_code,states)
-                    DFG+=temp                 
+                    states=yield child.child_by_field_name('update'),states
                 flag=True
         dic={}
-        for x in DFG:
+        for x in DFG[start:]:
             if (x[0],x[1],x[2]) not in dic:
                 dic[(x[0],x[1],x[2])]=[x[3],x[4]]
             else:
                 dic[(x[0],x[1],x[2])][0]=list(set(dic[(x[0],x[1],x[2])][0]+x[3]))
                 dic[(x[0],x[1],x[2])][1]=sorted(list(set(dic[(x[0],x[1],x[2])][1]+x[4])))
-        DFG=[(x[0],x[1],x[2],y[0],y[1]) for x,y in sorted(dic.items(),key=lambda t:t[0][1])]
-        return sorted(DFG,key=lambda x:x[1]),states
+        DFG[start:]=[(x[0],x[1],x[2],y[0],y[1]) for x,y in sorted(dic.items(),key=lambda t:t[0][1])]
+        return states
     else:
-        DFG=[]
         for child in root_node.children:
             if child.type in do_first_statement:
-                temp,states=DFG_go(child,index_to_code,states)
-                DFG+=temp
+                states=yield child,states
         for child in root_node.children:
             if child.type not in do_first_statement:
-                temp,states=DFG_go(child,index_to_code,states)
-                DFG+=temp
-        
-        return sorted(DFG,key=lambda x:x[1]),states
+                states=yield child,states
+
+        return states
 
-    
-    
 
 def DFG_php(root_node,index_to_code,states):
+    return run_dfg(_DFG_php,root_node,index_to_code,states)
+
+
+def _DFG_php(root_node,index_to_code,states,DFG):
     assignment=['assignment_expression','augmented_assignment_expression']
     def_statement=['simple_parameter']
     increment_statement=['update_expression']
@@ -848,58 +825,54 @@ def DFG_php(root_node,index_to_code,states):
     for_statement=['for_statement']
     enhanced_for_statement=['foreach_statement']
     while_statement=['while_statement']
-    do_first_statement=[]    
-    states=states.copy()
+    do_first_statement=[]
     if (len(root_node.children)==0 or root_node.type in ['string_literal','string','character_literal']) and root_node.type!='comment':
         idx,code=index_to_code[(root_node.start_point,root_node.end_point)]
         if root_node.type==code:
-            return [],states
+            return states
         elif code in states:
-            return [(code,idx,'comesFrom',[code],states[code].copy())],states
+            DFG.append((code,idx,'comesFrom',[code],states[code].copy()))
+            return states
         else:
             if root_node.type=='identifier':
                 states[code]=[idx]
-            return [(code,idx,'comesFrom',[],[])],states
+            DFG.append((code,idx,'comesFrom',[],[]))
+            return states
     elif root_node.type in def_statement:
         name=root_node.child_by_field_name('name')
         value=root_node.child_by_field_name('default_value')
-        DFG=[]
         if value is None:
             indexs=tree_to_variable_index(name,index_to_code)
             for index in indexs:
                 idx,code=index_to_code[index]
                 DFG.append((code,idx,'comesFrom',[],[]))
                 states[code]=[idx]
-            return sorted(DFG,key=lambda x:x[1]),states
+            return states
         else:
             name_indexs=tree_to_variable_index(name,index_to_code)
             value_indexs=tree_to_variable_index(value,index_to_code)
-            temp,states=DFG_php(value,index_to_code,states)
-            DFG+=temp            
+            states=yield value,states
             for index1 in name_indexs:
                 idx1,code1=index_to_code[index1]
                 for index2 in value_indexs:
                     idx2,code2=index_to_code[index2]
                     DFG.append((code1,idx1,'comesFrom',[code2],[idx2]))
-                states[code1]=[idx1]   
-            return sorted(DFG,key=lambda x:x[1]),states
+                states[code1]=[idx1]
+            return states
     elif root_node.type in assignment:
         left_nodes=root_node.child_by_field_name('left')
         right_nodes=root_node.child_by_field_name('right')
-        DFG=[]
-        temp,states=DFG_php(right_nodes,index_to_code,states)
-        DFG+=temp            
+        states=yield right_nodes,states
         name_indexs=tree_to_variable_index(left_nodes,index_to_code)
-        value_indexs=tree_to_variable_index(right_nodes,index_to_code)        
+        value_indexs=tree_to_variable_index(right_nodes,index_to_code)
         for index1 in name_indexs:
             idx1,code1=index_to_code[index1]
             for index2 in value_indexs:
                 idx2,code2=index_to_code[index2]
                 DFG.append((code1,idx1,'computedFrom',[code2],[idx2]))
-            states[code1]=[idx1]   
-        return sorted(DFG,key=lambda x:x[1]),states
+            states[code1]=[idx1]
+        return states
     elif root_node.type in increment_statement:
-        DFG=[]
         indexs=tree_to_variable_index(root_node,index_to_code)
         for index1 in indexs:
             idx1,code1=index_to_code[index1]
@@ -907,9 +880,8 @@ def DFG_php(root_node,index_to_code,states):
                 idx2,code2=index_to_code[index2]
                 DFG.append((code1,idx1,'computedFrom',[code2],[idx2]))
             states[code1]=[idx1]
-        return sorted(DFG,key=lambda x:x[1]),states   
+        return states
     elif root_node.type in if_statement:
-        DFG=[]
         current_states=states.copy()
         others_states=[]
         flag=False
@@ -920,12 +892,10 @@ def DFG_php(root_node,index_to_code,states):
             if 'else' in child.type:
                 tag=True
             if child.type not in if_statement and flag is False:
-                temp,current_states=DFG_php(child,index_to_code,current_states)
-                DFG+=temp
+                current_states=yield child,current_states
             else:
                 flag=True
-                temp,new_states=DFG_php(child,index_to_code,states)
-                DFG+=temp
+                new_states=yield child,states.copy()
                 others_states.append(new_states)
         others_states.append(current_states)
         new_states={}
@@ -942,28 +912,26 @@ def DFG_php(root_node,index_to_code,states):
                 new_states[key]+=states[key]
         for key in new_states:
             new_states[key]=sorted(list(set(new_states[key])))
-        return sorted(DFG,key=lambda x:x[1]),new_states
+        return new_states
     elif root_node.type in for_statement:
-        DFG=[]
+        start=len(DFG)
         for child in root_node.children:
-            temp,states=DFG_php(child,index_to_code,states)
-            DFG+=temp
+            states=yield child,states
         flag=False
         for child in root_node.children:
             if flag:
-                temp,states=DFG_php(child,index_to_code,states)
-                DFG+=temp                
-            elif child.type=="assignment_expression":               
+                states=yield child,states
+            elif child.type=="assignment_expression":
                 flag=True
         dic={}
-        for x in DFG:
+        for x in DFG[start:]:
             if (x[0],x[1],x[2]) not in dic:
                 dic[(x[0],x[1],x[2])]=[x[3],x[4]]
             else:
                 dic[(x[0],x[1],x[2])][0]=list(set(dic[(x[0],x[1],x[2])][0]+x[3]))
                 dic[(x[0],x[1],x[2])][1]=sorted(list(set(dic[(x[0],x[1],x[2])][1]+x[4])))
-        DFG=[(x[0],x[1],x[2],y[0],y[1]) for x,y in sorted(dic.items(),key=lambda t:t[0][1])]
-        return sorted(DFG,key=lambda x:x[1]),states
+        DFG[start:]=[(x[0],x[1],x[2],y[0],y[1]) for x,y in sorted(dic.items(),key=lambda t:t[0][1])]
+        return states
     elif root_node.type in enhanced_for_statement:
         name=None
         value=None
@@ -974,59 +942,57 @@ def DFG_php(root_node,index_to_code,states):
                 name=child
                 break
         body=root_node.child_by_field_name('body')
-        DFG=[]
+        start=len(DFG)
         for i in range(2):
-            temp,states=DFG_php(value,index_to_code,states)
-            DFG+=temp       
+            states=yield value,states
             name_indexs=tree_to_variable_index(name,index_to_code)
-            value_indexs=tree_to_variable_index(value,index_to_code)        
+            value_indexs=tree_to_variable_index(value,index_to_code)
             for index1 in name_indexs:
                 idx1,code1=index_to_code[index1]
                 for index2 in value_indexs:
                     idx2,code2=index_to_code[index2]
                     DFG.append((code1,idx1,'computedFrom',[code2],[idx2]))
-                states[code1]=[idx1]   
-            temp,states=DFG_php(body,index_to_code,states)
-            DFG+=temp                       
+                states[code1]=[idx1]
+            states=yield body,states
         dic={}
-        for x in DFG:
+        for x in DFG[start:]:
             if (x[0],x[1],x[2]) not in dic:
                 dic[(x[0],x[1],x[2])]=[x[3],x[4]]
             else:
                 dic[(x[0],x[1],x[2])][0]=list(set(dic[(x[0],x[1],x[2])][0]+x[3]))
                 dic[(x[0],x[1],x[2])][1]=sorted(list(set(dic[(x[0],x[1],x[2])][1]+x[4])))
-        DFG=[(x[0],x[1],x[2],y[0],y[1]) for x,y in sorted(dic.items(),key=lambda t:t[0][1])]
-        return sorted(DFG,key=lambda x:x[1]),states
-    elif root_node.type in while_statement:  
-        DFG=[]
+        DFG[start:]=[(x[0],x[1],x[2],y[0],y[1]) for x,y in sorted(dic.items(),key=lambda t:t[0][1])]
+        return states
+    elif root_node.type in while_statement:
+        start=len(DFG)
         for i in range(2):
             for child in root_node.children:
-                temp,states=DFG_php(child,index_to_code,states)
-                DFG+=temp    
+                states=yield child,states
         dic={}
-        for x in DFG:
+        for x in DFG[start:]:
             if (x[0],x[1],x[2]) not in dic:
                 dic[(x[0],x[1],x[2])]=[x[3],x[4]]
             else:
                 dic[(x[0],x[1],x[2])][0]=list(set(dic[(x[0],x[1],x[2])][0]+x[3]))
                 dic[(x[0],x[1],x[2])][1]=sorted(list(set(dic[(x[0],x[1],x[2])][1]+x[4])))
-        DFG=[(x[0],x[1],x[2],y[0],y[1]) for x,y in sorted(dic.items(),key=lambda t:t[0][1])]
-        return sorted(DFG,key=lambda x:x[1]),states        
+        DFG[start:]=[(x[0],x[1],x[2],y[0],y[1]) for x,y in sorted(dic.items(),key=lambda t:t[0][1])]
+        return states
     else:
-        DFG=[]
         for child in root_node.children:
             if child.type in do_first_statement:
-                temp,states=DFG_php(child,index_to_code,states)
-                DFG+=temp
+                states=yield child,states
         for child in root_node.children:
             if child.type not in do_first_statement:
-                temp,states=DFG_php(child,index_to_code,states)
-                DFG+=temp
-        
-        return sorted(DFG,key=lambda x:x[1]),states
+                states=yield child,states
+
+        return states
 
 
 def DFG_javascript(root_node,index_to_code,states):
+    return run_dfg(_DFG_javascript,root_node,index_to_code,states)
+
+
+def _DFG_javascript(root_node,index_to_code,states,DFG):
     assignment=['assignment_pattern','augmented_assignment_expression']
     def_statement=['variable_declarator']
     increment_statement=['update_expression']
@@ -1034,58 +1000,54 @@ def DFG_javascript(root_node,index_to_code,states):
     for_statement=['for_statement']
     enhanced_for_statement=[]
     while_statement=['while_statement']
-    do_first_statement=[]    
-    states=states.copy()
+    do_first_statement=[]
     if (len(root_node.children)==0 or root_node.type in ['string_literal','string','character_literal']) and root_node.type!='comment':
         idx,code=index_to_code[(root_node.start_point,root_node.end_point)]
         if root_node.type==code:
-            return [],states
+            return states
         elif code in states:
-            return [(code,idx,'comesFrom',[code],states[code].copy())],states
+            DFG.append((code,idx,'comesFrom',[code],states[code].copy()))
+            return states
         else:
             if root_node.type=='identifier':
                 states[code]=[idx]
-            return [(code,idx,'comesFrom',[],[])],states
+            DFG.append((code,idx,'comesFrom',[],[]))
+            return states
     elif root_node.type in def_statement:
         name=root_node.child_by_field_name('name')
         value=root_node.child_by_field_name('value')
-        DFG=[]
         if value is None:
             indexs=tree_to_variable_index(name,index_to_code)
             for index in indexs:
                 idx,code=index_to_code[index]
                 DFG.append((code,idx,'comesFrom',[],[]))
                 states[code]=[idx]
-            return sorted(DFG,key=lambda x:x[1]),states
+            return states
         else:
             name_indexs=tree_to_variable_index(name,index_to_code)
             value_indexs=tree_to_variable_index(value,index_to_code)
-            temp,states=DFG_javascript(value,index_to_code,states)
-            DFG+=temp            
+            states=yield value,states
             for index1 in name_indexs:
                 idx1,code1=index_to_code[index1]
                 for index2 in value_indexs:
                     idx2,code2=index_to_code[index2]
                     DFG.append((code1,idx1,'comesFrom',[code2],[idx2]))
-                states[code1]=[idx1]   
-            return sorted(DFG,key=lambda x:x[1]),states
+                states[code1]=[idx1]
+            return states
     elif root_node.type in assignment:
         left_nodes=root_node.child_by_field_name('left')
         right_nodes=root_node.child_by_field_name('right')
-        DFG=[]
-        temp,states=DFG_javascript(right_nodes,index_to_code,states)
-        DFG+=temp            
+        states=yield right_nodes,states
         name_indexs=tree_to_variable_index(left_nodes,index_to_code)
-        value_indexs=tree_to_variable_index(right_nodes,index_to_code)        
+        value_indexs=tree_to_variable_index(right_nodes,index_to_code)
         for index1 in name_indexs:
             idx1,code1=index_to_code[index1]
             for index2 in value_indexs:
                 idx2,code2=index_to_code[index2]
                 DFG.append((code1,idx1,'computedFrom',[code2],[idx2]))
-            states[code1]=[idx1]   
-        return sorted(DFG,key=lambda x:x[1]),states
+            states[code1]=[idx1]
+        return states
     elif root_node.type in increment_statement:
-        DFG=[]
         indexs=tree_to_variable_index(root_node,index_to_code)
         for index1 in indexs:
             idx1,code1=index_to_code[index1]
@@ -1093,9 +1055,8 @@ def DFG_javascript(root_node,index_to_code,states):
                 idx2,code2=index_to_code[index2]
                 DFG.append((code1,idx1,'computedFrom',[code2],[idx2]))
             states[code1]=[idx1]
-        return sorted(DFG,key=lambda x:x[1]),states   
+        return states
     elif root_node.type in if_statement:
-        DFG=[]
         current_states=states.copy()
         others_states=[]
         flag=False
@@ -1106,16 +1067,14 @@ def DFG_javascript(root_node,index_to_code,states):
             if 'else' in child.type:
                 tag=True
             if child.type not in if_statement and flag is False:
-                temp,current_states=DFG_javascript(child,index_to_code,current_states)
-                DFG+=temp
+                current_states=yield child,current_states
             else:
                 flag=True
-                temp,new_states=DFG_javascript(child,index_to_code,states)
-                DFG+=temp
+                new_states=yield child,states.copy()
                 others_states.append(new_states)
         others_states.append(current_states)
         if tag is False:
-            others_states.append(states)        
+            others_states.append(states)
         new_states={}
         for dic in others_states:
             for key in dic:
@@ -1130,55 +1089,46 @@ def DFG_javascript(root_node,index_to_code,states):
                 new_states[key]+=states[key]
         for key in new_states:
             new_states[key]=sorted(list(set(new_states[key])))
-        return sorted(DFG,key=lambda x:x[1]),new_states
+        return new_states
     elif root_node.type in for_statement:
-        DFG=[]
+        start=len(DFG)
         for child in root_node.children:
-            temp,states=DFG_javascript(child,index_to_code,states)
-            DFG+=temp
+            states=yield child,states
         flag=False
         for child in root_node.children:
             if flag:
-                temp,states=DFG_javascript(child,index_to_code,states)
-                DFG+=temp                
-            elif child.type=="variable_declaration":               
+                states=yield child,states
+            elif child.type=="variable_declaration":
                 flag=True
         dic={}
-        for x in DFG:
+        for x in DFG[start:]:
             if (x[0],x[1],x[2]) not in dic:
                 dic[(x[0],x[1],x[2])]=[x[3],x[4]]
             else:
                 dic[(x[0],x[1],x[2])][0]=list(set(dic[(x[0],x[1],x[2])][0]+x[3]))
                 dic[(x[0],x[1],x[2])][1]=sorted(list(set(dic[(x[0],x[1],x[2])][1]+x[4])))
-        DFG=[(x[0],x[1],x[2],y[0],y[1]) for x,y in sorted(dic.items(),key=lambda t:t[0][1])]
-        return sorted(DFG,key=lambda x:x[1]),states
-    elif root_node.type in while_statement:  
-        DFG=[]
+        DFG[start:]=[(x[0],x[1],x[2],y[0],y[1]) for x,y in sorted(dic.items(),key=lambda t:t[0][1])]
+        return states
+    elif root_node.type in while_statement:
+        start=len(DFG)
         for i in range(2):
             for child in root_node.children:
-                temp,states=DFG_javascript(child,index_to_code,states)
-                DFG+=temp    
+                states=yield child,states
         dic={}
-        for x in DFG:
+        for x in DFG[start:]:
             if (x[0],x[1],x[2]) not in dic:
                 dic[(x[0],x[1],x[2])]=[x[3],x[4]]
             else:
                 dic[(x[0],x[1],x[2])][0]=list(set(dic[(x[0],x[1],x[2])][0]+x[3]))
                 dic[(x[0],x[1],x[2])][1]=sorted(list(set(dic[(x[0],x[1],x[2])][1]+x[4])))
-        DFG=[(x[0],x[1],x[2],y[0],y[1]) for x,y in sorted(dic.items(),key=lambda t:t[0][1])]
-        return sorted(DFG,key=lambda x:x[1]),states    
+        DFG[start:]=[(x[0],x[1],x[2],y[0],y[1]) for x,y in sorted(dic.items(),key=lambda t:t[0][1])]
+        return states
     else:
-        DFG=[]
         for child in root_node.children:
             if child.type in do_first_statement:
-                temp,states=DFG_javascript(child,index_to_code,states)
-                DFG+=temp
+                states=yield child,states
         for child in root_node.children:
             if child.type not in do_first_statement:
-                temp,states=DFG_javascript(child,index_to_code,states)
-                DFG+=temp
-        
-        return sorted(DFG,key=lambda x:x[1]),states
-
+                states=yield child,states
 
-     
+        return states
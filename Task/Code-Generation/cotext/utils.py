@@ -1,12 +1,10 @@
-from torch.utils.data import TensorDataset
 import numpy as np
 import logging
-import os
 import random
-import torch
 import time
 from tqdm import tqdm
 from _utils import *
+from token_cache import token_cache_path, load_token_cache, build_token_dataset
 
 logger = logging.getLogger(__name__)
 
@@ -14,115 +12,113 @@ logger = logging.getLogger(__name__)
 def load_and_cache_gen_data(args, filename, pool, tokenizer, split_tag, only_src=False, is_sample=False):
     # cache the data into args.cache_path except it is sampled
     # only_src: control whether to return only source ids for bleu evaluating (dev/test)
-    # return: examples (Example object), data (TensorDataset)
-    data_tag = '_all' if args.data_num == -1 else '_%d' % args.data_num
-    cache_fn = '{}/{}.pt'.format(args.cache_path, split_tag + ('_src' if only_src else '') + data_tag)
+    # return: examples (Example object), data (TokenDataset)
+    cache_fn = token_cache_path(args, filename, tokenizer, 'gen_' + split_tag + ('_src' if only_src else ''))
 
     examples = read_examples(filename, args.data_num, args.task, args)
 
     if is_sample:
         examples = random.sample(examples, min(1000, len(examples)))
-    if split_tag == 'train':
-        calc_stats(examples, tokenizer, is_tokenize=True)
-    else:
-        calc_stats(examples)
-    if os.path.exists(cache_fn) and not is_sample:
+    cache = None if is_sample else load_token_cache(cache_fn)
+    if cache is not None:
         logger.info("Load cache data from %s", cache_fn)
-        data = torch.load(cache_fn)
+        data, stats = cache
+        log_stats(stats)
     else:
+        if split_tag == 'train':
+            stats = calc_stats(examples, tokenizer, is_tokenize=True)
+        else:
+            stats = calc_stats(examples)
         if is_sample:
             logger.info("Sample 5k data for computing bleu from %s", filename)
         else:
             logger.info("Create cache data into %s", cache_fn)
         tuple_examples = [(example, idx, tokenizer, args, split_tag) for idx, example in enumerate(examples)]
         features = pool.map(convert_examples_to_features, tqdm(tuple_examples, total=len(tuple_examples)))
-        all_source_ids = torch.tensor([f.source_ids for f in features], dtype=torch.long)
+        all_source_ids = [f.source_ids for f in features]
         if split_tag == 'test' or only_src:
-            data = TensorDataset(all_source_ids)
+            columns = [all_source_ids]
         else:
-            all_target_ids = torch.tensor([f.target_ids for f in features], dtype=torch.long)
-            data = TensorDataset(all_source_ids, all_target_ids)
-        if args.local_rank in [-1, 0] and not is_sample:
-            torch.save(data, cache_fn)
+            all_target_ids = [f.target_ids for f in features]
+            columns = [all_source_ids, all_target_ids]
+        data = build_token_dataset(cache_fn, columns, stats, save=args.local_rank in [-1, 0] and not is_sample)
     return examples, data
 
 
 def load_and_cache_clone_data(args, filename, pool, tokenizer, split_tag, is_sample=False):
-    cache_fn = '{}/{}.pt'.format(args.cache_path, split_tag + '_all' if args.data_num == -1 else '_%d' % args.data_num)
+    cache_fn = token_cache_path(args, filename, tokenizer, 'clone_' + split_tag)
     examples = read_examples(filename, args.data_num, args.task, args)
     if is_sample:
         examples = random.sample(examples, int(len(examples) * 0.1))
 
-    # calc_stats(examples, tokenizer, is_tokenize=True)
-    if os.path.exists(cache_fn):
+    cache = None if is_sample else load_token_cache(cache_fn)
+    if cache is not None:
         logger.info("Load cache data from %s", cache_fn)
-        data = torch.load(cache_fn)
+        data = cache[0]
     else:
+        # calc_stats(examples, tokenizer, is_tokenize=True)
         if is_sample:
             logger.info("Sample 10 percent of data from %s", filename)
-        elif args.data_num == -1:
+        else:
             logger.info("Create cache data into %s", cache_fn)
         tuple_examples = [(example, idx, tokenizer, args) for idx, example in enumerate(examples)]
         features = pool.map(convert_clone_examples_to_features, tqdm(tuple_examples, total=len(tuple_examples)))
-        all_source_ids = torch.tensor([f.source_ids for f in features], dtype=torch.long)
-        all_labels = torch.tensor([f.label for f in features], dtype=torch.long)
-        data = TensorDataset(all_source_ids, all_labels)
-
-        if args.local_rank in [-1, 0] and args.data_num == -1:
-            torch.save(data, cache_fn)
+        all_source_ids = [f.source_ids for f in features]
+        all_labels = [f.label for f in features]
+        data = build_token_dataset(cache_fn, [all_source_ids, all_labels],
+                                   save=args.local_rank in [-1, 0] and not is_sample)
     return examples, data
 
 
 def load_and_cache_search_data(args, filename, pool, tokenizer, split_tag, is_sample=False):
-    cache_fn = '{}/{}.pt'.format(args.cache_path, split_tag + '_all' if args.data_num == -1 else '_%d' % args.data_num)
+    cache_fn = token_cache_path(args, filename, tokenizer, 'search_' + split_tag)
     examples = read_examples(filename, args.data_num, args.task, args)
     if is_sample:
         examples = random.sample(examples, int(len(examples) * 0.1))
 
-    if os.path.exists(cache_fn):
+    cache = None if is_sample else load_token_cache(cache_fn)
+    if cache is not None:
         logger.info("Load cache data from %s", cache_fn)
-        data = torch.load(cache_fn)
+        data = cache[0]
     else:
         if is_sample:
             logger.info("Sample 10 percent of data from %s", filename)
-        elif args.data_num == -1:
+        else:
             logger.info("Create cache data into %s", cache_fn)
         tuple_examples = [(example, idx, tokenizer, args) for idx, example in enumerate(examples)]
         features = pool.map(convert_search_examples_to_features, tqdm(tuple_examples, total=len(tuple_examples)))
-        code_ids = torch.tensor([f.code_ids for f in features], dtype=torch.long)
-        nl_ids = torch.tensor([f.nl_ids for f in features], dtype=torch.long)
-        data = TensorDataset(code_ids, nl_ids)
-
-        if args.local_rank in [-1, 0] and args.data_num == -1:
-            torch.save(data, cache_fn)
+        code_ids = [f.code_ids for f in features]
+        nl_ids = [f.nl_ids for f in features]
+        data = build_token_dataset(cache_fn, [code_ids, nl_ids],
+                                   save=args.local_rank in [-1, 0] and not is_sample)
     return examples, data
 
 
 
 def load_and_cache_defect_data(args, filename, pool, tokenizer, split_tag, is_sample=False):
-    cache_fn = os.path.join(args.cache_path, split_tag)
+    cache_fn = token_cache_path(args, filename, tokenizer, 'defect_' + split_tag)
     examples = read_examples(filename, args.data_num, args.task, args)
     if is_sample:
         examples = random.sample(examples, int(len(examples) * 0.1))
 
-    calc_stats(examples, tokenizer, is_tokenize=True)
-    if os.path.exists(cache_fn):
+    cache = None if is_sample else load_token_cache(cache_fn)
+    if cache is not None:
         logger.info("Load cache data from %s", cache_fn)
-        data = torch.load(cache_fn)
+        data, stats = cache
+        log_stats(stats)
     else:
+        stats = calc_stats(examples, tokenizer, is_tokenize=True)
         if is_sample:
             logger.info("Sample 10 percent of data from %s", filename)
-        elif args.data_num == -1:
+        else:
             logger.info("Create cache data into %s", cache_fn)
         tuple_examples = [(example, idx, tokenizer, args) for idx, example in enumerate(examples)]
         features = pool.map(convert_defect_examples_to_features, tqdm(tuple_examples, total=len(tuple_examples)))
         # features = [convert_clone_examples_to_features(x) for x in tuple_examples]
-        all_source_ids = torch.tensor([f.source_ids for f in features], dtype=torch.long)
-        all_labels = torch.tensor([f.label for f in features], dtype=torch.long)
-        data = TensorDataset(all_source_ids, all_labels)
-
-        if args.local_rank in [-1, 0] and args.data_num == -1:
-            torch.save(data, cache_fn)
+        all_source_ids = [f.source_ids for f in features]
+        all_labels = [f.label for f in features]
+        data = build_token_dataset(cache_fn, [all_source_ids, all_labels], stats,
+                                   save=args.local_rank in [-1, 0] and not is_sample)
     return examples, data
 
 
@@ -217,15 +213,29 @@ def calc_stats(examples, tokenizer=None, is_tokenize=False):
         else:
             avg_src_len.append(len(ex.source.split()))
             avg_trg_len.append(len(str(ex.target).split()))
+    stats = {'num_examples': len(examples),
+             'avg_src_len': float(np.mean(avg_src_len)), 'avg_trg_len': float(np.mean(avg_trg_len)),
+             'max_src_len': max(avg_src_len), 'max_trg_len': max(avg_trg_len)}
     if is_tokenize:
-        logger.info("Read %d examples, avg src len: %d, avg trg len: %d, max src len: %d, max trg len: %d",
-                    len(examples), np.mean(avg_src_len), np.mean(avg_trg_len), max(avg_src_len), max(avg_trg_len))
+        stats.update({'avg_src_len_tokenize': float(np.mean(avg_src_len_tokenize)),
+                      'avg_trg_len_tokenize': float(np.mean(avg_trg_len_tokenize)),
+                      'max_src_len_tokenize': max(avg_src_len_tokenize),
+                      'max_trg_len_tokenize': max(avg_trg_len_tokenize)})
+    log_stats(stats)
+    return stats
+
+
+def log_stats(stats):
+    # stats as returned by calc_stats (or stored with a token cache); None logs nothing
+    if stats is None:
+        return
+    logger.info("Read %d examples, avg src len: %d, avg trg len: %d, max src len: %d, max trg len: %d",
+                stats['num_examples'], stats['avg_src_len'], stats['avg_trg_len'], stats['max_src_len'],
+                stats['max_trg_len'])
+    if 'avg_src_len_tokenize' in stats:
         logger.info("[TOKENIZE] avg src len: %d, avg trg len: %d, max src len: %d, max trg len: %d",
-                    np.mean(avg_src_len_tokenize), np.mean(avg_trg_len_tokenize), max(avg_src_len_tokenize),
-                    max(avg_trg_len_tokenize))
-    else:
-        logger.info("Read %d examples, avg src len: %d, avg trg len: %d, max src len: %d, max trg len: %d",
-                    len(examples), np.mean(avg_src_len), np.mean(avg_trg_len), max(avg_src_len), max(avg_trg_len))
+                    stats['avg_src_len_tokenize'], stats['avg_trg_len_tokenize'], stats['max_src_len_tokenize'],
+                    stats['max_trg_len_tokenize'])
 
 
 def get_elapse_time(t0):
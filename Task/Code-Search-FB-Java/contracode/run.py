@@ -43,6 +43,7 @@ except:
 from tqdm import tqdm, trange
 import multiprocessing
 from model import Model, CodeModel
+from retrieval_eval import reciprocal_ranks, write_predictions
 cpu_cont = multiprocessing.cpu_count()
 from transformers import (WEIGHTS_NAME, AdamW, get_linear_schedule_with_warmup,
                           BertConfig, BertForMaskedLM, BertTokenizer,
@@ -341,31 +342,15 @@ def evaluate(args, model, tokenizer,eval_when_training=False, eval_file=None, st
     eval_loss = eval_loss / nb_eval_steps
     perplexity = torch.tensor(eval_loss)
 
-    scores=np.matmul(nl_vecs,code_vecs.T)
-    ranks=[]
-    for i in range(len(scores)):
-        score=scores[i,i]
-        rank=1
-        for j in range(len(scores)):
-            if i!=j and scores[i,j]>=score:
-                rank+=1
-        ranks.append(1/rank)    
+    ranks=reciprocal_ranks(nl_vecs,code_vecs)
     
     if eval_file == args.test_data_file:
-        sort_ids=np.argsort(scores, axis=-1, kind='quicksort', order=None)[:,::-1]
         indexs=[]
         urls=[]
         for example in eval_dataset.examples:
             indexs.append(example.idx)
             urls.append(example.url)
-        with open(os.path.join(args.output_dir,"predictions_{}.jsonl".format(steps)),'w') as f:
-            for index,url,sort_id in zip(indexs,urls,sort_ids):
-                js={}
-                js['url']=url
-                js['answers']=[]
-                for idx in sort_id[:100]:
-                    js['answers'].append(indexs[int(idx)])
-                f.write(json.dumps(js)+'\n')
+        write_predictions(os.path.join(args.output_dir,"predictions_{}.jsonl".format(steps)),nl_vecs,code_vecs,indexs,urls)
             
     result = {
         "eval_loss": float(perplexity),
@@ -411,30 +396,14 @@ def test(args, model, tokenizer):
     eval_loss = eval_loss / nb_eval_steps
     perplexity = torch.tensor(eval_loss)
 
-    scores=np.matmul(nl_vecs,code_vecs.T)
-    ranks=[]
-    for i in range(len(scores)):
-        score=scores[i,i]
-        rank=1
-        for j in range(len(scores)):
-            if i!=j and scores[i,j]>=score:
-                rank+=1
-        ranks.append(1/rank) 
-
-    sort_ids=np.argsort(scores, axis=-1, kind='quicksort', order=None)[:,::-1]
+    ranks=reciprocal_ranks(nl_vecs,code_vecs)
+
     indexs=[]
     urls=[]
     for example in eval_dataset.examples:
         indexs.append(example.idx)
         urls.append(example.url)
-    with open(os.path.join(args.output_dir,"predictions.jsonl"),'w') as f:
-        for index,url,sort_id in zip(indexs,urls,sort_ids):
-            js={}
-            js['url']=url
-            js['answers']=[]
-            for idx in sort_id[:100]:
-                js['answers'].append(indexs[int(idx)])
-            f.write(json.dumps(js)+'\n')
+    write_predictions(os.path.join(args.output_dir,"predictions.jsonl"),nl_vecs,code_vecs,indexs,urls)
     
     result = {
         "eval_loss": float(perplexity),
@@ -26,7 +26,6 @@ import logging
 import argparse
 import math
 import numpy as np
-import json
 from io import open
 from tqdm import tqdm
 import torch
@@ -44,6 +43,7 @@ import sentencepiece as spm
 from configs import add_args, set_seed
 from utils import get_filenames, get_elapse_time, load_and_cache_search_data, load_and_cache_clone_data
 from models import get_model_size
+from retrieval_eval import reciprocal_ranks, write_predictions
 
 MODEL_CLASSES = {'roberta': (RobertaConfig, RobertaModel, RobertaTokenizer),
                  't5': (T5Config, T5ForConditionalGeneration, T5Tokenizer),
@@ -85,15 +85,7 @@ def evaluate(args, model, eval_examples, eval_data, write_to_pred=False):
     eval_loss = eval_loss / nb_eval_steps
     perplexity = torch.tensor(eval_loss)
 
-    scores=np.matmul(nl_vecs,code_vecs.T)
-    ranks=[]
-    for i in range(len(scores)):
-        score=scores[i,i]
-        rank=1
-        for j in range(len(scores)):
-            if i!=j and scores[i,j]>=score:
-                rank+=1
-        ranks.append(1/rank)    
+    ranks=reciprocal_ranks(nl_vecs,code_vecs)
     
     result = {
         "eval_loss": float(perplexity),
@@ -101,20 +93,12 @@ def evaluate(args, model, eval_examples, eval_data, write_to_pred=False):
     }
 
     if write_to_pred:
-        sort_ids=np.argsort(scores, axis=-1, kind='quicksort', order=None)[:,::-1]
         indexs=[]
         urls=[]
         for example in eval_examples:
             indexs.append(example.idx)
             urls.append(example.url)
-        with open(os.path.join(args.output_dir,"predictions.jsonl"),'w') as f:
-            for index,url,sort_id in zip(indexs,urls,sort_ids):
-                js={}
-                js['url']=url
-                js['answers']=[]
-                for idx in sort_id[:100]:
-                    js['answers'].append(indexs[int(idx)])
-                f.write(json.dumps(js)+'\n')
+        write_predictions(os.path.join(args.output_dir,"predictions.jsonl"),nl_vecs,code_vecs,indexs,urls)
 
     return result
 
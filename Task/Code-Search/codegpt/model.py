@@ -48,6 +48,12 @@ class Model(nn.Module):
         loss = loss_fct(scores, torch.arange(bs, device=scores.device))
         return loss,code_vec,nl_vec
 
+    def encode_nl(self, nl_inputs):
+        sequence_lengths = torch.ne(nl_inputs, self.tokenizer.pad_token_id).sum(-1) - 1
+        outputs=self.encoder(nl_inputs,attention_mask=nl_inputs.ne(1))[0] # B * L * D
+        outputs=outputs[range(nl_inputs.shape[0]),sequence_lengths,:] # B * D
+        return self.pooler(outputs)
+
       
         
  
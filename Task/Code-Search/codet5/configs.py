@@ -94,6 +94,8 @@ def add_args(parser):
                         help="")
     parser.add_argument("--warmup_steps", default=100, type=int,
                         help="Linear warmup over warmup_steps.")
+    parser.add_argument("--no_length_bucketing", action='store_true',
+                        help="Batch examples in random/sequential order instead of by length (still cut per batch).")
     parser.add_argument("--local_rank", type=int, default=-1,
                         help="For distributed training: local_rank")
     parser.add_argument('--seed', type=int, default=1234,
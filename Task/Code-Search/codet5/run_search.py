@@ -26,12 +26,11 @@ import logging
 import argparse
 import math
 import numpy as np
-import json
 from io import open
 from tqdm import tqdm
 import torch
 from torch.utils.tensorboard import SummaryWriter
-from torch.utils.data import DataLoader, SequentialSampler, RandomSampler
+from torch.utils.data import DataLoader
 from torch.utils.data.distributed import DistributedSampler
 from transformers import (AdamW, get_linear_schedule_with_warmup,
                           RobertaConfig, RobertaModel, RobertaTokenizer,
@@ -43,6 +42,8 @@ import time
 from configs import add_args, set_seed
 from utils import get_filenames, get_elapse_time, load_and_cache_search_data, load_and_cache_clone_data
 from models import get_model_size
+from retrieval_eval import reciprocal_ranks, write_predictions
+from dynamic_padding import PadCollate, bucketed_dataloader, restore_order, sequence_lengths
 
 MODEL_CLASSES = {'roberta': (RobertaConfig, RobertaModel, RobertaTokenizer),
                  't5': (T5Config, T5ForConditionalGeneration, T5Tokenizer),
@@ -57,9 +58,22 @@ logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message
 logger = logging.getLogger(__name__)
 
 
-def evaluate(args, model, eval_examples, eval_data, write_to_pred=False):
-    eval_sampler = SequentialSampler(eval_data)
-    eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.eval_batch_size)
+def search_dataloader(args, data, pad_id, batch_size, shuffle):
+    """DataLoader over the cached (code_ids, nl_ids) columns, by length unless --no_length_bucketing.
+
+    The cache keeps its fixed-width padded columns; every batch is cut to its longest sequence.
+    """
+    collate_fn = PadCollate([pad_id, pad_id])
+    if args.local_rank != -1 and shuffle:
+        return DataLoader(data, sampler=DistributedSampler(data), batch_size=batch_size, collate_fn=collate_fn)
+    # code and queries are encoded in one batch, both are cut to the longer of the two
+    lengths = np.maximum(sequence_lengths(data.columns[0], pad_id), sequence_lengths(data.columns[1], pad_id))
+    return bucketed_dataloader(data, lengths, batch_size, shuffle=shuffle,
+                               bucketing=not args.no_length_bucketing, collate_fn=collate_fn)
+
+
+def evaluate(args, model, eval_examples, eval_data, pad_id, write_to_pred=False):
+    eval_dataloader = search_dataloader(args, eval_data, pad_id, args.eval_batch_size, shuffle=False)
 
     # Eval!
     logger.info("***** Running evaluation  *****")
@@ -79,20 +93,13 @@ def evaluate(args, model, eval_examples, eval_data, write_to_pred=False):
             code_vecs.append(code_vec.cpu().numpy())
             nl_vecs.append(nl_vec.cpu().numpy())
         nb_eval_steps += 1
-    code_vecs=np.concatenate(code_vecs,0)
-    nl_vecs=np.concatenate(nl_vecs,0)
+    # batches come sorted by length, back to the order of the examples
+    code_vecs=restore_order(eval_dataloader,np.concatenate(code_vecs,0))
+    nl_vecs=restore_order(eval_dataloader,np.concatenate(nl_vecs,0))
     eval_loss = eval_loss / nb_eval_steps
     perplexity = torch.tensor(eval_loss)
 
-    scores=np.matmul(nl_vecs,code_vecs.T)
-    ranks=[]
-    for i in range(len(scores)):
-        score=scores[i,i]
-        rank=1
-        for j in range(len(scores)):
-            if i!=j and scores[i,j]>=score:
-                rank+=1
-        ranks.append(1/rank)    
+    ranks=reciprocal_ranks(nl_vecs,code_vecs)
     
     result = {
         "eval_loss": float(perplexity),
@@ -100,20 +107,12 @@ def evaluate(args, model, eval_examples, eval_data, write_to_pred=False):
     }
 
     if write_to_pred:
-        sort_ids=np.argsort(scores, axis=-1, kind='quicksort', order=None)[:,::-1]
         indexs=[]
         urls=[]
         for example in eval_examples:
             indexs.append(example.idx)
             urls.append(example.url)
-        with open(os.path.join(args.output_dir,"predictions.jsonl"),'w') as f:
-            for index,url,sort_id in zip(indexs,urls,sort_ids):
-                js={}
-                js['url']=url
-                js['answers']=[]
-                for idx in sort_id[:100]:
-                    js['answers'].append(indexs[int(idx)])
-                f.write(json.dumps(js)+'\n')
+        write_predictions(os.path.join(args.output_dir,"predictions.jsonl"),nl_vecs,code_vecs,indexs,urls)
 
     return result
 
@@ -146,6 +145,7 @@ def main():
     tokenizer = tokenizer_class.from_pretrained(args.tokenizer_name)
 
     model = SearchModel(model, config, tokenizer, args)
+    pad_id = tokenizer.pad_token_id
     logger.info("Finish loading model [%s] from %s", get_model_size(model), args.model_name_or_path)
 
     if args.load_model_path is not None:
@@ -169,11 +169,7 @@ def main():
         # Prepare training data loader
         train_examples, train_data = load_and_cache_search_data(args, args.train_filename, pool, tokenizer, 'train',
                                                                is_sample=False)
-        if args.local_rank == -1:
-            train_sampler = RandomSampler(train_data)
-        else:
-            train_sampler = DistributedSampler(train_data)
-        train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=args.train_batch_size)
+        train_dataloader = search_dataloader(args, train_data, pad_id, args.train_batch_size, shuffle=True)
 
         num_train_optimization_steps = args.num_train_epochs * len(train_dataloader)
         save_steps = max(len(train_dataloader) // 5, 1)
@@ -243,7 +239,7 @@ def main():
                     eval_examples, eval_data = load_and_cache_search_data(args, args.dev_filename, pool, tokenizer,
                                                                          'valid', is_sample=True)
 
-                    result = evaluate(args, model, eval_examples, eval_data)
+                    result = evaluate(args, model, eval_examples, eval_data, pad_id)
                     eval_mrr = result['eval_mrr']
 
                     if args.data_num == -1:
@@ -313,7 +309,7 @@ def main():
             eval_examples, eval_data = load_and_cache_search_data(args, args.test_filename, pool, tokenizer, 'test',
                                                                  False)
 
-            result = evaluate(args, model, eval_examples, eval_data, write_to_pred=True)
+            result = evaluate(args, model, eval_examples, eval_data, pad_id, write_to_pred=True)
             logger.info("  test_mrr=%.4f", result['eval_mrr'])
             logger.info("  " + "*" * 20)
 
@@ -0,0 +1,252 @@
+"""
+Persistent code-embedding index for code search.
+
+Code vectors only depend on the checkpoint and the data file, so instead of
+re-encoding the whole codebase on every `test` call they are written once to an
+index directory and memory-mapped afterwards:
+
+    vectors.npy   (N, D) float32 or float16 code vectors
+    meta.json     url and idx of every vector
+    ivfpq.npz     optional IVF-PQ quantizer for approximate search
+
+`CodeIndex.search` does an exact blocked inner-product search, or an approximate
+one when a quantizer has been trained: vectors are bucketed by k-means (the
+inverted file) and their residuals are product-quantized to one byte per
+sub-vector, so a query only scores the codes of its `nprobe` closest buckets
+with table lookups and re-ranks the best candidates exactly.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+from retrieval_eval import top_k
+
+
+def code_index_path(output_dir, checkpoint, data_file):
+    """Index directory for the code of `data_file` encoded by `checkpoint`.
+
+    Sizes and mtimes are part of the key, so retraining the checkpoint or editing
+    the data file never reuses stale vectors.
+    """
+    key = []
+    for path in (checkpoint, data_file):
+        stat = os.stat(path)
+        key.append('{}|{}|{}'.format(os.path.abspath(path), stat.st_size, int(stat.st_mtime)))
+    digest = hashlib.md5('||'.join(key).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(output_dir, 'code_index', 'index_{}'.format(digest))
+
+
+def _blocks(n, block_size):
+    for start in range(0, n, block_size):
+        yield start, min(start+block_size, n)
+
+
+def kmeans(x, n_clusters, n_iter=20, seed=0, block_size=8192):
+    """Lloyd's k-means on the rows of `x`; returns (n_clusters, D) centroids."""
+    rng = np.random.RandomState(seed)
+    x = np.asarray(x, dtype=np.float32)
+    if len(x) < n_clusters:
+        raise ValueError("Need at least {} vectors to train {} clusters, got {}".format(
+            n_clusters, n_clusters, len(x)))
+    centroids = x[rng.choice(len(x), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        assign = assign_clusters(x, centroids, block_size)
+        counts = np.bincount(assign, minlength=n_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        #re-seed empty clusters with random points
+        centroids[empty] = x[rng.choice(len(x), int(empty.sum()), replace=False)]
+    return centroids
+
+
+def assign_clusters(x, centroids, block_size=8192):
+    """Index of the nearest (L2) centroid of every row of `x`."""
+    c_norms = (centroids ** 2).sum(-1)
+    assign = np.empty(len(x), dtype=np.int64)
+    for start, end in _blocks(len(x), block_size):
+        block = np.asarray(x[start:end], dtype=np.float32)
+        assign[start:end] = np.argmin(c_norms[None, :] - 2 * np.matmul(block, centroids.T), -1)
+    return assign
+
+
+class IVFPQ(object):
+    """Inverted file over k-means buckets with product-quantized residuals."""
+
+    def __init__(self, coarse, codebooks, codes, order, offsets):
+        #(n_lists, D) bucket centroids
+        self.coarse = coarse
+        #(n_subspaces, n_centroids, D / n_subspaces) residual codebooks
+        self.codebooks = codebooks
+        #(N, n_subspaces) uint8 residual codes, stored in bucket order
+        self.codes = codes
+        #vector ids in bucket order, bucket i is order[offsets[i]:offsets[i+1]]
+        self.order = order
+        self.offsets = offsets
+
+    @classmethod
+    def train(cls, vectors, n_lists, n_subspaces, n_centroids=256, n_iter=20, sample=65536, seed=0):
+        n, dim = vectors.shape
+        if dim % n_subspaces:
+            raise ValueError("Vector size {} is not divisible into {} sub-vectors".format(dim, n_subspaces))
+        if n_centroids > 256:
+            raise ValueError("Product quantization codes are one byte, n_centroids must be <= 256")
+        rng = np.random.RandomState(seed)
+        train = np.asarray(vectors[np.sort(rng.choice(n, min(n, sample), replace=False))], dtype=np.float32)
+
+        coarse = kmeans(train, n_lists, n_iter, seed)
+        residuals = train - coarse[assign_clusters(train, coarse)]
+        sub_dim = dim // n_subspaces
+        codebooks = np.stack([kmeans(residuals[:, m*sub_dim:(m+1)*sub_dim], n_centroids, n_iter, seed)
+                              for m in range(n_subspaces)])
+
+        assign = np.empty(n, dtype=np.int64)
+        codes = np.empty((n, n_subspaces), dtype=np.uint8)
+        for start, end in _blocks(n, 65536):
+            block = np.asarray(vectors[start:end], dtype=np.float32)
+            assign[start:end] = assign_clusters(block, coarse)
+            residual = block - coarse[assign[start:end]]
+            for m in range(n_subspaces):
+                codes[start:end, m] = assign_clusters(residual[:, m*sub_dim:(m+1)*sub_dim], codebooks[m])
+        order = np.argsort(assign, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=n_lists))])
+        return cls(coarse, codebooks, codes[order], order, offsets)
+
+    def save(self, path):
+        np.savez(path, coarse=self.coarse, codebooks=self.codebooks, codes=self.codes,
+                 order=self.order, offsets=self.offsets)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data['coarse'], data['codebooks'], data['codes'], data['order'], data['offsets'])
+
+    def candidates(self, query, k, nprobe):
+        """Approximate inner-product search of one query: (scores, ids) of up to k vectors."""
+        n_subspaces, _, sub_dim = self.codebooks.shape
+        coarse_scores = np.matmul(self.coarse, query)
+        lists = np.argsort(-coarse_scores, kind='stable')[:nprobe]
+        #inner product of every query sub-vector with every codeword
+        table = np.einsum('mkd,md->mk', self.codebooks, query.reshape(n_subspaces, sub_dim))
+        scores, ids = [], []
+        for l in lists:
+            start, end = self.offsets[l], self.offsets[l+1]
+            if start == end:
+                continue
+            codes = self.codes[start:end]
+            scores.append(coarse_scores[l] + table[np.arange(n_subspaces), codes].sum(-1))
+            ids.append(self.order[start:end])
+        if not scores:
+            return np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int64)
+        scores, ids = np.concatenate(scores), np.concatenate(ids)
+        best = top_k(scores[None, :], min(k, len(scores)))[0]
+        return scores[best], ids[best]
+
+
+class CodeIndex(object):
+    """Code vectors plus their url/idx, searchable by natural-language vectors.
+
+    `encode_query` maps a list of query strings to an (n, D) array; it is only
+    needed for `query`.
+    """
+
+    def __init__(self, vectors, urls, indexs, path=None, quantizer=None, encode_query=None):
+        self.vectors = vectors
+        self.urls = urls
+        self.indexs = indexs
+        self.path = path
+        self.quantizer = quantizer
+        self.encode_query = encode_query
+
+    def __len__(self):
+        return len(self.vectors)
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, 'meta.json'))
+
+    @classmethod
+    def build(cls, path, vectors, urls, indexs, dtype='float32'):
+        """Write vectors and metadata under `path` and return the memory-mapped index."""
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        np.save(os.path.join(tmp_path, 'vectors.npy'), np.asarray(vectors, dtype=dtype))
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump({'urls': list(urls), 'indexs': list(indexs), 'dtype': str(np.dtype(dtype))}, f)
+        #swap the whole directory in so readers never see a partial index
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(tmp_path, path)
+        return cls.load(path)
+
+    @classmethod
+    def load(cls, path, encode_query=None):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
+        quantizer_file = os.path.join(path, 'ivfpq.npz')
+        quantizer = IVFPQ.load(quantizer_file) if os.path.exists(quantizer_file) else None
+        return cls(vectors, meta['urls'], meta['indexs'], path, quantizer, encode_query)
+
+    def train_quantizer(self, n_lists, n_subspaces, **kwargs):
+        """Train (and save with the index) the IVF-PQ quantizer for approximate search."""
+        self.quantizer = IVFPQ.train(self.vectors, n_lists, n_subspaces, **kwargs)
+        if self.path is not None:
+            self.quantizer.save(os.path.join(self.path, 'ivfpq.npz'))
+        return self.quantizer
+
+    def exact_search(self, query_vecs, k=100, block_size=64, code_block_size=65536):
+        """Brute-force top-k by inner product; returns (scores, ids) of shape (Q, k)."""
+        query_vecs = np.asarray(query_vecs, dtype=np.float32)
+        k = min(k, len(self))
+        all_scores = np.empty((len(query_vecs), k), dtype=np.float32)
+        all_ids = np.empty((len(query_vecs), k), dtype=np.int64)
+        for start, end in _blocks(len(query_vecs), block_size):
+            scores = np.empty((end-start, len(self)), dtype=np.float32)
+            for c_start, c_end in _blocks(len(self), code_block_size):
+                codes = np.asarray(self.vectors[c_start:c_end], dtype=np.float32)
+                scores[:, c_start:c_end] = np.matmul(query_vecs[start:end], codes.T)
+            ids = top_k(scores, k)
+            all_ids[start:end] = ids
+            all_scores[start:end] = np.take_along_axis(scores, ids, -1)
+        return all_scores, all_ids
+
+    def search(self, query_vecs, k=100, nprobe=None, refine=4):
+        """Top-k codes of every query vector; returns (scores, ids) lists of arrays.
+
+        With `nprobe` set and a trained quantizer the search is approximate: the
+        `refine * k` best IVF-PQ candidates are re-scored exactly before the
+        final top-k is taken. Otherwise every code is scored.
+        """
+        if nprobe is None or self.quantizer is None:
+            scores, ids = self.exact_search(query_vecs, k)
+            return list(scores), list(ids)
+        all_scores, all_ids = [], []
+        for query in np.asarray(query_vecs, dtype=np.float32):
+            _, ids = self.quantizer.candidates(query, max(k, refine*k), nprobe)
+            ids = np.sort(ids)
+            scores = np.matmul(np.asarray(self.vectors[ids], dtype=np.float32), query)
+            best = top_k(scores[None, :], min(k, len(ids)))[0]
+            all_scores.append(scores[best])
+            all_ids.append(ids[best])
+        return all_scores, all_ids
+
+    def query(self, nl_text, k=10, nprobe=None):
+        """Search the index with a natural-language query.
+
+        Returns up to k dicts with the url, idx and score of the matching codes,
+        best first.
+        """
+        if self.encode_query is None:
+            raise ValueError("CodeIndex.query needs an index loaded with encode_query")
+        query_vec = np.asarray(self.encode_query([nl_text]), dtype=np.float32)
+        scores, ids = self.search(query_vec, k, nprobe)
+        return [{'url': self.urls[i], 'idx': self.indexs[i], 'score': float(s)}
+                for s, i in zip(scores[0], ids[0])]
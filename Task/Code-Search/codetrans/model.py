@@ -58,6 +58,16 @@ class Model(nn.Module):
         loss = loss_fct(scores, torch.arange(bs, device=scores.device))
         return loss,code_vec,nl_vec
 
+    def encode_nl(self, nl_inputs, prev_nl_ids, nl_lengths):
+        attention_mask=nl_inputs.ne(self.tokenizer.pad_token_id)
+        decoder_attention_mask=prev_nl_ids.ne(self.tokenizer.pad_token_id)
+        decoder_attention_mask[:,0] = 1
+        outputs=self.encoder(nl_inputs,attention_mask=attention_mask,
+                             decoder_input_ids=prev_nl_ids,
+                             decoder_attention_mask=decoder_attention_mask)[0] # B * L * D
+        outputs=outputs[range(nl_inputs.shape[0]),nl_lengths-1,:] # B * D
+        return self.pooler(outputs)
+
       
         
  
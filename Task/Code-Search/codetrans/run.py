@@ -32,7 +32,7 @@ import shutil
 
 import numpy as np
 import torch
-from torch.utils.data import DataLoader, Dataset, SequentialSampler, RandomSampler,TensorDataset
+from torch.utils.data import DataLoader, Dataset,TensorDataset
 from torch.utils.data.distributed import DistributedSampler
 import json
 try:
@@ -43,6 +43,10 @@ except:
 from tqdm import tqdm, trange
 import multiprocessing
 from model import Model
+from retrieval_eval import reciprocal_ranks, write_predictions
+from code_index import CodeIndex, code_index_path
+from dynamic_padding import PadCollate, bucketed_dataloader, restore_order
+from functools import partial
 cpu_cont = multiprocessing.cpu_count()
 from transformers import (WEIGHTS_NAME, AdamW, get_linear_schedule_with_warmup,
                           BertConfig, BertForMaskedLM, BertTokenizer,
@@ -90,6 +94,16 @@ class InputFeatures(object):
         self.idx=idx
 
         
+def convert_nl_to_features(nl,tokenizer,args):
+    nl_tokens=tokenizer.tokenize(nl)[:args.block_size-1]
+    nl_tokens =nl_tokens+[tokenizer.eos_token]
+    nl_ids =  tokenizer.convert_tokens_to_ids(nl_tokens)
+    nl_lengths = len(nl_ids)
+    # padded per batch by PadCollate
+    prev_nl_tokens = ([tokenizer.pad_token_id]+nl_ids)[:args.block_size]
+    return nl_tokens,nl_ids,prev_nl_tokens,nl_lengths
+
+
 def convert_examples_to_features(js,tokenizer,args):
     #code
     if 'code_tokens' in js:
@@ -100,20 +114,10 @@ def convert_examples_to_features(js,tokenizer,args):
     code_tokens = code_tokens+[tokenizer.eos_token]
     code_ids = tokenizer.convert_tokens_to_ids(code_tokens)
     code_lengths = len(code_ids)
-    padding_length = args.block_size - code_lengths
-    code_ids+=[tokenizer.pad_token_id]*padding_length
-    prev_code_tokens = np.roll(code_ids, 1)
-    prev_code_tokens[0] = tokenizer.pad_token_id
+    # padded per batch by PadCollate
+    prev_code_tokens = ([tokenizer.pad_token_id]+code_ids)[:args.block_size]
     
-    nl=' '.join(js['docstring_tokens'])
-    nl_tokens=tokenizer.tokenize(nl)[:args.block_size-1]
-    nl_tokens =nl_tokens+[tokenizer.eos_token]
-    nl_ids =  tokenizer.convert_tokens_to_ids(nl_tokens)
-    nl_lengths = len(nl_ids)
-    padding_length = args.block_size - nl_lengths
-    nl_ids+=[tokenizer.pad_token_id]*padding_length 
-    prev_nl_tokens = np.roll(nl_ids, 1)
-    prev_nl_tokens[0] = tokenizer.pad_token_id   
+    nl_tokens,nl_ids,prev_nl_tokens,nl_lengths=convert_nl_to_features(' '.join(js['docstring_tokens']),tokenizer,args)
     
     return InputFeatures(code_tokens,code_ids,prev_code_tokens,code_lengths,
                          nl_tokens,nl_ids,prev_nl_tokens,nl_lengths,
@@ -130,6 +134,9 @@ class TextDataset(Dataset):
                 data.append(js)
         for js in data:
             self.examples.append(convert_examples_to_features(js,tokenizer,args))
+        #code and queries are encoded in one batch, all the inputs are padded to the longest decoder input
+        self.lengths=[max(len(example.prev_code_tokens),len(example.prev_nl_tokens)) for example in self.examples]
+        self.collate_fn=PadCollate([tokenizer.pad_token_id,tokenizer.pad_token_id,None,tokenizer.pad_token_id,tokenizer.pad_token_id,None])
         if 'train' in file_path:
             for idx, example in enumerate(self.examples[:3]):
                     logger.info("*** Example ***")
@@ -164,10 +171,13 @@ def train(args, train_dataset, model, tokenizer):
     """ Train the model """
     
     args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
-    train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
-    
-    train_dataloader = DataLoader(train_dataset, sampler=train_sampler, 
-                                  batch_size=args.train_batch_size,num_workers=4,pin_memory=True)
+    if args.local_rank == -1:
+        train_dataloader = bucketed_dataloader(train_dataset, train_dataset.lengths, args.train_batch_size, shuffle=True,
+                                               bucketing=not args.no_length_bucketing, collate_fn=train_dataset.collate_fn,
+                                               num_workers=4,pin_memory=True)
+    else:
+        train_dataloader = DataLoader(train_dataset, sampler=DistributedSampler(train_dataset), collate_fn=train_dataset.collate_fn,
+                                      batch_size=args.train_batch_size,num_workers=4,pin_memory=True)
     args.max_steps=args.epoch*len( train_dataloader)
     args.save_steps=len( train_dataloader)//5
     args.warmup_steps=len( train_dataloader)
@@ -329,8 +339,13 @@ def evaluate(args, model, tokenizer,eval_when_training=False, eval_file=None, st
 
     args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
     # Note that DistributedSampler samples randomly
-    eval_sampler = SequentialSampler(eval_dataset) if args.local_rank == -1 else DistributedSampler(eval_dataset)
-    eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size,num_workers=4,pin_memory=True)
+    if args.local_rank == -1:
+        eval_dataloader = bucketed_dataloader(eval_dataset, eval_dataset.lengths, args.eval_batch_size, shuffle=False,
+                                              bucketing=not args.no_length_bucketing, collate_fn=eval_dataset.collate_fn,
+                                              num_workers=4,pin_memory=True)
+    else:
+        eval_dataloader = DataLoader(eval_dataset, sampler=DistributedSampler(eval_dataset), collate_fn=eval_dataset.collate_fn,
+                                     batch_size=args.eval_batch_size,num_workers=4,pin_memory=True)
 
     # multi-gpu evaluate
     if args.n_gpu > 1 and eval_when_training is False:
@@ -360,36 +375,21 @@ def evaluate(args, model, tokenizer,eval_when_training=False, eval_file=None, st
             code_vecs.append(code_vec.cpu().numpy())
             nl_vecs.append(nl_vec.cpu().numpy())
         nb_eval_steps += 1
-    code_vecs=np.concatenate(code_vecs,0)
-    nl_vecs=np.concatenate(nl_vecs,0)
+    #batches come sorted by length, back to the order of the examples
+    code_vecs=restore_order(eval_dataloader,np.concatenate(code_vecs,0))
+    nl_vecs=restore_order(eval_dataloader,np.concatenate(nl_vecs,0))
     eval_loss = eval_loss / nb_eval_steps
     perplexity = torch.tensor(eval_loss)
 
-    scores=np.matmul(nl_vecs,code_vecs.T)
-    ranks=[]
-    for i in range(len(scores)):
-        score=scores[i,i]
-        rank=1
-        for j in range(len(scores)):
-            if i!=j and scores[i,j]>=score:
-                rank+=1
-        ranks.append(1/rank)    
+    ranks=reciprocal_ranks(nl_vecs,code_vecs)
     
     if eval_file == args.test_data_file:
-        sort_ids=np.argsort(scores, axis=-1, kind='quicksort', order=None)[:,::-1]
         indexs=[]
         urls=[]
         for example in eval_dataset.examples:
             indexs.append(example.idx)
             urls.append(example.url)
-        with open(os.path.join(args.output_dir,"predictions_{}.jsonl".format(steps)),'w') as f:
-            for index,url,sort_id in zip(indexs,urls,sort_ids):
-                js={}
-                js['url']=url
-                js['answers']=[]
-                for idx in sort_id[:100]:
-                    js['answers'].append(indexs[int(idx)])
-                f.write(json.dumps(js)+'\n')
+        write_predictions(os.path.join(args.output_dir,"predictions_{}.jsonl".format(steps)),nl_vecs,code_vecs,indexs,urls)
             
     result = {
         "eval_loss": float(perplexity),
@@ -399,15 +399,20 @@ def evaluate(args, model, tokenizer,eval_when_training=False, eval_file=None, st
 
     return result
 
-def test(args, model, tokenizer):
+def test(args, model, tokenizer, checkpoint=None):
     # Loop to handle MNLI double evaluation (matched, mis-matched)
     eval_dataset = TextDataset(tokenizer, args,args.test_data_file)
+    index_dir=code_index_path(args.output_dir,checkpoint,args.test_data_file) if checkpoint else None
 
 
     args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
     # Note that DistributedSampler samples randomly
-    eval_sampler = SequentialSampler(eval_dataset) if args.local_rank == -1 else DistributedSampler(eval_dataset)
-    eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size)
+    if args.local_rank == -1:
+        eval_dataloader = bucketed_dataloader(eval_dataset, eval_dataset.lengths, args.eval_batch_size, shuffle=False,
+                                              bucketing=not args.no_length_bucketing, collate_fn=eval_dataset.collate_fn)
+    else:
+        eval_dataloader = DataLoader(eval_dataset, sampler=DistributedSampler(eval_dataset), collate_fn=eval_dataset.collate_fn,
+                                     batch_size=args.eval_batch_size)
 
     # multi-gpu evaluate
     if args.n_gpu > 1:
@@ -419,6 +424,11 @@ def test(args, model, tokenizer):
     logger.info("  Batch size = %d", args.eval_batch_size)
     eval_loss = 0.0
     nb_eval_steps = 0
+    code_index=None
+    if index_dir is not None and CodeIndex.exists(index_dir) and not args.overwrite_cache:
+        logger.info("  Reusing code vectors from %s", index_dir)
+        code_index=CodeIndex.load(index_dir)
+    model_to_encode=model.module if hasattr(model,'module') else model
     code_vecs=[] 
     nl_vecs=[]
     for batch in eval_dataloader:
@@ -429,36 +439,45 @@ def test(args, model, tokenizer):
         prev_nl_ids = batch[4].to(args.device)    
         nl_lengths = batch[5].to(args.device)
         with torch.no_grad():
-            lm_loss,code_vec,nl_vec = model(code_inputs=code_inputs,prev_code_ids=prev_code_ids,code_lengths=code_lengths, 
-                                         nl_inputs=nl_inputs,prev_nl_ids=prev_nl_ids,nl_lengths=nl_lengths,)
-
-            eval_loss += lm_loss.mean().item()
-            code_vecs.append(code_vec.cpu().numpy())
+            if code_index is None:
+                lm_loss,code_vec,nl_vec = model(code_inputs=code_inputs,prev_code_ids=prev_code_ids,code_lengths=code_lengths, 
+                                             nl_inputs=nl_inputs,prev_nl_ids=prev_nl_ids,nl_lengths=nl_lengths,)
+                eval_loss += lm_loss.mean().item()
+                code_vecs.append(code_vec.cpu().numpy())
+            else:
+                nl_vec=model_to_encode.encode_nl(nl_inputs,prev_nl_ids,nl_lengths)
             nl_vecs.append(nl_vec.cpu().numpy())
         nb_eval_steps += 1
-    code_vecs=np.concatenate(code_vecs,0)
-    nl_vecs=np.concatenate(nl_vecs,0)
+    #batches come sorted by length, back to the order of the examples
+    nl_vecs=restore_order(eval_dataloader,np.concatenate(nl_vecs,0))
     eval_loss = eval_loss / nb_eval_steps
     perplexity = torch.tensor(eval_loss)
 
-    scores=np.matmul(nl_vecs,code_vecs.T)
-
-    sort_ids=np.argsort(scores, axis=-1, kind='quicksort', order=None)[:,::-1]
     indexs=[]
     urls=[]
     for example in eval_dataset.examples:
         indexs.append(example.idx)
         urls.append(example.url)
-    with open(os.path.join(args.output_dir,"predictions.jsonl"),'w') as f:
-        for index,url,sort_id in zip(indexs,urls,sort_ids):
-            js={}
-            js['url']=url
-            js['answers']=[]
-            for idx in sort_id[:100]:
-                js['answers'].append(indexs[int(idx)])
-            f.write(json.dumps(js)+'\n')
-                        
+    if code_index is None:
+        code_vecs=restore_order(eval_dataloader,np.concatenate(code_vecs,0))
+        if index_dir is not None:
+            CodeIndex.build(index_dir,code_vecs,urls,indexs,args.code_index_dtype)
+    else:
+        code_vecs=np.asarray(code_index.vectors,dtype=np.float32)
+    write_predictions(os.path.join(args.output_dir,"predictions.jsonl"),nl_vecs,code_vecs,indexs,urls)
+
+
+def encode_queries(args, model, tokenizer, queries):
+    """Encode natural-language queries with the NL side of the model (see CodeIndex.query)."""
+    features=[convert_nl_to_features(query,tokenizer,args) for query in queries]
+    nl_inputs,prev_nl_ids=PadCollate([tokenizer.pad_token_id,tokenizer.pad_token_id])(
+        [(torch.tensor(x[1]),torch.tensor(x[2])) for x in features])
+    nl_inputs,prev_nl_ids=nl_inputs.to(args.device),prev_nl_ids.to(args.device)
+    nl_lengths=torch.tensor([x[3] for x in features]).to(args.device)
+    with torch.no_grad():
+        return model.encode_nl(nl_inputs,prev_nl_ids,nl_lengths).cpu().numpy()
                         
+
 def main():
     parser = argparse.ArgumentParser()
 
@@ -549,10 +568,24 @@ def main():
     parser.add_argument('--fp16_opt_level', type=str, default='O1',
                         help="For fp16: Apex AMP optimization level selected in ['O0', 'O1', 'O2', and 'O3']."
                              "See details at https://nvidia.github.io/apex/amp.html")
+    parser.add_argument("--no_length_bucketing", action='store_true',
+                        help="Batch examples in random/sequential order instead of by length (still padded per batch).")
     parser.add_argument("--local_rank", type=int, default=-1,
                         help="For distributed training: local_rank")
     parser.add_argument('--server_ip', type=str, default='', help="For distant debugging.")
     parser.add_argument('--server_port', type=str, default='', help="For distant debugging.")
+    parser.add_argument("--code_index_dtype", default="float32", type=str, choices=["float32", "float16"],
+                        help="Storage type of the code vectors cached by --do_test.")
+    parser.add_argument("--query", default=None, type=str,
+                        help="Natural-language query to search the code of test_data_file with.")
+    parser.add_argument("--query_top_k", default=10, type=int,
+                        help="Number of code snippets returned for --query.")
+    parser.add_argument("--ann_lists", default=0, type=int,
+                        help="Inverted lists of the IVF-PQ quantizer used by --query, 0 for exact search.")
+    parser.add_argument("--ann_subspaces", default=16, type=int,
+                        help="Product-quantized sub-vectors per code vector.")
+    parser.add_argument("--ann_nprobe", default=8, type=int,
+                        help="Inverted lists scanned per query.")
 
     
 
@@ -666,7 +699,27 @@ def main():
         output_dir = os.path.join(args.output_dir, '{}'.format(checkpoint_prefix))  
         model.load_state_dict(torch.load(output_dir))                  
         model.to(args.device)
-        test(args, model, tokenizer)
+        test(args, model, tokenizer, checkpoint=output_dir)
+
+    if args.query is not None and args.local_rank in [-1, 0]:
+        checkpoint_prefix = 'checkpoint-best-mrr/model.bin'
+        output_dir = os.path.join(args.output_dir, '{}'.format(checkpoint_prefix))  
+        model.load_state_dict(torch.load(output_dir))                  
+        model.to(args.device)
+        index_dir=code_index_path(args.output_dir,output_dir,args.test_data_file)
+        if not CodeIndex.exists(index_dir):
+            #encodes the code of test_data_file once and caches it
+            test(args, model, tokenizer, checkpoint=output_dir)
+        code_index=CodeIndex.load(index_dir,encode_query=partial(encode_queries,args,model,tokenizer))
+        nprobe=None
+        if args.ann_lists>0:
+            quantizer=code_index.quantizer
+            if quantizer is None or quantizer.coarse.shape[0]!=args.ann_lists or quantizer.codebooks.shape[0]!=args.ann_subspaces:
+                code_index.train_quantizer(args.ann_lists,args.ann_subspaces)
+            nprobe=args.ann_nprobe
+        logger.info("***** Query results *****")
+        for answer in code_index.query(args.query,args.query_top_k,nprobe):
+            logger.info("  %s %s %.4f", answer['idx'], answer['url'], answer['score'])
 
     return results
 
@@ -87,6 +87,9 @@ class Model(nn.Module):
         loss = loss_fct(scores, torch.arange(bs, device=scores.device))
         return loss,code_vec,nl_vec
 
+    def encode_nl(self, nl_inputs):
+        return self.encoder(nl_inputs)[1]
+
       
         
  
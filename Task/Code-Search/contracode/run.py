@@ -43,6 +43,9 @@ except:
 from tqdm import tqdm, trange
 import multiprocessing
 from model import Model, CodeModel
+from retrieval_eval import reciprocal_ranks, write_predictions
+from code_index import CodeIndex, code_index_path
+from functools import partial
 cpu_cont = multiprocessing.cpu_count()
 from transformers import (WEIGHTS_NAME, AdamW, get_linear_schedule_with_warmup,
                           BertConfig, BertForMaskedLM, BertTokenizer,
@@ -84,6 +87,16 @@ class InputFeatures(object):
         self.idx=idx
 
         
+def convert_nl_to_features(nl,tokenizer,args):
+    nl_tokens = normalize_program(nl)
+    nl_ids =  EncodeAsIds(tokenizer, 0, nl_tokens)
+    nl_ids = [tokenizer.PieceToId("<s>")] + nl_ids[: (args.block_size - 2)] + [tokenizer.PieceToId("</s>")]
+    padding_length = args.block_size - len(nl_ids)
+    nl_ids += [tokenizer.PieceToId("[PAD]")]*padding_length
+    nl_tokens = tokenizer.EncodeAsPieces(nl_tokens)
+    return nl_tokens,nl_ids
+
+
 def convert_examples_to_features(js,tokenizer,args):
     #code
     if 'code_tokens' in js:
@@ -97,13 +110,7 @@ def convert_examples_to_features(js,tokenizer,args):
     code_ids += [tokenizer.PieceToId("[PAD]")]*padding_length
     code_tokens = tokenizer.EncodeAsPieces(code_tokens)
     
-    nl=' '.join(js['docstring_tokens'])
-    nl_tokens = normalize_program(nl)
-    nl_ids =  EncodeAsIds(tokenizer, 0, nl_tokens)
-    nl_ids = [tokenizer.PieceToId("<s>")] + nl_ids[: (args.block_size - 2)] + [tokenizer.PieceToId("</s>")]
-    padding_length = args.block_size - len(nl_ids)
-    nl_ids += [tokenizer.PieceToId("[PAD]")]*padding_length
-    nl_tokens = tokenizer.EncodeAsPieces(nl_tokens)  
+    nl_tokens,nl_ids=convert_nl_to_features(' '.join(js['docstring_tokens']),tokenizer,args)
     
     return InputFeatures(code_tokens,code_ids,nl_tokens,nl_ids,js['url'],js['idx'])
 
@@ -338,31 +345,15 @@ def evaluate(args, model, tokenizer,eval_when_training=False, eval_file=None, st
     eval_loss = eval_loss / nb_eval_steps
     perplexity = torch.tensor(eval_loss)
 
-    scores=np.matmul(nl_vecs,code_vecs.T)
-    ranks=[]
-    for i in range(len(scores)):
-        score=scores[i,i]
-        rank=1
-        for j in range(len(scores)):
-            if i!=j and scores[i,j]>=score:
-                rank+=1
-        ranks.append(1/rank)    
+    ranks=reciprocal_ranks(nl_vecs,code_vecs)
     
     if eval_file == args.test_data_file:
-        sort_ids=np.argsort(scores, axis=-1, kind='quicksort', order=None)[:,::-1]
         indexs=[]
         urls=[]
         for example in eval_dataset.examples:
             indexs.append(example.idx)
             urls.append(example.url)
-        with open(os.path.join(args.output_dir,"predictions_{}.jsonl".format(steps)),'w') as f:
-            for index,url,sort_id in zip(indexs,urls,sort_ids):
-                js={}
-                js['url']=url
-                js['answers']=[]
-                for idx in sort_id[:100]:
-                    js['answers'].append(indexs[int(idx)])
-                f.write(json.dumps(js)+'\n')
+        write_predictions(os.path.join(args.output_dir,"predictions_{}.jsonl".format(steps)),nl_vecs,code_vecs,indexs,urls)
             
     result = {
         "eval_loss": float(perplexity),
@@ -372,9 +363,10 @@ def evaluate(args, model, tokenizer,eval_when_training=False, eval_file=None, st
 
     return result
 
-def test(args, model, tokenizer):
+def test(args, model, tokenizer, checkpoint=None):
     # Loop to handle MNLI double evaluation (matched, mis-matched)
     eval_dataset = TextDataset(tokenizer, args,args.test_data_file)
+    index_dir=code_index_path(args.output_dir,checkpoint,args.test_data_file) if checkpoint else None
 
 
     args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
@@ -392,40 +384,51 @@ def test(args, model, tokenizer):
     logger.info("  Batch size = %d", args.eval_batch_size)
     eval_loss = 0.0
     nb_eval_steps = 0
+    code_index=None
+    if index_dir is not None and CodeIndex.exists(index_dir) and not args.overwrite_cache:
+        logger.info("  Reusing code vectors from %s", index_dir)
+        code_index=CodeIndex.load(index_dir)
+    model_to_encode=model.module if hasattr(model,'module') else model
     code_vecs=[] 
     nl_vecs=[]
     for batch in eval_dataloader:
         code_inputs = batch[0].to(args.device)    
         nl_inputs = batch[1].to(args.device)
         with torch.no_grad():
-            lm_loss,code_vec,nl_vec = model(code_inputs,nl_inputs)
-            eval_loss += lm_loss.mean().item()
-            code_vecs.append(code_vec.cpu().numpy())
+            if code_index is None:
+                lm_loss,code_vec,nl_vec = model(code_inputs,nl_inputs)
+                eval_loss += lm_loss.mean().item()
+                code_vecs.append(code_vec.cpu().numpy())
+            else:
+                nl_vec=model_to_encode.encode_nl(nl_inputs)
             nl_vecs.append(nl_vec.cpu().numpy())
         nb_eval_steps += 1
-    code_vecs=np.concatenate(code_vecs,0)
     nl_vecs=np.concatenate(nl_vecs,0)
     eval_loss = eval_loss / nb_eval_steps
     perplexity = torch.tensor(eval_loss)
 
-    scores=np.matmul(nl_vecs,code_vecs.T)
-
-    sort_ids=np.argsort(scores, axis=-1, kind='quicksort', order=None)[:,::-1]
     indexs=[]
     urls=[]
     for example in eval_dataset.examples:
         indexs.append(example.idx)
         urls.append(example.url)
-    with open(os.path.join(args.output_dir,"predictions.jsonl"),'w') as f:
-        for index,url,sort_id in zip(indexs,urls,sort_ids):
-            js={}
-            js['url']=url
-            js['answers']=[]
-            for idx in sort_id[:100]:
-                js['answers'].append(indexs[int(idx)])
-            f.write(json.dumps(js)+'\n')
-                        
+    if code_index is None:
+        code_vecs=np.concatenate(code_vecs,0)
+        if index_dir is not None:
+            CodeIndex.build(index_dir,code_vecs,urls,indexs,args.code_index_dtype)
+    else:
+        code_vecs=np.asarray(code_index.vectors,dtype=np.float32)
+    write_predictions(os.path.join(args.output_dir,"predictions.jsonl"),nl_vecs,code_vecs,indexs,urls)
+
+
+def encode_queries(args, model, tokenizer, queries):
+    """Encode natural-language queries with the NL side of the model (see CodeIndex.query)."""
+    features=[convert_nl_to_features(query,tokenizer,args) for query in queries]
+    nl_inputs=torch.tensor([x[1] for x in features]).to(args.device)
+    with torch.no_grad():
+        return model.encode_nl(nl_inputs).cpu().numpy()
                         
+
 def main():
     parser = argparse.ArgumentParser()
 
@@ -522,6 +525,18 @@ def main():
                         help="For distributed training: local_rank")
     parser.add_argument('--server_ip', type=str, default='', help="For distant debugging.")
     parser.add_argument('--server_port', type=str, default='', help="For distant debugging.")
+    parser.add_argument("--code_index_dtype", default="float32", type=str, choices=["float32", "float16"],
+                        help="Storage type of the code vectors cached by --do_test.")
+    parser.add_argument("--query", default=None, type=str,
+                        help="Natural-language query to search the code of test_data_file with.")
+    parser.add_argument("--query_top_k", default=10, type=int,
+                        help="Number of code snippets returned for --query.")
+    parser.add_argument("--ann_lists", default=0, type=int,
+                        help="Inverted lists of the IVF-PQ quantizer used by --query, 0 for exact search.")
+    parser.add_argument("--ann_subspaces", default=16, type=int,
+                        help="Product-quantized sub-vectors per code vector.")
+    parser.add_argument("--ann_nprobe", default=8, type=int,
+                        help="Inverted lists scanned per query.")
 
     
 
@@ -648,7 +663,27 @@ def main():
         output_dir = os.path.join(args.output_dir, '{}'.format(checkpoint_prefix))  
         model.load_state_dict(torch.load(output_dir))                  
         model.to(args.device)
-        test(args, model, tokenizer)
+        test(args, model, tokenizer, checkpoint=output_dir)
+
+    if args.query is not None and args.local_rank in [-1, 0]:
+        checkpoint_prefix = 'checkpoint-best-mrr/model.bin'
+        output_dir = os.path.join(args.output_dir, '{}'.format(checkpoint_prefix))  
+        model.load_state_dict(torch.load(output_dir))                  
+        model.to(args.device)
+        index_dir=code_index_path(args.output_dir,output_dir,args.test_data_file)
+        if not CodeIndex.exists(index_dir):
+            #encodes the code of test_data_file once and caches it
+            test(args, model, tokenizer, checkpoint=output_dir)
+        code_index=CodeIndex.load(index_dir,encode_query=partial(encode_queries,args,model,tokenizer))
+        nprobe=None
+        if args.ann_lists>0:
+            quantizer=code_index.quantizer
+            if quantizer is None or quantizer.coarse.shape[0]!=args.ann_lists or quantizer.codebooks.shape[0]!=args.ann_subspaces:
+                code_index.train_quantizer(args.ann_lists,args.ann_subspaces)
+            nprobe=args.ann_nprobe
+        logger.info("***** Query results *****")
+        for answer in code_index.query(args.query,args.query_top_k,nprobe):
+            logger.info("  %s %s %.4f", answer['idx'], answer['url'], answer['score'])
 
     return results
 
@@ -7,6 +7,7 @@ from torch.autograd import Variable
 import copy
 import torch.nn.functional as F
 from torch.nn import CrossEntropyLoss, MSELoss
+from graph_mask import GraphAttnMask
 
 
     
@@ -21,6 +22,8 @@ class Model(nn.Module):
         
     def forward(self, code_inputs=None, attn_mask=None,position_idx=None, nl_inputs=None,return_vec=False): 
         bs=code_inputs.shape[0]
+        if isinstance(attn_mask,GraphAttnMask):
+            attn_mask=attn_mask.dense()
 
         nodes_mask=position_idx.eq(0)
         token_mask=position_idx.ge(2)        
@@ -39,6 +42,9 @@ class Model(nn.Module):
         loss = loss_fct(scores, torch.arange(bs, device=scores.device))
         return loss,code_vec,nl_vec
 
+    def encode_nl(self, nl_inputs):
+        return self.encoder(nl_inputs,attention_mask=nl_inputs.ne(1))[1]
+
       
         
  
@@ -32,7 +32,7 @@ import shutil
 
 import numpy as np
 import torch
-from torch.utils.data import DataLoader, Dataset, SequentialSampler, RandomSampler,TensorDataset
+from torch.utils.data import DataLoader, Dataset,TensorDataset
 from torch.utils.data.distributed import DistributedSampler
 import json
 try:
@@ -43,6 +43,11 @@ except:
 from tqdm import tqdm, trange
 import multiprocessing
 from model import Model
+from retrieval_eval import reciprocal_ranks, write_predictions
+from code_index import CodeIndex, code_index_path
+from graph_mask import DFGGraph, collate_graph_batch
+from dynamic_padding import PadCollate, bucketed_dataloader, restore_order
+from functools import partial
 cpu_cont = multiprocessing.cpu_count()
 from transformers import (WEIGHTS_NAME, AdamW, get_linear_schedule_with_warmup,
                           BertConfig, BertForMaskedLM, BertTokenizer,
@@ -150,6 +155,15 @@ class InputFeatures(object):
         self.url=url
 
         
+def convert_nl_to_features(nl,tokenizer,args):
+    nl_tokens=tokenizer.tokenize(nl)[:args.nl_length-2]
+    nl_tokens =[tokenizer.cls_token]+nl_tokens+[tokenizer.sep_token]
+    nl_ids =  tokenizer.convert_tokens_to_ids(nl_tokens)
+    padding_length = args.nl_length - len(nl_ids)
+    nl_ids+=[tokenizer.pad_token_id]*padding_length
+    return nl_tokens,nl_ids
+
+
 def convert_examples_to_features(item):
     js,tokenizer,args=item
     #code
@@ -189,12 +203,7 @@ def convert_examples_to_features(item):
     length=len([tokenizer.cls_token])
     dfg_to_code=[(x[0]+length,x[1]+length) for x in dfg_to_code]        
     #nl
-    nl=' '.join(js['docstring_tokens'])
-    nl_tokens=tokenizer.tokenize(nl)[:args.nl_length-2]
-    nl_tokens =[tokenizer.cls_token]+nl_tokens+[tokenizer.sep_token]
-    nl_ids =  tokenizer.convert_tokens_to_ids(nl_tokens)
-    padding_length = args.nl_length - len(nl_ids)
-    nl_ids+=[tokenizer.pad_token_id]*padding_length    
+    nl_tokens,nl_ids=convert_nl_to_features(' '.join(js['docstring_tokens']),tokenizer,args)
     
     return InputFeatures(js['idx'], code_tokens,code_ids,position_idx,dfg_to_code,dfg_to_dfg,nl_tokens,nl_ids,js['url'])
 
@@ -228,40 +237,28 @@ class TextDataset(Dataset):
                 logger.info("dfg_to_dfg: {}".format(' '.join(map(str, example.dfg_to_dfg))))                
                 logger.info("nl_tokens: {}".format([x.replace('\u0120','_') for x in example.nl_tokens]))
                 logger.info("nl_ids: {}".format(' '.join(map(str, example.nl_ids))))          
+        #compact graph-guided attention masks, expanded per batch by collate_graph_batch
+        self.graphs=[DFGGraph.from_features(example.code_ids,example.position_idx,
+                                            example.dfg_to_code,example.dfg_to_dfg) for example in self.examples]
+        #code and queries are encoded in one batch, the longer of the two sets the length
+        self.lengths=[max(graph.max_length,np.count_nonzero(np.asarray(example.nl_ids)!=tokenizer.pad_token_id))
+                      for graph,example in zip(self.graphs,self.examples)]
                 
     def __len__(self):
         return len(self.examples)
     
     def __getitem__(self, item): 
-        #calculate graph-guided masked function
-        attn_mask=np.zeros((self.args.code_length+self.args.data_flow_length,
-                            self.args.code_length+self.args.data_flow_length),dtype=bool)
-        #calculate begin index of node and max length of input
-        node_index=sum([i>1 for i in self.examples[item].position_idx])
-        max_length=sum([i!=1 for i in self.examples[item].position_idx])
-        #sequence can attend to sequence
-        attn_mask[:node_index,:node_index]=True
-        #special tokens attend to all tokens
-        for idx,i in enumerate(self.examples[item].code_ids):
-            if i in [0,2]:
-                attn_mask[idx,:max_length]=True
-        #nodes attend to code tokens that are identified from
-        for idx,(a,b) in enumerate(self.examples[item].dfg_to_code):
-            if a<node_index and b<node_index:
-                attn_mask[idx+node_index,a:b]=True
-                attn_mask[a:b,idx+node_index]=True
-        #nodes attend to adjacent nodes 
-        for idx,nodes in enumerate(self.examples[item].dfg_to_dfg):
-            for a in nodes:
-                if a+node_index<len(self.examples[item].position_idx):
-                    attn_mask[idx+node_index,a+node_index]=True  
-                    
         return (torch.tensor(self.examples[item].code_ids),
-              torch.tensor(attn_mask),
+              self.graphs[item],
               torch.tensor(self.examples[item].position_idx), 
               torch.tensor(self.examples[item].nl_ids))
 
 
+def collate_search_batch(batch,packed=False):
+    """collate_graph_batch trimming the code side, PadCollate cutting the queries to their longest one."""
+    return collate_graph_batch([x[:3] for x in batch],packed=packed,trim=True)+PadCollate([1])([x[3:] for x in batch])
+
+
 def set_seed(seed=42):
     random.seed(seed)
     os.environ['PYHTONHASHSEED'] = str(seed)
@@ -275,10 +272,14 @@ def train(args, train_dataset, model, tokenizer):
     """ Train the model """
     
     args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
-    train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
-    
-    train_dataloader = DataLoader(train_dataset, sampler=train_sampler, 
-                                  batch_size=args.train_batch_size,num_workers=4,pin_memory=True)
+    collate_fn=partial(collate_search_batch,packed=args.packed_graph_mask)
+    if args.local_rank == -1:
+        train_dataloader = bucketed_dataloader(train_dataset, train_dataset.lengths, args.train_batch_size, shuffle=True,
+                                               bucketing=not args.no_length_bucketing, collate_fn=collate_fn,
+                                               num_workers=4,pin_memory=True)
+    else:
+        train_dataloader = DataLoader(train_dataset, sampler=DistributedSampler(train_dataset), batch_size=args.train_batch_size,
+                                      num_workers=4,pin_memory=True,collate_fn=collate_fn)
     args.max_steps=args.epoch*len( train_dataloader)
     args.save_steps=len( train_dataloader)//5
     args.warmup_steps=len( train_dataloader)
@@ -437,8 +438,14 @@ def evaluate(args, model, tokenizer,eval_when_training=False, eval_file=None, st
 
     args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
     # Note that DistributedSampler samples randomly
-    eval_sampler = SequentialSampler(eval_dataset) if args.local_rank == -1 else DistributedSampler(eval_dataset)
-    eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size,num_workers=4,pin_memory=True)
+    collate_fn=partial(collate_search_batch,packed=args.packed_graph_mask)
+    if args.local_rank == -1:
+        eval_dataloader = bucketed_dataloader(eval_dataset, eval_dataset.lengths, args.eval_batch_size, shuffle=False,
+                                              bucketing=not args.no_length_bucketing, collate_fn=collate_fn,
+                                              num_workers=4,pin_memory=True)
+    else:
+        eval_dataloader = DataLoader(eval_dataset, sampler=DistributedSampler(eval_dataset), batch_size=args.eval_batch_size,
+                                     num_workers=4,pin_memory=True,collate_fn=collate_fn)
 
     # multi-gpu evaluate
     if args.n_gpu > 1 and eval_when_training is False:
@@ -464,36 +471,21 @@ def evaluate(args, model, tokenizer,eval_when_training=False, eval_file=None, st
             code_vecs.append(code_vec.cpu().numpy())
             nl_vecs.append(nl_vec.cpu().numpy())
         nb_eval_steps += 1
-    code_vecs=np.concatenate(code_vecs,0)
-    nl_vecs=np.concatenate(nl_vecs,0)
+    #batches come sorted by length, back to the order of the examples
+    code_vecs=restore_order(eval_dataloader,np.concatenate(code_vecs,0))
+    nl_vecs=restore_order(eval_dataloader,np.concatenate(nl_vecs,0))
     eval_loss = eval_loss / nb_eval_steps
     perplexity = torch.tensor(eval_loss)
 
-    scores=np.matmul(nl_vecs,code_vecs.T)
-    ranks=[]
-    for i in range(len(scores)):
-        score=scores[i,i]
-        rank=1
-        for j in range(len(scores)):
-            if i!=j and scores[i,j]>=score:
-                rank+=1
-        ranks.append(1/rank)    
+    ranks=reciprocal_ranks(nl_vecs,code_vecs)
     
     if eval_file == args.test_data_file:
-        sort_ids=np.argsort(scores, axis=-1, kind='quicksort', order=None)[:,::-1]
         indexs=[]
         urls=[]
         for example in eval_dataset.examples:
             indexs.append(example.idx)
             urls.append(example.url)
-        with open(os.path.join(args.output_dir,"predictions_{}.jsonl".format(steps)),'w') as f:
-            for index,url,sort_id in zip(indexs,urls,sort_ids):
-                js={}
-                js['url']=url
-                js['answers']=[]
-                for idx in sort_id[:100]:
-                    js['answers'].append(indexs[int(idx)])
-                f.write(json.dumps(js)+'\n')
+        write_predictions(os.path.join(args.output_dir,"predictions_{}.jsonl".format(steps)),nl_vecs,code_vecs,indexs,urls)
             
     result = {
         "eval_loss": float(perplexity),
@@ -503,15 +495,21 @@ def evaluate(args, model, tokenizer,eval_when_training=False, eval_file=None, st
 
     return result
 
-def test(args, model, tokenizer):
+def test(args, model, tokenizer, checkpoint=None):
     # Loop to handle MNLI double evaluation (matched, mis-matched)
     eval_dataset = TextDataset(tokenizer, args,args.test_data_file)
+    index_dir=code_index_path(args.output_dir,checkpoint,args.test_data_file) if checkpoint else None
 
 
     args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
     # Note that DistributedSampler samples randomly
-    eval_sampler = SequentialSampler(eval_dataset) if args.local_rank == -1 else DistributedSampler(eval_dataset)
-    eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size)
+    collate_fn=partial(collate_search_batch,packed=args.packed_graph_mask)
+    if args.local_rank == -1:
+        eval_dataloader = bucketed_dataloader(eval_dataset, eval_dataset.lengths, args.eval_batch_size, shuffle=False,
+                                              bucketing=not args.no_length_bucketing, collate_fn=collate_fn)
+    else:
+        eval_dataloader = DataLoader(eval_dataset, sampler=DistributedSampler(eval_dataset), batch_size=args.eval_batch_size,
+                                     collate_fn=collate_fn)
 
     # multi-gpu evaluate
     if args.n_gpu > 1:
@@ -523,6 +521,11 @@ def test(args, model, tokenizer):
     logger.info("  Batch size = %d", args.eval_batch_size)
     eval_loss = 0.0
     nb_eval_steps = 0
+    code_index=None
+    if index_dir is not None and CodeIndex.exists(index_dir) and not args.overwrite_cache:
+        logger.info("  Reusing code vectors from %s", index_dir)
+        code_index=CodeIndex.load(index_dir)
+    model_to_encode=model.module if hasattr(model,'module') else model
     code_vecs=[] 
     nl_vecs=[]
     for batch in eval_dataloader:
@@ -531,34 +534,41 @@ def test(args, model, tokenizer):
         position_idx = batch[2].to(args.device)
         nl_inputs = batch[3].to(args.device)
         with torch.no_grad():
-            lm_loss,code_vec,nl_vec = model(code_inputs=code_inputs,attn_mask=attn_mask,position_idx=position_idx,nl_inputs=nl_inputs)
-            eval_loss += lm_loss.mean().item()
-            code_vecs.append(code_vec.cpu().numpy())
+            if code_index is None:
+                lm_loss,code_vec,nl_vec = model(code_inputs=code_inputs,attn_mask=attn_mask,position_idx=position_idx,nl_inputs=nl_inputs)
+                eval_loss += lm_loss.mean().item()
+                code_vecs.append(code_vec.cpu().numpy())
+            else:
+                nl_vec=model_to_encode.encode_nl(nl_inputs)
             nl_vecs.append(nl_vec.cpu().numpy())
         nb_eval_steps += 1
-    code_vecs=np.concatenate(code_vecs,0)
-    nl_vecs=np.concatenate(nl_vecs,0)
+    #batches come sorted by length, back to the order of the examples
+    nl_vecs=restore_order(eval_dataloader,np.concatenate(nl_vecs,0))
     eval_loss = eval_loss / nb_eval_steps
     perplexity = torch.tensor(eval_loss)
 
-    scores=np.matmul(nl_vecs,code_vecs.T)
-
-    sort_ids=np.argsort(scores, axis=-1, kind='quicksort', order=None)[:,::-1]
     indexs=[]
     urls=[]
     for example in eval_dataset.examples:
         indexs.append(example.idx)
         urls.append(example.url)
-    with open(os.path.join(args.output_dir,"predictions.jsonl"),'w') as f:
-        for index,url,sort_id in zip(indexs,urls,sort_ids):
-            js={}
-            js['url']=url
-            js['answers']=[]
-            for idx in sort_id[:100]:
-                js['answers'].append(indexs[int(idx)])
-            f.write(json.dumps(js)+'\n')
-                        
+    if code_index is None:
+        code_vecs=restore_order(eval_dataloader,np.concatenate(code_vecs,0))
+        if index_dir is not None:
+            CodeIndex.build(index_dir,code_vecs,urls,indexs,args.code_index_dtype)
+    else:
+        code_vecs=np.asarray(code_index.vectors,dtype=np.float32)
+    write_predictions(os.path.join(args.output_dir,"predictions.jsonl"),nl_vecs,code_vecs,indexs,urls)
+
+
+def encode_queries(args, model, tokenizer, queries):
+    """Encode natural-language queries with the NL side of the model (see CodeIndex.query)."""
+    features=[convert_nl_to_features(query,tokenizer,args) for query in queries]
+    nl_inputs=PadCollate([tokenizer.pad_token_id])([(torch.tensor(x[1]),) for x in features])[0].to(args.device)
+    with torch.no_grad():
+        return model.encode_nl(nl_inputs).cpu().numpy()
                         
+
 def main():
     parser = argparse.ArgumentParser()
 
@@ -663,6 +673,22 @@ def main():
                         help="For distributed training: local_rank")
     parser.add_argument('--server_ip', type=str, default='', help="For distant debugging.")
     parser.add_argument('--server_port', type=str, default='', help="For distant debugging.")
+    parser.add_argument("--code_index_dtype", default="float32", type=str, choices=["float32", "float16"],
+                        help="Storage type of the code vectors cached by --do_test.")
+    parser.add_argument("--query", default=None, type=str,
+                        help="Natural-language query to search the code of test_data_file with.")
+    parser.add_argument("--query_top_k", default=10, type=int,
+                        help="Number of code snippets returned for --query.")
+    parser.add_argument("--ann_lists", default=0, type=int,
+                        help="Inverted lists of the IVF-PQ quantizer used by --query, 0 for exact search.")
+    parser.add_argument("--ann_subspaces", default=16, type=int,
+                        help="Product-quantized sub-vectors per code vector.")
+    parser.add_argument("--ann_nprobe", default=8, type=int,
+                        help="Inverted lists scanned per query.")
+    parser.add_argument('--packed_graph_mask', action='store_true',
+                        help="Send packed DFG graphs to the model and expand the graph-guided attention mask on device.")
+    parser.add_argument('--no_length_bucketing', action='store_true',
+                        help="Batch examples in random/sequential order instead of by length (still trimmed per batch).")
 
     
 
@@ -687,6 +713,9 @@ def main():
         torch.distributed.init_process_group(backend='nccl')
         args.n_gpu = 1
     args.device = device
+    if args.packed_graph_mask and args.n_gpu > 1 and args.local_rank == -1:
+        # DataParallel cannot scatter a packed mask across replicas
+        args.packed_graph_mask = False
     args.per_gpu_train_batch_size=args.train_batch_size//args.n_gpu
     args.per_gpu_eval_batch_size=args.eval_batch_size//args.n_gpu
     # Setup logging
@@ -776,7 +805,27 @@ def main():
         output_dir = os.path.join(args.output_dir, '{}'.format(checkpoint_prefix))  
         model.load_state_dict(torch.load(output_dir))                  
         model.to(args.device)
-        test(args, model, tokenizer)
+        test(args, model, tokenizer, checkpoint=output_dir)
+
+    if args.query is not None and args.local_rank in [-1, 0]:
+        checkpoint_prefix = 'checkpoint-best-mrr/model.bin'
+        output_dir = os.path.join(args.output_dir, '{}'.format(checkpoint_prefix))  
+        model.load_state_dict(torch.load(output_dir))                  
+        model.to(args.device)
+        index_dir=code_index_path(args.output_dir,output_dir,args.test_data_file)
+        if not CodeIndex.exists(index_dir):
+            #encodes the code of test_data_file once and caches it
+            test(args, model, tokenizer, checkpoint=output_dir)
+        code_index=CodeIndex.load(index_dir,encode_query=partial(encode_queries,args,model,tokenizer))
+        nprobe=None
+        if args.ann_lists>0:
+            quantizer=code_index.quantizer
+            if quantizer is None or quantizer.coarse.shape[0]!=args.ann_lists or quantizer.codebooks.shape[0]!=args.ann_subspaces:
+                code_index.train_quantizer(args.ann_lists,args.ann_subspaces)
+            nprobe=args.ann_nprobe
+        logger.info("***** Query results *****")
+        for answer in code_index.query(args.query,args.query_top_k,nprobe):
+            logger.info("  %s %s %.4f", answer['idx'], answer['url'], answer['score'])
 
     return results
 
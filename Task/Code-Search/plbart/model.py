@@ -30,12 +30,17 @@ class Model(nn.Module):
         self.args=args
         self.pooler = Pooler(self.config.encoder_embed_dim)
 
+    def pool_positions(self, input_ids):
+        if self.args.no_length_bucketing:
+            # fixed-width batches: the last-but-one column, as checkpoints trained before length bucketing
+            return torch.ne(input_ids, 0).sum(-1) - 1
+        return torch.ne(input_ids, 1).sum(-1) - 1 # position of </s>, independent of the batch width
     
     def forward(self, code_inputs,prev_code_inputs,nl_inputs,prev_nl_inputs,return_vec=False): 
         bs=code_inputs.shape[0]
         input_ids=torch.cat((code_inputs,nl_inputs),0)
         prev_tokens_ids=torch.cat((prev_code_inputs,prev_nl_inputs),0)
-        lengths = torch.ne(input_ids, 0).sum(-1) - 1
+        lengths = self.pool_positions(input_ids)
         outputs=self.encoder(src_tokens=input_ids,src_lengths=lengths,prev_output_tokens=prev_tokens_ids,features_only=True)[0] # L * B * D 
         outputs=outputs[range(2*bs),lengths,:] # 3B * D
         code_vec=outputs[:bs]
@@ -48,6 +53,11 @@ class Model(nn.Module):
         loss = loss_fct(scores, torch.arange(bs, device=scores.device))
         return loss,code_vec,nl_vec
 
+    def encode_nl(self, nl_inputs, prev_nl_inputs):
+        lengths = self.pool_positions(nl_inputs)
+        outputs=self.encoder(src_tokens=nl_inputs,src_lengths=lengths,prev_output_tokens=prev_nl_inputs,features_only=True)[0]
+        return outputs[range(nl_inputs.shape[0]),lengths,:]
+
       
         
  
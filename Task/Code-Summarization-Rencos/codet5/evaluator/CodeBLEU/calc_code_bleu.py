@@ -5,10 +5,10 @@
 # -*- coding:utf-8 -*-
 import argparse
 import os
-from evaluator.CodeBLEU import bleu, weighted_ngram_match, syntax_match, dataflow_match
+from evaluator.CodeBLEU import bleu, weighted_ngram_match, code_match
 
 
-def get_codebleu(refs, hyp, lang, params='0.25,0.25,0.25,0.25'):
+def get_codebleu(refs, hyp, lang, params='0.25,0.25,0.25,0.25', workers=None):
     if not isinstance(refs, list):
         refs = [refs]
     alpha, beta, gamma, theta = [float(x) for x in params.split(',')]
@@ -36,7 +36,7 @@ def get_codebleu(refs, hyp, lang, params='0.25,0.25,0.25,0.25'):
 
     # calculate weighted ngram match
     root_dir = os.path.dirname(__file__)
-    keywords = [x.strip() for x in open(root_dir + '/keywords/' + lang + '.txt', 'r', encoding='utf-8').readlines()]
+    keywords = {x.strip() for x in open(root_dir + '/keywords/' + lang + '.txt', 'r', encoding='utf-8').readlines()}
 
     def make_weights(reference_tokens, key_word_list):
         return {token: 1 if token in key_word_list else 0.2 for token in reference_tokens}
@@ -46,11 +46,9 @@ def get_codebleu(refs, hyp, lang, params='0.25,0.25,0.25,0.25'):
 
     weighted_ngram_match_score = weighted_ngram_match.corpus_bleu(tokenized_refs_with_weights, tokenized_hyps)
 
-    # calculate syntax match
-    syntax_match_score = syntax_match.corpus_syntax_match(references, hypothesis, lang)
-
-    # calculate dataflow match
-    dataflow_match_score = dataflow_match.corpus_dataflow_match(references, hypothesis, lang)
+    # calculate syntax match and dataflow match, parsing every snippet once
+    syntax_match_score, dataflow_match_score = code_match.corpus_syntax_dataflow_match(references, hypothesis, lang,
+                                                                                       workers)
 
     print('ngram match: {0}, weighted ngram match: {1}, syntax_match: {2}, dataflow_match: {3}'. \
           format(ngram_match_score, weighted_ngram_match_score, syntax_match_score, dataflow_match_score))
@@ -74,8 +72,10 @@ if __name__ == '__main__':
                         help='programming language')
     parser.add_argument('--params', type=str, default='0.25,0.25,0.25,0.25',
                         help='alpha, beta and gamma')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='processes for syntax/dataflow matching (default: all cpus, at most 8)')
 
     args = parser.parse_args()
-    code_bleu_score = get_codebleu(args.refs, args.hyp, args.lang, args.params)
+    code_bleu_score = get_codebleu(args.refs, args.hyp, args.lang, args.params, args.workers)
     print('CodeBLEU score: ', code_bleu_score)
 
@@ -68,30 +68,32 @@ def remove_comments_and_docstrings(source, lang):
 
 
 def tree_to_token_index(root_node):
-    if (len(root_node.children) == 0 or root_node.type in ['string_literal', 'string',
-                                                           'character_literal']) and root_node.type != 'comment':
-        return [(root_node.start_point, root_node.end_point)]
-    else:
-        code_tokens = []
-        for child in root_node.children:
-            code_tokens += tree_to_token_index(child)
-        return code_tokens
+    code_tokens = []
+    stack = [root_node]
+    while stack:
+        node = stack.pop()
+        if (len(node.children) == 0 or node.type in ['string_literal', 'string',
+                                                      'character_literal']) and node.type != 'comment':
+            code_tokens.append((node.start_point, node.end_point))
+        else:
+            stack.extend(reversed(node.children))
+    return code_tokens
 
 
 def tree_to_variable_index(root_node, index_to_code):
-    if (len(root_node.children) == 0 or root_node.type in ['string_literal', 'string',
-                                                           'character_literal']) and root_node.type != 'comment':
-        index = (root_node.start_point, root_node.end_point)
-        _, code = index_to_code[index]
-        if root_node.type != code:
-            return [(root_node.start_point, root_node.end_point)]
+    code_tokens = []
+    stack = [root_node]
+    while stack:
+        node = stack.pop()
+        if (len(node.children) == 0 or node.type in ['string_literal', 'string',
+                                                      'character_literal']) and node.type != 'comment':
+            index = (node.start_point, node.end_point)
+            _, code = index_to_code[index]
+            if node.type != code:
+                code_tokens.append(index)
         else:
-            return []
-    else:
-        code_tokens = []
-        for child in root_node.children:
-            code_tokens += tree_to_variable_index(child, index_to_code)
-        return code_tokens
+            stack.extend(reversed(node.children))
+    return code_tokens
 
 
 def index_to_code_token(index, code):
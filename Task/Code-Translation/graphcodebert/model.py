@@ -1,9 +1,10 @@
 # Copyright (c) Microsoft Corporation. 
 # Licensed under the MIT license.
 
+import math
 import torch
 import torch.nn as nn
-import torch
+import torch.nn.functional as F
 from torch.autograd import Variable
 import copy
 class Seq2Seq(nn.Module):
@@ -82,48 +83,222 @@ class Seq2Seq(nn.Module):
             return outputs
         else:
             #Predict 
-            preds=[]       
-            zero=torch.cuda.LongTensor(1).fill_(0)     # [0]
-            for i in range(source_ids.shape[0]): # B
-                context=encoder_output[:,i:i+1] # L * 1 * D
-                context_mask=source_mask[i:i+1,:] # 1 * L
-                beam = Beam(self.beam_size,self.sos_id,self.eos_id)
-                input_ids=beam.getCurrentState() # beam * 1
-                context=context.repeat(1, self.beam_size,1) # L * beam * D
-                context_mask=context_mask.repeat(self.beam_size,1) # beam * L
-                for _ in range(self.max_length): 
-                    if beam.done():
+            return self.beam_search(outputs[0],source_mask)
+
+    def beam_search(self, encoder_output, source_mask):
+        """
+            Batched beam search with incremental decoding.
+
+            All examples of the batch are decoded together. Decoder self-attention
+            keys/values and the projected encoder memory are cached, so every step
+            only runs the decoder on the newest token. Hypotheses are scored, stopped
+            and ranked exactly like `Beam`.
+
+            Parameters:
+
+            * `encoder_output`- encoder states, B * L * D
+            * `source_mask`- source attention mask, B * L
+
+            Returns: B * beam * max_length predicted ids, padded with 0.
+        """
+        batch_size,beam_size=encoder_output.shape[0],self.beam_size
+        device=encoder_output.device
+        embeddings=self.encoder.embeddings
+        pad_id=embeddings.padding_idx
+        #row a*beam+k holds beam k of the a-th active example
+        decoder=IncrementalDecoder(self.decoder,encoder_output,(1-source_mask).bool(),self.max_length)
+        decoder.select(torch.arange(batch_size,device=device).repeat_interleave(beam_size),memory=True)
+        active=list(range(batch_size))
+        input_ids=torch.full((batch_size*beam_size,1),self.sos_id,dtype=torch.long,device=device) # (B*beam) * 1
+        lengths=torch.zeros(batch_size*beam_size,dtype=torch.long,device=device)
+        scores=torch.zeros(batch_size,beam_size,device=device)
+        #per example: (tokens, backpointers) of every step, finished hypotheses, last scores
+        history=[[] for _ in range(batch_size)]
+        finished=[[] for _ in range(batch_size)]
+        eos_top=[False]*batch_size
+        last_scores=[None]*batch_size
+        for step in range(self.max_length):
+            #position ids as RoBERTa derives them from the full prefix
+            not_pad=input_ids.ne(pad_id).long()
+            lengths=lengths+not_pad[:,0]
+            position_ids=lengths[:,None]*not_pad+pad_id
+            tgt_embeddings=embeddings(input_ids=input_ids,position_ids=position_ids)[:,0] # (A*beam) * D
+            out=torch.tanh(self.dense(decoder.step(tgt_embeddings)))
+            out=self.lsm(self.lm_head(out)).data.view(len(active),beam_size,-1) # A * beam * V
+            num_words=out.shape[-1]
+            if step==0:
+                #all beams start from the same prefix
+                best_scores,best_ids=out[:,0].topk(beam_size,-1,True,True) # A * beam
+            else:
+                beam_lk=out+scores[:,:,None]
+                # Don't let EOS have children.
+                beam_lk.masked_fill_(input_ids.view(-1,beam_size,1).eq(self.eos_id),-1e20)
+                best_scores,best_ids=beam_lk.view(len(active),-1).topk(beam_size,-1,True,True) # A * beam
+            scores=best_scores
+            prev_k=best_ids//num_words
+            next_ys=best_ids-prev_k*num_words
+
+            keep=[]
+            for a,(ys,ks,ss) in enumerate(zip(next_ys.tolist(),prev_k.tolist(),scores.tolist())):
+                b=active[a]
+                history[b].append((ys,ks))
+                last_scores[b]=ss
+                for k,y in enumerate(ys):
+                    if y==self.eos_id:
+                        finished[b].append((ss[k],len(history[b]),k))
+                if ys[0]==self.eos_id:
+                    eos_top[b]=True
+                if not (eos_top[b] and len(finished[b])>=beam_size):
+                    keep.append(a)
+            if not keep:
+                break
+            origins=(torch.arange(len(active),device=device)[:,None]*beam_size+prev_k).view(-1)
+            if len(keep)<len(active):
+                #drop the examples whose beam is done
+                keep_ids=torch.tensor(keep,device=device)
+                origins=origins.view(len(active),beam_size)[keep_ids].view(-1)
+                next_ys,scores=next_ys[keep_ids],scores[keep_ids]
+                active=[active[a] for a in keep]
+            decoder.select(origins,memory=len(origins)!=len(input_ids))
+            lengths=lengths[origins]
+            input_ids=next_ys.view(-1,1)
+
+        preds=[]
+        for b in range(batch_size):
+            last_ys=history[b][-1][0]
+            final=finished[b]
+            if len(final)==0:
+                final.append((last_scores[b][0],len(history[b]),0))
+            final.sort(key=lambda a: -a[0])
+            if len(final)!=beam_size:
+                unfinished=[(last_scores[b][k],len(history[b]),k) for k in range(beam_size) if last_ys[k]!=self.eos_id]
+                unfinished.sort(key=lambda a: -a[0])
+                final+=unfinished[:beam_size-len(final)]
+            pred=[]
+            for _,timestep,k in final[:beam_size]:
+                hyp=[]
+                for j in range(timestep-1,-1,-1):
+                    hyp.append(history[b][j][0][k])
+                    k=history[b][j][1][k]
+                tokens=[]
+                for tok in hyp[::-1]:
+                    if tok==self.eos_id:
                         break
-                    attn_mask=-1e4 *(1-self.bias[:input_ids.shape[1],:input_ids.shape[1]])
-                    tgt_embeddings = self.encoder.embeddings(input_ids).permute([1,0,2]).contiguous() # 1 * beam * D
-                    out = self.decoder(tgt_embeddings,context,tgt_mask=attn_mask,memory_key_padding_mask=(1-context_mask).bool()) # 1 * beam * D
-                    out = torch.tanh(self.dense(out))
-                    hidden_states=out.permute([1,0,2]).contiguous()[:,-1,:] # beam * D
-                    out = self.lsm(self.lm_head(hidden_states)).data # beam * V
-                    beam.advance(out)
-                    input_ids.data.copy_(input_ids.data.index_select(0, beam.getCurrentOrigin())) # beam * 1
-                    input_ids=torch.cat((input_ids,beam.getCurrentState()),-1) # beam * 2
-                hyp= beam.getHyp(beam.getFinal())
-                pred=beam.buildTargetTokens(hyp)[:self.beam_size]
-                pred=[torch.cat([x.view(-1) for x in p]+[zero]*(self.max_length-len(p))).view(1,-1) for p in pred] # beam * l
-                preds.append(torch.cat(pred,0).unsqueeze(0)) # 1 * beam * l
-                
-            preds=torch.cat(preds,0)                # B * beam * l
-            return preds   
+                    tokens.append(tok)
+                pred.append(tokens+[0]*(self.max_length-len(tokens)))
+            pred+=[[0]*self.max_length]*(beam_size-len(pred))
+            preds.append(pred)
+        return torch.tensor(preds,dtype=torch.long,device=device) # B * beam * l
+
+
+class IncrementalDecoder(object):
+    """
+        Runs an nn.TransformerDecoder one target position at a time.
+
+        Self-attention keys/values of the decoded prefix are kept in per-layer
+        buffers and the encoder memory is projected to keys/values once, so a step
+        costs O(prefix) instead of re-running the decoder over the whole prefix.
+        Rows are batch first: memory is N * S * D and step inputs are N * D.
+    """
+    def __init__(self, decoder, memory, memory_key_padding_mask, max_length):
+        self.layers=decoder.layers
+        self.norm=decoder.norm
+        self.max_length=max_length
+        self.length=0
+        self.memory_mask=memory_key_padding_mask[:,None,None,:] # N * 1 * 1 * S
+        self.memory_kv=[]
+        self.self_kv=[]
+        for layer in self.layers:
+            attn=layer.multihead_attn
+            self.memory_kv.append((self._heads(self._project(attn,memory,1),attn.num_heads),
+                                   self._heads(self._project(attn,memory,2),attn.num_heads)))
+            self.self_kv.append(None)
+
+    @staticmethod
+    def _project(attn, x, index):
+        dim=attn.embed_dim
+        bias=None if attn.in_proj_bias is None else attn.in_proj_bias[index*dim:(index+1)*dim]
+        return F.linear(x,attn.in_proj_weight[index*dim:(index+1)*dim],bias)
+
+    @staticmethod
+    def _heads(x, num_heads):
+        # N * S * D -> N * H * S * D/H
+        return x.view(x.shape[0],-1,num_heads,x.shape[-1]//num_heads).transpose(1,2)
+
+    @staticmethod
+    def _attend(attn, q, k, v, mask=None):
+        n=q.shape[0]
+        q=q.view(n,attn.num_heads,1,-1)
+        weights=torch.matmul(q,k.transpose(-1,-2))/math.sqrt(q.shape[-1]) # N * H * 1 * S
+        if mask is not None:
+            weights=weights.masked_fill(mask,float('-inf'))
+        weights=F.dropout(torch.softmax(weights,-1),p=attn.dropout,training=attn.training)
+        return attn.out_proj(torch.matmul(weights,v).view(n,-1))
+
+    def _self_attn(self, i, layer, x):
+        attn=layer.self_attn
+        n,num_heads=x.shape[0],attn.num_heads
+        k,v=self._project(attn,x,1),self._project(attn,x,2)
+        if self.self_kv[i] is None:
+            self.self_kv[i]=x.new_zeros(2,n,num_heads,self.max_length,x.shape[-1]//num_heads)
+        cache=self.self_kv[i]
+        cache[0,:,:,self.length]=k.view(n,num_heads,-1)
+        cache[1,:,:,self.length]=v.view(n,num_heads,-1)
+        t=self.length+1
+        return self._attend(attn,self._project(attn,x,0),cache[0,:,:,:t],cache[1,:,:,:t])
+
+    def _cross_attn(self, i, layer, x):
+        attn=layer.multihead_attn
+        k,v=self.memory_kv[i]
+        return self._attend(attn,self._project(attn,x,0),k,v,self.memory_mask)
+
+    def _ff(self, layer, x):
+        return layer.linear2(layer.dropout(layer.activation(layer.linear1(x))))
+
+    def step(self, x):
+        """Decode the next position of every row; x is N * D, returns N * D."""
+        for i,layer in enumerate(self.layers):
+            if getattr(layer,'norm_first',False):
+                x=x+layer.dropout1(self._self_attn(i,layer,layer.norm1(x)))
+                x=x+layer.dropout2(self._cross_attn(i,layer,layer.norm2(x)))
+                x=x+layer.dropout3(self._ff(layer,layer.norm3(x)))
+            else:
+                x=layer.norm1(x+layer.dropout1(self._self_attn(i,layer,x)))
+                x=layer.norm2(x+layer.dropout2(self._cross_attn(i,layer,x)))
+                x=layer.norm3(x+layer.dropout3(self._ff(layer,x)))
+        self.length+=1
+        if self.norm is not None:
+            x=self.norm(x)
+        return x
+
+    def select(self, index, memory=False):
+        """Reorder/shrink the rows of the caches (and of the encoder memory if `memory`)."""
+        t=self.length
+        for i,cache in enumerate(self.self_kv):
+            if cache is None:
+                continue
+            if len(index)==cache.shape[1]:
+                cache[:,:,:,:t]=cache[:,:,:,:t].index_select(1,index)
+            else:
+                new_cache=cache.new_zeros(2,len(index),*cache.shape[2:])
+                new_cache[:,:,:,:t]=cache[:,:,:,:t].index_select(1,index)
+                self.self_kv[i]=new_cache
+        if memory:
+            self.memory_kv=[(k.index_select(0,index),v.index_select(0,index)) for k,v in self.memory_kv]
+            self.memory_mask=self.memory_mask.index_select(0,index)
         
         
 
 class Beam(object):
-    def __init__(self, size,sos,eos):
+    def __init__(self, size,sos,eos,device=None):
         self.size = size
-        self.tt = torch.cuda
+        self.device = device
         # The score for each translation on the beam.
-        self.scores = self.tt.FloatTensor(size).zero_()
+        self.scores = torch.zeros(size,device=device)
         # The backpointers at each time-step.
         self.prevKs = []
         # The outputs at each time-step.
-        self.nextYs = [self.tt.LongTensor(size)
-                       .fill_(0)]
+        self.nextYs = [torch.zeros(size,dtype=torch.long,device=device)]
         self.nextYs[0][0] = sos
         # Has EOS topped the beam yet.
         self._eos = eos
@@ -133,7 +308,7 @@ class Beam(object):
 
     def getCurrentState(self):
         "Get the outputs for the current timestep."
-        batch = self.tt.LongTensor(self.nextYs[-1]).view(-1, 1)
+        batch = self.nextYs[-1].clone().view(-1, 1)
         return batch
 
     def getCurrentOrigin(self):
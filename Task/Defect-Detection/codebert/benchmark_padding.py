@@ -0,0 +1,110 @@
+"""Benchmark of fixed padding, per-batch padding and length-bucketed batches on Devign.
+
+For every batching mode, the script reports the fraction of pad tokens the encoder sees
+and the training throughput (forward + backward) in real (non-pad) tokens per second.
+
+    python benchmark_padding.py --data_file ../dataset/train.jsonl --model_name_or_path microsoft/codebert-base
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, RandomSampler
+from transformers import RobertaForSequenceClassification, RobertaTokenizer
+
+from dynamic_padding import LengthBucketSampler, PadCollate
+
+
+class _IdsDataset(torch.utils.data.Dataset):
+    def __init__(self, ids, pad_to=None, pad_id=1):
+        self.ids = ids
+        self.pad_to = pad_to
+        self.pad_id = pad_id
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        ids = self.ids[i]
+        if self.pad_to is not None:
+            ids = ids + [self.pad_id] * (self.pad_to - len(ids))
+        return torch.tensor(ids), torch.tensor(0)
+
+
+def read_ids(data_file, tokenizer, block_size, limit):
+    ids = []
+    with open(data_file) as f:
+        for line in f:
+            code = ' '.join(json.loads(line)['func'].split())
+            tokens = [tokenizer.cls_token] + tokenizer.tokenize(code)[:block_size - 2] + [tokenizer.sep_token]
+            ids.append(tokenizer.convert_tokens_to_ids(tokens))
+            if len(ids) == limit:
+                break
+    return ids
+
+
+def dataloaders(ids, block_size, batch_size, pad_id):
+    lengths = [len(x) for x in ids]
+    collate_fn = PadCollate([pad_id, None])
+    fixed = _IdsDataset(ids, pad_to=block_size, pad_id=pad_id)
+    dynamic = _IdsDataset(ids, pad_id=pad_id)
+    return [
+        ('fixed', DataLoader(fixed, sampler=RandomSampler(fixed), batch_size=batch_size)),
+        ('dynamic', DataLoader(dynamic, sampler=RandomSampler(dynamic), batch_size=batch_size, collate_fn=collate_fn)),
+        ('bucketed', DataLoader(dynamic, batch_sampler=LengthBucketSampler(lengths, batch_size), collate_fn=collate_fn)),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_file', required=True)
+    parser.add_argument('--model_name_or_path', default='microsoft/codebert-base')
+    parser.add_argument('--block_size', type=int, default=400)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--limit', type=int, default=4096, help="Number of examples to read.")
+    parser.add_argument('--steps', type=int, default=50, help="Training steps timed per mode, 0 to only count padding.")
+    parser.add_argument('--seed', type=int, default=123456)
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    tokenizer = RobertaTokenizer.from_pretrained(args.model_name_or_path)
+    ids = read_ids(args.data_file, tokenizer, args.block_size, args.limit)
+    model = None
+    if args.steps > 0:
+        model = RobertaForSequenceClassification.from_pretrained(args.model_name_or_path, num_labels=1).to(device)
+        model.train()
+
+    for mode, dataloader in dataloaders(ids, args.block_size, args.batch_size, tokenizer.pad_token_id):
+        np.random.seed(args.seed)
+        torch.manual_seed(args.seed)
+        total = real = 0
+        for input_ids, _ in dataloader:
+            total += input_ids.numel()
+            real += int(input_ids.ne(tokenizer.pad_token_id).sum())
+        line = '%-8s pad fraction %5.1f%%' % (mode, 100 * (1 - real / total))
+        if model is not None:
+            timed_real, steps = 0, 0
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            while steps < args.steps:
+                for input_ids, _ in dataloader:
+                    input_ids = input_ids.to(device)
+                    logits = model(input_ids, attention_mask=input_ids.ne(tokenizer.pad_token_id))[0]
+                    logits.sum().backward()
+                    model.zero_grad()
+                    timed_real += int(input_ids.ne(tokenizer.pad_token_id).sum())
+                    steps += 1
+                    if steps == args.steps:
+                        break
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            elapsed = time.perf_counter() - start
+            line += '  %8.1f ms/step  %9.0f real tokens/s' % (1000 * elapsed / steps, timed_real / elapsed)
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
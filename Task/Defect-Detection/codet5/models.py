@@ -163,7 +163,7 @@ class DefectModel(nn.Module):
         return vec
 
     def forward(self, source_ids=None, labels=None):
-        source_ids = source_ids.view(-1, self.args.max_source_length)
+        source_ids = source_ids.view(-1, source_ids.size(-1))
 
         if self.args.model_type == 'codet5':
             vec = self.get_t5_vec(source_ids)
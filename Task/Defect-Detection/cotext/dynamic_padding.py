@@ -0,0 +1,132 @@
+"""
+Length-bucketed batching with per-batch padding.
+
+Padding every example to block_size / max_source_length spends most of the
+attention FLOPs on pad tokens, since most functions are far shorter than the
+cap. Examples are instead stored unpadded (or trimmed when they come from a
+fixed-width cache), `LengthBucketSampler` groups examples of similar length into
+the same batch, and `PadCollate` pads each batch to its own longest sequence.
+
+For evaluation the sampler visits the examples sorted by length, and
+`restore_order` puts the per-example outputs back in dataset order.
+"""
+
+import numpy as np
+import torch
+from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data import DataLoader, RandomSampler, Sampler, SequentialSampler
+from torch.utils.data.dataloader import default_collate
+
+
+def sequence_lengths(ids, pad_id, chunk_size=65536):
+    """Length (last non-pad position + 1) of every row of a (N, L) array of right-padded ids."""
+    lengths = np.zeros(len(ids), dtype=np.int64)
+    for start in range(0, len(ids), chunk_size):
+        used = np.asarray(ids[start:start + chunk_size]) != pad_id
+        # index of the last non-pad id, counted from the right end
+        last = np.argmax(used[:, ::-1], axis=1)
+        lengths[start:start + chunk_size] = np.where(used.any(1), used.shape[1] - last, 0)
+    return lengths
+
+
+class LengthBucketSampler(Sampler):
+    """Batch sampler whose batches hold examples of similar length.
+
+    With shuffle, the examples are shuffled, cut into pools of `pool_size` batches,
+    each pool is sorted by length and cut into batches, and the batches are
+    shuffled: batches stay random but their lengths are homogeneous. Without
+    shuffle, the examples are visited longest first (so an out-of-memory error
+    shows up on the first batch) in a fixed order.
+    """
+
+    def __init__(self, lengths, batch_size, shuffle=True, pool_size=100, drop_last=False):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pool_size = pool_size
+        self.drop_last = drop_last
+        self.order = np.argsort(-self.lengths, kind='stable')
+
+    def __iter__(self):
+        if self.shuffle:
+            order = np.random.permutation(len(self.lengths))
+            pool = self.batch_size * self.pool_size
+            batches = []
+            for start in range(0, len(order), pool):
+                chunk = order[start:start + pool]
+                chunk = chunk[np.argsort(self.lengths[chunk], kind='stable')]
+                batches.extend(chunk[i:i + self.batch_size] for i in range(0, len(chunk), self.batch_size))
+            np.random.shuffle(batches)
+        else:
+            batches = [self.order[i:i + self.batch_size] for i in range(0, len(self.order), self.batch_size)]
+        for batch in batches:
+            if self.drop_last and len(batch) < self.batch_size:
+                continue
+            yield batch.tolist()
+
+    def _num_batches(self, n):
+        return n // self.batch_size if self.drop_last else -(-n // self.batch_size)
+
+    def __len__(self):
+        if not self.shuffle:
+            return self._num_batches(len(self.lengths))
+        # only the last batch of every pool can be partial
+        full_pools, rest = divmod(len(self.lengths), self.batch_size * self.pool_size)
+        return full_pools * self.pool_size + self._num_batches(rest)
+
+
+class PadCollate(object):
+    """Collate function padding the sequence fields of a batch to its longest sequence.
+
+    `pad_ids` gives, for every field of the examples, the padding id of a sequence
+    field, or None for a field collated as is (labels, ...). All the sequence
+    fields are padded or cut to the same width, and columns that are padding in
+    every sequence (from fixed-width storage) are dropped. With `width`, every
+    batch is padded or cut to that fixed width instead.
+    """
+
+    def __init__(self, pad_ids, width=None):
+        self.pad_ids = pad_ids
+        self.width = width
+
+    def __call__(self, batch):
+        fields = []
+        for values, pad_id in zip(zip(*batch), self.pad_ids):
+            if pad_id is None:
+                fields.append(default_collate(values))
+            else:
+                fields.append(pad_sequence([torch.as_tensor(v) for v in values], batch_first=True,
+                                           padding_value=pad_id))
+        width = self.width
+        if width is None:
+            width = 1
+            for field, pad_id in zip(fields, self.pad_ids):
+                if pad_id is not None:
+                    used = field.ne(pad_id).any(0).nonzero()
+                    if len(used) > 0:
+                        width = max(width, int(used[-1]) + 1)
+        batch = []
+        for field, pad_id in zip(fields, self.pad_ids):
+            if pad_id is not None:
+                if field.size(1) < width:
+                    field = torch.cat([field, field.new_full((field.size(0), width - field.size(1)), pad_id)], 1)
+                field = field[:, :width].contiguous()
+            batch.append(field)
+        return batch
+
+
+def bucketed_dataloader(dataset, lengths, batch_size, shuffle, bucketing=True, **kwargs):
+    """DataLoader over length buckets, or in random/sequential order if not `bucketing`."""
+    if bucketing:
+        return DataLoader(dataset, batch_sampler=LengthBucketSampler(lengths, batch_size, shuffle=shuffle), **kwargs)
+    sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    return DataLoader(dataset, sampler=sampler, batch_size=batch_size, **kwargs)
+
+
+def restore_order(dataloader, outputs):
+    """Per-example `outputs` of a non-shuffling DataLoader, back in dataset order."""
+    if not isinstance(dataloader.batch_sampler, LengthBucketSampler):
+        return outputs
+    restored = np.empty_like(outputs)
+    restored[dataloader.batch_sampler.order] = outputs
+    return restored
@@ -29,7 +29,7 @@ from io import open
 from tqdm import tqdm
 import torch
 from torch.utils.tensorboard import SummaryWriter
-from torch.utils.data import DataLoader, Dataset, SequentialSampler, RandomSampler, TensorDataset
+from torch.utils.data import DataLoader, Dataset, TensorDataset
 from torch.utils.data.distributed import DistributedSampler
 from transformers import (WEIGHTS_NAME, AdamW, get_linear_schedule_with_warmup,
                           RobertaConfig, RobertaModel, RobertaTokenizer,
@@ -41,6 +41,7 @@ import tokenizers
 import sentencepiece as spm
 
 from models import DefectModel
+from dynamic_padding import PadCollate, bucketed_dataloader, restore_order, sequence_lengths
 from configs import add_args, set_seed
 from utils import get_filenames, get_elapse_time, load_and_cache_defect_data
 from models import get_model_size
@@ -58,9 +59,11 @@ logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message
 logger = logging.getLogger(__name__)
 
 
-def evaluate(args, model, eval_examples, eval_data, write_to_pred=False):
-    eval_sampler = SequentialSampler(eval_data)
-    eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.eval_batch_size)
+def evaluate(args, model, eval_examples, eval_data, pad_id, write_to_pred=False):
+    # the cached source ids are padded to max_source_length; batches are cut to their longest example
+    eval_dataloader = bucketed_dataloader(eval_data, sequence_lengths(eval_data.columns[0], pad_id),
+                                          args.eval_batch_size, shuffle=False,
+                                          bucketing=not args.no_length_bucketing, collate_fn=PadCollate([pad_id, None]))
 
     # Eval!
     logger.info("***** Running evaluation *****")
@@ -81,8 +84,9 @@ def evaluate(args, model, eval_examples, eval_data, write_to_pred=False):
             logits.append(logit.cpu().numpy())
             labels.append(label.cpu().numpy())
         nb_eval_steps += 1
-    logits = np.concatenate(logits, 0)
-    labels = np.concatenate(labels, 0)
+    # batches come sorted by length, back to the order of the examples
+    logits = restore_order(eval_dataloader, np.concatenate(logits, 0))
+    labels = restore_order(eval_dataloader, np.concatenate(labels, 0))
     preds = logits[:, 1] > 0.5
     eval_acc = np.mean(labels == preds)
     eval_loss = eval_loss / nb_eval_steps
@@ -137,6 +141,8 @@ def main():
     tokenizer = tokenizers.SentencePieceUnigramTokenizer.from_spm(args.tokenizer_path)
     # tokenizer = spm.SentencePieceProcessor(model_file=args.tokenizer_path)
     model = DefectModel(model, config, tokenizer, args)
+    pad_id = tokenizer.token_to_id("<pad>")
+    collate_fn = PadCollate([pad_id, None])
     logger.info("Finish loading model [%s] from %s", get_model_size(model), args.model_name_or_path)
 
     if args.load_model_path is not None:
@@ -161,10 +167,12 @@ def main():
         train_examples, train_data = load_and_cache_defect_data(args, args.train_filename, pool, tokenizer, 'train',
                                                                 is_sample=False)
         if args.local_rank == -1:
-            train_sampler = RandomSampler(train_data)
+            train_dataloader = bucketed_dataloader(train_data, sequence_lengths(train_data.columns[0], pad_id),
+                                                   args.train_batch_size, shuffle=True,
+                                                   bucketing=not args.no_length_bucketing, collate_fn=collate_fn)
         else:
-            train_sampler = DistributedSampler(train_data)
-        train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=args.train_batch_size)
+            train_dataloader = DataLoader(train_data, sampler=DistributedSampler(train_data),
+                                          batch_size=args.train_batch_size, collate_fn=collate_fn)
 
         num_train_optimization_steps = args.num_train_epochs * len(train_dataloader)
         save_steps = max(len(train_dataloader), 1)
@@ -233,7 +241,7 @@ def main():
                     eval_examples, eval_data = load_and_cache_defect_data(args, args.dev_filename, pool, tokenizer,
                                                                           'valid', is_sample=False)
 
-                    result = evaluate(args, model, eval_examples, eval_data)
+                    result = evaluate(args, model, eval_examples, eval_data, pad_id)
                     eval_acc = result['eval_acc']
 
                     if args.data_num == -1:
@@ -300,7 +308,7 @@ def main():
             eval_examples, eval_data = load_and_cache_defect_data(args, args.test_filename, pool, tokenizer, 'test',
                                                                   False)
 
-            result = evaluate(args, model, eval_examples, eval_data, write_to_pred=True)
+            result = evaluate(args, model, eval_examples, eval_data, pad_id, write_to_pred=True)
             logger.info("  test_acc=%.4f", result['eval_acc'])
             logger.info("  " + "*" * 20)
 
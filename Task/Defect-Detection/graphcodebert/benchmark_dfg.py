@@ -0,0 +1,131 @@
+"""
+Per-function timing of the data-flow extraction on a dataset file.
+
+Every function of `--data_file` is parsed once and its DFG extracted with the
+`parser` package next to this script. With `--baseline_dir` pointing at another
+copy of the package (e.g. an older checkout of `parser/`) the same trees are also
+run through it, the edges are compared and both timings are reported side by side.
+
+    python benchmark_dfg.py --data_file ../dataset/test.jsonl --lang c \
+        --baseline_dir /tmp/old_parser
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import time
+
+import numpy as np
+from tree_sitter import Language, Parser
+
+import parser as dfg_parser
+
+dfg_names = {
+    'python': 'DFG_python',
+    'java': 'DFG_java',
+    'ruby': 'DFG_ruby',
+    'go': 'DFG_go',
+    'php': 'DFG_php',
+    'javascript': 'DFG_javascript',
+    'c_sharp': 'DFG_csharp',
+    'c': 'DFG_c',
+}
+
+
+def load_package(path, name):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(path, '__init__.py'),
+                                                  submodule_search_locations=[path])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def prepare(code, tree_parser, lang):
+    """(root node, index_to_code) of one function, built as run.py builds them."""
+    try:
+        code = dfg_parser.remove_comments_and_docstrings(code, lang)
+    except:
+        pass
+    if lang == "php":
+        code = "<?php" + code + "?>"
+    root_node = tree_parser.parse(bytes(code, 'utf8')).root_node
+    tokens_index = dfg_parser.tree_to_token_index(root_node)
+    code = code.split('\n')
+    index_to_code = {}
+    for idx, index in enumerate(tokens_index):
+        index_to_code[index] = (idx, dfg_parser.index_to_code_token(index, code))
+    return root_node, index_to_code
+
+
+def time_dfg(dfg_fn, root_node, index_to_code):
+    """(seconds, edges or None if the extraction raised) of one call."""
+    start = time.perf_counter()
+    try:
+        dfg, _ = dfg_fn(root_node, index_to_code, {})
+    except Exception:
+        dfg = None
+    return time.perf_counter() - start, dfg
+
+
+def summary(name, times, failed):
+    times = np.asarray(times) * 1000
+    print("{:<10} total {:9.1f}ms  mean {:7.3f}ms  p50 {:7.3f}ms  p99 {:8.3f}ms  max {:9.3f}ms  failed {}".format(
+        name, times.sum(), times.mean(), np.percentile(times, 50), np.percentile(times, 99), times.max(), failed))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_file", default=None, type=str, required=True,
+                        help="jsonl file with one function per line.")
+    parser.add_argument("--lang", default="c", type=str, choices=sorted(dfg_names))
+    parser.add_argument("--code_key", default="func", type=str,
+                        help="Field of each json line holding the source code.")
+    parser.add_argument("--language_file", default="parser/my-languages.so", type=str)
+    parser.add_argument("--baseline_dir", default=None, type=str,
+                        help="Another copy of the parser package to compare against.")
+    parser.add_argument("--max_functions", default=None, type=int)
+    parser.add_argument("--repeat", default=3, type=int,
+                        help="Time each function this many times and keep the best.")
+    args = parser.parse_args()
+
+    tree_parser = Parser()
+    tree_parser.set_language(Language(args.language_file, args.lang))
+    dfg_fns = [('current', getattr(dfg_parser, dfg_names[args.lang]))]
+    if args.baseline_dir is not None:
+        baseline = load_package(os.path.abspath(args.baseline_dir), 'baseline_parser')
+        dfg_fns.append(('baseline', getattr(baseline, dfg_names[args.lang])))
+
+    times = {name: [] for name, _ in dfg_fns}
+    failed = {name: 0 for name, _ in dfg_fns}
+    sizes, mismatches = [], 0
+    with open(args.data_file) as f:
+        for i, line in enumerate(f):
+            if args.max_functions is not None and i >= args.max_functions:
+                break
+            root_node, index_to_code = prepare(json.loads(line)[args.code_key], tree_parser, args.lang)
+            sizes.append(len(index_to_code))
+            results = []
+            for name, dfg_fn in dfg_fns:
+                best, dfg = min((time_dfg(dfg_fn, root_node, index_to_code) for _ in range(args.repeat)),
+                                key=lambda x: x[0])
+                times[name].append(best)
+                failed[name] += dfg is None
+                results.append(dfg)
+            mismatches += any(dfg != results[0] for dfg in results[1:])
+
+    print("{} functions, {:.0f} tokens on average, {} max".format(len(sizes), np.mean(sizes), max(sizes)))
+    for name, _ in dfg_fns:
+        summary(name, times[name], failed[name])
+    if len(dfg_fns) > 1:
+        print("functions with different edges: {}".format(mismatches))
+        #speedup on the largest functions, where the extraction cost matters
+        largest = np.argsort(sizes)[-max(1, len(sizes) // 100):]
+        ratio = np.sum(np.asarray(times['baseline'])[largest]) / np.sum(np.asarray(times['current'])[largest])
+        print("speedup on the largest 1% of functions: {:.2f}x".format(ratio))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 import torch
 import torch.nn.functional as F
+from graph_mask import GraphAttnMask
 
         
 class Model(nn.Module):   
@@ -13,6 +14,8 @@ class Model(nn.Module):
         self.args=args
         
     def forward(self, inputs_ids,position_idx,attn_mask,labels=None): 
+        if isinstance(attn_mask,GraphAttnMask):
+            attn_mask=attn_mask.dense()
         nodes_mask=position_idx.eq(0)
         token_mask=position_idx.ge(2)        
         inputs_embeddings=self.encoder.roberta.embeddings.word_embeddings(inputs_ids)
@@ -32,13 +32,16 @@ import shutil
 import json
 import numpy as np
 import torch
-from torch.utils.data import DataLoader, Dataset, SequentialSampler, RandomSampler,TensorDataset
+from torch.utils.data import Dataset,TensorDataset
 from torch.utils.data.distributed import DistributedSampler
 from transformers import (WEIGHTS_NAME, AdamW, get_linear_schedule_with_warmup,
                           RobertaConfig, RobertaForSequenceClassification, RobertaTokenizer)
 from tqdm import tqdm, trange
 import multiprocessing
 from model import Model
+from graph_mask import DFGGraph, collate_graph_batch
+from dynamic_padding import bucketed_dataloader, restore_order
+from functools import partial
 
 cpu_cont = 16
 logger = logging.getLogger(__name__)
@@ -195,37 +198,18 @@ class TextDataset(Dataset):
                 logger.info("position_idx: {}".format(example.position_idx))
                 logger.info("dfg_to_code: {}".format(' '.join(map(str, example.dfg_to_code))))
                 logger.info("dfg_to_dfg: {}".format(' '.join(map(str, example.dfg_to_dfg))))
+        #compact graph-guided attention masks, expanded per batch by collate_graph_batch
+        self.graphs=[DFGGraph.from_features(example.input_ids,example.position_idx,
+                                            example.dfg_to_code,example.dfg_to_dfg) for example in self.examples]
+        self.lengths=[graph.max_length for graph in self.graphs]
 
     def __len__(self):
         return len(self.examples)
     
     def __getitem__(self, item):
-        #calculate graph-guided masked function
-        attn_mask= np.zeros((self.args.code_length+self.args.data_flow_length,
-                        self.args.code_length+self.args.data_flow_length),dtype=np.bool)
-        #calculate begin index of node and max length of input
-        node_index=sum([i>1 for i in self.examples[item].position_idx])
-        max_length=sum([i!=1 for i in self.examples[item].position_idx])
-        #sequence can attend to sequence
-        attn_mask[:node_index,:node_index]=True
-        #special tokens attend to all tokens
-        for idx,i in enumerate(self.examples[item].input_ids):
-            if i in [0,2]:
-                attn_mask[idx,:max_length]=True
-        #nodes attend to code tokens that are identified from
-        for idx,(a,b) in enumerate(self.examples[item].dfg_to_code):
-            if a<node_index and b<node_index:
-                attn_mask[idx+node_index,a:b]=True
-                attn_mask[a:b,idx+node_index]=True
-        #nodes attend to adjacent nodes 
-        for idx,nodes in enumerate(self.examples[item].dfg_to_dfg):
-            for a in nodes:
-                if a+node_index<len(self.examples[item].position_idx):
-                    attn_mask[idx+node_index,a+node_index]=True  
-                    
         return (torch.tensor(self.examples[item].input_ids),
                 torch.tensor(self.examples[item].position_idx),
-                torch.tensor(attn_mask),                 
+                self.graphs[item],
                 torch.tensor(self.examples[item].label))
 
 
@@ -241,8 +225,9 @@ def train(args, train_dataset, model, tokenizer):
     """ Train the model """
     
     #build dataloader
-    train_sampler = RandomSampler(train_dataset)
-    train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.train_batch_size,num_workers=4)
+    train_dataloader = bucketed_dataloader(train_dataset, train_dataset.lengths, args.train_batch_size, shuffle=True,
+                                           bucketing=not args.no_length_bucketing, num_workers=4,
+                                           collate_fn=partial(collate_graph_batch,packed=args.packed_graph_mask,trim=True))
     
     args.max_steps=args.epochs*len( train_dataloader)
     args.save_steps=len( train_dataloader)//10
@@ -356,8 +341,9 @@ def evaluate(args, model, tokenizer,eval_when_training=False, eval_data_file="")
     # Loop to handle MNLI double evaluation (matched, mis-matched)
     eval_data_file = eval_data_file if eval_data_file else args.eval_data_file
     eval_dataset = TextDataset(tokenizer, args, eval_data_file)
-    eval_sampler = SequentialSampler(eval_dataset)
-    eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler,batch_size=args.eval_batch_size,num_workers=4)
+    eval_dataloader = bucketed_dataloader(eval_dataset, eval_dataset.lengths, args.eval_batch_size, shuffle=False,
+                                          bucketing=not args.no_length_bucketing, num_workers=4,
+                                          collate_fn=partial(collate_graph_batch,packed=args.packed_graph_mask,trim=True))
 
     # multi-gpu evaluate
     if args.n_gpu > 1 and eval_when_training is False:
@@ -384,8 +370,9 @@ def evaluate(args, model, tokenizer,eval_when_training=False, eval_data_file="")
         nb_eval_steps += 1
     
     #calculate scores
-    logits=np.concatenate(logits,0)
-    labels=np.concatenate(labels,0)
+    #batches come sorted by length, back to the order of the examples
+    logits=restore_order(eval_dataloader,np.concatenate(logits,0))
+    labels=restore_order(eval_dataloader,np.concatenate(labels,0))
     best_threshold=0.5
     preds=logits[:,0]>best_threshold
     eval_acc=np.mean(labels==preds)
@@ -402,8 +389,9 @@ def evaluate(args, model, tokenizer,eval_when_training=False, eval_data_file="")
 def test(args, model, tokenizer, best_threshold=0):
     #build dataloader
     eval_dataset = TextDataset(tokenizer, args, file_path=args.test_data_file)
-    eval_sampler = SequentialSampler(eval_dataset)
-    eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size,num_workers=4)
+    eval_dataloader = bucketed_dataloader(eval_dataset, eval_dataset.lengths, args.eval_batch_size, shuffle=False,
+                                          bucketing=not args.no_length_bucketing, num_workers=4,
+                                          collate_fn=partial(collate_graph_batch,packed=args.packed_graph_mask,trim=True))
 
     # multi-gpu evaluate
     if args.n_gpu > 1:
@@ -429,8 +417,9 @@ def test(args, model, tokenizer, best_threshold=0):
         nb_eval_steps += 1
     
     #output result
-    logits=np.concatenate(logits,0)
-    labels=np.concatenate(labels,0)
+    #batches come sorted by length, back to the order of the examples
+    logits=restore_order(eval_dataloader,np.concatenate(logits,0))
+    labels=restore_order(eval_dataloader,np.concatenate(labels,0))
     preds=logits[:,0]>best_threshold
     with open(os.path.join(args.output_dir,"predictions.txt"),'w') as f:
         for example,pred in zip(eval_dataset.examples,preds):
@@ -507,6 +496,10 @@ def main():
                         help="random seed for initialization")
     parser.add_argument('--epochs', type=int, default=1,
                         help="training epochs")
+    parser.add_argument('--packed_graph_mask', action='store_true',
+                        help="Send packed DFG graphs to the model and expand the graph-guided attention mask on device.")
+    parser.add_argument('--no_length_bucketing', action='store_true',
+                        help="Batch examples in random/sequential order instead of by length (still trimmed per batch).")
 
     args = parser.parse_args()
 
@@ -515,6 +508,9 @@ def main():
     args.n_gpu = torch.cuda.device_count()
 
     args.device = device
+    if args.packed_graph_mask and args.n_gpu > 1:
+        # DataParallel cannot scatter a packed mask across replicas
+        args.packed_graph_mask = False
 
     # Setup logging
     logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',datefmt='%m/%d/%Y %H:%M:%S',level=logging.INFO)
@@ -32,7 +32,7 @@ import shutil
 
 import numpy as np
 import torch
-from torch.utils.data import DataLoader, Dataset, SequentialSampler, RandomSampler,TensorDataset
+from torch.utils.data import DataLoader, Dataset,TensorDataset
 from torch.utils.data.distributed import DistributedSampler
 import json
 from tqdm import tqdm, trange
@@ -40,6 +40,7 @@ import multiprocessing
 import sentencepiece as spm
 
 from model import Model
+from dynamic_padding import PadCollate, bucketed_dataloader, restore_order
 cpu_cont = multiprocessing.cpu_count()
 from transformers import (WEIGHTS_NAME, AdamW, get_linear_schedule_with_warmup,
                           BartConfig, BartForSequenceClassification, BartTokenizer)
@@ -98,12 +99,10 @@ def convert_examples_to_features(js,sp,args):
     source_ids = sp.encode(code, out_type=int)
     source_ids = [0] + source_ids[: (args.block_size - 2)] + [2]
     src_lengths = len(source_ids)
-    padding_length = args.block_size - src_lengths
-    source_ids+=[1]*padding_length
-    prev_output_tokens = np.roll(source_ids, 1)
+    # padded per batch by PadCollate; same as rolling the ids padded to block_size, cut after the eos
+    prev_output_tokens = np.array(([0] + source_ids)[:args.block_size])
     # TODO fix decoder attention mask 
     # Cancel
-    prev_output_tokens[0] = 0
     return InputFeatures(source_tokens,source_ids,src_lengths,prev_output_tokens,js['idx'],js['target'])
 
 class TextDataset(Dataset):
@@ -113,6 +112,8 @@ class TextDataset(Dataset):
             for line in f:
                 js=json.loads(line.strip())
                 self.examples.append(convert_examples_to_features(js,sp,args))
+        self.lengths=[len(example.prev_output_tokens) for example in self.examples]
+        self.collate_fn=PadCollate([1,None,None,1])
         if 'train' in file_path:
             for idx, example in enumerate(self.examples[:3]):
                     logger.info("*** Example ***")
@@ -143,10 +144,13 @@ def set_seed(seed=42):
 def train(args, train_dataset, model, sp):
     """ Train the model """ 
     args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
-    train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
-    
-    train_dataloader = DataLoader(train_dataset, sampler=train_sampler, 
-                                  batch_size=args.train_batch_size,num_workers=4,pin_memory=True)
+    if args.local_rank == -1:
+        train_dataloader = bucketed_dataloader(train_dataset, train_dataset.lengths, args.train_batch_size, shuffle=True,
+                                               bucketing=not args.no_length_bucketing, collate_fn=train_dataset.collate_fn,
+                                               num_workers=4,pin_memory=True)
+    else:
+        train_dataloader = DataLoader(train_dataset, sampler=DistributedSampler(train_dataset), collate_fn=train_dataset.collate_fn,
+                                      batch_size=args.train_batch_size,num_workers=4,pin_memory=True)
     args.max_steps=args.epoch*len( train_dataloader)
     args.save_steps=len( train_dataloader)
     args.warmup_steps=len( train_dataloader)
@@ -306,8 +310,13 @@ def evaluate(args, model, sp,eval_when_training=False, eval_data_file=""):
 
     args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
     # Note that DistributedSampler samples randomly
-    eval_sampler = SequentialSampler(eval_dataset) if args.local_rank == -1 else DistributedSampler(eval_dataset)
-    eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size,num_workers=4,pin_memory=True)
+    if args.local_rank == -1:
+        eval_dataloader = bucketed_dataloader(eval_dataset, eval_dataset.lengths, args.eval_batch_size, shuffle=False,
+                                              bucketing=not args.no_length_bucketing, collate_fn=eval_dataset.collate_fn,
+                                              num_workers=4,pin_memory=True)
+    else:
+        eval_dataloader = DataLoader(eval_dataset, sampler=DistributedSampler(eval_dataset), collate_fn=eval_dataset.collate_fn,
+                                     batch_size=args.eval_batch_size,num_workers=4,pin_memory=True)
 
     # multi-gpu evaluate
     if args.n_gpu > 1 and eval_when_training is False:
@@ -333,8 +342,9 @@ def evaluate(args, model, sp,eval_when_training=False, eval_data_file=""):
             logits.append(logit.cpu().numpy())
             labels.append(label.cpu().numpy())
         nb_eval_steps += 1
-    logits=np.concatenate(logits,0)
-    labels=np.concatenate(labels,0)
+    # batches come sorted by length, back to the order of the examples
+    logits=restore_order(eval_dataloader,np.concatenate(logits,0))
+    labels=restore_order(eval_dataloader,np.concatenate(labels,0))
     preds=logits[:,0]>0.5
     eval_acc=np.mean(labels==preds)
     eval_loss = eval_loss / nb_eval_steps
@@ -353,8 +363,12 @@ def test(args, model, sp):
 
     args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
     # Note that DistributedSampler samples randomly
-    eval_sampler = SequentialSampler(eval_dataset) if args.local_rank == -1 else DistributedSampler(eval_dataset)
-    eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size)
+    if args.local_rank == -1:
+        eval_dataloader = bucketed_dataloader(eval_dataset, eval_dataset.lengths, args.eval_batch_size, shuffle=False,
+                                              bucketing=not args.no_length_bucketing, collate_fn=eval_dataset.collate_fn)
+    else:
+        eval_dataloader = DataLoader(eval_dataset, sampler=DistributedSampler(eval_dataset), collate_fn=eval_dataset.collate_fn,
+                                     batch_size=args.eval_batch_size)
 
     # multi-gpu evaluate
     if args.n_gpu > 1:
@@ -377,8 +391,9 @@ def test(args, model, sp):
             logits.append(logit.cpu().numpy())
             labels.append(label.cpu().numpy())
 
-    logits=np.concatenate(logits,0)
-    labels=np.concatenate(labels,0)
+    # batches come sorted by length, back to the order of the examples
+    logits=restore_order(eval_dataloader,np.concatenate(logits,0))
+    labels=restore_order(eval_dataloader,np.concatenate(labels,0))
     preds=logits[:,0]>0.5
     with open(os.path.join(args.output_dir,"predictions.txt"),'w') as f:
         for example,pred in zip(eval_dataset.examples,preds):
@@ -487,6 +502,8 @@ def main():
     parser.add_argument('--fp16_opt_level', type=str, default='O1',
                         help="For fp16: Apex AMP optimization level selected in ['O0', 'O1', 'O2', and 'O3']."
                              "See details at https://nvidia.github.io/apex/amp.html")
+    parser.add_argument("--no_length_bucketing", action='store_true',
+                        help="Batch examples in random/sequential order instead of by length (still padded per batch).")
     parser.add_argument("--local_rank", type=int, default=-1,
                         help="For distributed training: local_rank")
     parser.add_argument('--server_ip', type=str, default='', help="For distant debugging.")
@@ -0,0 +1,35 @@
+// Long-lived augmentation worker driven by representjs/data/node_pool.py.
+// Reads one JSON request per line on stdin:
+//     {"id": 3, "payload": [{"src": "...", "augmentations": [...]}, ...]}
+// and writes one JSON response per line on stdout:
+//     {"id": 3, "result": ["transformed src" or null, ...]}
+// A null result means the transformation of that program failed.
+
+const readline = require('readline');
+
+// stdout carries the responses, keep the augmentations' logging off it
+console.log = console.error;
+var JavascriptAugmentations = require('./javascript_augmentations');
+const javascriptAugmenter = new JavascriptAugmentations();
+
+const rl = readline.createInterface({input: process.stdin, terminal: false});
+rl.on('line', (line) => {
+    let request;
+    try {
+        request = JSON.parse(line);
+    } catch (e) {
+        console.error(`Malformed request: ${e}`);
+        return;
+    }
+    const result = request['payload'].map(x => {
+        try {
+            const transformed = javascriptAugmenter.transform(x['src'], x['augmentations']);
+            return typeof transformed === 'string' ? transformed : null;
+        } catch (e) {
+            console.error(`Transformation failed: ${e}`);
+            return null;
+        }
+    });
+    process.stdout.write(JSON.stringify({'id': request['id'], 'result': result}) + '\n');
+});
+rl.on('close', () => process.exit(0));
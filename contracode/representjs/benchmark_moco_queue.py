@@ -0,0 +1,101 @@
+"""Micro-benchmark of the MoCo negative queue: in-place ring buffer vs. rebuilding it with torch.cat.
+
+Both variants run the same forward/backward steps of `MoCoTemplate` with a linear encoder, so the
+time is dominated by the logits against the queue and the queue update. On CUDA, the allocator
+statistics show how many bytes are allocated per step and how often the caching allocator had to
+free cached blocks and retry (a sign of fragmentation).
+
+    python representjs/benchmark_moco_queue.py --K 107520 --batch_size 96 --steps 200
+"""
+import time
+
+import fire
+import torch
+from torch import nn
+
+from models.code_moco import MoCoTemplate, concat_all_gather
+
+
+class _LinearEncoder(nn.Module):
+    def __init__(self, d_in, d_rep):
+        super().__init__()
+        self.proj = nn.Linear(d_in, d_rep)
+
+    def forward(self, x, lengths):
+        return self.proj(x)
+
+
+class _BenchMoCo(MoCoTemplate):
+    def make_encoder(self, d_in, d_rep):
+        return _LinearEncoder(d_in, d_rep)
+
+
+class _CatQueueMoCo(_BenchMoCo):
+    """The previous implementation: the queue is rebuilt with torch.cat and queue_ptr read back every step."""
+
+    @torch.no_grad()
+    def _dequeue_and_enqueue(self, keys):
+        keys = concat_all_gather(keys)
+        batch_size = keys.shape[0]
+        ptr = int(self.queue_ptr.item())
+        assert self.K % batch_size == 0  # for simplicity
+        self.queue = torch.cat([self.queue[:, :ptr], keys.T, self.queue[:, ptr + batch_size :]], dim=1).detach()
+        ptr = (ptr + batch_size) % self.K
+        self.queue_ptr[0] = ptr
+
+    def forward(self, im_q, im_k, lengths_k, lengths_q, q=None):
+        q = nn.functional.normalize(self.encoder_q(im_q, lengths_q), dim=1)
+        with torch.no_grad():
+            self._momentum_update_key_encoder()
+            k = nn.functional.normalize(self.encoder_k(im_k, lengths_k), dim=1)
+        l_pos = torch.einsum("nc,nc->n", *[q, k]).unsqueeze(-1)
+        l_neg = torch.einsum("nc,ck->nk", *[q, self.queue.detach()])
+        logits = torch.cat([l_pos, l_neg], dim=1)
+        logits /= self.T
+        labels = torch.zeros(logits.shape[0], dtype=torch.long, device=logits.device)
+        self._dequeue_and_enqueue(k)
+        return logits, labels
+
+
+def _run(model, steps, warmup, batch_size, d_in, device):
+    optimizer = torch.optim.SGD(model.encoder_q.parameters(), lr=0.01)
+    x_q = torch.randn(batch_size, d_in, device=device)
+    x_k = torch.randn(batch_size, d_in, device=device)
+    lengths = torch.full((batch_size,), d_in, dtype=torch.long, device=device)
+
+    def step():
+        logits, labels = model(x_q, x_k, lengths, lengths)
+        loss = nn.functional.cross_entropy(logits, labels)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    for _ in range(warmup):
+        step()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        before = torch.cuda.memory_stats(device)
+    start = time.perf_counter()
+    for _ in range(steps):
+        step()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    result = {"ms/step": 1000 * (time.perf_counter() - start) / steps}
+    if device.type == "cuda":
+        after = torch.cuda.memory_stats(device)
+        for key in ("allocated_bytes.all.allocated", "allocation.all.allocated", "num_alloc_retries", "segment.all.allocated"):
+            result[key + "/step"] = (after.get(key, 0) - before.get(key, 0)) / steps
+    return result
+
+
+def main(K=107520, d_rep=128, d_in=512, batch_size=96, steps=200, warmup=20, device=None, seed=0):
+    device = torch.device(device or ("cuda" if torch.cuda.is_available() else "cpu"))
+    for name, cls in (("cat", _CatQueueMoCo), ("ring", _BenchMoCo)):
+        torch.manual_seed(seed)
+        model = cls(d_rep=d_rep, K=K, encoder_params=dict(d_in=d_in, d_rep=d_rep)).to(device)
+        result = _run(model, steps, warmup, batch_size, d_in, device)
+        print(f"{name:>5}: " + "  ".join(f"{key} {value:,.3f}" for key, value in result.items()))
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
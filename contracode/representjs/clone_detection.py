@@ -23,7 +23,7 @@ import wandb
 from loguru import logger
 
 from data.util import Timer, normalize_program, EncodeAsIds
-from data.old_dataloader import _augment_server
+from data.old_dataloader import _augment
 from models.clone import CloneModel
 from representjs import RUN_DIR
 from utils import count_parameters, get_linear_schedule_with_warmup
@@ -60,7 +60,7 @@ class CloneProgramsDataset(torch.utils.data.Dataset):
         if self.augmentations and augment:
             # Set up transformation input
             transform_payload = [dict(src=program, augmentations=self.augmentations)]
-            program = _augment_server(transform_payload)
+            program = _augment(transform_payload)
             assert isinstance(program, list) and len(program) == 1
             program = program[0]
         return self.encode(program)
@@ -72,60 +72,96 @@ class CloneProgramsDataset(torch.utils.data.Dataset):
 
 
 class ClonePairDataset(torch.utils.data.Dataset):
+    """Pairs of programs, addressed by a flat pair index that is mapped to the two programs arithmetically.
+
+    Pairs are never materialized: subclasses define the number of pairs of every problem
+    (`problem_pair_counts`) and how to unrank a pair index within a problem (`unrank`).
+    With max_pairs > 0, max_pairs distinct pairs are sampled uniformly without replacement.
+    """
+
+    label = 0
+
     def __init__(self, dataset: CloneProgramsDataset, max_pairs=-1, seed=None):
         self.dataset = dataset
-        self.label = 0
-        self.indices = self.get_indices()
-        if max_pairs > 0:
-            if seed is not None:
-                np.random.seed(seed)
-            subsample_idx = np.random.choice(len(self.indices), size=max_pairs)
-            self.indices = self.indices[subsample_idx, :]
+        self.problem_ends = np.asarray(dataset.cumulative_sizes, dtype=np.int64)
+        self.problem_starts = np.concatenate([[0], self.problem_ends[:-1]])
+        counts = self.problem_pair_counts()
+        # pairs of problem p are [pair_offsets[p], pair_offsets[p + 1])
+        self.pair_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        self.num_pairs = int(self.pair_offsets[-1])
+        self.pair_ids = None
+        if 0 < max_pairs < self.num_pairs:
+            rng = random.Random(seed)
+            self.pair_ids = np.asarray(rng.sample(range(self.num_pairs), max_pairs), dtype=np.int64)
+
+    def problem_pair_counts(self):
+        raise NotImplementedError()
+
+    def unrank(self, problem, rank):
+        """Programs (idx1, idx2) of the rank-th pair of problem `problem`."""
+        raise NotImplementedError()
+
+    def get_pair(self, pair_id):
+        problem = int(np.searchsorted(self.pair_offsets, pair_id, side="right")) - 1
+        return self.unrank(problem, int(pair_id - self.pair_offsets[problem]))
 
     def __len__(self):
-        return len(self.indices)
+        return self.num_pairs if self.pair_ids is None else len(self.pair_ids)
 
     def __getitem__(self, idx):
-        idx1, idx2 = self.indices[idx]
+        pair_id = idx if self.pair_ids is None else self.pair_ids[idx]
+        idx1, idx2 = self.get_pair(pair_id)
         prog1_toks = self.dataset.__getitem__(idx1, augment=True)
         prog2_toks = self.dataset.__getitem__(idx2, augment=False)
         return prog1_toks, prog2_toks, self.label
 
 
 class ClonePositivesDataset(ClonePairDataset):
-    def get_indices(self):
-        self.label = 1
-
-        # Get all pairs of indices of programs solving the same problem
-        indices = []
-        for i in range(self.dataset.num_problems):
-            # set_size = self.dataset.set_sizes[i]
-            start_idx = self.dataset.cumulative_sizes[i - 1] if i > 0 else 0
-            end_idx = self.dataset.cumulative_sizes[i]  # exclusive, index of solution after the last solution for this problem
-            for idx1 in range(start_idx, end_idx - 1):
-                for idx2 in range(start_idx + 1, end_idx):
-                    indices.append((idx1, idx2))
-        logger.info(f"ClonePositvesDataset: Found {len(indices)} cloned pairs")
-        return np.array(indices)
+    """Pairs of programs solving the same problem.
+
+    Same pairs as the original nested loops: for a problem with solutions start..end-1,
+    idx1 in [start, end - 1) and idx2 in [start + 1, end), so both orders of a pair
+    and self-pairs are included.
+    """
+
+    label = 1
+
+    def problem_pair_counts(self):
+        sizes = self.problem_ends - self.problem_starts
+        counts = np.maximum(sizes - 1, 0) ** 2
+        logger.info(f"ClonePositvesDataset: Found {counts.sum()} cloned pairs")
+        return counts
+
+    def unrank(self, problem, rank):
+        start = int(self.problem_starts[problem])
+        n = int(self.problem_ends[problem]) - start
+        return start + rank // (n - 1), start + 1 + rank % (n - 1)
 
 
 class CloneNegativesDataset(ClonePairDataset):
-    def get_indices(self):
-        # Get all pairs of indices of programs solving different problems
-        indices = []
-        for i in range(self.dataset.num_problems - 1):
-            start_idx_i = self.dataset.cumulative_sizes[i - 1] if i > 0 else 0
-            end_idx_i = self.dataset.cumulative_sizes[i]
-
-            for j in range(1, self.dataset.num_problems):
-                start_idx_j = self.dataset.cumulative_sizes[j - 1]
-                end_idx_j = self.dataset.cumulative_sizes[j]
-
-                for idx_i in range(start_idx_i, end_idx_i):
-                    for idx_j in range(start_idx_j, end_idx_j):
-                        indices.append((idx_i, idx_j))
-        logger.info(f"CloneNegativesDataset: Found {len(indices)} non-cloned pairs")
-        return np.array(indices)
+    """Pairs of programs solving different problems.
+
+    Same pairs as the original nested loops (idx1 solves problem i in [0, P - 1), idx2
+    solves problem j in [1, P)), except for j == i: those pairs solve the same problem.
+    """
+
+    def problem_pair_counts(self):
+        sizes = self.problem_ends - self.problem_starts
+        # number of second programs of every problem: the solutions of problems 1..P-1 but its own
+        self.num_second = (self.problem_ends[-1] - self.problem_ends[0]) - np.where(np.arange(len(sizes)) > 0, sizes, 0)
+        counts = sizes * self.num_second
+        counts[len(counts) - 1:] = 0  # the last problem is never the first one
+        logger.info(f"CloneNegativesDataset: Found {counts.sum()} non-cloned pairs")
+        return counts
+
+    def unrank(self, problem, rank):
+        num_second = int(self.num_second[problem])
+        idx1 = int(self.problem_starts[problem]) + rank // num_second
+        idx2 = int(self.problem_ends[0]) + rank % num_second
+        if problem > 0 and idx2 >= self.problem_starts[problem]:
+            # skip the solutions of the same problem
+            idx2 += int(self.problem_ends[problem] - self.problem_starts[problem])
+        return idx1, idx2
 
 
 def get_pad_collate(pad_id):
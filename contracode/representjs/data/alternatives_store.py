@@ -0,0 +1,208 @@
+"""Memory-mapped store of the tokenized alternatives of every program.
+
+Loading the pickle of all augmented alternatives takes minutes and several GB per
+DataLoader worker, and every `__getitem__` re-runs SentencePiece. `materialize`
+tokenizes every alternative once, offline, into a directory of chunks:
+
+    meta.json                   number of examples/chunks, SentencePiece model, max_length
+    example_offsets.npy         (N + 1,) int64, alternatives of example e are [offsets[e], offsets[e + 1])
+    chunk_starts.npy            (C + 1,) int64, first alternative of every chunk
+    tokens.{c}.npy              flat token ids of the alternatives of chunk c, without <s> and </s>
+    token_offsets.{c}.npy       (A_c + 1,) int64 offsets of every alternative of chunk c into tokens.{c}
+    text.{c}.npy, text_offsets.{c}.npy
+                                optional normalized source as UTF-8 bytes, for online subword regularization
+
+Examples never straddle two chunks. `AlternativesStore` memory-maps the chunks on
+first access, so DataLoader workers share the page cache instead of unpickling.
+
+Run it with representjs/materialize_alternatives.py.
+"""
+import gzip
+import json
+import os
+import pathlib
+import pickle
+import shutil
+from multiprocessing import Pool
+
+import jsonlines
+import numpy as np
+import sentencepiece as spm
+import tqdm
+from loguru import logger
+
+from data.util import Timer, normalize_program
+
+
+class AlternativesStore:
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        with (self.path / "meta.json").open() as f:
+            self.meta = json.load(f)
+        self.example_offsets = np.load(str(self.path / "example_offsets.npy"), mmap_mode="r")
+        self.chunk_starts = np.load(str(self.path / "chunk_starts.npy"))
+        self.has_text = self.meta["store_text"]
+        self._chunks = {}
+
+    @staticmethod
+    def exists(path) -> bool:
+        return (pathlib.Path(path) / "meta.json").exists()
+
+    def __len__(self):
+        return len(self.example_offsets) - 1
+
+    def num_alternatives(self, example=None):
+        """Number of alternatives of `example`, or of every example as an array."""
+        if example is None:
+            return np.diff(self.example_offsets)
+        return int(self.example_offsets[example + 1] - self.example_offsets[example])
+
+    def _chunk(self, c):
+        if c not in self._chunks:
+            names = ["tokens", "token_offsets"] + (["text", "text_offsets"] if self.has_text else [])
+            self._chunks[c] = {name: np.load(str(self.path / f"{name}.{c}.npy"), mmap_mode="r") for name in names}
+        return self._chunks[c]
+
+    def _locate(self, example, i):
+        alternative = int(self.example_offsets[example]) + i
+        c = int(np.searchsorted(self.chunk_starts, alternative, side="right")) - 1
+        return self._chunk(c), alternative - int(self.chunk_starts[c])
+
+    def ids(self, example, i) -> np.ndarray:
+        """Token ids of the i-th alternative of `example`, without <s> and </s>."""
+        chunk, a = self._locate(example, i)
+        return np.asarray(chunk["tokens"][chunk["token_offsets"][a] : chunk["token_offsets"][a + 1]], dtype=np.int64)
+
+    def text(self, example, i) -> str:
+        """Normalized source of the i-th alternative of `example`."""
+        if not self.has_text:
+            raise ValueError(f"{self.path} was materialized without store_text")
+        chunk, a = self._locate(example, i)
+        return bytes(chunk["text"][chunk["text_offsets"][a] : chunk["text_offsets"][a + 1]]).decode("utf-8")
+
+
+def _read_examples(input_path):
+    """Yield the list of alternatives of every program from a pickle or augmented jsonl file."""
+    input_path = str(input_path)
+    if ".jsonl" in input_path:
+        with open(input_path, "r") as f:
+            for line in jsonlines.Reader(f):
+                yield list(set(line))
+        return
+    with gzip.open(input_path, "rb") if input_path.endswith(".gz") else open(input_path, "rb") as f:
+        examples = pickle.load(f)
+    for example in examples:
+        yield list(example)
+
+
+_sp = None
+
+
+def _init_worker(spm_model_path):
+    global _sp
+    _sp = spm.SentencePieceProcessor()
+    _sp.Load(spm_model_path)
+
+
+def _encode_example(args):
+    alternatives, max_length = args
+    texts = [normalize_program(alternative) for alternative in alternatives]
+    return texts, [_sp.EncodeAsIds(text)[: max_length - 2] for text in texts]
+
+
+class _ChunkWriter:
+    def __init__(self, path, dtype, store_text):
+        self.path = path
+        self.dtype = dtype
+        self.store_text = store_text
+        self.chunk_starts = [0]
+        self._reset()
+
+    def _reset(self):
+        self.tokens, self.token_lengths, self.text, self.text_lengths = [], [], [], []
+
+    def add(self, texts, ids):
+        for text, alternative_ids in zip(texts, ids):
+            self.tokens.append(np.asarray(alternative_ids, dtype=self.dtype))
+            self.token_lengths.append(len(alternative_ids))
+            if self.store_text:
+                encoded = np.frombuffer(text.encode("utf-8"), dtype=np.uint8)
+                self.text.append(encoded)
+                self.text_lengths.append(len(encoded))
+
+    def flush(self):
+        if not self.token_lengths:
+            return
+        c = len(self.chunk_starts) - 1
+        np.save(os.path.join(self.path, f"tokens.{c}.npy"), np.concatenate(self.tokens))
+        np.save(os.path.join(self.path, f"token_offsets.{c}.npy"), np.concatenate([[0], np.cumsum(self.token_lengths)]).astype(np.int64))
+        if self.store_text:
+            np.save(os.path.join(self.path, f"text.{c}.npy"), np.concatenate(self.text))
+            np.save(os.path.join(self.path, f"text_offsets.{c}.npy"), np.concatenate([[0], np.cumsum(self.text_lengths)]).astype(np.int64))
+        self.chunk_starts.append(self.chunk_starts[-1] + len(self.token_lengths))
+        self._reset()
+
+
+def materialize(
+    input_path, output_dir, spm_model_path, max_length=1024, chunk_size=65536, store_text=False, num_workers=1, limit_size=-1
+):
+    """Tokenize the alternatives of every program of `input_path` into an AlternativesStore.
+
+    Arguments:
+        input_path: pickle (optionally gzipped) of lists or sets of alternatives, or an augmented jsonl file
+        chunk_size: number of examples per chunk
+        store_text: also keep the normalized source, needed for subword regularization
+    """
+    sp = spm.SentencePieceProcessor()
+    sp.Load(spm_model_path)
+    vocab_size = sp.GetPieceSize()
+    dtype = np.uint16 if vocab_size <= np.iinfo(np.uint16).max else np.int32
+
+    tmp_dir = f"{output_dir}.{os.getpid()}.tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    writer = _ChunkWriter(tmp_dir, dtype, store_text)
+    num_alternatives = []
+
+    def jobs():
+        for n, alternatives in enumerate(_read_examples(input_path)):
+            if 0 <= limit_size <= n:
+                break
+            yield alternatives, max_length
+
+    with Timer() as t:
+        if num_workers > 1:
+            pool = Pool(num_workers, initializer=_init_worker, initargs=(spm_model_path,))
+            encoded = pool.imap(_encode_example, jobs(), chunksize=256)
+        else:
+            pool = None
+            _init_worker(spm_model_path)
+            encoded = map(_encode_example, jobs())
+        for texts, ids in tqdm.tqdm(encoded, desc="materialize"):
+            writer.add(texts, ids)
+            num_alternatives.append(len(ids))
+            if len(num_alternatives) % chunk_size == 0:
+                writer.flush()
+        writer.flush()
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    np.save(os.path.join(tmp_dir, "example_offsets.npy"), np.concatenate([[0], np.cumsum(num_alternatives)]).astype(np.int64))
+    np.save(os.path.join(tmp_dir, "chunk_starts.npy"), np.asarray(writer.chunk_starts, dtype=np.int64))
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        meta = {
+            "num_examples": len(num_alternatives),
+            "num_chunks": len(writer.chunk_starts) - 1,
+            "spm_model_path": str(pathlib.Path(spm_model_path).resolve()),
+            "vocab_size": vocab_size,
+            "max_length": max_length,
+            "store_text": store_text,
+        }
+        json.dump(meta, f)
+    # swap the whole directory in so readers never see a partial store
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    os.replace(tmp_dir, output_dir)
+    logger.info(f"Materialized {len(num_alternatives)} examples, {sum(num_alternatives)} alternatives in {t.interval:.3f}s")
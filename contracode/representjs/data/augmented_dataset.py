@@ -31,10 +31,22 @@ class AugmentedJSDataset(Dataset):
             idx = idx.tolist()
         samples = self.json_dataset[idx]
         if isinstance(samples, list):
-            return [self.augment_element(sample) for sample in samples]
+            return self.augment_batch(samples)
         else:
             return self.augment_element(samples)
 
+    def augment_batch(self, samples):
+        """Augment a list of samples, e.g. a whole batch when used with a BatchSampler.
+        Transforms with a `transform_batch` method send the batch to the Node worker pool at once."""
+        if not hasattr(self.transform, "transform_batch"):
+            return [self.augment_element(sample) for sample in samples]
+        if self.contrastive:
+            transformed = self.transform.transform_batch([sample.copy() for sample in samples + samples])
+            keys, queries = transformed[: len(samples)], transformed[len(samples) :]
+            assert all("data" in key.keys() and "data" in query.keys() for key, query in zip(keys, queries))
+            return [{"data_key": key["data"], "data_query": query["data"]} for key, query in zip(keys, queries)]
+        return self.transform.transform_batch(samples)
+
     def augment_element(self, sample):
         if self.contrastive:
             assert self.transform is not None, "Must specify a transformation if creating contrastive dataset"
@@ -6,7 +6,7 @@ import sentencepiece as spm
 import torch
 from torch.nn.utils.rnn import pad_sequence
 
-from representjs.data.old_dataloader import _augment_server
+from representjs.data.old_dataloader import _augment
 from representjs.data.util import normalize_program, EncodeAsIds
 
 
@@ -85,10 +85,10 @@ def _tokenize(
 
         js_beautified = re.sub(name_re, _remove_newlines_in_segment, js_beautified, flags=re.DOTALL)
 
-        # Augment code by calling _augment_server
+        # Augment code by calling _augment
         # assert augmentations
         transform_payload = [dict(src=js_beautified, augmentations=augmentations)]
-        js_beautified = _augment_server(transform_payload)[0]
+        js_beautified = _augment(transform_payload)[0]
 
         # Extract labels from program names. Match across lines because train_dataset[99] has a } with type
         # annotation and the beautifier inserts a newline right after it.
@@ -0,0 +1,237 @@
+"""Pool of long-lived Node.js augmentation workers.
+
+Spawning `node transform.js` per call, or POSTing one program at a time to
+`transform_server.js`, makes augmentation the bottleneck of contrastive
+pretraining. The pool keeps `num_workers` `transform_worker.js` processes alive
+and talks to them over pipes with newline-delimited JSON. A batch of programs is
+split across the workers, at most `max_pending` requests are in flight
+(`transform` blocks beyond that), and a program whose transformation fails or
+times out falls back to its untransformed source.
+"""
+import atexit
+import itertools
+import json
+import os
+import threading
+import time
+from subprocess import Popen, PIPE, DEVNULL
+from typing import List, Optional
+
+from loguru import logger
+
+from representjs import PACKAGE_ROOT
+
+
+class _NodeWorker:
+    """One `transform_worker.js` process and the requests it has in flight."""
+
+    def __init__(self, script_path: str):
+        self.process = Popen(["node", script_path], stdin=PIPE, stdout=PIPE, stderr=DEVNULL, universal_newlines=True, bufsize=1)
+        self.write_lock = threading.Lock()
+        self.pending = {}  # request id -> _Request
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+
+    def _read(self):
+        for line in self.process.stdout:
+            try:
+                response = json.loads(line)
+            except json.JSONDecodeError:
+                logger.error(f"Malformed line from Node worker {self.process.pid}: {line[:200]}")
+                continue
+            request = self.pending.pop(response.get("id"), None)
+            if request is not None:
+                request.result = response.get("result")
+                request.done.set()
+        # the process exited, whatever is still pending will not be answered
+        for request in list(self.pending.values()):
+            request.done.set()
+        self.pending.clear()
+
+    @property
+    def alive(self):
+        return self.process.poll() is None
+
+    def send(self, request: "_Request"):
+        self.pending[request.id] = request
+        try:
+            with self.write_lock:
+                self.process.stdin.write(json.dumps({"id": request.id, "payload": request.payload}) + "\n")
+                self.process.stdin.flush()
+        except (BrokenPipeError, OSError, ValueError) as e:
+            logger.error(f"Could not write to Node worker {self.process.pid}: {e}")
+            self.pending.pop(request.id, None)
+            request.done.set()
+
+    def kill(self):
+        if self.alive:
+            self.process.kill()
+        self.process.wait()
+
+
+class _Request:
+    def __init__(self, request_id: int, payload: List[dict]):
+        self.id = request_id
+        self.payload = payload
+        self.result = None
+        self.done = threading.Event()
+
+
+class NodeWorkerPool:
+    def __init__(
+        self, num_workers: int = 4, max_pending: int = 64, timeout_s: float = 5, script: str = "transform_worker.js", log_every: int = 1000
+    ):
+        """
+        Arguments:
+            num_workers: number of Node processes
+            max_pending: maximum number of requests in flight, across all workers
+            timeout_s: a request not answered within timeout_s seconds falls back to the
+                untransformed programs and its worker is restarted
+            log_every: log the statistics every log_every transformed programs (0 to disable)
+        """
+        self.num_workers = num_workers
+        self.timeout_s = timeout_s
+        self.script_path = str((PACKAGE_ROOT / "node_src" / script).resolve())
+        self.log_every = log_every
+        self.max_pending = max_pending
+        self.in_flight = 0
+        self.slots = threading.Condition()
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        self.workers = [_NodeWorker(self.script_path) for _ in range(num_workers)]
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.lock:
+            self.num_programs = 0
+            self.num_failures = 0
+            self.num_requests = 0
+            self.num_timeouts = 0
+            self.total_latency = 0.0
+            self.max_latency = 0.0
+
+    def stats(self) -> dict:
+        """Transform latency (per request, in seconds) and failure rates since the last `reset_stats`."""
+        with self.lock:
+            return {
+                "programs": self.num_programs,
+                "requests": self.num_requests,
+                "failure_rate": self.num_failures / max(self.num_programs, 1),
+                "timeout_rate": self.num_timeouts / max(self.num_requests, 1),
+                "mean_latency": self.total_latency / max(self.num_requests, 1),
+                "max_latency": self.max_latency,
+            }
+
+    def _least_loaded_worker(self) -> int:
+        with self.lock:
+            for i, worker in enumerate(self.workers):
+                if not worker.alive:
+                    logger.warning(f"Node worker {worker.process.pid} died, restarting it")
+                    self.workers[i] = _NodeWorker(self.script_path)
+            return min(range(len(self.workers)), key=lambda i: len(self.workers[i].pending))
+
+    def _restart(self, worker: _NodeWorker):
+        with self.lock:
+            if worker in self.workers:
+                self.workers[self.workers.index(worker)] = _NodeWorker(self.script_path)
+        worker.kill()
+
+    def transform(self, transform_payload: List[dict], fallback: bool = True) -> List[Optional[str]]:
+        """Transform a batch of {"src": ..., "augmentations": [...]} dicts.
+
+        Returns the transformed programs in order, or the untransformed source of the
+        programs that could not be transformed (None instead if not `fallback`).
+        """
+        if not transform_payload:
+            return []
+        chunk_size = -(-len(transform_payload) // self.num_workers)
+        num_chunks = -(-len(transform_payload) // chunk_size)
+        # backpressure: block while the requests of this batch would exceed max_pending.
+        # All slots of a batch are taken at once so that concurrent callers can't deadlock.
+        with self.slots:
+            self.slots.wait_for(lambda: self.in_flight == 0 or self.in_flight + num_chunks <= self.max_pending)
+            self.in_flight += num_chunks
+        requests = []
+        for start in range(0, len(transform_payload), chunk_size):
+            request = _Request(next(self.ids), transform_payload[start : start + chunk_size])
+            request.start = time.time()
+            request.worker = self.workers[self._least_loaded_worker()]
+            request.worker.send(request)
+            requests.append(request)
+
+        transformed = []
+        num_failures, num_timeouts, latencies = 0, 0, []
+        for request in requests:
+            try:
+                answered = request.done.wait(max(request.start + self.timeout_s - time.time(), 0))
+                if not answered:
+                    num_timeouts += 1
+                    logger.error(f"Node worker {request.worker.process.pid} timed out after {self.timeout_s}s, restarting it")
+                    self._restart(request.worker)
+                latencies.append(time.time() - request.start)
+                result = request.result
+                if not isinstance(result, list) or len(result) != len(request.payload):
+                    result = [None] * len(request.payload)
+                for prog, out in zip(request.payload, result):
+                    if isinstance(out, str):
+                        transformed.append(out)
+                    else:
+                        # Transformation failed in Node.js, so don't transform
+                        num_failures += 1
+                        transformed.append(prog["src"] if fallback else None)
+            finally:
+                with self.slots:
+                    self.in_flight -= 1
+                    self.slots.notify_all()
+
+        with self.lock:
+            logged = self.num_programs // self.log_every if self.log_every else 0
+            self.num_programs += len(transform_payload)
+            self.num_failures += num_failures
+            self.num_requests += len(requests)
+            self.num_timeouts += num_timeouts
+            self.total_latency += sum(latencies)
+            self.max_latency = max([self.max_latency] + latencies)
+            log = self.log_every and self.num_programs // self.log_every > logged
+        if log:
+            logger.info("Node augmentation pool: {}".format(self.stats()))
+        return transformed
+
+    def close(self):
+        with self.lock:
+            workers, self.workers = self.workers, []
+        for worker in workers:
+            try:
+                worker.process.stdin.close()
+            except (BrokenPipeError, OSError):
+                pass
+            try:
+                worker.process.wait(timeout=1)
+            except Exception:
+                worker.kill()
+
+
+_pool: Optional[NodeWorkerPool] = None
+_pool_pid: Optional[int] = None
+
+
+def get_node_pool(**kwargs) -> NodeWorkerPool:
+    """The pool of the current process, started on first use.
+
+    DataLoader workers are forked, so every process gets its own pool rather than
+    sharing the pipes of its parent. `kwargs` only apply when the pool is created;
+    the number of Node workers defaults to the NODE_POOL_WORKERS environment variable.
+    """
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        kwargs.setdefault("num_workers", int(os.environ.get("NODE_POOL_WORKERS", 4)))
+        _pool = NodeWorkerPool(**kwargs)
+        _pool_pid = os.getpid()
+    return _pool
+
+
+@atexit.register
+def _close_node_pool():
+    # a forked child inherits the handler and the parent's pool, which is not its own
+    if _pool is not None and _pool_pid == os.getpid():
+        _pool.close()
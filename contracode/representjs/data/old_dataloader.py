@@ -1,7 +1,5 @@
-import json
 import os
 from typing import List
-import requests
 
 import sentencepiece as spm
 import torch
@@ -10,62 +8,17 @@ from torch.nn.utils.rnn import pad_sequence
 
 from data.jsonl_dataset import JSONLinesDataset
 from data.util import normalize_program
-from data.util import dispatch_to_node
+from data.node_pool import get_node_pool
 
 
 def _augment(transform_payload: List[dict]) -> List[str]:
-    # Transform code
-    transform_payload = json.dumps(transform_payload)
-    is_successful, stdout, stderr = dispatch_to_node("transform.js", transform_payload)
-    if is_successful:
-        try:
-            transformed = json.loads(stdout)
-        except json.JSONDecodeError:
-            # Transformation failed in Node.js (got malformed stdout), so don't transform
-            logger.error(f"JSONDecodeError in _augment transform input: {transform_payload}")
-            logger.error(f"JSONDecodeError in _augment transform stdout: {stdout}")
-            logger.error(f"JSONDecodeError in _augment transform stderr: {stderr}")
-            transformed = [prog["src"] for prog in transform_payload]
-        except Exception as e:
-            # Transformation failed in Node.js (got malformed stdout), so don't transform
-            logger.error(f"Exception (maybe JSONDecodeError) in _augment: {e}")
-            logger.error(f"Exception in _augment transform input: {transform_payload}")
-            logger.error(f"Exception in _augment transform stdout: {stdout}")
-            logger.error(f"Exception in _augment transform stderr: {stderr}")
-            transformed = [prog["src"] for prog in transform_payload]
-    else:
-        logger.error("Non-zero exit code in _augment:")
-        logger.error(f"Exception in _augment transform input: {transform_payload}")
-        logger.error(f"Exception in _augment transform stdout: {stdout}")
-        logger.error(f"Exception in _augment transform stderr: {stderr}")
-        transformed = [prog["src"] for prog in transform_payload]
+    # Transform code with the process' pool of long-lived Node.js workers.
+    # Programs that fail to transform come back untransformed.
+    transformed = get_node_pool().transform(transform_payload)
     assert isinstance(transformed, list)
     return transformed
 
 
-_headers = {"Content-type": "application/json", "Accept": "application_json"}
-
-
-def _augment_server(transform_payload: List[dict]) -> List[str]:
-    # Transform code
-    transform_payload = transform_payload
-    response = None
-    try:
-        response = requests.post("http://127.0.0.1:3000", data=json.dumps(transform_payload), headers=_headers, timeout=5)
-        assert response.status_code == 200
-        transformed = response.json()
-        assert isinstance(transformed, list)
-    except Exception as e:
-        # Transformation failed in Node.js (got malformed stdout), so don't transform
-        logger.error(f"Exception in _augment_server: {e}")
-        # logger.error(f"Exception in _augment_server transform input: {transform_payload}")
-        # if response:
-        #     logger.error(f"Exception in _augment_server transform status code: {response.status_code}")
-        #     logger.error(f"Exception in _augment_server transform response: {response}")
-        transformed = [prog["src"] for prog in transform_payload]
-    return transformed
-
-
 def get_javascript_collate(
     augmentations: List[dict],
     sp: spm.SentencePieceProcessor,
@@ -97,7 +50,7 @@ def get_javascript_collate(
             if program_mode == "contrastive":
                 # Augment each input function twice
                 transform_payload = transform_payload + transform_payload
-            X = _augment_server(transform_payload)
+            X = _augment(transform_payload)
         else:
             X = [prog["function"] for prog in examples]
 
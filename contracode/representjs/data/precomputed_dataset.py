@@ -6,11 +6,13 @@ import numpy as np
 import torch
 from loguru import logger
 
+from data.alternatives_store import AlternativesStore
 from data.util import Timer, normalize_program, EncodeAsIds
 
 
 class PrecomputedDataset(torch.utils.data.Dataset):
-    """Defines a Dataset of unsupervised programs stored in pickle format."""
+    """Defines a Dataset of unsupervised programs stored in pickle format, or materialized
+    as an AlternativesStore directory (see data/alternatives_store.py)."""
 
     def __init__(
         self,
@@ -25,11 +27,28 @@ class PrecomputedDataset(torch.utils.data.Dataset):
     ):
         """Create a JSONLinesDataset given a path and field mapping dictionary.
         Arguments:
-            path (str): Path to the data file. Must be in .pickle format.
+            path (str): Path to the data file. Must be in .pickle format, or an AlternativesStore directory.
         """
         super().__init__()
         full_path = pathlib.Path(path).resolve()
-        if preloaded_examples is not None:
+        self.store = None
+        if preloaded_examples is None and AlternativesStore.exists(full_path):
+            self.store = AlternativesStore(full_path)
+            if self.store.meta["vocab_size"] != sp.GetPieceSize():
+                raise ValueError(f"{full_path} was tokenized with {self.store.meta['spm_model_path']}, which doesn't match sp")
+            if self.store.meta["max_length"] != max_length:
+                raise ValueError(f"{full_path} was truncated to max_length={self.store.meta['max_length']}, not {max_length}")
+            if subword_regularization_alpha and not self.store.has_text:
+                logger.warning(f"{full_path} was materialized without store_text, disabling subword regularization")
+                subword_regularization_alpha = 0
+            # examples are only indices into the store, alternatives are read on demand
+            self.examples = np.arange(len(self.store))
+            if limit_size > 0:
+                self.examples = self.examples[:limit_size]
+            if min_alternatives:
+                self.examples = self.examples[self.store.num_alternatives()[self.examples] >= min_alternatives]
+            logger.debug(f"Memory-mapped {full_path}, {len(self.examples)} examples with at least {min_alternatives} alternatives")
+        elif preloaded_examples is not None:
             logger.debug("Using preloaded examples passed via argument")
             self.examples = preloaded_examples
         else:
@@ -42,14 +61,15 @@ class PrecomputedDataset(torch.utils.data.Dataset):
                     with full_path.open("rb") as f:
                         self.examples = pickle.load(f)
             logger.debug(f"Loaded {len(self.examples)} examples in {t.interval:.3f}s")
-        if limit_size > 0:
-            self.examples = self.examples[:limit_size]
-            logger.debug(f"Limited size: took first {limit_size} examples")
-        self.examples = list(map(list, self.examples))
-        logger.debug("Converted examples to lists of alternatives")
-        if min_alternatives:
-            self.examples = list(filter(lambda ex: len(ex) >= min_alternatives, self.examples))
-        logger.debug(f"Filtered dataset to {len(self.examples)} examples with at least {min_alternatives} alternatives")
+        if self.store is None:
+            if limit_size > 0:
+                self.examples = self.examples[:limit_size]
+                logger.debug(f"Limited size: took first {limit_size} examples")
+            self.examples = list(map(list, self.examples))
+            logger.debug("Converted examples to lists of alternatives")
+            if min_alternatives:
+                self.examples = list(filter(lambda ex: len(ex) >= min_alternatives, self.examples))
+            logger.debug(f"Filtered dataset to {len(self.examples)} examples with at least {min_alternatives} alternatives")
 
         self.program_mode = program_mode
         self.max_length = max_length
@@ -62,25 +82,36 @@ class PrecomputedDataset(torch.utils.data.Dataset):
         return len(self.examples)
 
     def __getitem__(self, idx):
-        alternatives = self.examples[idx]
-        n_alt = len(alternatives)
+        if self.store is None:
+            n_alt = len(self.examples[idx])
+        else:
+            n_alt = self.store.num_alternatives(self.examples[idx])
         if self.program_mode == "identity":
-            return self.encode(alternatives[0])
+            return self.encode_alternative(idx, 0)
         elif self.program_mode == "augmentation":
             i = np.random.randint(n_alt)
-            return self.encode(alternatives[i])
+            return self.encode_alternative(idx, i)
         elif self.program_mode == "contrastive":
             i = np.random.randint(n_alt)
             j = i
             if n_alt > 1:
                 while j == i:
                     j = np.random.randint(n_alt)
-            return self.encode(alternatives[i]), self.encode(alternatives[j])
+            return self.encode_alternative(idx, i), self.encode_alternative(idx, j)
         elif self.program_mode == "all_alternatives":
-            return [self.encode(alt) for alt in alternatives]
+            return [self.encode_alternative(idx, i) for i in range(n_alt)]
         else:
             raise ValueError(f"Invalid program mode {self.program_mode}")
 
+    def encode_alternative(self, idx, i):
+        if self.store is None:
+            return self.encode(self.examples[idx][i])
+        if self.subword_regularization_alpha:
+            # online path: sample a new segmentation of the stored source
+            return self.encode(self.store.text(self.examples[idx], i))
+        ids = self.store.ids(self.examples[idx], i)[: (self.max_length - 2)]
+        return torch.from_numpy(np.concatenate([[self.bos_id], ids, [self.eos_id]]))
+
     def encode(self, program):
         program = normalize_program(program)
         program = EncodeAsIds(self.sp, self.subword_regularization_alpha, program)
@@ -6,7 +6,7 @@ from loguru import logger
 from torchtext.data import load_sp_model
 
 from data.util import Timer, normalize_program
-from data.old_dataloader import _augment_server
+from data.old_dataloader import _augment
 
 
 class Transform:
@@ -94,12 +94,25 @@ class ComposeTransform(Transform):
             sample = transform(sample)
         return sample
 
+    def transform_batch(self, samples):
+        """Apply the transforms to a list of samples, batching those that support it"""
+        for transform in self.transforms:
+            if hasattr(transform, "transform_batch"):
+                samples = transform.transform_batch(samples)
+            else:
+                samples = [transform(sample) for sample in samples]
+        return samples
+
 
 class NodeServerTransform(Transform):
     def __init__(self, augmentations):
         self.augmentations = augmentations
 
     def __call__(self, sample):
-        transformed = _augment_server([{"src": sample["function"], "augmentations": self.augmentations}])
-        assert len(transformed) == 1
-        return {"function": transformed[0]}
+        return self.transform_batch([sample])[0]
+
+    def transform_batch(self, samples):
+        """Augment a list of samples with a single request to the Node worker pool"""
+        transformed = _augment([{"src": sample["function"], "augmentations": self.augmentations} for sample in samples])
+        assert len(transformed) == len(samples)
+        return [{"function": function} for function in transformed]
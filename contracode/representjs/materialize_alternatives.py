@@ -0,0 +1,6 @@
+import fire
+
+from data.alternatives_store import materialize
+
+if __name__ == "__main__":
+    fire.Fire(materialize)
@@ -34,6 +34,10 @@ class MoCoTemplate(nn.Module):
         self.register_buffer("queue", torch.randn(d_rep, K))
         self.queue = nn.functional.normalize(self.queue, dim=0)
         self.register_buffer("queue_ptr", torch.zeros(1, dtype=torch.long))
+        # host copy of queue_ptr, so that updating the queue never syncs with the device
+        self._ptr = None
+        # keys of the last step, enqueued at the start of the next one
+        self._pending_keys = None
 
     def make_encoder(self, **kwargs):
         raise NotImplementedError()
@@ -54,19 +58,36 @@ class MoCoTemplate(nn.Module):
         else:
             keys = concat_all_gather(keys)
 
+        # The logits of this step keep a reference to the queue for the backward pass,
+        # so the queue is only overwritten in place at the start of the next step.
+        self._pending_keys = keys.detach()
+
+    @torch.no_grad()
+    def _enqueue_pending_keys(self):
+        if self._pending_keys is None:
+            return
+        keys, self._pending_keys = self._pending_keys, None
+        if self._ptr is None:
+            self._ptr = int(self.queue_ptr.item())
+
+        # a gathered batch larger than the queue only keeps its last K keys
+        keys = keys[-self.K :]
         batch_size = keys.shape[0]
+        ptr = self._ptr
 
-        # ptr = int(self.queue_ptr)
-        ptr = int(self.queue_ptr.item())
-        assert self.K % batch_size == 0  # for simplicity
+        # replace the keys at ptr (dequeue and enqueue), wrapping around the end of the ring buffer
+        n_tail = min(batch_size, self.K - ptr)
+        self.queue[:, ptr : ptr + n_tail] = keys[:n_tail].T
+        if n_tail < batch_size:
+            self.queue[:, : batch_size - n_tail] = keys[n_tail:].T
+        self._ptr = (ptr + batch_size) % self.K  # move pointer
 
-        # replace the keys at ptr (dequeue and enqueue)
-        self.queue = torch.cat([self.queue[:, :ptr], keys.T, self.queue[:, ptr + batch_size :]], dim=1).detach()
-        # self.queue = self.queue.clone()
-        # self.queue[:, ptr : ptr + batch_size] = keys.T
-        ptr = (ptr + batch_size) % self.K  # move pointer
+        self.queue_ptr.fill_(self._ptr)
 
-        self.queue_ptr[0] = ptr
+    def _load_from_state_dict(self, *args, **kwargs):
+        super()._load_from_state_dict(*args, **kwargs)
+        self._ptr = None
+        self._pending_keys = None
 
     def embed_x(self, img, lens):
         return self.encoder_q(img, lens)
@@ -83,6 +104,8 @@ class MoCoTemplate(nn.Module):
             logits, targets
         """
 
+        self._enqueue_pending_keys()
+
         # compute query features
         if q is None:
             q = self.encoder_q(im_q, lengths_q)  # queries: NxC
@@ -95,20 +118,18 @@ class MoCoTemplate(nn.Module):
             k = nn.functional.normalize(k, dim=1)
 
         # compute logits
-        # Einstein sum is more intuitive
+        # apply temperature to the NxC queries rather than to the Nx(1+K) logits
+        q_t = q / self.T
         # positive logits: Nx1
-        l_pos = torch.einsum("nc,nc->n", *[q, k]).unsqueeze(-1)
+        l_pos = (q_t * k).sum(dim=1, keepdim=True)
         # negative logits: NxK
-        l_neg = torch.einsum("nc,ck->nk", *[q, self.queue.detach()])
+        l_neg = torch.mm(q_t, self.queue)
 
         # logits: Nx(1+K)
         logits = torch.cat([l_pos, l_neg], dim=1)
 
-        # apply temperature
-        logits /= self.T
-
         # labels: positive key indicators
-        labels = torch.zeros(logits.shape[0], dtype=torch.long).cuda()
+        labels = torch.zeros(logits.shape[0], dtype=torch.long, device=logits.device)
 
         # dequeue and enqueue
         # print("world size", torch.distributed.get_world_size())
@@ -123,6 +144,8 @@ def concat_all_gather(tensor):
     Performs all_gather operation on the provided tensors.
     *** Warning ***: torch.distributed.all_gather has no gradient.
     """
+    if not torch.distributed.is_available() or not torch.distributed.is_initialized():
+        return tensor
     tensors_gather = [torch.ones_like(tensor) for _ in range(torch.distributed.get_world_size())]
     torch.distributed.all_gather(tensors_gather, tensor, async_op=False)
 
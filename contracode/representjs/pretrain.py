@@ -14,6 +14,7 @@ from torch.nn import functional as F
 from torch.nn.utils.rnn import pad_sequence
 
 from representjs import RUN_DIR, CSNJS_DIR
+from data.alternatives_store import AlternativesStore
 from data.precomputed_dataset import PrecomputedDataset
 from models.code_mlm import CodeMLM
 from models.code_moco import CodeMoCo
@@ -77,7 +78,7 @@ def pretrain(
     pad_id = sp.PieceToId("[PAD]")
 
     # Create training dataset and dataloader
-    assert train_filepath.endswith(".pickle")
+    assert train_filepath.endswith(".pickle") or AlternativesStore.exists(train_filepath)
 
     def pad_collate(batch):
         B = len(batch)
@@ -17,6 +17,7 @@ import horovod.torch as hvd
 
 from models.code_mlm import CodeMLM, CodeContrastiveMLM
 from representjs import RUN_DIR, CSNJS_DIR
+from data.alternatives_store import AlternativesStore
 from data.precomputed_dataset import PrecomputedDataset
 from models.code_moco import CodeMoCo
 from utils import accuracy, count_parameters, get_linear_schedule_with_warmup
@@ -221,7 +222,7 @@ def pretrain(
     logger.info(f"Saving logs, model checkpoints to {run_dir}")
 
     # Create training dataset and dataloader
-    assert train_filepath.endswith(".pickle") or train_filepath.endswith(".gz")
+    assert train_filepath.endswith(".pickle") or train_filepath.endswith(".gz") or AlternativesStore.exists(train_filepath)
 
     # Setup distributed
     gpu = hvd.local_rank()
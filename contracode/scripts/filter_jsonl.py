@@ -1,5 +1,4 @@
 import gzip
-import json
 import jsonlines
 import re
 
@@ -9,7 +8,7 @@ import tqdm
 from loguru import logger
 
 from data.jsonl_dataset import _fix_json_dict
-from data.util import dispatch_to_node
+from data.node_pool import get_node_pool
 
 _valid_identifier_regex = re.compile(r"^[a-zA-Z_$][0-9a-zA-Z_$]*$")
 
@@ -22,9 +21,9 @@ def has_transform_error(json_dict):
     transform_payload = [
         dict(src=json_dict["function"], augmentations=[{"fn": "identity_ast2ast"}],)  # TODO: this key should be "code" for supervised set
     ]
-    transform_payload = json.dumps(transform_payload)
-    stdout, stderr = dispatch_to_node("transform.js", transform_payload)
-    if stderr:
+    # every process of the Pool talks to its own long-lived Node worker
+    transformed = get_node_pool(num_workers=1).transform(transform_payload, fallback=False)
+    if transformed[0] is None:
         return True, None
 
     return False, json_dict
@@ -89,9 +88,8 @@ def filter_dataset(path: str, out_path: str, require_fields=[], exclude_transfor
                     augmentations=[{"fn": "identity_ast2ast"}],
                 )
             ]
-            transform_payload = json.dumps(transform_payload)
-            stdout, stderr = dispatch_to_node("transform.js", transform_payload)
-            if stderr:
+            transformed = get_node_pool(num_workers=1).transform(transform_payload, fallback=False)
+            if transformed[0] is None:
                 continue
 
         examples.append(json_dict)
@@ -0,0 +1,145 @@
+"""
+Embeddable BM25 inverted index used for the syntactic-level retrieval.
+
+It replaces the PyLucene index of syntax.py: documents are whitespace-tokenized
+(like Lucene's WhitespaceAnalyzer) and scored with BM25 (Lucene's default
+similarity). The index is a directory of flat arrays that are memory-mapped when
+loaded:
+
+    meta.json      vocabulary, BM25 parameters and corpus statistics
+    offsets.npy    (V + 1,) postings of term t are [offsets[t], offsets[t + 1])
+    doc_ids.npy    (P,) document of every posting, ascending within a term
+    weights.npy    (P,) float32 BM25 weight of the term in that document
+
+offsets and doc_ids are int32 (int64 past 2^31 postings), one dtype for both so
+that the scipy postings matrix uses the memory-mapped doc_ids and weights as is.
+Since the weights are precomputed, searching a block of queries is one sparse
+product of their term counts with the postings matrix followed by a top-k.
+"""
+
+import json
+import os
+import shutil
+from collections import Counter
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+
+def tokenize(text):
+    return text.split()
+
+
+class BM25Index(object):
+
+    def __init__(self, vocab, offsets, doc_ids, weights, num_docs, path=None):
+        self.vocab = vocab
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.num_docs = num_docs
+        self.path = path
+        # (V, N) postings matrix over the memory-mapped doc_ids and weights, not copied since
+        # the offsets have the same index dtype; only the (V + 1) offsets of indexes written
+        # with int64 offsets are converted
+        if offsets.dtype != doc_ids.dtype and offsets[-1] <= np.iinfo(doc_ids.dtype).max:
+            offsets = np.asarray(offsets, dtype=doc_ids.dtype)
+        self.postings = csr_matrix((weights, doc_ids, offsets), shape=(len(vocab), num_docs), copy=False)
+
+    def __len__(self):
+        return self.num_docs
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, 'meta.json'))
+
+    @classmethod
+    def build(cls, path, documents, k1=1.2, b=0.75, source=None):
+        """Index `documents` (strings) under `path` and return the memory-mapped index.
+
+        `source` is stored in the metadata so callers can tell which file the
+        index was built from.
+        """
+        vocab = {}
+        doc_terms = []
+        doc_lens = np.zeros(len(documents), dtype=np.float64)
+        for k, document in enumerate(documents):
+            tokens = tokenize(document)
+            doc_lens[k] = len(tokens)
+            doc_terms.append([(vocab.setdefault(t, len(vocab)), tf) for t, tf in Counter(tokens).items()])
+        term_ids = np.fromiter((t for terms in doc_terms for t, _ in terms), dtype=np.int64)
+        tfs = np.fromiter((tf for terms in doc_terms for _, tf in terms), dtype=np.float64, count=len(term_ids))
+        doc_ids = np.repeat(np.arange(len(documents), dtype=np.int32), [len(terms) for terms in doc_terms])
+
+        # group postings by term, keeping documents in ascending order
+        order = np.argsort(term_ids, kind='stable')
+        term_ids, tfs, doc_ids = term_ids[order], tfs[order], doc_ids[order]
+        dfs = np.bincount(term_ids, minlength=len(vocab))
+        index_dtype = np.int32 if len(doc_ids) < 2 ** 31 and len(documents) < 2 ** 31 else np.int64
+        offsets = np.concatenate([[0], np.cumsum(dfs)]).astype(index_dtype)
+        doc_ids = doc_ids.astype(index_dtype, copy=False)
+
+        num_docs = len(documents)
+        avgdl = float(doc_lens.mean()) if num_docs else 0.0
+        idf = np.log(1 + (num_docs - dfs + 0.5) / (dfs + 0.5))
+        norm = k1 * (1 - b + b * doc_lens[doc_ids] / max(avgdl, 1e-12))
+        weights = (idf[term_ids] * (k1 + 1) * tfs / (tfs + norm)).astype(np.float32)
+
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        np.save(os.path.join(tmp_path, 'offsets.npy'), offsets)
+        np.save(os.path.join(tmp_path, 'doc_ids.npy'), doc_ids)
+        np.save(os.path.join(tmp_path, 'weights.npy'), weights)
+        terms = sorted(vocab, key=vocab.get)
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump({'num_docs': num_docs, 'avgdl': avgdl, 'k1': k1, 'b': b,
+                       'source': source, 'terms': terms}, f)
+        # swap the whole directory in so readers never see a partial index
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(tmp_path, path)
+        return cls.load(path)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        vocab = {t: i for i, t in enumerate(meta['terms'])}
+        arrays = [np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+                  for name in ('offsets', 'doc_ids', 'weights')]
+        index = cls(vocab, *arrays, num_docs=meta['num_docs'], path=path)
+        index.meta = meta
+        return index
+
+    def query_matrix(self, queries):
+        """(Q, V) term counts of `queries`; terms missing from the index are dropped."""
+        rows, cols, counts = [], [], []
+        for i, query in enumerate(queries):
+            for term, count in Counter(tokenize(query)).items():
+                if term in self.vocab:
+                    rows.append(i)
+                    cols.append(self.vocab[term])
+                    counts.append(count)
+        return csr_matrix((np.asarray(counts, dtype=np.float32), (rows, cols)),
+                          shape=(len(queries), len(self.vocab)))
+
+    def search(self, queries, k=10, batch_size=256):
+        """Top-k documents of every query as (doc ids, scores) array pairs, best first.
+
+        Only documents sharing a term with the query are returned, and equal
+        scores are ranked by document id, so a query can get fewer than k hits.
+        """
+        k = min(k, self.num_docs)
+        results = []
+        for start in range(0, len(queries), batch_size):
+            scores = (self.query_matrix(queries[start:start + batch_size]) @ self.postings).toarray()
+            # k-th best score of every query; every document tied with it is kept
+            # so that ties are broken by document id, not by the partition
+            kth = -np.partition(-scores, k - 1, axis=-1)[:, k - 1] if k else np.full(len(scores), np.inf)
+            for row, threshold in zip(scores, kth):
+                candidates = np.flatnonzero((row >= threshold) & (row > 0))
+                order = np.lexsort((candidates, -row[candidates]))[:k]
+                results.append((candidates[order], row[candidates[order]]))
+        return results
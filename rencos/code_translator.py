@@ -15,6 +15,7 @@ import onmt.inputters as inputters
 import onmt.opts as opts
 import onmt.decoders.ensemble
 from onmt.translate.translator import Translator
+from vector_index import VectorIndex, VectorIndexWriter
 
 
 def build_translator(opt, report_score=True, logger=None, out_file=None):
@@ -175,8 +176,7 @@ class CodeTranslator(Translator):
             batch_size=batch_size, train=False, sort=False,
             sort_within_batch=True, shuffle=False)
 
-        doc_feats = []
-        shard = 1
+        writer = VectorIndexWriter(self.index_path(src_path))
         for batch in data_iter:
 
             # Encoder forward.
@@ -186,23 +186,16 @@ class CodeTranslator(Translator):
             feature = torch.max(memory_bank, 0)[0]
             _, recover_indices = torch.sort(batch.indices, descending=False)
             feature = feature[recover_indices]
-            doc_feats.append(feature)
-            if len(doc_feats) % 1250 == 0:
-                print('saving shard %d' % shard)
-                doc_feats = torch.cat(doc_feats)
-                torch.save(doc_feats, '{}/indexes/codev{}.pt'.format('/'.join(src_path.split('/')[:2]), shard))
-
-                doc_feats = []
-                shard += 1
-        if doc_feats:
-            doc_feats = torch.cat(doc_feats)
-            torch.save(doc_feats, '{}/indexes/codev{}.pt'.format('/'.join(src_path.split('/')[:2]), shard))
-            print('done.')
-    @staticmethod
-    def load_indexes(src_path, shard):
-        indexes = torch.load('{}/indexes/codev{}.pt'.format('/'.join(src_path.split('/')[:2]), shard))  # M*H
+            writer.add(feature)
+        index = writer.close()
+        if self.ann_lists:
+            print('training IVF-PQ quantizer...')
+            index.train_quantizer(self.ann_lists, self.ann_subspaces)
+        print('done.')
 
-        return indexes
+    @staticmethod
+    def index_path(src_path):
+        return '{}/indexes/code_vectors'.format('/'.join(src_path.split('/')[:2]))
 
     def search(self, test_iter, data, src_path=None, threshold=0, train=False):
         with open('{}/train/train.txt.tgt'.format('/'.join(src_path.split('/')[:2])), 'r') as tr:
@@ -212,41 +205,34 @@ class CodeTranslator(Translator):
         
         all_summaries = []
         all_generated = []
-        all_indexes = []
-        for shard in range(1, 8):
-            try:
-                indexes = self.load_indexes(src_path, shard)
-                all_indexes.append(indexes)
-            except FileNotFoundError:
-                pass
-        all_indexes = torch.cat(all_indexes)
+        index = VectorIndex.load(self.index_path(src_path))
         for batch in test_iter:
             src = inputters.make_features(batch, 'src', data.data_type)
             _, src_lengths = batch.src
             last, memory_bank, _ = self.model.encoder(src, src_lengths)
             # props_v, props_idx = [], []
 
-            props = self._search_batch(batch, memory_bank, all_indexes)
             if train:
-                props = torch.topk(props, 6, dim=1)
+                props = self._search_batch(batch, memory_bank, index, 6, self.ann_nprobe)
                 props_idx = props[1].tolist()
                 props_v = props[0].tolist()
                 # if random.random() > 0.4:
                 #     generated = summaries[props_idx[1]]
                 # else:
                 for item, j in zip(props_idx, props_v):
-                    generated = ' '.join([summaries[i].strip() for i in item[1:]])+'\n'
+                    generated = ' '.join([summaries[i].strip() for i in item[1:] if i >= 0])+'\n'
                     all_generated.append(generated)
 
             else:
-                props = torch.topk(props, 1, dim=1)  # B*2*k
+                props = self._search_batch(batch, memory_bank, index, 1, self.ann_nprobe)  # B*k
                 props_v = props[0][:, -1] #.append(props[0].unsqueeze(1))
                 props_idx = props[1][:, -1] #.append((props[1]+40000*(shard-1)).unsqueeze(1))
 
                 props_v = props_v.tolist()
                 props_idx = props_idx.tolist()
                 for item, j in zip(props_idx, props_v):
-                    if j >= threshold:
+                    # -1: the approximate search found no candidate for this query
+                    if item >= 0 and j >= threshold:
                         generated = sources[item].strip()+'\n' 
                         all_generated.append(generated)
                         all_summaries.append(summaries[item].strip())
@@ -260,23 +246,10 @@ class CodeTranslator(Translator):
         return all_generated
 
     @staticmethod
-    def _search_batch(batch, memory_bank, indexes):
+    def _search_batch(batch, memory_bank, index, k, nprobe=0):
         enc_states = torch.max(memory_bank, 0)[0]  # B*H
         _, recover_indices = torch.sort(batch.indices, descending=False)
         enc_states = enc_states[recover_indices]
 
-        # props = CodeTranslator.pairwise_distances(enc_states, indexes)
-        numerator = torch.mm(enc_states, indexes.transpose(0, 1))  # B*M
-        denominator_1 = enc_states.norm(2, 1).unsqueeze(1)  # B*1
-        denominator_2 = indexes.norm(2, 1).unsqueeze(1)  # M*1
-        denominator = torch.mm(denominator_1, denominator_2.transpose(0, 1))  # B*M
-
-        props = torch.div(numerator, denominator)  # B*M
-
-        return props
-
-
-
-
-
-
+        # cosine similarities against the normalized index: (scores, ids), B*k each
+        return index.search(enc_states, k, nprobe=nprobe)
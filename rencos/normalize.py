@@ -1,15 +1,22 @@
 from simi import simi, read_data, write_data
+import multiprocessing
 import sys
 
-def modify_scores(filename, num, length=10000):
+
+def pair_score(pair):
+    r, s = pair
+    return simi(r, s, False)
+
+
+def modify_scores(filename, num, length=10000, pool=None):
 
     sources = read_data('%s/test/test.spl.src'%root)
     refs = read_data('%s/test/'%root+filename)
+    pairs = [(' '.join(r.split()[:length]), ' '.join(s.split()[:length])) for s, r in zip(sources, refs)]
+    scores = pool.imap(pair_score, pairs, chunksize=256) if pool is not None else map(pair_score, pairs)
     with open('%s/test/prs.%d'%(root,num), 'w') as fw:
-        for i, (s, r) in enumerate(zip(sources, refs)):
+        for i, score in enumerate(scores):
             print(i)
-            s,r = ' '.join(s.split()[:length]),' '.join(r.split()[:length])
-            score = simi(r, s, False)
             fw.write('%.2f\n'%score)
 
 
@@ -24,5 +31,6 @@ if __name__ == '__main__':
     else:
         print("Wrong argument.")
         exit(-1)
-    modify_scores("test.ref.src.0", 0, length=src_len)
-    modify_scores("test.ref.src.1", 1, length=src_len)
+    with multiprocessing.Pool(max(1, multiprocessing.cpu_count() - 1)) as pool:
+        modify_scores("test.ref.src.0", 0, length=src_len, pool=pool)
+        modify_scores("test.ref.src.1", 1, length=src_len, pool=pool)
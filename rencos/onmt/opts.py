@@ -551,6 +551,15 @@ def translate_opts(parser):
     group.add('--refer', '-refer', type=int, default=0,
               help="Use refer")
     group.add('--guide', '-guide', type=int, default=0)
+    group.add('--ann_lists', '-ann_lists', type=int, default=0,
+              help="""Number of IVF buckets of the approximate code vector
+                       index trained when indexing documents (0: exact
+                       search only)""")
+    group.add('--ann_subspaces', '-ann_subspaces', type=int, default=16,
+              help="Number of product-quantized sub-vectors per code vector")
+    group.add('--ann_nprobe', '-ann_nprobe', type=int, default=0,
+              help="""Buckets visited by the approximate search of the code
+                       vector index (0: exact search)""")
     group.add('--lower', '-lower', action="store_true", help="Lowercase source.")
 
     group = parser.add_argument_group('Beam')
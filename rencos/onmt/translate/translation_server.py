@@ -9,6 +9,7 @@ import json
 import threading
 import re
 import traceback
+import queue
 
 import torch
 import onmt.opts
@@ -47,6 +48,22 @@ class ServerModelError(Exception):
     pass
 
 
+class TranslationJob:
+    """Pre-processed inputs of one `ServerModel.run` call waiting in the
+       request queue. The scheduler fills `scores`/`predictions` (or `error`)
+       and sets `done`.
+    """
+    def __init__(self, texts):
+        self.texts = texts
+        self.ntokens = sum(len(text.split()) for text in texts)
+        self.scores = None
+        self.predictions = None
+        self.error = None
+        self.done = threading.Event()
+        # started on submission, so `stime` is the enqueue time
+        self.timer = Timer(start=True)
+
+
 class TranslationServer():
     def __init__(self):
         self.models = {}
@@ -72,7 +89,9 @@ class TranslationServer():
                       'load': conf.get('load', None),
                       'tokenizer_opt': conf.get('tokenizer', None),
                       'on_timeout': conf.get('on_timeout', None),
-                      'model_root': conf.get('model_root', self.models_root)
+                      'model_root': conf.get('model_root', self.models_root),
+                      'batch_tokens': conf.get('batch_tokens', None),
+                      'batch_latency': conf.get('batch_latency', None)
                       }
             kwargs = {k: v for (k, v) in kwargs.items() if v is not None}
             model_id = conf.get("id", None)
@@ -153,7 +172,8 @@ class TranslationServer():
 
 class ServerModel:
     def __init__(self, opt, model_id, tokenizer_opt=None, load=False,
-                 timeout=-1, on_timeout="to_cpu", model_root="./"):
+                 timeout=-1, on_timeout="to_cpu", model_root="./",
+                 batch_tokens=4096, batch_latency=0.01):
         """
             Args:
                 opt: (dict) options for the Translator
@@ -166,6 +186,10 @@ class ServerModel:
                             timeout (see function `do_timeout`)
                 model_root: (str) path to the model directory
                             it must contain de model and tokenizer file
+                batch_tokens: (int) source tokens budget of a batch of
+                              coalesced requests
+                batch_latency: (float) seconds a request may wait for
+                               others to be batched with it
 
         """
         self.model_root = model_root
@@ -177,6 +201,8 @@ class ServerModel:
         self.tokenizer_opt = tokenizer_opt
         self.timeout = timeout
         self.on_timeout = on_timeout
+        self.batch_tokens = batch_tokens
+        self.batch_latency = batch_latency
 
         self.unload_timer = None
         self.user_opt = opt
@@ -191,7 +217,14 @@ class ServerModel:
 
         self.loading_lock = threading.Event()
         self.loading_lock.set()
-        self.running_lock = threading.Semaphore(value=1)
+        self.running_lock = threading.Lock()
+
+        # requests of concurrent callers are coalesced by a single scheduler
+        # thread, see `schedule`. It is started by the first request and
+        # stopped by `unload`
+        self.requests = queue.Queue()
+        self.scheduler = None
+        self.scheduler_lock = threading.Lock()
 
         if load:
             self.load()
@@ -304,10 +337,6 @@ class ServerModel:
         """
         self.stop_unload_timer()
 
-        if not self.running_lock.acquire(blocking=True, timeout=120):
-            raise ServerModelError("Model %d running lock timeout"
-                                   % self.model_id)
-
         timer = Timer()
         timer.start()
 
@@ -322,17 +351,19 @@ class ServerModel:
                                        % self.model_id)
 
         else:
-            if not self.loaded:
-                self.load()
-                timer.tick(name="load")
-            elif self.opt.cuda:
-                self.to_gpu()
-                timer.tick(name="to_gpu")
+            if not self.running_lock.acquire(blocking=True, timeout=120):
+                raise ServerModelError("Model %d running lock timeout"
+                                       % self.model_id)
+            try:
+                if not self.loaded:
+                    self.load()
+                    timer.tick(name="load")
+            finally:
+                self.running_lock.release()
 
         texts = []
         head_spaces = []
         tail_spaces = []
-        sslength = []
         for i, inp in enumerate(inputs):
             src = inp['src']
             if src.strip() == "":
@@ -350,35 +381,31 @@ class ServerModel:
                 head_spaces.append(whitespaces_before)
                 tok = self.maybe_tokenize(src.strip())
                 texts.append(tok)
-                sslength.append(len(tok.split()))
                 tail_spaces.append(whitespaces_after)
 
         empty_indices = [i for i, x in enumerate(texts) if x == ""]
         texts_to_translate = [x for x in texts if x != ""]
+        timer.tick(name="tokenize")
 
         scores = []
         predictions = []
         if len(texts_to_translate) > 0:
-            try:
-                scores, predictions = self.translator.translate(
-                    src_data_iter=texts_to_translate,
-                    batch_size=self.opt.batch_size)
-            except (RuntimeError, Exception) as e:
-                err = "Error: %s" % str(e)
-                self.logger.error(err)
-                self.logger.error("repr(text_to_translate): "
-                                  + repr(texts_to_translate))
-                self.logger.error("model: #%s" % self.model_id)
-                self.logger.error("model opt: " + str(self.opt.__dict__))
-                self.logger.error(traceback.format_exc())
-
-                raise ServerModelError(err)
-
-        timer.tick(name="translation")
-        self.logger.info("""Using model #%d\t%d inputs
-               \ttranslation time: %f""" % (self.model_id, len(texts),
-                                            timer.times['translation']))
-        self.reset_unload_timer()
+            job = TranslationJob(texts_to_translate)
+            with self.scheduler_lock:
+                if self.scheduler is None or not self.scheduler.is_alive():
+                    self.scheduler = threading.Thread(target=self.schedule,
+                                                      daemon=True)
+                    self.scheduler.start()
+                self.requests.put(job)
+            if not job.done.wait(timeout=120):
+                raise ServerModelError("Model %d translation timeout"
+                                       % self.model_id)
+            if job.error is not None:
+                raise job.error
+            scores, predictions = job.scores, job.predictions
+            # "queue" and "translation" are measured by the scheduler
+            timer.times.update(job.timer.times)
+            timer.tick()
 
         # NOTE: translator returns lists of `n_best` list
         #       we can ignore that (i.e. flatten lists) only because
@@ -398,11 +425,96 @@ class ServerModel:
 
         results = ["".join(items)
                    for items in zip(head_spaces, results, tail_spaces)]
+        timer.tick(name="detokenize")
 
         self.logger.info("Translation Results: %d", len(results))
-        self.running_lock.release()
         return results, scores, self.opt.n_best, timer.times
 
+    def schedule(self):
+        """Scheduler loop: take the oldest request and coalesce it with the
+           following ones until `batch_tokens` source tokens are gathered or
+           the oldest request has waited `batch_latency` seconds, then
+           translate them all in a single `translator.translate` call.
+           A None request, queued by `stop_scheduler`, ends the loop.
+        """
+        carry = None
+        stop = False
+        while not stop:
+            job = carry if carry is not None else self.requests.get()
+            carry = None
+            if job is None:
+                return
+            jobs, ntokens = [job], job.ntokens
+            deadline = job.timer.stime + self.batch_latency
+            while ntokens < self.batch_tokens:
+                try:
+                    remaining = deadline - time.time()
+                    if remaining > 0:
+                        nxt = self.requests.get(timeout=remaining)
+                    else:
+                        nxt = self.requests.get_nowait()
+                except queue.Empty:
+                    break
+                if nxt is None:
+                    # translate what was gathered, then stop
+                    stop = True
+                    break
+                if ntokens + nxt.ntokens > self.batch_tokens:
+                    # left for the next batch, where it is the oldest request
+                    carry = nxt
+                    break
+                jobs.append(nxt)
+                ntokens += nxt.ntokens
+            self.translate_jobs(jobs)
+
+    def translate_jobs(self, jobs):
+        """Translate the texts of all `jobs` at once and scatter the results
+           back to each job
+        """
+        for job in jobs:
+            job.timer.tick(name="queue")
+        texts_to_translate = [text for job in jobs for text in job.texts]
+        timer = Timer()
+        timer.start()
+        try:
+            # the model may have been unloaded or sent to CPU on timeout
+            # while the requests were queued
+            with self.running_lock:
+                if not self.loaded:
+                    self.load()
+                elif self.opt.cuda:
+                    self.to_gpu()
+            scores, predictions = self.translator.translate(
+                src_data_iter=texts_to_translate,
+                batch_size=self.opt.batch_size)
+        except (RuntimeError, Exception) as e:
+            err = "Error: %s" % str(e)
+            self.logger.error(err)
+            self.logger.error("repr(text_to_translate): "
+                              + repr(texts_to_translate))
+            self.logger.error("model: #%s" % self.model_id)
+            self.logger.error("model opt: " + str(self.opt.__dict__))
+            self.logger.error(traceback.format_exc())
+            for job in jobs:
+                job.error = ServerModelError(err)
+        else:
+            timer.tick(name="translation")
+            self.logger.info("""Using model #%d\t%d requests\t%d inputs
+               \ttranslation time: %f""" % (self.model_id, len(jobs),
+                                            len(texts_to_translate),
+                                            timer.times['translation']))
+            start = 0
+            for job in jobs:
+                end = start + len(job.texts)
+                job.scores = scores[start:end]
+                job.predictions = predictions[start:end]
+                job.timer.tick(name="translation")
+                start = end
+        finally:
+            self.reset_unload_timer()
+            for job in jobs:
+                job.done.set()
+
     def do_timeout(self):
         """Timeout function that free GPU memory by moving the model to CPU
            or unloading it; depending on `self.on_timemout` value
@@ -415,8 +527,19 @@ class ServerModel:
                              % self.model_id)
             self.to_cpu()
 
+    def stop_scheduler(self):
+        """Stop the scheduler thread once the requests queued before are
+           translated; the next request starts a new one
+        """
+        with self.scheduler_lock:
+            if self.scheduler is not None and self.scheduler.is_alive():
+                self.requests.put(None)
+                self.scheduler.join()
+            self.scheduler = None
+
     def unload(self):
         self.logger.info("Unloading model %d" % self.model_id)
+        self.stop_scheduler()
         del self.translator
         if self.opt.cuda:
             torch.cuda.empty_cache()
@@ -442,6 +565,8 @@ class ServerModel:
              "models": self.user_opt["models"],
              "loaded": self.loaded,
              "timeout": self.timeout,
+             "batch_tokens": self.batch_tokens,
+             "batch_latency": self.batch_latency,
              }
         if self.tokenizer_opt is not None:
             d["tokenizer"] = self.tokenizer_opt
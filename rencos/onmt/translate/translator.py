@@ -97,6 +97,9 @@ class Translator(object):
         self.fast = opt.fast
         self.refer = opt.refer
         self.guide = opt.guide
+        self.ann_lists = opt.ann_lists
+        self.ann_subspaces = opt.ann_subspaces
+        self.ann_nprobe = opt.ann_nprobe
         self.extra_decoders = [copy.deepcopy(self.model.decoder) for r in range(self.refer)] if self.refer else None
         self.prob_files = ["samples/%s/test/prs.%d"%(opt.lang, r) for r in range(self.refer)] if self.refer else []
 
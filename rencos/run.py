@@ -2,6 +2,8 @@ import os
 import sys
 import time
 
+import syntax
+
 
 def main(opt, mode=2):
     if opt == 'preprocess':
@@ -32,8 +34,7 @@ def main(opt, mode=2):
         os.system(command)
     elif opt == 'retrieval':
         print('Syntactic level...')
-        command1 = "python syntax.py %s" % lang
-        os.system(command1)
+        syntax.main('samples/%s' % lang)
         print('Semantic level...')
         batch_size = 32 if lang == 'python' else 16
         command2 = "python translate.py -model models/%s/baseline_spl_step_100000.pt \
@@ -8,6 +8,14 @@ from sklearn.metrics.pairwise import cosine_similarity
 import multiprocessing
 
 
+def intern_tokens(first_sentence, second_sentence):
+    # map tokens to small ints so rows can be compared with numpy
+    vocab = {}
+    first_ids = np.array([vocab.setdefault(w, len(vocab)) for w in first_sentence], dtype=np.int64)
+    second_ids = np.array([vocab.setdefault(w, len(vocab)) for w in second_sentence], dtype=np.int64)
+    return first_ids, second_ids
+
+
 def sentence_distance(first_sentence, second_sentence, is_list):
     if not is_list:
         first_sentence = first_sentence.split(' ')
@@ -15,26 +23,52 @@ def sentence_distance(first_sentence, second_sentence, is_list):
     m = len(first_sentence)+1
     n = len(second_sentence)+1
     matrix = np.zeros((n, m), dtype=int)
+    matrix[0] = np.arange(m)  # m columns
+    first_ids, second_ids = intern_tokens(first_sentence, second_sentence)
+    offsets = np.arange(m)
+    # one row at a time: deletions and substitutions come from the row above,
+    # insertions along the row are a running minimum of (value - column)
+    for i in range(1, n):
+        row = np.empty(m, dtype=int)
+        row[0] = i  # n rows
+        penalty = (first_ids != second_ids[i-1])
+        row[1:] = np.minimum(matrix[i-1][1:]+1, matrix[i-1][:-1] + penalty)
+        matrix[i] = np.minimum.accumulate(row - offsets) + offsets
 
-    for i in range(n):
-        matrix[i][0] = i  # n rows
+    return matrix, matrix[n-1][m-1]
 
-    for i in range(m):
-        matrix[0][i] = i  # m columns
-    # print("-----------")
-    for i in range(1, n):
-        for j in range(1, m):
-            if first_sentence[j-1] == second_sentence[i-1]:
-                penalty = 0
-            else:
-                penalty = 1
 
-            # get min
-            matrix[i][j] = min(matrix[i-1][j]+1, matrix[i][j-1]+1, matrix[i-1][j-1] + penalty)
+def edit_distance(first_sentence, second_sentence):
+    """Token-level Levenshtein distance (same as `sentence_distance(...)[1]`).
 
-    # print(matrix[n-1][m-1]
-    # print(matrix
-    return matrix, matrix[n-1][m-1]
+    Myers/Hyyro bit-parallel algorithm: one column of the DP matrix is kept as
+    the bit vectors of its +1/-1 vertical deltas, so each token of the second
+    sentence costs a few big-int operations instead of a row of cell updates.
+    """
+    m = len(first_sentence)
+    if m == 0:
+        return len(second_sentence)
+    peq = {}
+    for i, w in enumerate(first_sentence):
+        peq[w] = peq.get(w, 0) | (1 << i)
+    mask = (1 << m) - 1
+    high = 1 << (m - 1)
+    pv, mv, distance = mask, 0, m
+    for w in second_sentence:
+        eq = peq.get(w, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | ~(xh | pv)
+        mh = pv & xh
+        if ph & high:
+            distance += 1
+        elif mh & high:
+            distance -= 1
+        ph = (ph << 1) | 1
+        mh = mh << 1
+        pv = (mh | ~(xv | ph)) & mask
+        mv = ph & xv & mask
+    return distance
 
 
 def align(first_sentence, second_sentence, matrix, print_flag, is_list):
@@ -117,12 +151,11 @@ def align(first_sentence, second_sentence, matrix, print_flag, is_list):
 def simi(first_sentence, second_sentence, is_list):
     if not is_list:
         max_score = max(len(first_sentence.split()), len(second_sentence.split()))
-        simi = 1.0 - (float(sentence_distance(first_sentence,
-                                              second_sentence, False)[1])/float(max_score))
+        first_sentence = first_sentence.split(' ')
+        second_sentence = second_sentence.split(' ')
     else:
         max_score = max(len(first_sentence), len(second_sentence))
-        simi = 1.0 - (float(sentence_distance(first_sentence,
-                                              second_sentence, True)[1])/float(max_score))
+    simi = 1.0 - (float(edit_distance(first_sentence, second_sentence))/float(max_score))
     return simi
 
 
@@ -137,10 +170,9 @@ def ranker(input_sentence, list_of_sentences, is_list):
     best_sentence = ""
     best_index = 0
 
-    input_sentences = [input_sentence]*len(list_of_sentences)
-    pairs = zip(input_sentences, list_of_sentences, list(range(len(list_of_sentences))))
-
-    results = pool.map(score, pairs)
+    # the candidates of one query are scored in this process, queries are spread
+    # over the pool by re_ranker
+    results = [score((input_sentence, sentence, i)) for i, sentence in enumerate(list_of_sentences)]
 
     for p in results:
 
@@ -193,12 +225,13 @@ def load_documents():
     return (tfidf, vectorizer), (corpus, sources, summaries)
 
 
-def re_ranker(queries):
-    import time
-    hypothesis = []
-    prs = []
-    refs = []
-    k = 10
+def rank_query(item):
+    query, documents = item
+    score, _, position = ranker(query, documents, False)
+    return score, position
+
+
+def top_k_documents(queries, k):
     cosine_similarities_list = cosine_similarity(vectorizer.transform(queries), tfidf)
     for i in range(len(cosine_similarities_list)):
         cosine_similarities = cosine_similarities_list[i]
@@ -206,8 +239,18 @@ def re_ranker(queries):
         indexes = np.argpartition(cosine_similarities, -k)[-k:]
 
         documents = [corpus[index].strip() for index in indexes]
+        yield indexes, (queries[i], documents)
+
 
-        score, sentence, position = ranker(queries[i], documents, False)
+def re_ranker(queries):
+    import time
+    hypothesis = []
+    prs = []
+    refs = []
+    k = 10
+    candidates = list(top_k_documents(queries, k))
+    results = pool.imap(rank_query, [item for _, item in candidates], chunksize=64)
+    for i, ((indexes, _), (score, position)) in enumerate(zip(candidates, results)):
 
         index = indexes[position]
         prs.append('%.2f\n' % score)
@@ -229,5 +272,5 @@ if __name__ == "__main__":
     queries = read_data('samples/python/test/test.ast.src')
     raws = read_data('samples/python/test/test.spl.src')
     (tfidf, vectorizer), (corpus, sources, summaries) = load_documents()
-    with multiprocessing.Pool(multiprocessing.cpu_count() - 1) as pool:
+    with multiprocessing.Pool(max(1, multiprocessing.cpu_count() - 1)) as pool:
         re_ranker(queries)
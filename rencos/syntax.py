@@ -1,88 +1,62 @@
 import sys
-import lucene
+import os
 import re
-from java.nio.file import Paths
-from java.lang import Integer
-from org.apache.lucene.analysis.standard import StandardAnalyzer
-from org.apache.lucene.analysis.core import WhitespaceAnalyzer
-from org.apache.lucene.document import Document, Field, StringField, TextField, StoredField
-from org.apache.lucene.index import IndexWriter, IndexWriterConfig,IndexOptions,DirectoryReader
-from org.apache.lucene.store import SimpleFSDirectory
-from org.apache.lucene.search import IndexSearcher, BooleanQuery
-from org.apache.lucene.queryparser.classic import QueryParser
 
-lucene.initVM()
+from bm25_index import BM25Index
+
+
+def clean(line):
+    return re.sub("[\W\s]+|AND|NOT|OR", ' ', line.strip())
 
 
 def build_index(file_dir):
-    indexDir = SimpleFSDirectory(Paths.get(file_dir+"/lucene_index/"))
-    config = IndexWriterConfig(WhitespaceAnalyzer())
-    config.setOpenMode(IndexWriterConfig.OpenMode.CREATE)
-    writer = IndexWriter(indexDir, config)
-
-    # t1 = FieldType()
-    # t1.setStored(True)
-    # t1.setTokenized(False)
-    # t1.setIndexOptions(IndexOptions.DOCS_AND_FREQS)
-    #
-    # t2 = FieldType()
-    # t2.setStored(True)
-    # t2.setTokenized(True)
-    # t2.setIndexOptions(IndexOptions.DOCS_AND_FREQS_AND_POSITIONS)
-
-    print("%d docs in index" % writer.numDocs())
-    if writer.numDocs():
-        print("Index already built.")
-        return
-    with open(file_dir+"/train/train.ast.src") as fc:
-
-        codes = [re.sub("[\W\s]+|AND|NOT|OR", ' ', line.strip()) for line in fc.readlines()]
-
-    for k, code in enumerate(codes):
-        doc = Document()
-        doc.add(StoredField("id", str(k)))
-        doc.add(TextField("code", code, Field.Store.YES))
-
-        writer.addDocument(doc)
-
-    print("Closing index of %d docs..." % writer.numDocs())
-    writer.close()
-
-
-def retriever(file_dir):
-    analyzer = WhitespaceAnalyzer()
-    reader = DirectoryReader.open(SimpleFSDirectory(Paths.get(file_dir+"/lucene_index/")))
-    searcher = IndexSearcher(reader)
-    queryParser = QueryParser("code", analyzer)
-    BooleanQuery.setMaxClauseCount(Integer.MAX_VALUE)
+    index_dir = file_dir + "/bm25_index"
+    train_file = file_dir + "/train/train.ast.src"
+    stat = os.stat(train_file)
+    source = '%s|%d|%d' % (os.path.abspath(train_file), stat.st_size, int(stat.st_mtime))
+    if BM25Index.exists(index_dir):
+        index = BM25Index.load(index_dir)
+        if index.meta['source'] == source:
+            print("%d docs in index" % len(index))
+            print("Index already built.")
+            return index
+    with open(train_file) as fc:
+
+        codes = [clean(line) for line in fc.readlines()]
+
+    index = BM25Index.build(index_dir, codes, source=source)
+    print("Built index of %d docs..." % len(index))
+    return index
+
+
+def retriever(file_dir, index=None, batch_size=256):
+    if index is None:
+        index = BM25Index.load(file_dir + "/bm25_index")
 
     with open(file_dir + "/train/train.spl.src", 'r') as fso,  open(file_dir + "/train/train.txt.tgt", 'r') as fsu:
         sources = [line.strip() for line in fso.readlines()]
         summaries = [line.strip() for line in fsu.readlines()]
     with open(file_dir+"/test/test.ast.src") as ft, open(file_dir+"/test/test.ref.src.0", 'w') as fwo, \
             open(file_dir+"/output/ast.out", 'w') as fws:
-        queries = [re.sub("[\W\s]+|AND|NOT|OR", ' ', line.strip()) for line in ft.readlines()]
-
-        for i, line in enumerate(queries):
-            print("query %d" % i)
-            query = queryParser.parse(QueryParser.escape(line))
-            hits = searcher.search(query, 1).scoreDocs
-            flag = False
-
-            for hit in hits:
-                doc = searcher.doc(hit.doc)
-                _id = eval(doc.get("id"))
-                flag = True
-                fwo.write(sources[_id]+'\n')
-                fws.write(summaries[_id] + '\n')
-            if not flag:
-                print(query)
-                print(hits)
+        queries = [clean(line) for line in ft.readlines()]
+
+        for i, (hits, _) in enumerate(index.search(queries, k=1, batch_size=batch_size)):
+            if len(hits) == 0:
+                print("query %d has no hit" % i)
+                print(queries[i])
                 exit(-1)
+            _id = int(hits[0])
+            fwo.write(sources[_id]+'\n')
+            fws.write(summaries[_id] + '\n')
+        print("%d queries" % len(queries))
+
+
+def main(root):
+    index = build_index(root)
+    retriever(root, index)
 
 
 if __name__ == '__main__':
     root = 'samples/%s'%sys.argv[1]
 
-    build_index(root)
-    retriever(root)
+    main(root)
@@ -1,16 +1,16 @@
 from __future__ import division, unicode_literals
 import argparse
-import os
 
 from onmt.utils.logging import init_logger
 from code_translator import build_translator
 
 import onmt.opts
+from vector_index import VectorIndex
 
 
 def main(opt):
     translator = build_translator(opt, report_score=True)
-    if not os.path.exists('samples/{}/indexes/codev1.pt'.format(lang)):
+    if not VectorIndex.exists('samples/{}/indexes/code_vectors'.format(lang)):
         print('Index documents...')
         translator.index_documents(src_path=opt.src,batch_size=opt.batch_size)
         exit(0)
@@ -0,0 +1,305 @@
+"""
+Sharded, memory-mapped index of the code vectors used for the semantic-level
+retrieval.
+
+`CodeTranslator.index_documents` streams the max-pooled encoder states of the
+training code into a directory of flat shards, and `CodeTranslator.search`
+memory-maps them instead of loading every shard into one tensor:
+
+    manifest.json   vector size, dtype, file and number of vectors of every shard
+    shard{i}.npy    (n_i, D) float16 L2-normalized vectors
+    ivfpq.npz       optional IVF-PQ quantizer for approximate search
+
+Since the vectors are normalized when written, cosine similarity is a plain
+inner product. The exact search scores one block of a shard at a time and keeps
+a running top-k; the blocks are kept on the device between searches up to
+`device_cache_bytes`, past which they are re-read. The approximate search
+buckets the vectors by k-means (the inverted file) and product-quantizes their
+residuals to one byte per sub-vector; a query only scores the codes of its
+`nprobe` closest buckets and re-ranks the best candidates exactly.
+"""
+
+import json
+import os
+import shutil
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def _blocks(n, block_size):
+    for start in range(0, n, block_size):
+        yield start, min(start + block_size, n)
+
+
+def _top_k(scores, k):
+    """Indices of the k best entries of the 1-d `scores`, best first."""
+    return np.argsort(-scores, kind='stable')[:k]
+
+
+def kmeans(x, n_clusters, n_iter=20, seed=0, block_size=8192):
+    """Lloyd's k-means on the rows of `x`; returns (n_clusters, D) centroids."""
+    rng = np.random.RandomState(seed)
+    x = np.asarray(x, dtype=np.float32)
+    if len(x) < n_clusters:
+        raise ValueError("Need at least {} vectors to train {} clusters, got {}".format(
+            n_clusters, n_clusters, len(x)))
+    centroids = x[rng.choice(len(x), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        assign = assign_clusters(x, centroids, block_size)
+        counts = np.bincount(assign, minlength=n_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # re-seed empty clusters with random points
+        centroids[empty] = x[rng.choice(len(x), int(empty.sum()), replace=False)]
+    return centroids
+
+
+def assign_clusters(x, centroids, block_size=8192):
+    """Index of the nearest (L2) centroid of every row of `x`."""
+    c_norms = (centroids ** 2).sum(-1)
+    assign = np.empty(len(x), dtype=np.int64)
+    for start, end in _blocks(len(x), block_size):
+        block = np.asarray(x[start:end], dtype=np.float32)
+        assign[start:end] = np.argmin(c_norms[None, :] - 2 * np.matmul(block, centroids.T), -1)
+    return assign
+
+
+class IVFPQ(object):
+    """Inverted file over k-means buckets with product-quantized residuals."""
+
+    def __init__(self, coarse, codebooks, codes, order, offsets):
+        # (n_lists, D) bucket centroids
+        self.coarse = coarse
+        # (n_subspaces, n_centroids, D / n_subspaces) residual codebooks
+        self.codebooks = codebooks
+        # (N, n_subspaces) uint8 residual codes, stored in bucket order
+        self.codes = codes
+        # vector ids in bucket order, bucket i is order[offsets[i]:offsets[i + 1]]
+        self.order = order
+        self.offsets = offsets
+
+    @classmethod
+    def train(cls, index, n_lists, n_subspaces, n_centroids=256, n_iter=20, sample=65536, seed=0):
+        n, dim = len(index), index.dim
+        if dim % n_subspaces:
+            raise ValueError("Vector size {} is not divisible into {} sub-vectors".format(dim, n_subspaces))
+        if n_centroids > 256:
+            raise ValueError("Product quantization codes are one byte, n_centroids must be <= 256")
+        rng = np.random.RandomState(seed)
+        train = index.take(np.sort(rng.choice(n, min(n, sample), replace=False)))
+
+        coarse = kmeans(train, n_lists, n_iter, seed)
+        residuals = train - coarse[assign_clusters(train, coarse)]
+        sub_dim = dim // n_subspaces
+        codebooks = np.stack([kmeans(residuals[:, m * sub_dim:(m + 1) * sub_dim], n_centroids, n_iter, seed)
+                              for m in range(n_subspaces)])
+
+        assign = np.empty(n, dtype=np.int64)
+        codes = np.empty((n, n_subspaces), dtype=np.uint8)
+        for start, end, block in index.blocks():
+            assign[start:end] = assign_clusters(block, coarse)
+            residual = block - coarse[assign[start:end]]
+            for m in range(n_subspaces):
+                codes[start:end, m] = assign_clusters(residual[:, m * sub_dim:(m + 1) * sub_dim], codebooks[m])
+        order = np.argsort(assign, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=n_lists))])
+        return cls(coarse, codebooks, codes[order], order, offsets)
+
+    def save(self, path):
+        np.savez(path, coarse=self.coarse, codebooks=self.codebooks, codes=self.codes,
+                 order=self.order, offsets=self.offsets)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        data = np.load(path)
+        return cls(data['coarse'], data['codebooks'], data['codes'], data['order'], data['offsets'])
+
+    def candidates(self, query, k, nprobe):
+        """Approximate inner-product search of one query: ids of up to k vectors."""
+        n_subspaces, _, sub_dim = self.codebooks.shape
+        coarse_scores = np.matmul(self.coarse, query)
+        lists = np.argsort(-coarse_scores, kind='stable')[:nprobe]
+        # inner product of every query sub-vector with every codeword
+        table = np.einsum('mkd,md->mk', self.codebooks, query.reshape(n_subspaces, sub_dim))
+        scores, ids = [], []
+        for l in lists:
+            start, end = self.offsets[l], self.offsets[l + 1]
+            if start == end:
+                continue
+            codes = self.codes[start:end]
+            scores.append(coarse_scores[l] + table[np.arange(n_subspaces), codes].sum(-1))
+            ids.append(self.order[start:end])
+        if not scores:
+            return np.zeros(0, dtype=np.int64)
+        scores, ids = np.concatenate(scores), np.concatenate(ids)
+        return ids[_top_k(scores, k)]
+
+
+class VectorIndexWriter(object):
+    """Normalizes and appends vectors, writing a shard every `shard_size` rows.
+
+    The index only appears under `path` once `close` has written the manifest.
+    """
+
+    def __init__(self, path, shard_size=40000, dtype='float16'):
+        self.path = path
+        self.shard_size = shard_size
+        self.dtype = np.dtype(dtype)
+        self.tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        if os.path.exists(self.tmp_path):
+            shutil.rmtree(self.tmp_path)
+        os.makedirs(self.tmp_path)
+        self.buffer = []
+        self.buffered = 0
+        self.shards = []
+        self.dim = None
+
+    def add(self, vectors):
+        """Append a (B, D) tensor of vectors."""
+        vectors = F.normalize(vectors.detach().float(), p=2, dim=1)
+        self.dim = vectors.size(1)
+        self.buffer.append(vectors.cpu().numpy().astype(self.dtype))
+        self.buffered += len(self.buffer[-1])
+        if self.buffered >= self.shard_size:
+            self.flush()
+
+    def flush(self, final=False):
+        """Write the buffered vectors as full shards; the remainder stays buffered unless `final`."""
+        if not self.buffered:
+            return
+        vectors = np.concatenate(self.buffer)
+        end = len(vectors) if final else len(vectors) - len(vectors) % self.shard_size
+        for start, stop in _blocks(end, self.shard_size):
+            name = 'shard{}.npy'.format(len(self.shards) + 1)
+            print('saving %s' % name)
+            np.save(os.path.join(self.tmp_path, name), vectors[start:stop])
+            self.shards.append({'file': name, 'size': stop - start})
+        self.buffer = [vectors[end:].copy()] if end < len(vectors) else []
+        self.buffered = len(vectors) - end
+
+    def close(self):
+        self.flush(final=True)
+        with open(os.path.join(self.tmp_path, 'manifest.json'), 'w') as f:
+            json.dump({'dim': self.dim, 'dtype': str(self.dtype), 'normalized': True,
+                       'shards': self.shards}, f)
+        # swap the whole directory in so readers never see a partial index
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.replace(self.tmp_path, self.path)
+        return VectorIndex.load(self.path)
+
+
+class VectorIndex(object):
+
+    def __init__(self, shards, dim, path=None, quantizer=None, device_cache_bytes=2 << 30):
+        self.shards = shards
+        self.dim = dim
+        self.path = path
+        self.quantizer = quantizer
+        # global id of the first vector of every shard, plus the total
+        self.starts = np.concatenate([[0], np.cumsum([len(s) for s in shards])]).astype(np.int64)
+        # float32 blocks kept on the search device between calls to `search`,
+        # per (device, block size), up to device_cache_bytes in total
+        self.device_cache_bytes = device_cache_bytes
+        self.device_cache = {}
+        self.device_cached_bytes = 0
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, 'manifest.json'))
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        with open(os.path.join(path, 'manifest.json')) as f:
+            manifest = json.load(f)
+        shards = [np.load(os.path.join(path, shard['file']), mmap_mode='r')
+                  for shard in manifest['shards']]
+        quantizer_file = os.path.join(path, 'ivfpq.npz')
+        quantizer = IVFPQ.load(quantizer_file) if os.path.exists(quantizer_file) else None
+        return cls(shards, manifest['dim'], path, quantizer, **kwargs)
+
+    def blocks(self, block_size=65536):
+        """Yield (start, end, float32 vectors) over the whole index."""
+        for shard, offset in zip(self.shards, self.starts):
+            for start, end in _blocks(len(shard), block_size):
+                yield offset + start, offset + end, np.asarray(shard[start:end], dtype=np.float32)
+
+    def device_blocks(self, device, block_size=65536):
+        """Yield (start, float32 tensor on `device`) over the whole index.
+
+        The leading blocks that fit in `device_cache_bytes` stay on the device,
+        so repeated searches only re-read the shards for the blocks past it.
+        """
+        cached = self.device_cache.setdefault((str(device), block_size), [])
+        i = 0
+        for shard, offset in zip(self.shards, self.starts):
+            for start, end in _blocks(len(shard), block_size):
+                if i < len(cached):
+                    block = cached[i]
+                else:
+                    block = torch.from_numpy(np.asarray(shard[start:end], dtype=np.float32)).to(device)
+                    nbytes = block.numel() * block.element_size()
+                    if i == len(cached) and self.device_cached_bytes + nbytes <= self.device_cache_bytes:
+                        cached.append(block)
+                        self.device_cached_bytes += nbytes
+                yield offset + start, block
+                i += 1
+
+    def take(self, ids):
+        """float32 vectors of the sorted global `ids`."""
+        which = np.searchsorted(self.starts, ids, side='right') - 1
+        vectors = np.empty((len(ids), self.dim), dtype=np.float32)
+        for s in np.unique(which):
+            mask = which == s
+            vectors[mask] = self.shards[s][ids[mask] - self.starts[s]]
+        return vectors
+
+    def train_quantizer(self, n_lists, n_subspaces, **kwargs):
+        """Train (and save with the index) the IVF-PQ quantizer for approximate search."""
+        self.quantizer = IVFPQ.train(self, n_lists, n_subspaces, **kwargs)
+        if self.path is not None:
+            self.quantizer.save(os.path.join(self.path, 'ivfpq.npz'))
+        return self.quantizer
+
+    def search(self, queries, k, nprobe=0, refine=4, block_size=65536):
+        """Top-k cosine similarities of every row of the (B, D) `queries`.
+
+        Returns (scores, ids), two (B, k) tensors on the device of `queries`,
+        best first. With `nprobe` > 0 and a trained quantizer the search is
+        approximate; a query with fewer than k candidates is padded with -inf
+        scores and -1 ids.
+        """
+        queries = F.normalize(queries.float(), p=2, dim=1)
+        if nprobe > 0 and self.quantizer is not None:
+            return self._approximate_search(queries, k, nprobe, refine)
+        k = min(k, len(self))
+        best_scores, best_ids = None, None
+        for start, block in self.device_blocks(queries.device, block_size):
+            scores = torch.mm(queries, block.t())  # B*block
+            ids = torch.arange(start, start + block.size(0), dtype=torch.long,
+                               device=queries.device).unsqueeze(0).expand_as(scores)
+            if best_scores is not None:
+                scores = torch.cat([best_scores, scores], 1)
+                ids = torch.cat([best_ids, ids], 1)
+            best_scores, top = torch.topk(scores, min(k, scores.size(1)), dim=1)
+            best_ids = ids.gather(1, top)
+        return best_scores, best_ids
+
+    def _approximate_search(self, queries, k, nprobe, refine):
+        all_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        all_ids = np.full((len(queries), k), -1, dtype=np.int64)
+        for i, query in enumerate(queries.cpu().numpy()):
+            ids = np.sort(self.quantizer.candidates(query, max(k, refine * k), nprobe))
+            scores = np.matmul(self.take(ids), query)
+            best = _top_k(scores, k)
+            all_scores[i, :len(best)] = scores[best]
+            all_ids[i, :len(best)] = ids[best]
+        return (torch.from_numpy(all_scores).to(queries.device),
+                torch.from_numpy(all_ids).to(queries.device))